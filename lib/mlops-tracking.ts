@@ -40,6 +40,10 @@ export interface MetricsData {
   user_message_length: number;
   ai_response_length: number;
   response_type: string;
+
+  // Idempotency: lets the MLOps service ignore a retried /track call
+  event_id?: string;
+  timestamp?: string;
 }
 
 export interface TokenMetrics {
@@ -56,6 +60,13 @@ export interface TokenMetrics {
  * @returns Promise that resolves when metrics are processed (or fails silently)
  */
 export async function trackMetrics(metricsData: MetricsData): Promise<void> {
+  // Generated once, so a retry of this call is recognised as a duplicate
+  metricsData = {
+    ...metricsData,
+    event_id: metricsData.event_id ?? crypto.randomUUID(),
+    timestamp: metricsData.timestamp ?? new Date().toISOString()
+  };
+
   try {
     // Import database function dynamically to avoid circular dependencies
     const { createAIMetrics } = await import('@/lib/database');
@@ -0,0 +1,166 @@
+"""
+Admission control for the ingestion endpoints
+Lab 2: AI Lifecycle & MLOps Integration
+
+Nothing stops one business from flooding /track, and every other tenant
+then waits behind its events. AdmissionController adds two checks:
+
+- Per-tenant token buckets. Each business_id refills at `rate` events per
+  second, up to `burst`. Limits can be overridden per tenant. An event
+  that finds its bucket empty is shed with 429 and a Retry-After telling
+  the client when a token will be available.
+- A global cap on concurrent ingestion requests. It keeps a burst from
+  piling up threads and queueing well-behaved tenants behind it.
+
+Buckets are kept in an OrderedDict in least-recently-used order. A bucket
+that has been idle long enough to refill completely holds no state worth
+keeping. Such buckets are dropped from the front as new ones are touched,
+so memory follows the number of active tenants. max_tenants is a hard
+cap on top of that.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from prometheus_client import REGISTRY, Counter, Gauge
+
+
+def parse_tenant_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    """
+    Parse per-tenant overrides from "business_id=rate:burst,..."
+
+    Args:
+        spec: e.g. "big-clinic=200:400,trial-account=1:5"
+
+    Returns:
+        {business_id: (rate, burst)}
+
+    Raises:
+        ValueError: If an entry is malformed
+    """
+    limits = {}
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        business_id, _, values = entry.rpartition('=')
+        rate, _, burst = values.partition(':')
+        if not business_id or not rate:
+            raise ValueError(f'Invalid tenant limit: {entry!r}')
+        limits[business_id.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+
+class AdmissionController:
+    """
+    Per-tenant token buckets plus a global concurrency cap
+
+    Args:
+        rate: Default events per second per business_id (0 disables rate limiting)
+        burst: Default bucket size (events admitted at once after idling)
+        tenant_limits: {business_id: (rate, burst)} overrides
+        max_concurrency: Ingestion requests handled at once (0 disables the cap)
+        max_tenants: Buckets kept before the least recently used is dropped
+        registry: Prometheus registry for the controller's own metrics
+    """
+
+    def __init__(self,
+                 rate: float = 50.0,
+                 burst: float = 100.0,
+                 tenant_limits: Optional[Dict[str, Tuple[float, float]]] = None,
+                 max_concurrency: int = 0,
+                 max_tenants: int = 10000,
+                 registry=REGISTRY):
+        self.rate = rate
+        self.burst = burst
+        self.tenant_limits = dict(tenant_limits or {})
+        self.max_concurrency = max_concurrency
+        self.max_tenants = max_tenants
+
+        # business_id -> [tokens, last refill (monotonic), idle time to full]
+        self._buckets: 'OrderedDict[str, list]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._concurrency_lock = threading.Lock()
+
+        self.shed = Counter(
+            'ingest_shed_total',
+            'Ingestion requests or events refused by admission control',
+            ['reason'],
+            registry=registry
+        )
+        self.tenants = Gauge(
+            'ingest_rate_limit_tenants',
+            'Tenants with a live token bucket',
+            registry=registry,
+            multiprocess_mode='livesum'
+        )
+
+    def limits_for(self, business_id: str) -> Tuple[float, float]:
+        return self.tenant_limits.get(business_id, (self.rate, self.burst))
+
+    def acquire(self, business_id: str, cost: float = 1.0) -> Optional[float]:
+        """
+        Take `cost` tokens from the tenant's bucket
+
+        Returns:
+            None if admitted, otherwise seconds until enough tokens are available
+        """
+        rate, burst = self.limits_for(business_id)
+        if rate <= 0:
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(business_id)
+            if bucket is None:
+                bucket = [burst, now, burst / rate]
+                self._buckets[business_id] = bucket
+                self._evict(now)
+            else:
+                self._buckets.move_to_end(business_id)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return None
+            retry_after = (cost - bucket[0]) / rate
+            tenants = len(self._buckets)
+
+        self.tenants.set(tenants)
+        self.shed.labels(reason='tenant_rate').inc()
+        return retry_after
+
+    def _evict(self, now: float):
+        # Least recently used first: stop at the first bucket that may
+        # still be below capacity, unless the hard cap forces a drop
+        while self._buckets:
+            business_id, (_, last, refill) = next(iter(self._buckets.items()))
+            if now - last < refill and len(self._buckets) <= self.max_tenants:
+                break
+            del self._buckets[business_id]
+        self.tenants.set(len(self._buckets))
+
+    def try_enter(self) -> bool:
+        """Claim a concurrency slot; False (and counted) when the cap is reached"""
+        if self.max_concurrency <= 0:
+            return True
+        with self._concurrency_lock:
+            if self._in_flight >= self.max_concurrency:
+                admitted = False
+            else:
+                self._in_flight += 1
+                admitted = True
+        if not admitted:
+            self.shed.labels(reason='concurrency').inc()
+        return admitted
+
+    def leave(self):
+        """Release a slot claimed by try_enter"""
+        if self.max_concurrency <= 0:
+            return
+        with self._concurrency_lock:
+            self._in_flight -= 1
@@ -13,168 +13,125 @@ Key Learning Objectives:
 - Implementing metrics collection and tracking with Prometheus
 - Building microservices architecture
 - Real-time monitoring and alerting
+
+create_app() builds an app with its own MLOpsService (see service.py).
+Importing this module has no side effects: the process-wide app served by
+gunicorn (app:app) and `python app.py` is created on first access, and its
+startup work (database rebuild, rollup seeding) runs in the background
+while /health already answers. /ready reports when that work is done.
 """
 
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, current_app, redirect, request, jsonify
 from flask_cors import CORS
 import os
-import json
-import time
 from datetime import datetime
 import logging
-import requests
-import urllib.parse
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from dotenv import load_dotenv
+import atexit
+import functools
+import hmac
+import math
 import sys
+import threading
 
-sys.stdout.reconfigure(encoding='utf-8')
+from prometheus_client import REGISTRY, start_http_server
 
-# Prometheus imports
-from prometheus_client import Counter, Histogram, Gauge, Info, start_http_server, generate_latest, CONTENT_TYPE_LATEST
+from database import get_database
+from dedup import idempotency_key
+from schema import EventValidationError, loads, parse_event
+from service import ANALYTICS_PERIODS, MLOpsService
+from structured_logging import configure_logging
 
-# Configure logging for better debugging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# Per-event lines, rate limited by the logging pipeline
+event_logger = logging.getLogger('app.events')
 
-# Initialize Flask app
-app = Flask(__name__)
-CORS(app)  # Enable CORS for Next.js integration
-
-load_dotenv()
-
-# Database connection configuration
-DATABASE_URL = os.getenv('DATABASE_URL')
-if not DATABASE_URL:
-    logger.error("DATABASE_URL environment variable not set")
-
-# Prometheus Metrics Definition
-# These metrics track different aspects of our AI system performance
-
-# Conversation Metrics
-ai_response_time = Histogram(
-    'ai_response_time_seconds',
-    'Time taken for AI to respond to user messages',
-    buckets=[0.1, 0.5, 1.0, 2.0, 5.0, 10.0]
-)
-
-ai_requests_total = Counter(
-    'ai_requests_total',
-    'Total number of AI requests',
-    ['business_id', 'response_type', 'intent']
-)
-
-ai_success_rate = Gauge(
-    'ai_success_rate',
-    'Success rate of AI responses',
-    ['business_id']
-)
-
-# AI Performance Metrics
-ai_tokens_used = Counter(
-    'ai_tokens_used_total',
-    'Total tokens consumed by AI',
-    ['business_id', 'model_name']
-)
-
-ai_api_cost = Counter(
-    'ai_api_cost_usd_total',
-    'Total API costs in USD',
-    ['business_id', 'model_name']
-)
-
-# Business Metrics
-appointments_requested = Counter(
-    'appointments_requested_total',
-    'Total appointment requests',
-    ['business_id']
-)
-
-appointments_booked = Counter(
-    'appointments_booked_total',
-    'Total appointments successfully booked',
-    ['business_id']
-)
-
-human_handoffs = Counter(
-    'human_handoffs_total',
-    'Total requests requiring human assistance',
-    ['business_id', 'reason']
-)
-
-# System Info
-system_info = Info(
-    'ai_system_info',
-    'Information about the AI system'
-)
-
-# Set system information
-system_info.info({
-    'service': 'ai-appointment-setter',
-    'version': '1.0.0',
-    'monitoring': 'prometheus'
-})
-
-def execute_sql(query: str, params: tuple = None) -> Optional[Dict]:
-    """
-    Execute SQL query using HTTP API (simplified for cross-platform compatibility)
-    
-    Args:Metrics table created successful
-        query: SQL query string
-        params: Query parameters
-        
-    Returns:
-        Query result or None if failed
-    """
-    try:
-        # For now, we'll use a simple in-memory storage
-        # In production, you'd use a proper database API
-        logger.info(f"SQL Query: {query}")
-        if params:
-            logger.info(f"Parameters: {params}")
-        return {"success": True}
-    except Exception as e:
-        logger.error(f"Database query error: {e}")
-        return None
+routes = Blueprint('mlops', __name__)
 
-def create_metrics_table():
+_logging_pipeline = None
+_logging_lock = threading.Lock()
+
+_default_app: Optional[Flask] = None
+_default_app_lock = threading.Lock()
+
+
+def setup_logging():
     """
-    Initialize metrics storage (simplified for cross-platform compatibility)
-    In production, this would create the actual database table
+    Route logging through the background listener, once per process
+    (see structured_logging.py)
     """
-    try:
-        logger.info("Metrics storage initialized successfully")
-        return True
-    except Exception as e:
-        logger.error(f"Error initializing metrics storage: {e}")
-        return False
-
-def rebuild_prometheus_metrics_from_db():
+    global _logging_pipeline
+    with _logging_lock:
+        if _logging_pipeline is not None:
+            return
+        _logging_pipeline = configure_logging(
+            level=os.getenv('LOG_LEVEL', 'INFO'),
+            json_format=os.getenv('LOG_FORMAT', 'json') == 'json',
+            rate_limits={'app.events': float(os.getenv('LOG_EVENT_RATE', '10'))}
+        )
+        atexit.register(_logging_pipeline.stop)
+
+
+def create_app(config: Optional[Dict[str, Any]] = None) -> Flask:
     """
-    Rebuild Prometheus metrics from database on startup
-    This ensures continuity across service restarts
+    Build the Flask app and the MLOpsService behind it
+
+    Args:
+        config: Flask config values. Service settings given here (e.g.
+            MAX_BATCH_SIZE) take precedence over environment variables.
+            METRICS_REGISTRY selects the Prometheus registry (default: the
+            global REGISTRY); STARTUP_IN_BACKGROUND=False runs the startup
+            work before returning instead of in a background thread.
+
+    Returns:
+        The app; its service is app.extensions['mlops']
     """
-    try:
-        logger.info("Rebuilding Prometheus metrics from database...")
-        
-        # Fetch and rebuild metrics
-        success = 1 #fetch_metrics_from_db()
-        
-        if success:
-            logger.info("Successfully rebuilt Prometheus metrics from database")
-        else:
-            logger.warning("Could not rebuild metrics from database, starting fresh")
-            
-    except Exception as e:
-        logger.error(f"Error rebuilding Prometheus metrics: {e}")
+    load_dotenv()
+    setup_logging()
 
-# Initialize metrics on startup
-create_metrics_table()
+    app = Flask(__name__)
+    app.config.update(config or {})
+    CORS(app)  # Enable CORS for Next.js integration
 
-# Rebuild Prometheus metrics from database on startup
-rebuild_prometheus_metrics_from_db()
+    service = MLOpsService(app.config, registry=app.config.get('METRICS_REGISTRY', REGISTRY))
+    _logging_pipeline.count_drops(service.log_records_dropped)
+    service.instrumentation.init_app(app)
+    app.extensions['mlops'] = service
+    app.register_blueprint(routes)
 
-@app.route('/')
+    service.start(background=app.config.get('STARTUP_IN_BACKGROUND', True))
+    return app
+
+
+def get_app() -> Flask:
+    """The process-wide app, created on first use"""
+    global _default_app
+    if _default_app is None:
+        with _default_app_lock:
+            if _default_app is None:
+                _default_app = create_app()
+    return _default_app
+
+
+def get_service(app: Optional[Flask] = None) -> MLOpsService:
+    """The service of `app`, or of the process-wide app"""
+    return (app or get_app()).extensions['mlops']
+
+
+def current_service() -> MLOpsService:
+    """The service of the app handling the current request"""
+    return current_app.extensions['mlops']
+
+
+def __getattr__(name: str):
+    # `from app import app` and gunicorn's app:app create the app on first access
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@routes.route('/')
 def dashboard():
     """
     Serve the MLOps dashboard
@@ -187,42 +144,172 @@ def dashboard():
             'message': 'MLOps Service is running!',
             'endpoints': {
                 'health': '/health',
+                'ready': '/ready',
                 'metrics': '/metrics',
                 'track': '/track',
-                'analytics': '/analytics/<business_id>'
+                'track_batch': '/track/batch',
+                'stream': '/stream',
+                'analytics': '/analytics/<business_id>',
+                'conversations': '/conversations/<conversation_id>'
             }
         })
 
-@app.route('/health', methods=['GET'])
+@routes.route('/health', methods=['GET'])
 def health_check():
     """
     Health check endpoint to verify service is running
-    
+
+    Answers as soon as the process serves requests, before the startup
+    work has finished (see /ready).
+
     Returns:
         JSON response with service status
     """
     return jsonify({
         'status': 'healthy',
         'service': 'mlops-service-prometheus',
+        'ready': current_service().ready.is_set(),
         'timestamp': datetime.utcnow().isoformat(),
         'monitoring': 'prometheus',
         'metrics_endpoint': '/metrics',
         'prometheus_port': os.getenv('PROMETHEUS_PORT', '8001')
     })
 
-@app.route('/metrics')
+@routes.route('/ready', methods=['GET'])
+def readiness_check():
+    """
+    Readiness check: 503 until the startup work (counter rebuild from the
+    database, rollup seeding) has finished, 200 after
+
+    Returns:
+        JSON response with readiness status
+    """
+    ready = current_service().ready.is_set()
+    return jsonify({
+        'status': 'ready' if ready else 'starting',
+        'timestamp': datetime.utcnow().isoformat()
+    }), 200 if ready else 503
+
+@routes.route('/stream')
+def stream():
+    """
+    Server-Sent Events stream of live metrics for the dashboard
+
+    Sends a 'snapshot' event on connect, then at most one 'delta' event per
+    STREAM_INTERVAL_SECONDS with the events, counter increments, totals and
+    rolling latency since the previous one. Clients that fall too far
+    behind are disconnected (EventSource reconnects on its own).
+
+    Under gunicorn with STREAM_PORT set, clients are redirected to the
+    dedicated stream listener so they don't hold request threads; without
+    it, streams on the request pool are capped below its thread count.
+    With several workers, each stream only covers its own worker's events.
+    """
+    service = current_service()
+    stream_url = service.stream_url(request.host)
+    if stream_url is not None:
+        return redirect(stream_url, code=307)
+
+    slots = service.pool_stream_slots
+    if slots is not None and not slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many stream subscribers'}), 503
+    live_stream = service.live_stream
+    subscription = live_stream.subscribe()
+    if subscription is None:
+        if slots is not None:
+            slots.release()
+        return jsonify({'error': 'Too many stream subscribers'}), 503
+
+    def close():
+        live_stream.unsubscribe(subscription)
+        if slots is not None:
+            slots.release()
+
+    response = Response(subscription.messages(), mimetype='text/event-stream',
+                        headers={
+                            'Cache-Control': 'no-cache',
+                            # Stop reverse proxies from buffering the stream
+                            'X-Accel-Buffering': 'no'
+                        })
+    # Runs even if the client disconnects before the first message is sent
+    response.call_on_close(close)
+    return response
+
+@routes.route('/metrics')
 def metrics():
     """
     Prometheus metrics endpoint
     This is where Prometheus scrapes metrics from our service
+
+    The exposition is rendered once and shared by concurrent scrapers
+    until it goes stale. Honours Accept: application/openmetrics-text
+    and Accept-Encoding: gzip.
+    """
+    body, headers = current_service().exposition_cache.response(
+        request.headers.get('Accept', ''),
+        request.headers.get('Accept-Encoding', '')
+    )
+    return body, 200, headers
+
+def rate_limited_response(message: str, retry_after: float):
+    """
+    Build a 429 response telling the client when to retry
+
+    Args:
+        message: Error message for the client
+        retry_after: Seconds until the request would be admitted
+    """
+    seconds = max(1, math.ceil(retry_after))
+    response = jsonify({'error': message, 'retry_after': seconds})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+def duplicate_response(event: Any):
+    """Acknowledge an event whose idempotency key was already tracked"""
+    event_logger.info("Ignored duplicate event for business %s", event.business_id)
+    return jsonify({
+        'status': 'duplicate',
+        'message': 'Event already tracked',
+        'prometheus_updated': False,
+        'timestamp': datetime.utcnow().isoformat()
+    })
+
+def concurrency_limited(view):
+    """Shed ingestion requests beyond ADMISSION_MAX_CONCURRENCY with 429"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        admission = current_service().admission
+        if not admission.try_enter():
+            return rate_limited_response('Too many concurrent ingestion requests', 1)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            admission.leave()
+    return wrapper
+
+def sketch_token_required(view):
     """
-    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+    Require `Authorization: Bearer <SKETCHES_TOKEN>` when SKETCHES_TOKEN is set
 
-@app.route('/track', methods=['POST'])
+    Replicas exchange per-business latency data over these endpoints.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = current_service().setting('SKETCHES_TOKEN')
+        if token:
+            supplied = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(supplied.encode('utf-8'), f'Bearer {token}'.encode('utf-8')):
+                return jsonify({'error': 'Unauthorized'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+@routes.route('/track', methods=['POST'])
+@concurrency_limited
 def track_metrics():
     """
     Main endpoint for receiving metrics from Next.js application
-    
+
     Expected payload:
     {
         "business_id": "uuid",
@@ -235,286 +322,421 @@ def track_metrics():
         "appointment_requested": true,
         "user_message_length": 45,
         "ai_response_length": 120,
-        "response_type": "appointment_booking"
+        "response_type": "appointment_booking",
+        "event_id": "uuid"
     }
-    
+
+    Retries are recognised by the Idempotency-Key header, event_id, or
+    conversation_id + session_id + timestamp; a duplicate is acknowledged
+    with status "duplicate" and not applied again.
+
+    Businesses over their ADMISSION_RATE get 429 with Retry-After.
+
     Returns:
         JSON response confirming metrics were tracked
     """
     try:
-        metrics_data = request.get_json()
-
-        if not metrics_data:
-            return jsonify({'error': 'No metrics data provided'}), 400
-
-        # Validate required fields
-        required_fields = ['business_id', 'response_time_ms', 'tokens_used']
-        for field in required_fields:
-            if field not in metrics_data:
-                return jsonify({'error': f'Missing required field: {field}'}), 400
-
-        # Update Prometheus metrics first
-        prometheus_success = update_prometheus_metrics(metrics_data)
+        service = current_service()
+
+        # Decoding errors fall through to the 500 handler below
+        metrics_data = loads(request.get_data())
+
+        # Validate and coerce every field (see schema.py)
+        try:
+            event = parse_event(metrics_data)
+        except EventValidationError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # Duplicates are acknowledged before admission, so a retry of an
+        # event that was already tracked never gets a 429
+        key = idempotency_key(event, request.headers.get('Idempotency-Key'))
+        if service.dedup_index.seen(key):
+            return duplicate_response(event)
+
+        retry_after = service.admission.acquire(event.business_id)
+        if retry_after is not None:
+            return rate_limited_response(f'Rate limit exceeded for business {event.business_id}', retry_after)
+
+        if not service.dedup_index.check_and_add(key):
+            # A concurrent request with the same key got here first
+            return duplicate_response(event)
+
+        # Store first: until the event is queued nothing has been applied,
+        # so a failed request can be retried without counting it twice
+        if not service.store_metrics_in_db(event):
+            service.dedup_index.discard(key)
+            return jsonify({'error': 'Failed to store metrics'}), 500
 
-        # Store in database
-        db_success = store_metrics_in_db(metrics_data)
+        # The event is stored, so its key stays even if an update below
+        # fails; the counters are reconciled from ai_metrics on the next rebuild
+        prometheus_success = service.update_prometheus_metrics(event)
+        service.record_events([event])
 
-        if db_success and prometheus_success:
-            logger.info(f"Successfully tracked metrics for business {metrics_data.get('business_id')}")
-            return jsonify({
-                'status': 'success',
-                'message': 'Metrics tracked successfully',
-                'prometheus_updated': prometheus_success,
-                'timestamp': datetime.utcnow().isoformat()
-            })
-        else:
-            return jsonify({'error': 'Failed to store metrics'}), 500
+        event_logger.info("Tracked metrics for business %s", event.business_id)
+        return jsonify({
+            'status': 'success',
+            'message': 'Metrics tracked successfully' if prometheus_success
+            else 'Metrics stored; Prometheus update failed',
+            'prometheus_updated': prometheus_success,
+            'timestamp': datetime.utcnow().isoformat()
+        })
 
     except Exception as e:
         logger.error(f"Error tracking metrics: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
-def update_prometheus_metrics(metrics_data: Dict[str, Any]):
+def parse_batch_payload(body: bytes) -> List[Tuple[Any, Optional[str]]]:
     """
-    Update Prometheus metrics with the received data
-    
+    Decode a batch request body into individual events
+
+    Accepts either a JSON array of events or NDJSON (one event per line).
+    A malformed NDJSON line only rejects that line, not the whole batch.
+
     Args:
-        metrics_data: Dictionary containing all metrics to track
-    """
-    try:
-        business_id = metrics_data.get('business_id', 'unknown')
-        response_type = metrics_data.get('response_type', 'unknown')
-        intent = metrics_data.get('intent_detected', 'unknown')
-        model_name = metrics_data.get('model_name', 'gemini-1.5-flash')
-        
-        # Update response time histogram
-        if 'response_time_ms' in metrics_data:
-            response_time_seconds = metrics_data['response_time_ms'] / 1000.0
-            ai_response_time.observe(response_time_seconds)
-        
-        # Increment request counter
-        ai_requests_total.labels(
-            business_id=business_id,
-            response_type=response_type,
-            intent=intent
-        ).inc()
-        
-        # Update success rate gauge
-        if 'success_rate' in metrics_data:
-            ai_success_rate.labels(business_id=business_id).set(metrics_data['success_rate'])
-        
-        # Update token usage
-        if 'tokens_used' in metrics_data:
-            ai_tokens_used.labels(
-                business_id=business_id,
-                model_name=model_name
-            ).inc(metrics_data['tokens_used'])
-        
-        # Update API costs
-        if 'api_cost_usd' in metrics_data:
-            ai_api_cost.labels(
-                business_id=business_id,
-                model_name=model_name
-            ).inc(metrics_data['api_cost_usd'])
-        
-        # Update business metrics
-        if metrics_data.get('appointment_requested', False):
-            appointments_requested.labels(business_id=business_id).inc()
-        
-        if metrics_data.get('appointment_booked', False):
-            appointments_booked.labels(business_id=business_id).inc()
-        
-        if metrics_data.get('human_handoff_requested', False):
-            reason = 'error' if response_type == 'error' else 'complex_query'
-            human_handoffs.labels(business_id=business_id, reason=reason).inc()
-        
-        logger.debug(f"Updated Prometheus metrics for business {business_id}")
-        
-    except Exception as e:
-        logger.error(f"Error updating Prometheus metrics: {e}")
+        body: Raw request body
 
-def fetch_metrics_from_db() -> bool:
-    """
-    Fetch metrics directly from Neon database using HTTP API
-    This avoids psycopg2 dependency while accessing the database directly
-    
     Returns:
-        True if successful, False otherwise
-    """
-    try:
-        if not DATABASE_URL:
-            logger.warning("DATABASE_URL not configured, skipping metrics fetch")
-            return False
-        
-        # Parse Neon connection string to get HTTP API details
-        # Neon provides both PostgreSQL and HTTP API access
-        from urllib.parse import urlparse
-        parsed = urlparse(DATABASE_URL)
-        
-        # Extract database details
-        host = parsed.hostname
-        database = parsed.path[1:]  # Remove leading slash
-        username = parsed.username
-        password = parsed.password
-        
-        logger.info("Fetching historical metrics directly from Neon database...")
-        
-        # Use Neon's HTTP API to query the database
-        # This is simpler than psycopg2 and works cross-platform
-        query = """
-        SELECT 
-            business_id, response_time_ms, tokens_used, api_cost_usd, model_name,
-            intent_detected, response_type, appointment_requested, appointment_booked,
-            human_handoff_requested, success_rate
-        FROM ai_metrics 
-        WHERE created_at >= NOW() - INTERVAL '30 days'
-        ORDER BY created_at DESC
-        LIMIT 10000
-        """
-        
-        # Neon HTTP API endpoint (if available) or fallback to simple approach
-        # For now, we'll use a simple SQL-over-HTTP approach
-        
-        logger.info("Fetched historical metrics from Neon database")
-        
-        # For Lab 2, we'll start with fresh metrics and implement full DB fetch in later labs
-        # This ensures the service works immediately without complex DB setup
-        logger.info("Starting with fresh Prometheus metrics (full DB integration in later labs)")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Error fetching metrics from database: {e}")
-        return False
+        List of (event, decode_error) tuples in request order
 
-def rebuild_prometheus_metrics_from_db():
+    Raises:
+        ValueError: If a JSON array body cannot be decoded
     """
-    Rebuild Prometheus metrics from database on startup
-    This ensures continuity across service restarts
+    body = body.strip()
+    if not body:
+        return []
+
+    if body.startswith(b'['):
+        events = loads(body)
+        if not isinstance(events, list):
+            raise ValueError('Expected a JSON array')
+        return [(event, None) for event in events]
+
+    items = []
+    for line in body.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            items.append((loads(line), None))
+        except ValueError as e:
+            items.append((None, f'Invalid JSON: {e}'))
+    return items
+
+@routes.route('/track/batch', methods=['POST'])
+@concurrency_limited
+def track_metrics_batch():
     """
-    try:
-        logger.info("Rebuilding Prometheus metrics from database...")
-        
-        # Fetch and rebuild metrics
-        success = 1 #fetch_metrics_from_db()
-        
-        if success:
-            logger.info("Successfully rebuilt Prometheus metrics from database")
-        else:
-            logger.warning("Could not rebuild metrics from database, starting fresh")
-            
-    except Exception as e:
-        logger.error(f"Error rebuilding Prometheus metrics: {e}")
+    Batch variant of /track for high-volume clients
+
+    Accepts a JSON array of events or an NDJSON stream
+    (Content-Type: application/x-ndjson). Each event is validated like
+    /track; valid events are applied to Prometheus in a single pass.
+
+    Events whose idempotency key was seen before (see /track) are
+    reported as "duplicate" and not applied again. Events of businesses
+    over their rate limit are reported as "rate_limited"; if that leaves
+    nothing accepted, the response is 429 with Retry-After.
 
-def store_metrics_in_db(metrics_data: Dict[str, Any]) -> bool:
-    """
-    Trigger Next.js to store metrics in database
-    The MLOps service doesn't store directly to avoid psycopg2 issues
-    
-    Args:
-        metrics_data: Dictionary containing all metrics
-        
     Returns:
-        True (Next.js handles database storage)
+        JSON response with a per-item status, in request order:
+        {
+            "status": "success" | "partial" | "failed",
+            "accepted": 2,
+            "rejected": 1,
+            "duplicates": 0,
+            "rate_limited": 0,
+            "results": [{"index": 0, "status": "accepted"}, ...]
+        }
     """
     try:
-        # Log the metrics data for debugging
-        logger.info(f"Processed metrics for business {metrics_data.get('business_id')}")
-        
-        # Database storage is handled by Next.js side
-        # Next.js already stores the metrics when trackMetrics() is called
-        return True
+        service = current_service()
+
+        try:
+            items = parse_batch_payload(request.get_data())
+        except (ValueError, UnicodeDecodeError) as e:
+            return jsonify({'error': f'Invalid batch payload: {e}'}), 400
+
+        if not items:
+            return jsonify({'error': 'No metrics data provided'}), 400
+
+        if len(items) > service.max_batch_size:
+            return jsonify({'error': f'Batch too large: {len(items)} events (max {service.max_batch_size})'}), 413
+
+        results = []
+        accepted_events = []
+        accepted_keys = []
+        duplicates = 0
+        rate_limited = 0
+        retry_after = 0.0
+        for index, (metrics_data, error) in enumerate(items):
+            if error is None:
+                try:
+                    event = parse_event(metrics_data)
+                except EventValidationError as e:
+                    error = str(e)
+            if error:
+                results.append({'index': index, 'status': 'rejected', 'error': error})
+                continue
+            # Same order as /track: duplicates, then admission
+            key = idempotency_key(event)
+            if service.dedup_index.seen(key):
+                duplicates += 1
+                results.append({'index': index, 'status': 'duplicate'})
+                continue
+            wait = service.admission.acquire(event.business_id)
+            if wait is not None:
+                rate_limited += 1
+                retry_after = max(retry_after, wait)
+                results.append({'index': index, 'status': 'rate_limited'})
+                continue
+            if not service.dedup_index.check_and_add(key):
+                duplicates += 1
+                results.append({'index': index, 'status': 'duplicate'})
+                continue
+            accepted_events.append(event)
+            accepted_keys.append(key)
+            results.append({'index': index, 'status': 'accepted'})
+
+        prometheus_success = True
+        if accepted_events:
+            # Stored whole or not at all (see store_metrics_batch_in_db);
+            # the keys are only kept once the events are stored
+            if not service.store_metrics_batch_in_db(accepted_events):
+                for key in accepted_keys:
+                    service.dedup_index.discard(key)
+                return jsonify({'error': 'Failed to store metrics'}), 500
+            prometheus_success = service.update_prometheus_metrics_batch(accepted_events)
+            service.record_events(accepted_events)
+
+        accepted = len(accepted_events)
+        rejected = len(items) - accepted - duplicates - rate_limited
+        if rejected == 0 and rate_limited == 0:
+            status = 'success'
+        elif accepted or duplicates:
+            status = 'partial'
+        else:
+            status = 'failed'
+
+        event_logger.info("Tracked batch of %d events (%d rejected, %d duplicates, %d rate limited)",
+                          accepted, rejected, duplicates, rate_limited)
+        response = jsonify({
+            'status': status,
+            'accepted': accepted,
+            'rejected': rejected,
+            'duplicates': duplicates,
+            'rate_limited': rate_limited,
+            'prometheus_updated': prometheus_success,
+            'results': results,
+            'timestamp': datetime.utcnow().isoformat()
+        })
+        if accepted or duplicates:
+            response.status_code = 200
+        elif rate_limited:
+            response.status_code = 429
+            response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        else:
+            response.status_code = 400
+        return response
+
     except Exception as e:
-        logger.error(f"Error processing metrics: {e}")
-        return False
+        logger.error(f"Error tracking metrics batch: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
 
-@app.route('/refresh-metrics', methods=['POST'])
+@routes.route('/refresh-metrics', methods=['POST'])
 def refresh_metrics():
     """
     Endpoint for Next.js to trigger metrics refresh from database
-    This rebuilds Prometheus metrics from persistent data
+    Applies rows added since the last refresh in a background job;
+    triggers arriving within REFRESH_DEBOUNCE_SECONDS share one job
     """
     try:
-        logger.info("Metrics refresh triggered by Next.js")
-        
-        # Fetch latest metrics from database and rebuild Prometheus
-        success = 1 #fetch_metrics_from_db()
-        
-        if success:
+        service = current_service()
+        event_logger.info("Metrics refresh triggered by Next.js")
+
+        if get_database() is None:
             return jsonify({
-                'status': 'success',
-                'message': 'Prometheus metrics refreshed from database',
+                'status': 'warning',
+                'message': 'Could not fetch from database, using current metrics',
                 'timestamp': datetime.utcnow().isoformat()
             })
-        else:
+
+        if service.multiprocess:
+            # A worker only sees its own share of the live counters, so it
+            # cannot reconcile them against database totals; the startup
+            # rebuild in the gunicorn master already covered the database
             return jsonify({
-                'status': 'warning', 
-                'message': 'Could not fetch from database, using current metrics',
+                'status': 'skipped',
+                'message': 'Metrics are aggregated across workers; refresh runs at startup only',
                 'timestamp': datetime.utcnow().isoformat()
             })
-            
+
+        scheduled = service.schedule_refresh()
+
+        return jsonify({
+            'status': 'success',
+            'message': 'Prometheus metrics refresh scheduled' if scheduled
+                       else 'Merged into pending metrics refresh',
+            'scheduled': scheduled,
+            'watermark': service.watermark(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+
     except Exception as e:
         logger.error(f"Error refreshing metrics: {e}")
         return jsonify({'error': 'Failed to refresh metrics'}), 500
 
-@app.route('/analytics/<business_id>', methods=['GET'])
+@routes.route('/analytics/<business_id>', methods=['GET'])
 def get_analytics(business_id: str):
     """
     Get analytics dashboard data for a specific business
-    
+    Served from in-memory rollups; responses are cached for a short TTL
+    and invalidated as soon as the business tracks a new event
+
     Args:
         business_id: UUID of the business
-        
+
+    Query parameters:
+        period: 1_hour, 24_hours, 7_days or 30_days (default)
+
     Returns:
         JSON with aggregated metrics and insights
     """
     try:
-        # Return sample analytics data for now
-        # In production, this would query your actual database
-        return jsonify({
-            'business_id': business_id,
-            'period': '30_days',
-            'metrics': {
-                'total_conversations': 150,
-                'avg_response_time_ms': 1250.5,
-                'avg_tokens_used': 125.3,
-                'total_api_cost_usd': 0.045,
-                'appointment_requests': 25,
-                'appointments_booked': 18,
-                'human_handoffs': 3,
-                'appointment_conversion_rate': 0.72
-            },
-            'monitoring': 'prometheus',
-            'prometheus_metrics_url': '/metrics',
-            'timestamp': datetime.utcnow().isoformat(),
-            'note': 'Sample data - connect to your database for real analytics'
-        })
-            
+        service = current_service()
+        period = request.args.get('period', '30_days')
+        if period not in ANALYTICS_PERIODS:
+            return jsonify({
+                'error': f"Invalid period: {period}",
+                'valid_periods': list(ANALYTICS_PERIODS)
+            }), 400
+
+        analytics = service.analytics_cache.get_or_set(
+            business_id, period,
+            lambda: service.build_analytics(business_id, period)
+        )
+        return jsonify(analytics)
+
     except Exception as e:
         logger.error(f"Error getting analytics: {e}")
         return jsonify({'error': 'Failed to retrieve analytics'}), 500
 
+@routes.route('/conversations/<conversation_id>', methods=['GET'])
+def get_conversation(conversation_id: str):
+    """
+    Running totals of a conversation that is still live in this worker
+    Finished conversations are in the ai_conversations table and the
+    ai_conversation_* histograms
+
+    Args:
+        conversation_id: Conversation ID as sent with /track
+
+    Returns:
+        JSON with the turns, tokens, cost and outcome so far
+    """
+    session = current_service().sessions.get(conversation_id)
+    if session is None:
+        return jsonify({'error': 'Conversation not found or already finished'}), 404
+    return jsonify(session)
+
+@routes.route('/sketches', methods=['GET'])
+@sketch_token_required
+def get_sketches():
+    """
+    Export latency sketches so another replica (or an aggregator) can merge them
+
+    Returns:
+        JSON with every (business_id, model_name) sketch
+    """
+    try:
+        latency_sketches = current_service().latency_sketches
+        return jsonify({
+            'relative_accuracy': latency_sketches.relative_accuracy,
+            'sketches': latency_sketches.to_dict(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    except Exception as e:
+        logger.error(f"Error exporting sketches: {e}")
+        return jsonify({'error': 'Failed to export sketches'}), 500
+
+@routes.route('/sketches/merge', methods=['POST'])
+@sketch_token_required
+def merge_sketches():
+    """
+    Merge latency sketches exported by other replicas' GET /sketches with
+    this replica's and return the combined sketches and quantiles
+
+    The merge is computed per request: this replica's own sketches, and so
+    its /metrics, are left unchanged.
+
+    Expected payload:
+    {
+        "sketches": [
+            {"business_id": "uuid", "model_name": "gemini-1.5-flash", "sketch": {...}}
+        ],
+        "include_local": true
+    }
+    """
+    try:
+        service = current_service()
+        payload = request.get_json(silent=True)
+        if not payload or not isinstance(payload.get('sketches'), list):
+            return jsonify({'error': 'No sketches provided'}), 400
+        if len(payload['sketches']) > service.max_batch_size:
+            return jsonify({'error': f'Too many sketches (max {service.max_batch_size})'}), 413
+
+        try:
+            view = service.latency_sketches.merged_with(
+                payload['sketches'], include_self=payload.get('include_local', True) is not False
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid sketch data: {e}'}), 400
+
+        sketches = view.to_dict()
+        for entry in sketches:
+            entry['quantiles_ms'] = {
+                f'p{int(q * 100)}': round(value * 1000, 1) if value is not None else None
+                for q, value in view.quantiles(entry['business_id'])[entry['model_name']].items()
+            }
+        return jsonify({
+            'status': 'success',
+            'merged': len(payload['sketches']),
+            'relative_accuracy': view.relative_accuracy,
+            'sketches': sketches,
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    except Exception as e:
+        logger.error(f"Error merging sketches: {e}")
+        return jsonify({'error': 'Failed to merge sketches'}), 500
+
 if __name__ == '__main__':
+    sys.stdout.reconfigure(encoding='utf-8')
+
     # Get port from environment or use default
     service_port = int(os.getenv('SERVICE_PORT', '5000'))
     prometheus_port = int(os.getenv('PROMETHEUS_PORT', '8001'))
-    
+
+    app = get_app()
+
     print("🚀 Starting MLOps Service with Prometheus")
     print("=========================================")
     print("📊 Monitoring: Prometheus")
-    print("💾 Database: Simplified (cross-platform)")
+    print(f"💾 Database: {'write-behind queue' if get_service(app).metrics_writer else 'handled by Next.js'}")
     print(f"🌐 Service Port: {service_port}")
     print("🌐 Endpoints:")
     print(f"   - GET  http://localhost:{service_port}/ (Dashboard)")
     print(f"   - GET  http://localhost:{service_port}/health")
+    print(f"   - GET  http://localhost:{service_port}/ready")
     print(f"   - GET  http://localhost:{service_port}/metrics (Prometheus)")
     print(f"   - POST http://localhost:{service_port}/track")
+    print(f"   - POST http://localhost:{service_port}/track/batch")
     print(f"   - GET  http://localhost:{service_port}/analytics/<business_id>")
+    print(f"   - GET  http://localhost:{service_port}/stream (live SSE)")
     print("")
     print("🎯 Quick Start:")
     print(f"   📊 View Dashboard: http://localhost:{service_port}/")
     print(f"   📈 View Raw Metrics: http://localhost:{service_port}/metrics")
     print("")
-    
+
     # Start Prometheus metrics server on a separate port
     try:
         start_http_server(prometheus_port)
@@ -523,10 +745,10 @@ if __name__ == '__main__':
     except Exception as e:
         logger.warning(f"Could not start Prometheus metrics server on port {prometheus_port}: {e}")
         print("⚠️  Prometheus metrics available at Flask /metrics endpoint")
-    
+
     print("")
     print("🔄 Press Ctrl+C to stop all services")
     print("")
-    
-    # Run Flask app in development mode
+
+    # Run Flask app in development mode (production: gunicorn -c gunicorn.conf.py app:app)
     app.run(host='0.0.0.0', port=service_port, debug=True)
@@ -0,0 +1,498 @@
+"""
+Columnar Parquet archive of ai_metrics events
+Lab 2: AI Lifecycle & MLOps Integration
+
+Offline analysis over months of data, such as cost per intent, latency by
+model or conversion funnels, shouldn't scan the OLTP ai_metrics table or
+compete with live writes. ParquetArchiver streams ingested events into
+Parquet files partitioned by day and business:
+
+    ARCHIVE_DIR/day=2024-05-01/business_id=<id>/part-<time>-<pid>-<n>.parquet
+
+- Events are buffered and written in row groups, at most row_group_size
+  rows at a time, so memory stays bounded; if writing falls behind
+  max_buffered_rows, new events are dropped and counted.
+- Each partition's rows are held until they fill min_row_group_size rows,
+  so a quiet business doesn't get a tiny row group on every flush. They
+  are written anyway once they have waited roll_interval seconds, once a
+  later day has started, when more than half of max_buffered_rows is held
+  this way, and on stop() or close_files().
+- Rows are sorted by created_at within each row group. Parquet records
+  per-column min/max statistics, so readers can skip row groups outside a
+  time range.
+- A file is written under a hidden name (.part-...) and renamed when it
+  is closed. Readers only ever see complete files. Files are closed after
+  roll_interval seconds, at the end of the day, or when too many are open.
+- Live events (record) whose created_at is more than max_clock_skew
+  seconds from now are archived at the current time instead and counted.
+  Otherwise a client with a wrong clock could open a file per stray day
+  and push the files of current partitions past max_open_files. Backfills
+  (write, export_from_db) keep every created_at.
+
+read_archive() is the query helper. It reads only the partitions (day,
+business_id) and columns a query needs, and pushes the time filter down
+to row-group statistics. export_from_db() backfills the archive from
+ai_metrics.
+
+pyarrow is an optional dependency, imported when this module loads. The
+service runs without it as long as ARCHIVE_DIR is not set.
+
+Usage:
+    python archive.py export --since 2024-01-01     # backfill from DATABASE_URL
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from urllib.parse import quote
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+
+from database import METRICS_COLUMNS
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - optional dependency
+    pa = ds = pq = None
+
+logger = logging.getLogger(__name__)
+
+# Columns stored in each file; business_id and day come from the path
+ARCHIVE_COLUMNS = ['created_at'] + [column for column in METRICS_COLUMNS if column != 'business_id']
+
+_INTEGER_COLUMNS = {'response_time_ms', 'tokens_used', 'prompt_tokens', 'completion_tokens',
+                    'user_message_length', 'ai_response_length'}
+_FLOAT_COLUMNS = {'success_rate', 'api_cost_usd'}
+_BOOLEAN_COLUMNS = {'appointment_requested', 'human_handoff_requested', 'appointment_booked'}
+
+
+def archive_schema():
+    """Arrow schema of the archived columns (business_id/day are partition keys)"""
+    fields = [pa.field('created_at', pa.timestamp('ms', tz='UTC'))]
+    for column in ARCHIVE_COLUMNS[1:]:
+        if column in _INTEGER_COLUMNS:
+            fields.append(pa.field(column, pa.int32()))
+        elif column in _FLOAT_COLUMNS:
+            fields.append(pa.field(column, pa.float64()))
+        elif column in _BOOLEAN_COLUMNS:
+            fields.append(pa.field(column, pa.bool_()))
+        else:
+            fields.append(pa.field(column, pa.string()))
+    return pa.schema(fields)
+
+
+def partitioning():
+    """Hive partitioning by day (YYYY-MM-DD) then business_id"""
+    return ds.partitioning(pa.schema([('day', pa.string()), ('business_id', pa.string())]), flavor='hive')
+
+
+def to_utc(value: Any) -> datetime:
+    """created_at from a row, event or spool record as an aware UTC datetime"""
+    if value is None:
+        return datetime.now(timezone.utc)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        # ai_metrics stores naive UTC timestamps
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _value(column: str, value: Any) -> Any:
+    if value is None:
+        return None
+    if column in _FLOAT_COLUMNS or isinstance(value, Decimal):
+        return float(value)
+    if column in _BOOLEAN_COLUMNS:
+        return bool(value)
+    return value
+
+
+class ParquetArchiver:
+    """
+    Streams events into day/business-partitioned Parquet files
+
+    Args:
+        root: Archive directory
+        row_group_size: Rows per Parquet row group (and per flush)
+        min_row_group_size: Rows a partition collects before they are written
+        max_buffered_rows: Rows held in memory before new events are dropped
+        flush_interval: Seconds between background flushes
+        roll_interval: Seconds a file stays open before it is closed and published
+        max_open_files: Partition files kept open at once
+        max_clock_skew: Seconds a recorded event's created_at may be from now
+            before the current time is used instead
+        registry: Prometheus registry for the archiver's own metrics
+    """
+
+    def __init__(self, root: str, row_group_size: int = 10000, max_buffered_rows: int = 100000,
+                 flush_interval: float = 60.0, roll_interval: float = 900.0,
+                 max_open_files: int = 64, max_clock_skew: float = 3600.0,
+                 min_row_group_size: int = 1000, registry=REGISTRY):
+        if pa is None:
+            raise RuntimeError('pyarrow is required for the Parquet archive (pip install pyarrow)')
+        self.root = root
+        self.row_group_size = row_group_size
+        self.min_row_group_size = min(min_row_group_size, row_group_size)
+        self.max_buffered_rows = max_buffered_rows
+        self.flush_interval = flush_interval
+        self.roll_interval = roll_interval
+        self.max_open_files = max_open_files
+        self.max_clock_skew = timedelta(seconds=max_clock_skew)
+        self.schema = archive_schema()
+
+        self._buffer: List[Tuple[datetime, Any]] = []
+        self._buffer_lock = threading.Lock()
+        # (day, business_id) -> [first held (monotonic), rows] not yet written
+        # because they don't fill a row group; guarded by _flush_lock
+        self._pending: Dict[Tuple[str, str], list] = {}
+        self._pending_rows = 0
+        self._newest_day = ''
+        self._flush_lock = threading.Lock()
+        # (day, business_id) -> [writer, hidden path, final path, opened (monotonic)]
+        self._writers: 'OrderedDict[Tuple[str, str], list]' = OrderedDict()
+        self._sequence = 0
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+        self.rows_written = Counter(
+            'metrics_archive_rows_written_total',
+            'Events written to the Parquet archive',
+            registry=registry
+        )
+        self.files_published = Counter(
+            'metrics_archive_files_total',
+            'Parquet files closed and published',
+            registry=registry
+        )
+        self.dropped = Counter(
+            'metrics_archive_dropped_total',
+            'Events dropped because the archive buffer was full',
+            registry=registry
+        )
+        self.clamped = Counter(
+            'metrics_archive_clamped_total',
+            'Recorded events whose created_at was too far from now and was replaced by it',
+            registry=registry
+        )
+        self.buffered = Gauge(
+            'metrics_archive_buffered_rows',
+            'Events waiting to be written to the archive, including those held for a full row group',
+            registry=registry,
+            multiprocess_mode='livesum'
+        )
+        self.flush_latency = Histogram(
+            'metrics_archive_flush_seconds',
+            'Time taken to write one buffer of events to Parquet',
+            buckets=[0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0],
+            registry=registry
+        )
+
+    def record(self, events: Iterable[Any]) -> int:
+        """
+        Buffer events for the archive (MetricEvents, dicts or database rows)
+
+        An event's created_at is used when present and within max_clock_skew
+        of now, otherwise the current time.
+
+        Returns:
+            Number of events buffered (the rest were dropped)
+        """
+        self._ensure_started()
+        return self._append(events, self.max_clock_skew)
+
+    def write(self, events: Iterable[Any]) -> int:
+        """
+        Buffer events and write full row groups right away, without the
+        background thread; close_files() writes the rest
+
+        Returns:
+            Number of events buffered (the rest were dropped)
+        """
+        accepted = self._append(events)
+        self.flush()
+        return accepted
+
+    def _append(self, events: Iterable[Any], max_skew: Optional[timedelta] = None) -> int:
+        now = datetime.now(timezone.utc)
+        clamped = 0
+        with self._buffer_lock:
+            room = self.max_buffered_rows - len(self._buffer) - self._pending_rows
+            accepted = 0
+            for event in events:
+                if accepted >= room:
+                    self.dropped.inc()
+                    continue
+                created_at = event.get('created_at')
+                created_at = now if created_at is None else to_utc(created_at)
+                if max_skew is not None and abs(created_at - now) > max_skew:
+                    created_at = now
+                    clamped += 1
+                self._buffer.append((created_at, event))
+                accepted += 1
+            size = len(self._buffer)
+        if clamped:
+            self.clamped.inc(clamped)
+        self.buffered.set(size + self._pending_rows)
+        if size >= self.row_group_size:
+            self._wake.set()
+        return accepted
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._flush_lock:
+            if self._pid != os.getpid():
+                # Forked from the process that opened these files: they are not ours
+                self._writers = OrderedDict()
+                self._pid = os.getpid()
+            if self._thread is None or not self._thread.is_alive():
+                self._stop_event.clear()
+                self._thread = threading.Thread(target=self._run, name='metrics-archive', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Error writing the Parquet archive: %s", e)
+
+    def stop(self, timeout: float = 10.0):
+        """Write everything buffered and publish every open file"""
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.close_files()
+
+    def close_files(self):
+        """Write everything buffered, then close and publish every open file"""
+        self.flush(force=True)
+        with self._flush_lock:
+            for key in list(self._writers):
+                self._close_writer(key)
+
+    def flush(self, force: bool = False) -> int:
+        """
+        Write buffered events as row groups of their partitions' files
+
+        Args:
+            force: Also write partitions that don't fill min_row_group_size
+
+        Returns:
+            Number of events written
+        """
+        with self._flush_lock:
+            while True:
+                with self._buffer_lock:
+                    batch = self._buffer[:self.row_group_size]
+                    del self._buffer[:self.row_group_size]
+                if not batch:
+                    break
+                now = time.monotonic()
+                for created_at, event in batch:
+                    key = (created_at.date().isoformat(), str(event.get('business_id') or 'unknown'))
+                    entry = self._pending.get(key)
+                    if entry is None:
+                        entry = self._pending[key] = [now, []]
+                    entry[1].append((created_at, event))
+                    self._newest_day = max(self._newest_day, key[0])
+                self._pending_rows += len(batch)
+            written = self._write_pending(force)
+            with self._buffer_lock:
+                self.buffered.set(len(self._buffer) + self._pending_rows)
+            self._roll_files()
+        return written
+
+    def _write_pending(self, force: bool) -> int:
+        # Called with _flush_lock held
+        force = force or self._pending_rows > self.max_buffered_rows // 2
+        deadline = time.monotonic() - self.roll_interval
+        start = time.perf_counter()
+        written = 0
+        for key, entry in list(self._pending.items()):
+            since, rows = entry
+            due = force or since <= deadline or key[0] < self._newest_day
+            if not due and len(rows) < self.min_row_group_size:
+                continue
+            rows.sort(key=lambda row: row[0])
+            end = len(rows)
+            if not due and end % self.row_group_size < self.min_row_group_size:
+                # Keep a short tail for the next flush rather than write a small row group
+                end -= end % self.row_group_size
+            for offset in range(0, end, self.row_group_size):
+                self._writer(key).write_table(self._table(rows[offset:min(offset + self.row_group_size, end)]),
+                                              row_group_size=self.row_group_size)
+            if end == len(rows):
+                del self._pending[key]
+            else:
+                entry[1] = rows[end:]
+            written += end
+        if written:
+            self._pending_rows -= written
+            self.flush_latency.observe(time.perf_counter() - start)
+            self.rows_written.inc(written)
+        return written
+
+    def _table(self, rows: List[Tuple[datetime, Any]]):
+        rows.sort(key=lambda row: row[0])
+        columns = {'created_at': [created_at for created_at, _ in rows]}
+        for column in ARCHIVE_COLUMNS[1:]:
+            columns[column] = [_value(column, event.get(column)) for _, event in rows]
+        return pa.Table.from_pydict(columns, schema=self.schema)
+
+    def _writer(self, key: Tuple[str, str]):
+        entry = self._writers.get(key)
+        if entry is not None:
+            self._writers.move_to_end(key)
+            return entry[0]
+
+        day, business_id = key
+        directory = os.path.join(self.root, f'day={day}', f"business_id={quote(business_id, safe='')}")
+        os.makedirs(directory, exist_ok=True)
+        self._sequence += 1
+        name = f"part-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{self._sequence}.parquet"
+        hidden = os.path.join(directory, '.' + name)
+        writer = pq.ParquetWriter(hidden, self.schema, compression='zstd', write_statistics=True)
+        self._writers[key] = [writer, hidden, os.path.join(directory, name), time.monotonic()]
+
+        while len(self._writers) > self.max_open_files:
+            self._close_writer(next(iter(self._writers)))
+        return writer
+
+    def _roll_files(self):
+        today = datetime.now(timezone.utc).date().isoformat()
+        deadline = time.monotonic() - self.roll_interval
+        for key, (_, _, _, opened) in list(self._writers.items()):
+            if opened <= deadline or key[0] < today:
+                self._close_writer(key)
+
+    def _close_writer(self, key: Tuple[str, str]):
+        writer, hidden, final, _ = self._writers.pop(key)
+        writer.close()
+        os.replace(hidden, final)
+        self.files_published.inc()
+
+
+def _day(value: Any) -> str:
+    if isinstance(value, datetime):
+        return to_utc(value).date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)[:10]
+
+
+def read_archive(root: str, columns: Optional[Sequence[str]] = None,
+                 business_ids: Optional[Sequence[str]] = None,
+                 start: Optional[Any] = None, end: Optional[Any] = None):
+    """
+    Read archived events, touching only the partitions and columns needed
+
+    Args:
+        root: Archive directory
+        columns: Columns to return (business_id and day are available too);
+            None returns every column
+        business_ids: Only these businesses (partition pruning)
+        start: Inclusive lower bound on created_at (datetime or ISO string)
+        end: Exclusive upper bound on created_at
+
+    Returns:
+        pyarrow.Table, e.g.
+        read_archive(root, ['intent_detected', 'api_cost_usd']).group_by('intent_detected').aggregate(
+            [('api_cost_usd', 'sum')])
+    """
+    if pa is None:
+        raise RuntimeError('pyarrow is required to read the Parquet archive (pip install pyarrow)')
+    if not os.path.isdir(root):
+        return archive_schema().empty_table()
+
+    dataset = ds.dataset(root, format='parquet', partitioning=partitioning(), schema=archive_schema()
+                         .append(pa.field('day', pa.string())).append(pa.field('business_id', pa.string())))
+    conditions = []
+    if business_ids is not None:
+        conditions.append(ds.field('business_id').isin(list(business_ids)))
+    if start is not None:
+        # The day condition prunes directories, the created_at one row groups
+        conditions.append(ds.field('day') >= _day(start))
+        conditions.append(ds.field('created_at') >= pa.scalar(to_utc(start), pa.timestamp('ms', tz='UTC')))
+    if end is not None:
+        conditions.append(ds.field('day') <= _day(end))
+        conditions.append(ds.field('created_at') < pa.scalar(to_utc(end), pa.timestamp('ms', tz='UTC')))
+
+    condition = None
+    for expression in conditions:
+        condition = expression if condition is None else condition & expression
+    return dataset.to_table(columns=list(columns) if columns is not None else None, filter=condition)
+
+
+EXPORT_QUERY = f"""
+SELECT created_at, business_id, {', '.join(ARCHIVE_COLUMNS[1:])}
+FROM ai_metrics
+WHERE created_at >= %s
+ORDER BY created_at, id
+"""
+
+
+def export_from_db(database, root: str, since: datetime, chunk_size: int = 10000,
+                   registry=None) -> int:
+    """
+    Backfill the archive with ai_metrics rows created since `since`
+
+    Rows are streamed from the database chunk by chunk and written as they
+    arrive, so memory use doesn't depend on the table size. They come in
+    created_at order, so each day's partitions are written one after the
+    other rather than all being kept open (ids follow insertion, and
+    spooled rows are inserted late with their original created_at).
+
+    Returns:
+        Number of rows archived
+    """
+    from prometheus_client import CollectorRegistry
+
+    # Up to half the buffer holds partitions short of a row group, so leave
+    # room for a whole chunk on top of them
+    archiver = ParquetArchiver(root, row_group_size=chunk_size, max_buffered_rows=2 * chunk_size,
+                               roll_interval=float('inf'), registry=registry or CollectorRegistry())
+    exported = 0
+    for chunk in database.stream(EXPORT_QUERY, (since.strftime('%Y-%m-%d %H:%M:%S'),), chunk_size=chunk_size):
+        exported += archiver.write(chunk)
+    archiver.close_files()
+    return exported
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Parquet archive of ai_metrics')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='Backfill the archive from DATABASE_URL')
+    export.add_argument('--since', required=True, help='Export rows created on or after this date (YYYY-MM-DD)')
+    export.add_argument('--archive-dir', default=os.getenv('ARCHIVE_DIR', 'archive'))
+    export.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    from database import get_database
+    database = get_database()
+    if database is None:
+        print('DATABASE_URL is not set', file=sys.stderr)
+        return 1
+    exported = export_from_db(database, args.archive_dir, datetime.fromisoformat(args.since), args.chunk_size)
+    print(f'Archived {exported} rows to {args.archive_dir}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""
+Small in-memory response cache
+Lab 2: AI Lifecycle & MLOps Integration
+
+Entries expire after a fixed TTL and can be invalidated early, per key
+group, when the data behind them changes.
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    Thread-safe TTL cache with per-group invalidation
+
+    Keys are (group, key) pairs. invalidate(group) drops every entry of
+    that group, e.g. all cached analytics periods for one business.
+
+    Args:
+        ttl: Seconds an entry stays valid
+        max_groups: Groups kept before the least recently written is evicted
+    """
+
+    def __init__(self, ttl: float = 5.0, max_groups: int = 10000):
+        self.ttl = ttl
+        self.max_groups = max_groups
+        self._entries: Dict[Hashable, Dict[Hashable, Tuple[float, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, group: Hashable, key: Hashable) -> Optional[Any]:
+        """Return the cached value, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(group, {}).get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, group: Hashable, key: Hashable, value: Any):
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            entries = self._entries.pop(group, None) or {}
+            entries[key] = (expires, value)
+            # Re-inserting keeps dict order = least recently written first
+            self._entries[group] = entries
+            while len(self._entries) > self.max_groups:
+                del self._entries[next(iter(self._entries))]
+
+    def get_or_set(self, group: Hashable, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """Return the cached value, computing and caching it on a miss"""
+        value = self.get(group, key)
+        if value is None:
+            value = compute()
+            self.set(group, key, value)
+        return value
+
+    def invalidate(self, group: Hashable):
+        """Drop every cached entry for a group"""
+        with self._lock:
+            self._entries.pop(group, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,200 @@
+"""
+Label-cardinality guard for Prometheus collectors
+Lab 2: AI Lifecycle & MLOps Integration
+
+business_id, intent and response_type come straight from client payloads,
+so a buggy or abusive client can create an unbounded number of label
+children. Every child costs memory and makes each /metrics scrape slower.
+
+CardinalityGuard sits in front of a labelled collector and caps the number
+of distinct label sets it holds. Once the cap is reached, new label sets
+are folded into a single "__other__" series, and the fold is counted in
+metrics_label_overflow_total. Allow-listed business ids are always kept.
+With top_k enabled, a folded label set that turns out to carry more traffic
+than the quietest admitted one replaces it. The evicted series' counts move
+into its __other__ child, so summed totals never go backwards. In gunicorn
+multiprocess mode the evicted series is left in place instead: its worker
+file keeps it whatever the guard does.
+"""
+
+import threading
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from prometheus_client import REGISTRY, Counter, Gauge
+
+from metric_internals import add_child, existing_child, is_multiprocess, label_names
+
+# Label value used for series folded by a CardinalityGuard
+OVERFLOW_LABEL_VALUE = '__other__'
+
+
+class CardinalityMetrics:
+    """Shared self-metrics for every guard registered on one registry"""
+
+    def __init__(self, registry=REGISTRY):
+        self.overflow = Counter(
+            'metrics_label_overflow_total',
+            'Updates folded into the __other__ series by the cardinality guard',
+            ['metric'],
+            registry=registry
+        )
+        self.series = Gauge(
+            'metrics_label_series',
+            'Distinct label sets currently admitted per metric',
+            ['metric'],
+            registry=registry,
+            multiprocess_mode='liveall'
+        )
+        self.evictions = Counter(
+            'metrics_label_evictions_total',
+            'Admitted label sets replaced by heavier traffic (top-K mode)',
+            ['metric'],
+            registry=registry
+        )
+
+
+class CardinalityGuard:
+    """
+    Bounds the distinct label sets of one labelled collector
+
+    Args:
+        metric: Labelled Counter/Gauge/Histogram to guard
+        name: Metric name reported in the guard's own metrics
+        max_series: Label sets admitted before new ones are folded
+        metrics: Shared CardinalityMetrics for reporting
+        fold_labels: Labels replaced with __other__ on overflow
+            (defaults to every label of the metric)
+        allow_list: business_id values that are always admitted
+        top_k: Promote heavy folded label sets over the quietest admitted ones
+        max_candidates: Folded label sets whose traffic is tracked in top-K mode
+        on_fold: Called with (evicted label values, __other__ label values)
+            after an evicted series' counts moved into its __other__ child
+    """
+
+    def __init__(self, metric, name: str, max_series: int, metrics: CardinalityMetrics,
+                 fold_labels: Optional[Iterable[str]] = None,
+                 allow_list: Optional[Iterable[str]] = None,
+                 top_k: bool = False,
+                 max_candidates: int = 100,
+                 on_fold: Optional[Callable[[Tuple[str, ...], Tuple[str, ...]], None]] = None):
+        self.metric = metric
+        self.name = name
+        self.max_series = max_series
+        self.labelnames = label_names(metric)
+        fold = set(self.labelnames if fold_labels is None else fold_labels)
+        self._fold_mask = tuple(label in fold for label in self.labelnames)
+        self._business_index = (self.labelnames.index('business_id')
+                                if 'business_id' in self.labelnames else None)
+        self.allow_list = frozenset(allow_list or ())
+        self.top_k = top_k
+        self.max_candidates = max_candidates
+        self.on_fold = on_fold
+
+        # Admitted label sets -> traffic seen (used to pick top-K evictions)
+        self._admitted: Dict[Tuple[str, ...], int] = {}
+        # Space-saving estimate of traffic for folded label sets (top-K only)
+        self._candidates: Dict[Tuple[str, ...], int] = {}
+        self._eviction_floor = 0
+        self._lock = threading.Lock()
+
+        self._overflow = metrics.overflow.labels(metric=self.name)
+        self._evictions = metrics.evictions.labels(metric=self.name)
+        # Set on every admission rather than via set_function, so gunicorn
+        # workers export it through their multiprocess files too
+        self._series = metrics.series.labels(metric=self.name)
+        self._series.set(0)
+
+    def labels(self, *labelvalues, **labelkwargs):
+        """
+        Drop-in replacement for metric.labels() that enforces the cap
+
+        Returns:
+            The child for the label set, or its folded __other__ child
+        """
+        if labelkwargs:
+            values = tuple(str(labelkwargs[label]) for label in self.labelnames)
+        else:
+            values = tuple(str(value) for value in labelvalues)
+        return self.metric.labels(*self.resolve(values))
+
+    def resolve(self, values: Tuple[str, ...]) -> Tuple[str, ...]:
+        """Map a label set to the one actually recorded"""
+        with self._lock:
+            traffic = self._admitted.get(values)
+            if traffic is not None:
+                self._admitted[values] = traffic + 1
+                return values
+
+            allowed = (self._business_index is not None
+                       and values[self._business_index] in self.allow_list)
+            if allowed or len(self._admitted) < self.max_series:
+                self._admitted[values] = 1
+                self._series.set(len(self._admitted))
+                return values
+
+            if self.top_k and self._promote(values):
+                return values
+
+            self._overflow.inc()
+            return self._folded(values)
+
+    def _folded(self, values: Tuple[str, ...]) -> Tuple[str, ...]:
+        return tuple(
+            OVERFLOW_LABEL_VALUE if fold else value
+            for value, fold in zip(values, self._fold_mask)
+        )
+
+    def _promote(self, values: Tuple[str, ...]) -> bool:
+        # Space-saving: an untracked candidate replaces the lightest one
+        # and inherits its count, so estimates never undercount
+        count = self._candidates.get(values)
+        if count is None:
+            if len(self._candidates) >= self.max_candidates:
+                lightest = min(self._candidates, key=self._candidates.get)
+                count = self._candidates.pop(lightest)
+            else:
+                count = 0
+        count += 1
+        self._candidates[values] = count
+
+        # Admitted traffic only grows, so the cached floor is a lower bound;
+        # the real minimum is only looked up once a candidate beats it
+        if count <= self._eviction_floor:
+            return False
+
+        evictable = [
+            key for key in self._admitted
+            if self._business_index is None or key[self._business_index] not in self.allow_list
+        ]
+        if not evictable:
+            self._eviction_floor = float('inf')
+            return False
+        quietest = min(evictable, key=self._admitted.get)
+        self._eviction_floor = self._admitted[quietest]
+        if count <= self._eviction_floor:
+            return False
+
+        del self._admitted[quietest]
+        self._retire(quietest)
+        del self._candidates[values]
+        self._admitted[values] = count
+        self._evictions.inc()
+        return True
+
+    def _retire(self, values: Tuple[str, ...]):
+        child = existing_child(self.metric, values)
+        if child is None or is_multiprocess(child):
+            return
+        if isinstance(self.metric, Gauge):
+            # A gauge is a current value, not a count; there is nothing to keep
+            self.metric.remove(*values)
+            return
+        folded = self._folded(values)
+        add_child(self.metric.labels(*folded), child)
+        self.metric.remove(*values)
+        if self.on_fold is not None:
+            self.on_fold(values, folded)
+
+    def series(self) -> int:
+        """Number of admitted label sets"""
+        return len(self._admitted)
@@ -3,11 +3,26 @@
 # This file provides shared test setup but is not required
 
 import pytest
-from app import app
+from prometheus_client import CollectorRegistry
+
+from app import create_app, get_service
+
+@pytest.fixture
+def app():
+    """Create an app with its own Prometheus registry, started up front"""
+    return create_app({
+        'TESTING': True,
+        'METRICS_REGISTRY': CollectorRegistry(),
+        'STARTUP_IN_BACKGROUND': False
+    })
+
+@pytest.fixture
+def service(app):
+    """The MLOpsService behind the app"""
+    return get_service(app)
 
 @pytest.fixture
-def client():
+def client(app):
     """Create a test client"""
-    app.config['TESTING'] = True
     with app.test_client() as client:
-        yield client
\ No newline at end of file
+        yield client
@@ -0,0 +1,474 @@
+"""
+Database access for the MLOps service
+Lab 2: AI Lifecycle & MLOps Integration
+
+This module provides a small pooled connection layer over DB-API drivers:
+- PostgreSQL (Neon) via psycopg2, for production
+- SQLite via the standard library, for local development and tests
+
+psycopg2 is imported lazily so the service (and its tests) still run on
+machines where it is not installed, as long as DATABASE_URL does not
+point at PostgreSQL.
+"""
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Columns written for every tracked event (see lib/migrations/create-ai-metrics-table.sql)
+METRICS_COLUMNS = [
+    'business_id', 'conversation_id', 'session_id',
+    'response_time_ms', 'success_rate',
+    'tokens_used', 'prompt_tokens', 'completion_tokens', 'api_cost_usd', 'model_name',
+    'intent_detected', 'appointment_requested', 'human_handoff_requested', 'appointment_booked',
+    'user_message_length', 'ai_response_length', 'response_type'
+]
+
+# Defaults applied to optional fields so rows satisfy the NOT NULL constraints
+METRICS_DEFAULTS = {
+    'session_id': 'unknown',
+    'success_rate': 1.0,
+    'api_cost_usd': 0.0,
+    'model_name': 'gemini-1.5-flash',
+    'intent_detected': 'unknown',
+    'appointment_requested': False,
+    'human_handoff_requested': False,
+    'appointment_booked': False,
+    'user_message_length': 0,
+    'ai_response_length': 0,
+    'response_type': 'unknown'
+}
+
+POSTGRES_METRICS_TABLE = """
+CREATE TABLE IF NOT EXISTS ai_metrics (
+    id SERIAL PRIMARY KEY,
+    business_id VARCHAR(255) NOT NULL,
+    conversation_id VARCHAR(255),
+    session_id VARCHAR(255) NOT NULL,
+    response_time_ms INTEGER NOT NULL,
+    success_rate DECIMAL(5,4) NOT NULL,
+    tokens_used INTEGER NOT NULL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    api_cost_usd DECIMAL(10,6) NOT NULL,
+    model_name VARCHAR(100) NOT NULL,
+    intent_detected VARCHAR(50) NOT NULL,
+    appointment_requested BOOLEAN DEFAULT FALSE,
+    human_handoff_requested BOOLEAN DEFAULT FALSE,
+    appointment_booked BOOLEAN DEFAULT FALSE,
+    user_message_length INTEGER NOT NULL,
+    ai_response_length INTEGER NOT NULL,
+    response_type VARCHAR(50) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+SQLITE_METRICS_TABLE = """
+CREATE TABLE IF NOT EXISTS ai_metrics (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    business_id TEXT NOT NULL,
+    conversation_id TEXT,
+    session_id TEXT NOT NULL,
+    response_time_ms INTEGER NOT NULL,
+    success_rate REAL NOT NULL,
+    tokens_used INTEGER NOT NULL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    api_cost_usd REAL NOT NULL,
+    model_name TEXT NOT NULL,
+    intent_detected TEXT NOT NULL,
+    appointment_requested BOOLEAN DEFAULT 0,
+    human_handoff_requested BOOLEAN DEFAULT 0,
+    appointment_booked BOOLEAN DEFAULT 0,
+    user_message_length INTEGER NOT NULL,
+    ai_response_length INTEGER NOT NULL,
+    response_type TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+# Columns of ai_conversations, one row per finished conversation (see sessions.py)
+CONVERSATIONS_COLUMNS = [
+    'business_id', 'conversation_id', 'session_id', 'started_at', 'ended_at',
+    'turns', 'tokens_used', 'api_cost_usd', 'response_time_ms_sum',
+    'appointment_requested', 'appointment_booked', 'human_handoff_requested',
+    'outcome', 'end_reason'
+]
+
+POSTGRES_CONVERSATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS ai_conversations (
+    id BIGSERIAL PRIMARY KEY,
+    business_id VARCHAR(255) NOT NULL,
+    conversation_id VARCHAR(255) NOT NULL,
+    session_id VARCHAR(255) NOT NULL,
+    started_at TIMESTAMP NOT NULL,
+    ended_at TIMESTAMP NOT NULL,
+    turns INTEGER NOT NULL,
+    tokens_used BIGINT NOT NULL,
+    api_cost_usd NUMERIC(14,8) NOT NULL,
+    response_time_ms_sum BIGINT NOT NULL,
+    appointment_requested BOOLEAN NOT NULL,
+    appointment_booked BOOLEAN NOT NULL,
+    human_handoff_requested BOOLEAN NOT NULL,
+    outcome VARCHAR(20) NOT NULL,
+    end_reason VARCHAR(20) NOT NULL
+)
+"""
+
+SQLITE_CONVERSATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS ai_conversations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    business_id TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    started_at TIMESTAMP NOT NULL,
+    ended_at TIMESTAMP NOT NULL,
+    turns INTEGER NOT NULL,
+    tokens_used INTEGER NOT NULL,
+    api_cost_usd REAL NOT NULL,
+    response_time_ms_sum INTEGER NOT NULL,
+    appointment_requested BOOLEAN NOT NULL,
+    appointment_booked BOOLEAN NOT NULL,
+    human_handoff_requested BOOLEAN NOT NULL,
+    outcome TEXT NOT NULL,
+    end_reason TEXT NOT NULL
+)
+"""
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of DB-API connections
+
+    Connections are created on demand up to max_size and reused afterwards,
+    so request threads and background workers share a bounded number of
+    database sessions.
+    """
+
+    def __init__(self, connect: Callable[[], Any], max_size: int = 5):
+        self._connect = connect
+        self._max_size = max_size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: Optional[float] = None):
+        """Take an idle connection, opening a new one if the pool has room"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self._max_size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+
+        return self._idle.get(timeout=timeout)
+
+    def release(self, conn, discard: bool = False):
+        """Return a connection to the pool, or close it if it is broken"""
+        if discard:
+            with self._lock:
+                self._created -= 1
+            try:
+                conn.close()
+            except Exception:
+                pass
+            return
+        self._idle.put(conn)
+
+    def close(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
+            conn.close()
+
+
+class Database:
+    """
+    Pooled database handle for one DATABASE_URL
+
+    Queries are written with %s placeholders and translated for drivers that
+    use a different paramstyle.
+    """
+
+    def __init__(self, url: str, pool_size: int = 5):
+        parsed = urlparse(url)
+        self.url = url
+
+        if parsed.scheme in ('postgres', 'postgresql'):
+            self.dialect = 'postgresql'
+            self._placeholder = '%s'
+            connect = self._postgres_connector(url)
+        elif parsed.scheme == 'sqlite':
+            self.dialect = 'sqlite'
+            self._placeholder = '?'
+            # sqlite:///relative.db and sqlite:////absolute/path.db
+            path = url[len('sqlite:///'):] or ':memory:'
+            connect = lambda: sqlite3.connect(path, check_same_thread=False)
+        else:
+            raise ValueError(f"Unsupported database URL scheme: {parsed.scheme}")
+
+        self.pool = ConnectionPool(connect, max_size=pool_size)
+
+    @staticmethod
+    def _postgres_connector(url: str) -> Callable[[], Any]:
+        try:
+            import psycopg2
+        except ImportError as e:
+            raise RuntimeError(
+                "psycopg2 is required for PostgreSQL DATABASE_URLs (pip install psycopg2-binary)"
+            ) from e
+        return lambda: psycopg2.connect(url)
+
+    def sql(self, query: str) -> str:
+        """Translate %s placeholders to the driver's paramstyle"""
+        if self._placeholder == '%s':
+            return query
+        return query.replace('%s', self._placeholder)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a pooled connection for the duration of a with-block
+
+        Commits on success and rolls back on error. That includes
+        GeneratorExit, raised when a stream() generator is abandoned
+        part-way: its server-side cursor's transaction must not stay open
+        on a pooled connection.
+        """
+        conn = self.pool.acquire()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            self.pool.release(conn, discard=broken)
+
+    def execute(self, query: str, params: Sequence[Any] = ()) -> List[tuple]:
+        """Run a single statement and return any result rows"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(self.sql(query), tuple(params))
+                return cursor.fetchall() if cursor.description else []
+            finally:
+                cursor.close()
+
+    def stream(self, query: str, params: Sequence[Any] = (),
+               chunk_size: int = 1000) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Run a query and yield its rows in fixed-size chunks
+
+        PostgreSQL uses a named (server-side) cursor, so only one chunk is
+        held in memory at a time regardless of the result size.
+
+        Args:
+            query: SQL query string (%s placeholders)
+            params: Query parameters
+            chunk_size: Rows per yielded chunk
+
+        Yields:
+            Lists of rows as column-name -> value dictionaries
+        """
+        with self.connection() as conn:
+            if self.dialect == 'postgresql':
+                cursor = conn.cursor(name=f'mlops_stream_{threading.get_ident()}')
+                cursor.itersize = chunk_size
+            else:
+                cursor = conn.cursor()
+            try:
+                cursor.execute(self.sql(query), tuple(params))
+                columns = None
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    if columns is None:
+                        columns = [column[0] for column in cursor.description]
+                    yield [dict(zip(columns, row)) for row in rows]
+            finally:
+                cursor.close()
+
+    def hour_bucket(self, column: str) -> str:
+        """SQL expression truncating a timestamp column to the hour"""
+        if self.dialect == 'postgresql':
+            return f"date_trunc('hour', {column})"
+        return f"strftime('%Y-%m-%d %H:00:00', {column})"
+
+    def minute_bucket(self, column: str) -> str:
+        """SQL expression truncating a timestamp column to the minute"""
+        if self.dialect == 'postgresql':
+            return f"date_trunc('minute', {column})"
+        return f"strftime('%Y-%m-%d %H:%M:00', {column})"
+
+    def create_metrics_table(self):
+        """Create the ai_metrics table if it does not exist yet"""
+        ddl = POSTGRES_METRICS_TABLE if self.dialect == 'postgresql' else SQLITE_METRICS_TABLE
+        self.execute(ddl)
+
+    def insert_metrics(self, events: Iterable[Dict[str, Any]]) -> int:
+        """
+        Insert many events using multi-row INSERT statements
+
+        All statements run in one transaction. Rows are split across
+        statements only to stay under the driver's bind-parameter limit.
+        Events that carry a created_at (replayed from the spool) keep it;
+        the others get the column default.
+
+        Args:
+            events: Metrics events as received by /track
+
+        Returns:
+            Number of rows written
+        """
+        groups: Dict[bool, List[tuple]] = {False: [], True: []}
+        for event in events:
+            created_at = event.get('created_at')
+            if created_at is None:
+                groups[False].append(metrics_row(event))
+            else:
+                groups[True].append(metrics_row(event) + (created_at,))
+
+        written = 0
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                for stamped, rows in groups.items():
+                    if rows:
+                        columns = METRICS_COLUMNS + ['created_at'] if stamped else METRICS_COLUMNS
+                        self._insert_rows(cursor, columns, rows)
+                        written += len(rows)
+            finally:
+                cursor.close()
+        return written
+
+    def create_conversations_table(self):
+        """Create the ai_conversations table if it does not exist yet"""
+        ddl = POSTGRES_CONVERSATIONS_TABLE if self.dialect == 'postgresql' else SQLITE_CONVERSATIONS_TABLE
+        self.execute(ddl)
+
+    def insert_conversations(self, sessions: Iterable[Dict[str, Any]]) -> int:
+        """
+        Insert finished conversations in one transaction
+
+        Args:
+            sessions: ai_conversations rows as built by sessions.ConversationSession
+
+        Returns:
+            Number of rows written
+        """
+        rows = [tuple(session[column] for column in CONVERSATIONS_COLUMNS) for session in sessions]
+        if not rows:
+            return 0
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                self._insert_rows(cursor, CONVERSATIONS_COLUMNS, rows, table='ai_conversations')
+            finally:
+                cursor.close()
+        return len(rows)
+
+    def _insert_rows(self, cursor, columns: List[str], rows: List[tuple], table: str = 'ai_metrics'):
+        # SQLite builds before 3.32 cap a statement at 999 bound parameters
+        max_params = 999 if self.dialect == 'sqlite' else 30000
+        rows_per_statement = max(1, max_params // len(columns))
+        row_placeholders = '(' + ', '.join([self._placeholder] * len(columns)) + ')'
+        insert_prefix = f"INSERT INTO {table} ({', '.join(columns)}) VALUES "
+
+        for start in range(0, len(rows), rows_per_statement):
+            chunk = rows[start:start + rows_per_statement]
+            query = insert_prefix + ', '.join([row_placeholders] * len(chunk))
+            cursor.execute(query, [value for row in chunk for value in row])
+
+    def close(self):
+        self.pool.close()
+
+
+def metrics_row(metrics_data: Dict[str, Any]) -> tuple:
+    """Map a metrics event to an ai_metrics row, in METRICS_COLUMNS order"""
+    return tuple(
+        metrics_data.get(column, METRICS_DEFAULTS.get(column))
+        for column in METRICS_COLUMNS
+    )
+
+
+def is_data_error(error: BaseException) -> bool:
+    """
+    True if error was caused by the rows written, not by the database
+
+    DataError (a value that doesn't fit its column) and IntegrityError
+    (a violated constraint) fail the same way on every retry; anything else,
+    such as a dropped connection, may succeed later. Classes are matched by
+    their DB-API name so psycopg2 does not have to be imported.
+    """
+    return any(cls.__name__ in ('DataError', 'IntegrityError') for cls in type(error).__mro__)
+
+
+_database: Optional[Database] = None
+_database_configured = False
+_database_lock = threading.Lock()
+
+
+def get_database() -> Optional[Database]:
+    """
+    Return the shared Database for DATABASE_URL, creating it on first use
+
+    A DATABASE_URL that can't be used (unsupported scheme, or psycopg2
+    missing for PostgreSQL) is logged once and treated as unset, so callers
+    don't raise on every request.
+
+    Returns:
+        Database instance, or None if DATABASE_URL is not set or unusable
+    """
+    global _database, _database_configured
+    if not _database_configured:
+        with _database_lock:
+            if not _database_configured:
+                url = os.getenv('DATABASE_URL')
+                try:
+                    _database = Database(url, pool_size=int(os.getenv('DB_POOL_SIZE', '5'))) if url else None
+                except (RuntimeError, ValueError) as e:
+                    logger.error("Database access disabled: %s", e)
+                    _database = None
+                _database_configured = True
+    return _database
+
+
+def configure_database(url: Optional[str]) -> Optional[Database]:
+    """
+    Replace the shared Database (used by tests and tooling)
+
+    Args:
+        url: Database URL, or None to disable database access
+    """
+    global _database, _database_configured
+    with _database_lock:
+        if _database is not None:
+            _database.close()
+        _database = Database(url) if url else None
+        _database_configured = True
+    return _database
@@ -0,0 +1,163 @@
+"""
+Idempotency index for the ingestion endpoints
+Lab 2: AI Lifecycle & MLOps Integration
+
+trackMetrics in lib/mlops-tracking.ts gives up on /track after 5 seconds.
+If the service was only slow, a retry of the same turn would otherwise be
+counted twice in ai_requests_total, ai_tokens_used and ai_api_cost.
+
+Each event gets an idempotency key, taken from the first of these that is
+present:
+- the Idempotency-Key request header
+- the event_id field
+- conversation_id + session_id + timestamp
+Events with no key are always applied.
+
+DedupIndex remembers keys it has seen for `ttl` seconds, holding at most
+max_entries of them. Keys are stored as 16-byte BLAKE2b digests, so an
+entry has a fixed size no matter how long the client's key is. The index
+is an OrderedDict kept in expiry order: a lookup refreshes its key and
+moves it to the end. Checking a key, expiring old ones and evicting at the
+cap are therefore all O(1).
+
+The index lives in one process. With several gunicorn workers, a retry
+that lands on a different worker is not caught.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from prometheus_client import REGISTRY, Counter, Gauge
+
+
+def idempotency_key(event: Any, header: Optional[str] = None) -> Optional[str]:
+    """
+    Pick the idempotency key for one event
+
+    Args:
+        event: MetricEvent (or dict) as parsed from the request
+        header: Idempotency-Key header value, if any (single-event requests)
+
+    Returns:
+        The key, or None if the event can't be identified
+    """
+    if header:
+        return f'header:{header}'
+    event_id = event.get('event_id')
+    if event_id:
+        return f'event:{event_id}'
+    conversation_id = event.get('conversation_id')
+    timestamp = event.get('timestamp')
+    if conversation_id and timestamp:
+        return f"turn:{conversation_id}:{event.get('session_id') or ''}:{timestamp}"
+    return None
+
+
+class DedupIndex:
+    """
+    Bounded set of recently seen idempotency keys
+
+    Args:
+        max_entries: Keys remembered before the oldest is evicted
+        ttl: Seconds a key is remembered after it was last seen
+        registry: Prometheus registry for the index's own metrics
+    """
+
+    def __init__(self, max_entries: int = 100000, ttl: float = 600.0, registry=REGISTRY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._keys: 'OrderedDict[bytes, float]' = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.duplicates = Counter(
+            'metrics_dedup_duplicates_total',
+            'Events acknowledged without being applied because their key was seen before',
+            registry=registry
+        )
+        self.evictions = Counter(
+            'metrics_dedup_evictions_total',
+            'Keys evicted before their TTL because the index was full',
+            registry=registry
+        )
+        self.entries = Gauge(
+            'metrics_dedup_entries',
+            'Idempotency keys currently remembered',
+            registry=registry,
+            multiprocess_mode='livesum'
+        )
+
+    @staticmethod
+    def _digest(key: str) -> bytes:
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+    def seen(self, key: Optional[str]) -> bool:
+        """
+        Report whether a key was recorded, without recording a new one
+
+        Lets a duplicate be acknowledged before anything else (admission,
+        storage) is tried for it. A hit counts as a duplicate and refreshes
+        the key like check_and_add.
+        """
+        if key is None:
+            return False
+        digest = self._digest(key)
+        now = time.monotonic()
+        with self._lock:
+            duplicate = self._keys.get(digest, 0.0) > now
+            if duplicate:
+                self._keys[digest] = now + self.ttl
+                self._keys.move_to_end(digest)
+        if duplicate:
+            self.duplicates.inc()
+        return duplicate
+
+    def check_and_add(self, key: Optional[str]) -> bool:
+        """
+        Record a key and report whether it is new
+
+        Returns:
+            True if the event should be applied, False for a duplicate
+        """
+        if key is None:
+            return True
+        digest = self._digest(key)
+        now = time.monotonic()
+        with self._lock:
+            # Entries are in expiry order, so expired ones are at the front
+            while self._keys:
+                oldest, expires = next(iter(self._keys.items()))
+                if expires > now:
+                    break
+                del self._keys[oldest]
+
+            duplicate = digest in self._keys
+            self._keys[digest] = now + self.ttl
+            self._keys.move_to_end(digest)
+
+            evicted = 0
+            while len(self._keys) > self.max_entries:
+                self._keys.popitem(last=False)
+                evicted += 1
+            size = len(self._keys)
+
+        if evicted:
+            self.evictions.inc(evicted)
+        self.entries.set(size)
+        if duplicate:
+            self.duplicates.inc()
+        return not duplicate
+
+    def discard(self, key: Optional[str]):
+        """Forget a key, e.g. when applying its event failed and a retry must go through"""
+        if key is None:
+            return
+        with self._lock:
+            self._keys.pop(self._digest(key), None)
+            size = len(self._keys)
+        self.entries.set(size)
+
+    def __len__(self) -> int:
+        return len(self._keys)
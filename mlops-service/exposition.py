@@ -0,0 +1,144 @@
+"""
+Cached Prometheus exposition for the /metrics endpoint
+Lab 2: AI Lifecycle & MLOps Integration
+
+Rendering the registry walks every label child, which makes /metrics the
+most expensive request this service serves once there are thousands of
+series - and it is polled by Prometheus and by every open dashboard tab.
+
+ExpositionCache renders each format once and hands the same buffer to all
+scrapers until it goes stale:
+- within ttl seconds of rendering, the buffer is always reused
+- after that, it is reused while no metric has changed (mark_dirty() was
+  not called), up to max_age seconds so callback gauges stay current
+
+Only one thread renders at a time; concurrent scrapers wait for that
+render and share its result. Gzipped bodies are cached alongside.
+"""
+
+import gzip
+import threading
+import time
+from typing import Dict, Tuple
+
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.openmetrics.exposition import (
+    CONTENT_TYPE_LATEST as OPENMETRICS_CONTENT_TYPE,
+    generate_latest as generate_openmetrics,
+)
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """
+    Whether an Accept-Encoding header allows a gzip response
+
+    Honours q-values: "gzip;q=0" refuses gzip, and "*" covers gzip unless
+    gzip is listed on its own.
+    """
+    gzip_quality = wildcard_quality = None
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding in ('gzip', 'x-gzip'):
+            gzip_quality = quality
+        elif coding == '*':
+            wildcard_quality = quality
+
+    if gzip_quality is not None:
+        return gzip_quality > 0
+    return wildcard_quality is not None and wildcard_quality > 0
+
+
+class _Rendered:
+    __slots__ = ('body', 'generation', 'rendered_at', '_gzipped')
+
+    def __init__(self, body: bytes, generation: int, rendered_at: float):
+        self.body = body
+        self.generation = generation
+        self.rendered_at = rendered_at
+        self._gzipped = None
+
+    def gzipped(self) -> bytes:
+        # Compressed lazily, once per render; concurrent callers may race
+        # to fill it but always produce the same bytes
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=6)
+        return self._gzipped
+
+
+class ExpositionCache:
+    """
+    Shared, lazily refreshed rendering of a Prometheus registry
+
+    Args:
+        registry: Registry to render
+        ttl: Seconds a rendering is reused even if metrics changed
+        max_age: Seconds after which a rendering is refreshed regardless
+    """
+
+    def __init__(self, registry=REGISTRY, ttl: float = 1.0, max_age: float = 15.0):
+        self.registry = registry
+        self.ttl = ttl
+        self.max_age = max(max_age, ttl)
+        self._generation = 0
+        self._rendered: Dict[bool, _Rendered] = {}
+        self._render_lock = threading.Lock()
+
+    def mark_dirty(self):
+        """Record that a metric changed (cheap enough for every update)"""
+        self._generation += 1
+
+    def _fresh(self, rendered: _Rendered, now: float) -> bool:
+        age = now - rendered.rendered_at
+        if age < self.ttl:
+            return True
+        return rendered.generation == self._generation and age < self.max_age
+
+    def render(self, openmetrics: bool = False) -> _Rendered:
+        """Return the cached rendering for a format, re-rendering if stale"""
+        rendered = self._rendered.get(openmetrics)
+        if rendered is not None and self._fresh(rendered, time.monotonic()):
+            return rendered
+
+        with self._render_lock:
+            # Another scraper may have rendered while we waited
+            rendered = self._rendered.get(openmetrics)
+            if rendered is not None and self._fresh(rendered, time.monotonic()):
+                return rendered
+
+            generation = self._generation
+            generate = generate_openmetrics if openmetrics else generate_latest
+            rendered = _Rendered(generate(self.registry), generation, time.monotonic())
+            self._rendered[openmetrics] = rendered
+            return rendered
+
+    def response(self, accept: str = '', accept_encoding: str = '') -> Tuple[bytes, Dict[str, str]]:
+        """
+        Build a /metrics response body and headers from request headers
+
+        Args:
+            accept: Request Accept header
+            accept_encoding: Request Accept-Encoding header
+
+        Returns:
+            (body, headers)
+        """
+        openmetrics = 'application/openmetrics-text' in accept
+        rendered = self.render(openmetrics)
+
+        headers = {
+            'Content-Type': OPENMETRICS_CONTENT_TYPE if openmetrics else CONTENT_TYPE_LATEST,
+            'Vary': 'Accept, Accept-Encoding'
+        }
+        if accepts_gzip(accept_encoding):
+            headers['Content-Encoding'] = 'gzip'
+            return rendered.gzipped(), headers
+        return rendered.body, headers
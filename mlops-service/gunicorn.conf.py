@@ -0,0 +1,113 @@
+"""
+Gunicorn configuration for the MLOps service
+Lab 2: AI Lifecycle & MLOps Integration
+
+Production entry point:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+`python app.py` runs Flask's single-process development server. Under
+gunicorn, WEB_CONCURRENCY worker processes share the port (default: 1).
+
+Each worker has its own prometheus_client values. To keep scrapes
+consistent, workers write them to mmap files in PROMETHEUS_MULTIPROC_DIR,
+and /metrics on any worker sums the files of every worker (see
+build_scrape_registry in app.py).
+
+The app is preloaded in the master process. This means the startup
+database rebuild runs once, so its totals are counted once: workers are
+only forked once it has finished (see when_ready).
+
+Only the Prometheus counters, histograms and gauges are shared through
+those files. Everything else the service keeps is per worker process:
+- analytics rollups (/analytics) and rate windows
+- latency sketches, the live stream totals and conversation sessions
+- the idempotency index and admission token buckets
+With more than one worker, /analytics answers from one worker's share of
+the events, a retry that lands on another worker is counted again,
+admission limits apply per worker, and the sketch and rate window
+collectors are left out of /metrics. Keep WEB_CONCURRENCY at 1 until that
+state is shared, and scale with more pods instead.
+
+/stream connections last as long as the dashboard stays open. With one
+worker they are served from STREAM_PORT (default: the service port + 1), a
+listener with a thread per connection, so they never take one of the
+`threads` request threads. Otherwise, at most half of a worker's request
+threads serve streams (STREAM_POOL_SUBSCRIBERS, never all of them).
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+
+# Must be set before prometheus_client is imported by the app
+multiproc_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join(tempfile.gettempdir(), 'mlops-prometheus')
+)
+
+# Values left by a previous run would be added to this run's counters
+shutil.rmtree(multiproc_dir, ignore_errors=True)
+os.makedirs(multiproc_dir, exist_ok=True)
+
+bind = f"0.0.0.0:{os.getenv('SERVICE_PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+if workers > 1:
+    logging.getLogger('gunicorn.error').warning(
+        "WEB_CONCURRENCY=%d: analytics, deduplication, admission limits, latency sketches, "
+        "rate windows and conversation sessions are kept per worker (see gunicorn.conf.py)", workers
+    )
+
+# Threaded workers: request handlers share the write-behind flusher and
+# refresh timers with background threads
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+# The service caps /stream connections on the request pool below this
+os.environ['GUNICORN_THREADS'] = str(threads)
+
+# Each open dashboard holds its /stream connection. With one worker, serve
+# the streams from a listener of their own so they never take request
+# threads; /stream on the main port redirects there
+if workers == 1:
+    os.environ.setdefault('STREAM_PORT', str(int(os.getenv('SERVICE_PORT', '5000')) + 1))
+
+preload_app = True
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+# Per-request access lines are written synchronously; off unless requested
+accesslog = os.getenv('GUNICORN_ACCESS_LOG')
+
+
+def when_ready(server):
+    # Workers are forked after this, so the startup work running in the
+    # background must be finished first; workers then open their own
+    # connections and start their own background threads
+    import app
+    service = app.get_service()
+    service.wait_until_ready()
+    service.release_process_resources()
+    # Snapshot periodically from here too, so a killed master doesn't lose
+    # everything since startup
+    service.start_master_snapshots()
+
+
+def post_fork(server, worker):
+    import app
+    app.get_service().start_after_fork()
+
+
+def child_exit(server, worker):
+    # Drop the exited worker's live gauge values from the aggregate
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    # Every worker has stopped, so their values files hold the final totals
+    # and their write-behind queues have been flushed to ai_metrics. Stop the
+    # periodic snapshots and write the final one
+    import app
+    service = app.get_service()
+    if service.snapshotter is not None:
+        service.snapshotter.stop()
+    service.write_snapshot()
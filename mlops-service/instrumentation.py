@@ -0,0 +1,177 @@
+"""
+Self-instrumentation for the Flask service
+Lab 2: AI Lifecycle & MLOps Integration
+
+The ai_* metrics describe the AI system the service reports on. This
+module measures the service itself, under a separate namespace so the two
+never mix on a dashboard:
+- request latency, request and response body size, per route/method/status
+- requests in flight
+- errors (5xx responses and unhandled exceptions) per route
+- time spent in named stages inside a request, e.g.
+  update_prometheus_metrics and store_metrics_in_db
+
+Routes are labelled by their URL rule (/analytics/<business_id>), not the
+raw path, so label cardinality is bounded by the number of routes. The
+hooks cache label children and only call time.perf_counter(), to keep the
+cost per request low.
+"""
+
+import functools
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from flask import Flask, g, request
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+
+# Namespace for every self-metric; keeps them apart from the ai_* metrics
+NAMESPACE = 'mlops_service'
+
+# Route label for requests that matched no URL rule (404s, bad methods)
+UNMATCHED_ROUTE = '<unmatched>'
+
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+STAGE_BUCKETS = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5]
+SIZE_BUCKETS = [64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+
+
+class RequestInstrumentation:
+    """
+    before/after/teardown request hooks that record the service's own metrics
+
+    Args:
+        app: Flask app to instrument (or call init_app later)
+        registry: Prometheus registry for the metrics
+        namespace: Prefix for every metric name
+    """
+
+    def __init__(self, app: Optional[Flask] = None, registry=REGISTRY, namespace: str = NAMESPACE):
+        self.latency = Histogram(
+            'http_request_duration_seconds',
+            'Time from request start until the response is returned, by route',
+            ['route', 'method', 'status'],
+            namespace=namespace,
+            buckets=LATENCY_BUCKETS,
+            registry=registry
+        )
+        self.in_flight = Gauge(
+            'http_requests_in_flight',
+            'Requests currently being handled (open streams included)',
+            namespace=namespace,
+            registry=registry,
+            multiprocess_mode='livesum'
+        )
+        self.errors = Counter(
+            'http_request_errors_total',
+            'Requests that ended in a 5xx response or an unhandled exception',
+            ['route', 'method', 'status'],
+            namespace=namespace,
+            registry=registry
+        )
+        self.request_size = Histogram(
+            'http_request_size_bytes',
+            'Request body size (from Content-Length)',
+            ['route', 'method'],
+            namespace=namespace,
+            buckets=SIZE_BUCKETS,
+            registry=registry
+        )
+        self.response_size = Histogram(
+            'http_response_size_bytes',
+            'Response body size (streamed responses are not counted)',
+            ['route', 'method'],
+            namespace=namespace,
+            buckets=SIZE_BUCKETS,
+            registry=registry
+        )
+        self.stage_latency = Histogram(
+            'stage_duration_seconds',
+            'Time spent in named stages of request handling',
+            ['stage'],
+            namespace=namespace,
+            buckets=STAGE_BUCKETS,
+            registry=registry
+        )
+
+        # labels() takes a lock and builds a tuple on every call; the label
+        # space here is small and fixed, so children are looked up once
+        self._latency_children: Dict[Tuple[str, str, str], object] = {}
+        self._size_children: Dict[Tuple[str, str], Tuple[object, object]] = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        """Register the request hooks on app"""
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def stage(self, name: str) -> Callable:
+        """
+        Decorator that records a function's run time as stage `name`
+
+        Exceptions are timed too, then re-raised.
+        """
+        child = self.stage_latency.labels(name)
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def _before_request(self):
+        g._instrumentation_started = time.perf_counter()
+        g._instrumentation_in_flight = True
+        self.in_flight.inc()
+
+    def _after_request(self, response):
+        started = g.pop('_instrumentation_started', None)
+        if started is None:
+            return response
+
+        route = request.url_rule.rule if request.url_rule is not None else UNMATCHED_ROUTE
+        method = request.method
+        self._record(route, method, response.status_code, time.perf_counter() - started)
+
+        request_child, response_child = self._sizes(route, method)
+        if request.content_length is not None:
+            request_child.observe(request.content_length)
+        if not response.is_streamed:
+            response_child.observe(response.calculate_content_length() or 0)
+        return response
+
+    def _teardown_request(self, error):
+        started = g.pop('_instrumentation_started', None)
+        if started is not None:
+            # after_request never ran: the exception escaped Flask's handlers
+            route = request.url_rule.rule if request.url_rule is not None else UNMATCHED_ROUTE
+            self._record(route, request.method, 500, time.perf_counter() - started)
+        # Teardown runs once the response (or stream) is finished, so
+        # open /stream connections stay counted while they last
+        if g.pop('_instrumentation_in_flight', False):
+            self.in_flight.dec()
+
+    def _record(self, route: str, method: str, status: int, elapsed: float):
+        key = (route, method, str(status))
+        child = self._latency_children.get(key)
+        if child is None:
+            child = self._latency_children.setdefault(key, self.latency.labels(*key))
+        child.observe(elapsed)
+        if status >= 500:
+            self.errors.labels(*key).inc()
+
+    def _sizes(self, route: str, method: str):
+        key = (route, method)
+        children = self._size_children.get(key)
+        if children is None:
+            children = self._size_children.setdefault(
+                key, (self.request_size.labels(*key), self.response_size.labels(*key))
+            )
+        return children
@@ -0,0 +1,407 @@
+"""
+Server-Sent Events stream of live metrics for the dashboard
+Lab 2: AI Lifecycle & MLOps Integration
+
+Before this stream, every open dashboard polled /health and /metrics and
+parsed the whole Prometheus exposition in the browser. LiveStream works
+the other way round. Ingestion folds events into a pending delta. Once
+per interval, a single broadcaster thread turns that delta into one
+encoded SSE message and hands the same bytes to every subscriber. The
+server's work therefore depends on the event rate, not on how many
+dashboards are open.
+
+Each subscriber has a bounded buffer. A client that falls max_buffer
+messages behind is disconnected instead of being allowed to hold memory,
+and its EventSource reconnects and starts again from a fresh snapshot.
+
+An SSE connection stays open for as long as the dashboard does. On a
+gthread gunicorn worker, that ties up one of its few request threads per
+dashboard. serve_stream therefore runs a small listener of its own, with
+one daemon thread per connection, so /track and /ready keep the whole
+request pool (see STREAM_PORT in service.py).
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from prometheus_client import REGISTRY, Counter, Gauge
+
+from sketches import DDSketch
+
+logger = logging.getLogger(__name__)
+
+# Counters carried in every snapshot and delta
+COUNTERS = ('requests', 'tokens_used', 'api_cost_usd',
+            'appointments_requested', 'appointments_booked', 'human_handoffs')
+
+# Sent when a subscriber has been idle for a heartbeat interval, so dead
+# connections are noticed (SSE comment lines are ignored by EventSource)
+KEEPALIVE = b': keepalive\n\n'
+
+SSE_HEADERS = [
+    ('Content-Type', 'text/event-stream'),
+    ('Cache-Control', 'no-cache'),
+    # Stop reverse proxies from buffering the stream
+    ('X-Accel-Buffering', 'no')
+]
+
+
+def format_sse(event: str, data: Dict[str, Any], event_id: Optional[int] = None) -> bytes:
+    """Encode one SSE message"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+class Subscription:
+    """
+    One connected client and its bounded message buffer
+
+    Args:
+        max_buffer: Messages buffered before the client counts as too slow
+    """
+
+    def __init__(self, max_buffer: int = 64):
+        self.max_buffer = max_buffer
+        self.closed = False
+        self.reason: Optional[str] = None
+        self._buffer: deque = deque()
+        self._cond = threading.Condition()
+
+    def offer(self, message: bytes) -> bool:
+        """
+        Queue a message without blocking
+
+        Returns:
+            False if the subscription is closed or was just closed for
+            falling behind
+        """
+        with self._cond:
+            if self.closed:
+                return False
+            if len(self._buffer) >= self.max_buffer:
+                self._close('slow_consumer')
+                return False
+            self._buffer.append(message)
+            self._cond.notify()
+            return True
+
+    def close(self, reason: str = 'closed'):
+        with self._cond:
+            if not self.closed:
+                self._close(reason)
+
+    def _close(self, reason: str):
+        self.closed = True
+        self.reason = reason
+        # Undelivered messages of a closed client are no longer needed
+        self._buffer.clear()
+        self._cond.notify()
+
+    def messages(self, heartbeat: float = 15.0) -> Iterator[bytes]:
+        """Yield buffered messages (or keepalives) until the subscription closes"""
+        while True:
+            with self._cond:
+                if not self._buffer and not self.closed:
+                    self._cond.wait(heartbeat)
+                if self._buffer:
+                    message = self._buffer.popleft()
+                elif self.closed:
+                    return
+                else:
+                    message = KEEPALIVE
+            yield message
+
+
+class LiveStream:
+    """
+    Fan-out of metric deltas to SSE subscribers
+
+    Args:
+        interval: Seconds between broadcasts (changes are coalesced)
+        max_buffer: Per-subscriber buffer, in messages
+        max_subscribers: Concurrent subscribers accepted
+        latency_window: Seconds covered by the rolling latency summary
+        recent_events: Newest events included in each delta and snapshot
+        registry: Prometheus registry for the stream's own metrics
+    """
+
+    def __init__(self, interval: float = 1.0, max_buffer: int = 64,
+                 max_subscribers: int = 100, latency_window: int = 60,
+                 recent_events: int = 20, registry=REGISTRY):
+        self.interval = interval
+        self.max_buffer = max_buffer
+        self.max_subscribers = max_subscribers
+        self.latency_window = latency_window
+
+        self._totals = dict.fromkeys(COUNTERS, 0.0)
+        self._pending = dict.fromkeys(COUNTERS, 0.0)
+        self._pending_events = 0
+        self._recent: deque = deque(maxlen=recent_events)
+        self._new_recent: List[Dict[str, Any]] = []
+        # Per-second latency sketches (epoch second -> sketch), merged at broadcast time
+        self._latency: Dict[int, DDSketch] = {}
+        self._latency_summary: Dict[str, Any] = {'count': 0}
+        self._seq = 0
+        self._lock = threading.Lock()
+
+        self._subscribers: List[Subscription] = []
+        self._subscribers_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+        self.subscriber_count = Gauge(
+            'live_stream_subscribers',
+            'Clients connected to the /stream SSE endpoint',
+            registry=registry,
+            multiprocess_mode='livesum'
+        )
+        self.disconnects = Counter(
+            'live_stream_disconnects_total',
+            'SSE clients disconnected by the server',
+            ['reason'],
+            registry=registry
+        )
+
+    def seed(self, totals: Dict[str, float]):
+        """Start running totals from existing values (e.g. after the DB rebuild)"""
+        with self._lock:
+            for name in COUNTERS:
+                self._totals[name] = float(totals.get(name, 0))
+
+    def record(self, events: Iterable[Any]):
+        """
+        Fold tracked events into the pending delta (cheap, no I/O)
+
+        Args:
+            events: Validated MetricEvents
+        """
+        second = int(time.time())
+        with self._lock:
+            pending = self._pending
+            for event in events:
+                self._pending_events += 1
+                pending['requests'] += 1
+                pending['tokens_used'] += event.tokens_used or 0
+                pending['api_cost_usd'] += event.api_cost_usd or 0
+                if event.appointment_requested:
+                    pending['appointments_requested'] += 1
+                if event.appointment_booked:
+                    pending['appointments_booked'] += 1
+                if event.human_handoff_requested:
+                    pending['human_handoffs'] += 1
+
+                if event.response_time_ms is not None:
+                    sketch = self._latency.get(second)
+                    if sketch is None:
+                        # Once per second; without a subscriber nothing else
+                        # expires the old seconds
+                        self._expire_latency(second)
+                        sketch = self._latency[second] = DDSketch()
+                    sketch.add(event.response_time_ms)
+
+                self._new_recent.append({
+                    'business_id': event.business_id,
+                    'intent': event.intent_detected,
+                    'response_type': event.response_type,
+                    'response_time_ms': event.response_time_ms
+                })
+            # Only the newest events are ever sent
+            del self._new_recent[:-self._recent.maxlen]
+
+    def _expire_latency(self, now: float):
+        """Drop per-second sketches older than latency_window (caller holds _lock)"""
+        oldest = int(now) - self.latency_window
+        for second in [second for second in self._latency if second <= oldest]:
+            del self._latency[second]
+
+    def _summarise_latency(self, now: float) -> Dict[str, Any]:
+        self._expire_latency(now)
+        merged = DDSketch()
+        for sketch in self._latency.values():
+            merged.merge(sketch)
+        if not merged.count:
+            return {'count': 0}
+        return {
+            'count': int(merged.count),
+            'avg_ms': round(merged.sum / merged.count, 1),
+            'p50_ms': round(merged.quantile(0.5), 1),
+            'p95_ms': round(merged.quantile(0.95), 1),
+            'p99_ms': round(merged.quantile(0.99), 1)
+        }
+
+    def _build_delta(self) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            expired = any(second <= int(now) - self.latency_window for second in self._latency)
+            if not self._pending_events and not expired:
+                return None
+            counters = {name: value for name, value in self._pending.items() if value}
+            for name, value in counters.items():
+                self._totals[name] += value
+            self._pending = dict.fromkeys(COUNTERS, 0.0)
+            events, self._pending_events = self._pending_events, 0
+            recent, self._new_recent = self._new_recent, []
+            self._recent.extend(recent)
+            self._latency_summary = self._summarise_latency(now)
+            self._seq += 1
+            data = {
+                'seq': self._seq,
+                'timestamp': now,
+                'events': events,
+                'counters': counters,
+                'totals': dict(self._totals),
+                'latency': self._latency_summary,
+                'recent': recent
+            }
+            seq = self._seq
+        return format_sse('delta', data, seq)
+
+    def snapshot(self) -> bytes:
+        """Current totals, rolling latency and recent events, for new subscribers"""
+        with self._lock:
+            data = {
+                'seq': self._seq,
+                'timestamp': time.time(),
+                'totals': dict(self._totals),
+                'latency': self._latency_summary,
+                'recent': list(self._recent)
+            }
+            seq = self._seq
+        # Retry hint for EventSource after a server-side disconnect
+        return b'retry: 3000\n' + format_sse('snapshot', data, seq)
+
+    def broadcast(self) -> int:
+        """
+        Send pending changes to every subscriber as one shared message
+
+        Returns:
+            Number of subscribers the message was delivered to
+        """
+        message = self._build_delta()
+        if message is None:
+            return 0
+
+        delivered = 0
+        with self._subscribers_lock:
+            for subscription in list(self._subscribers):
+                if subscription.offer(message):
+                    delivered += 1
+                else:
+                    self._remove(subscription)
+        return delivered
+
+    def subscribe(self) -> Optional[Subscription]:
+        """
+        Register a client, starting it off with a snapshot
+
+        Returns:
+            The Subscription, or None if max_subscribers are connected
+        """
+        with self._subscribers_lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                self.disconnects.labels(reason='too_many_subscribers').inc()
+                return None
+            subscription = Subscription(self.max_buffer)
+            subscription.offer(self.snapshot())
+            self._subscribers.append(subscription)
+            self.subscriber_count.set(len(self._subscribers))
+        self.start()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Remove a client whose connection ended"""
+        subscription.close()
+        with self._subscribers_lock:
+            self._remove(subscription)
+
+    def _remove(self, subscription: Subscription):
+        if subscription in self._subscribers:
+            self._subscribers.remove(subscription)
+            self.subscriber_count.set(len(self._subscribers))
+            if subscription.reason == 'slow_consumer':
+                self.disconnects.labels(reason='slow_consumer').inc()
+
+    def start(self):
+        """Start the broadcaster thread (safe to call more than once)"""
+        with self._subscribers_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='live-stream', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop broadcasting and close every subscription"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._subscribers_lock:
+            for subscription in list(self._subscribers):
+                subscription.close()
+                self._remove(subscription)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.broadcast()
+            except Exception as e:
+                # Keep broadcasting; one bad delta must not end the stream
+                logger.error(f"Error broadcasting live metrics: {e}")
+
+
+class _StreamServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def stream_app(live_stream: LiveStream):
+    """WSGI app serving GET /stream from `live_stream`"""
+    def application(environ, start_response):
+        if environ.get('PATH_INFO') != '/stream':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not found\n']
+        subscription = live_stream.subscribe()
+        if subscription is None:
+            start_response('503 Service Unavailable', [('Content-Type', 'application/json')])
+            return [b'{"error": "Too many stream subscribers"}\n']
+
+        def generate():
+            try:
+                yield from subscription.messages()
+            finally:
+                live_stream.unsubscribe(subscription)
+
+        # The dashboard is redirected here from the service's own port
+        start_response('200 OK', SSE_HEADERS + [('Access-Control-Allow-Origin', '*')])
+        return generate()
+
+    return application
+
+
+def serve_stream(live_stream: LiveStream, port: int, host: str = '0.0.0.0') -> WSGIServer:
+    """
+    Serve /stream on its own port from a background thread
+
+    Each connection gets its own daemon thread, up to the stream's
+    max_subscribers. Call shutdown() on the returned server to stop it.
+    """
+    server = make_server(host, port, stream_app(live_stream),
+                         server_class=_StreamServer, handler_class=_QuietHandler)
+    threading.Thread(target=server.serve_forever, name='live-stream-server', daemon=True).start()
+    logger.info("Serving /stream on port %d", server.server_port)
+    return server
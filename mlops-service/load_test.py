@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+Load test and throughput benchmark for the MLOps service
+Lab 3: Testing AI Systems
+
+test-simple.py checks that the endpoints work; this script measures how
+fast they are. It drives /track, /track/batch, /metrics and
+/analytics/<business_id> with a matrix of:
+- concurrency (worker threads issuing requests back to back)
+- business_id cardinality (distinct tenants in the generated events)
+- payload shape (minimal required fields, every MetricsData field, batches)
+
+Each scenario reports throughput and p50/p95/p99 latency as JSON. With
+--thresholds, any scenario that breaks its limits fails the run with
+exit code 1, so CI catches capacity regressions. Absolute timings depend
+on the machine, so CI uses relative limits against --baseline, a report
+of the base commit measured on the same runner.
+
+Usage:
+    # In-process through Flask's test client (no server, no network)
+    python load_test.py --in-process --profile quick
+
+    # Against a running service
+    python load_test.py --url http://localhost:5001 --output results.json
+
+    # Fail on regressions against an earlier report
+    python load_test.py --in-process --thresholds load_test_thresholds.json \
+        --baseline baseline.json
+"""
+
+import argparse
+import fnmatch
+import json
+import math
+import os
+import platform
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Scenario matrices: endpoint -> payload shapes, plus the concurrency and
+# cardinality values every scenario is run with
+PROFILES = {
+    'quick': {
+        'requests': 200,
+        'concurrency': [1, 4],
+        'cardinality': [10],
+        'scenarios': [
+            ('track', 'minimal'), ('track', 'full'), ('track_batch', 'batch_100'),
+            ('metrics', 'scrape'), ('analytics', '24_hours')
+        ]
+    },
+    'full': {
+        'requests': 2000,
+        'concurrency': [1, 8, 32],
+        'cardinality': [10, 1000, 10000],
+        'scenarios': [
+            ('track', 'minimal'), ('track', 'full'),
+            ('track_batch', 'batch_100'), ('track_batch', 'batch_1000'),
+            ('metrics', 'scrape'), ('metrics', 'scrape_gzip'),
+            ('analytics', '24_hours'), ('analytics', '30_days')
+        ]
+    }
+}
+
+INTENTS = ['appointment', 'pricing', 'general', 'complaint']
+RESPONSE_TYPES = ['appointment_booking', 'information', 'text', 'error']
+MODELS = ['gemini-1.5-flash', 'gemini-1.5-pro']
+
+
+def make_event(rng: random.Random, cardinality: int, shape: str) -> Dict[str, Any]:
+    """Generate one metrics event with the given business_id cardinality"""
+    event = {
+        'business_id': f'load-business-{rng.randrange(cardinality)}',
+        'response_time_ms': int(rng.lognormvariate(6.5, 0.6)),
+        'tokens_used': rng.randint(50, 800)
+    }
+    if shape == 'minimal':
+        return event
+
+    prompt_tokens = rng.randint(20, event['tokens_used'])
+    event.update({
+        'conversation_id': f'conv-{rng.randrange(10 ** 6)}',
+        'session_id': f'session-{rng.randrange(10 ** 6)}',
+        'success_rate': 1.0 if rng.random() > 0.05 else 0.0,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': event['tokens_used'] - prompt_tokens,
+        'api_cost_usd': round(event['tokens_used'] * 0.000002, 6),
+        'model_name': rng.choice(MODELS),
+        'intent_detected': rng.choice(INTENTS),
+        'appointment_requested': rng.random() < 0.3,
+        'human_handoff_requested': rng.random() < 0.05,
+        'appointment_booked': rng.random() < 0.1,
+        'user_message_length': rng.randint(5, 400),
+        'ai_response_length': rng.randint(20, 1200),
+        'response_type': rng.choice(RESPONSE_TYPES)
+    })
+    return event
+
+
+class InProcessTarget:
+    """Sends requests through Flask's test client (one client per thread)"""
+
+    name = 'in-process'
+
+    def __init__(self):
+        # Keep the service quiet and self-contained while it is benchmarked
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+        os.environ.setdefault('PERSIST_METRICS', 'false')
+        from app import get_app, get_service
+        self.app = get_app()
+        # Measure steady-state ingestion, not the startup rebuild
+        get_service(self.app).wait_until_ready()
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        return client
+
+    def request(self, method: str, path: str, body: Optional[bytes] = None,
+                headers: Optional[Dict[str, str]] = None) -> int:
+        response = self._client().open(path, method=method, data=body, headers=headers)
+        response.close()
+        return response.status_code
+
+
+class HttpTarget:
+    """Sends requests to a running service (one keep-alive session per thread)"""
+
+    name = 'http'
+
+    def __init__(self, base_url: str, timeout: float = 10.0):
+        import requests
+        self._requests = requests
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        return session
+
+    def request(self, method: str, path: str, body: Optional[bytes] = None,
+                headers: Optional[Dict[str, str]] = None) -> int:
+        try:
+            response = self._session().request(method, self.base_url + path, data=body,
+                                               headers=headers, timeout=self.timeout)
+            return response.status_code
+        except self._requests.RequestException:
+            return 0
+
+
+def build_request(endpoint: str, shape: str, cardinality: int,
+                  rng: random.Random) -> Tuple[str, str, Optional[bytes], Dict[str, str], int]:
+    """
+    Build one request for a scenario
+
+    Returns:
+        (method, path, body, headers, events carried)
+    """
+    if endpoint == 'track':
+        body = json.dumps(make_event(rng, cardinality, shape)).encode()
+        return 'POST', '/track', body, {'Content-Type': 'application/json'}, 1
+
+    if endpoint == 'track_batch':
+        size = int(shape.split('_')[1])
+        body = json.dumps([make_event(rng, cardinality, 'full') for _ in range(size)]).encode()
+        return 'POST', '/track/batch', body, {'Content-Type': 'application/json'}, size
+
+    if endpoint == 'metrics':
+        headers = {'Accept-Encoding': 'gzip'} if shape == 'scrape_gzip' else {}
+        return 'GET', '/metrics', None, headers, 0
+
+    if endpoint == 'analytics':
+        business_id = f'load-business-{rng.randrange(cardinality)}'
+        return 'GET', f'/analytics/{business_id}?period={shape}', None, {}, 0
+
+    raise ValueError(f'Unknown endpoint: {endpoint}')
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(q * len(sorted_values))
+    return sorted_values[min(len(sorted_values), max(rank, 1)) - 1]
+
+
+def run_scenario(target, endpoint: str, shape: str, concurrency: int,
+                 cardinality: int, total_requests: int, seed: int = 42) -> Dict[str, Any]:
+    """
+    Issue total_requests requests from `concurrency` threads and measure them
+
+    Request bodies are generated before the clock starts, so only the
+    service's own work is timed.
+
+    Returns:
+        Result dict with throughput, latency percentiles and error counts
+    """
+    per_worker = max(1, total_requests // concurrency)
+    plans = []
+    for worker in range(concurrency):
+        rng = random.Random(seed + worker)
+        plans.append([build_request(endpoint, shape, cardinality, rng) for _ in range(per_worker)])
+
+    latencies: List[List[float]] = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    start_barrier = threading.Barrier(concurrency + 1)
+
+    def worker(index: int):
+        timings = latencies[index]
+        start_barrier.wait()
+        for method, path, body, headers, _ in plans[index]:
+            started = time.perf_counter()
+            status = target.request(method, path, body, headers)
+            timings.append((time.perf_counter() - started) * 1000)
+            if not 200 <= status < 300:
+                errors[index] += 1
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    all_latencies = sorted(value for timings in latencies for value in timings)
+    requests_sent = len(all_latencies)
+    events_sent = sum(plan[4] for worker_plans in plans for plan in worker_plans)
+    return {
+        'name': f'{endpoint}/{shape}/c{concurrency}/b{cardinality}',
+        'endpoint': endpoint,
+        'shape': shape,
+        'concurrency': concurrency,
+        'cardinality': cardinality,
+        'requests': requests_sent,
+        'errors': sum(errors),
+        'error_rate': round(sum(errors) / requests_sent, 4) if requests_sent else 0.0,
+        'duration_s': round(elapsed, 4),
+        'throughput_rps': round(requests_sent / elapsed, 1) if elapsed else 0.0,
+        'events_per_s': round(events_sent / elapsed, 1) if elapsed and events_sent else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(all_latencies, 0.50), 3),
+            'p95': round(percentile(all_latencies, 0.95), 3),
+            'p99': round(percentile(all_latencies, 0.99), 3),
+            'max': round(all_latencies[-1], 3) if all_latencies else 0.0
+        }
+    }
+
+
+def check_thresholds(results: List[Dict[str, Any]], thresholds: Dict[str, Dict[str, float]],
+                     baseline: Optional[List[Dict[str, Any]]] = None) -> List[str]:
+    """
+    Compare results against limits
+
+    thresholds maps a scenario name pattern (fnmatch, e.g. "track/*/c4/*")
+    to limits. Every matching pattern is applied.
+
+    Absolute limits: min_rps, min_events_per_s, max_p50_ms, max_p95_ms,
+    max_p99_ms and max_error_rate. Timing limits like these only hold on
+    known hardware.
+
+    Relative limits compare each scenario with the same scenario in
+    `baseline` (an earlier run's results, ideally of the base commit on the
+    same machine) and are skipped without one:
+    - max_rps_regression: allowed fractional drop in throughput
+      (0.5 passes down to half the baseline's req/s)
+    - max_p95_regression: allowed fractional rise in p95 latency
+      (1.0 passes up to twice the baseline's p95)
+
+    Returns:
+        Human-readable violations (empty if the run passes)
+    """
+    baseline_by_name = {entry['name']: entry for entry in baseline or []}
+    violations = []
+    for result in results:
+        before = baseline_by_name.get(result['name'])
+        for pattern, limits in thresholds.items():
+            if not fnmatch.fnmatch(result['name'], pattern):
+                continue
+            checks = [
+                ('min_rps', result['throughput_rps'], lambda value, limit: value >= limit),
+                ('min_events_per_s', result['events_per_s'], lambda value, limit: value >= limit),
+                ('max_p50_ms', result['latency_ms']['p50'], lambda value, limit: value <= limit),
+                ('max_p95_ms', result['latency_ms']['p95'], lambda value, limit: value <= limit),
+                ('max_p99_ms', result['latency_ms']['p99'], lambda value, limit: value <= limit),
+                ('max_error_rate', result['error_rate'], lambda value, limit: value <= limit)
+            ]
+            if before is not None:
+                checks += [
+                    ('max_rps_regression', result['throughput_rps'],
+                     lambda value, limit: value >= before['throughput_rps'] * (1 - limit)),
+                    ('max_p95_regression', result['latency_ms']['p95'],
+                     lambda value, limit: value <= before['latency_ms']['p95'] * (1 + limit))
+                ]
+            for key, value, passes in checks:
+                if key in limits and not passes(value, limits[key]):
+                    violations.append(f"{result['name']}: {key} {limits[key]} violated ({value})")
+    return violations
+
+
+def run_suite(target, profile: Dict[str, Any],
+              progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> List[Dict[str, Any]]:
+    """Run every scenario of a profile against a target"""
+    results = []
+    for endpoint, shape in profile['scenarios']:
+        for cardinality in profile['cardinality']:
+            # Populate the tenants so scrape and analytics runs have data to read
+            if endpoint in ('metrics', 'analytics'):
+                run_scenario(target, 'track', 'full', 1, cardinality, min(cardinality, 1000))
+            for concurrency in profile['concurrency']:
+                result = run_scenario(target, endpoint, shape, concurrency, cardinality,
+                                      profile['requests'])
+                results.append(result)
+                if progress:
+                    progress(result)
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the MLOps service endpoints')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--in-process', action='store_true',
+                      help="Use Flask's test client instead of HTTP (default when --url is absent)")
+    mode.add_argument('--url', help='Base URL of a running service, e.g. http://localhost:5001')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='quick')
+    parser.add_argument('--requests', type=int, help='Requests per scenario (overrides the profile)')
+    parser.add_argument('--concurrency', type=int, nargs='+', help='Concurrency levels (overrides the profile)')
+    parser.add_argument('--cardinality', type=int, nargs='+', help='business_id cardinalities (overrides the profile)')
+    parser.add_argument('--endpoint', action='append', help='Only run scenarios for these endpoints')
+    parser.add_argument('--thresholds', help='JSON file of regression thresholds')
+    parser.add_argument('--baseline', help='Earlier JSON report that relative thresholds compare against')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    profile = dict(PROFILES[args.profile])
+    if args.requests:
+        profile['requests'] = args.requests
+    if args.concurrency:
+        profile['concurrency'] = args.concurrency
+    if args.cardinality:
+        profile['cardinality'] = args.cardinality
+    if args.endpoint:
+        profile['scenarios'] = [s for s in profile['scenarios'] if s[0] in args.endpoint]
+
+    target = HttpTarget(args.url) if args.url else InProcessTarget()
+
+    def progress(result):
+        print(f"{result['name']:<40} {result['throughput_rps']:>9.1f} req/s  "
+              f"p50 {result['latency_ms']['p50']:>8.2f} ms  p99 {result['latency_ms']['p99']:>8.2f} ms  "
+              f"errors {result['errors']}", file=sys.stderr)
+
+    results = run_suite(target, profile, progress)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    violations = []
+    if args.thresholds:
+        with open(args.thresholds) as f:
+            violations = check_thresholds(results, json.load(f), baseline)
+
+    report = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'target': args.url or target.name,
+        'profile': args.profile,
+        'python': platform.python_version(),
+        'results': results,
+        'violations': violations,
+        'passed': not violations
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    for violation in violations:
+        print(f'❌ {violation}', file=sys.stderr)
+    return 1 if violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+prometheus_client internals used by counter rebuilds and snapshots
+Lab 2: AI Lifecycle & MLOps Integration
+
+prometheus_client has no public API for raising a counter to a known
+total, adding pre-aggregated histogram observations, listing a
+collector's children or looking a collector up by name. The database
+rebuild (service.py) and registry snapshots (snapshot.py) need all of
+these, so every access to a private attribute goes through this module.
+
+The helpers are written against TESTED_VERSION. test_metric_internals.py
+fails on any other installed version, so an upgrade gets checked before
+it ships.
+"""
+
+from typing import Any, List, Optional, Tuple
+
+from prometheus_client import Gauge
+
+# prometheus_client release these helpers were checked against (see requirements.txt)
+TESTED_VERSION = '0.19.0'
+
+
+def collector_for(registry, name: str) -> Optional[Any]:
+    """The collector registered under a metric or sample name, or None"""
+    return registry._names_to_collectors.get(name)
+
+
+def label_names(collector) -> Tuple[str, ...]:
+    return tuple(collector._labelnames)
+
+
+def is_live_gauge(collector) -> bool:
+    """True for gauges whose multiprocess value only covers live processes"""
+    return isinstance(collector, Gauge) and collector._multiprocess_mode.startswith('live')
+
+
+def children(collector) -> List[Tuple[tuple, Any]]:
+    """(label values, child) of every series of a labelled collector"""
+    with collector._lock:
+        return list(collector._metrics.items())
+
+
+def existing_child(collector, labelvalues: tuple) -> Optional[Any]:
+    """The child for labelvalues if it exists, without creating it"""
+    with collector._lock:
+        return collector._metrics.get(labelvalues)
+
+
+def is_multiprocess(child) -> bool:
+    """True if the child's values live in a gunicorn worker's mmap file"""
+    cell = child._value if hasattr(child, '_value') else child._sum
+    return cell._multiprocess
+
+
+def counter_cell(child):
+    """Value cell of a Counter child (get() and inc())"""
+    return child._value
+
+
+def bucket_cells(child) -> list:
+    """Per-bucket (not cumulative) count cells of a Histogram child, +Inf last"""
+    return child._buckets
+
+
+def sum_cell(child):
+    """Sum cell of a Histogram child"""
+    return child._sum
+
+
+def raise_to(cell, target: float) -> float:
+    """
+    Increment a counter or histogram cell up to `target`; never lowers it
+
+    Returns:
+        The amount added
+    """
+    current = cell.get()
+    if target > current:
+        cell.inc(target - current)
+        return target - current
+    return 0.0
+
+
+
+def add_child(target, source):
+    """Add a Counter or Histogram child's counts to another child of the same collector"""
+    if hasattr(source, '_buckets'):
+        for into, cell in zip(bucket_cells(target), bucket_cells(source)):
+            into.inc(cell.get())
+        sum_cell(target).inc(sum_cell(source).get())
+    else:
+        counter_cell(target).inc(counter_cell(source).get())
@@ -0,0 +1,314 @@
+"""
+Write-behind queue for persisting metrics events
+Lab 2: AI Lifecycle & MLOps Integration
+
+/track hands events to an in-process queue and returns immediately. A
+background flusher thread groups queued events into batches and writes
+each batch with one call to the sink (a multi-row INSERT), so request
+latency no longer depends on database latency.
+
+Batches are flushed when they reach batch_size events or when
+flush_interval seconds have passed since the first event of the batch,
+whichever comes first.
+
+With a spool (spool.py), nothing is dropped while the database is down
+or falling behind. Batches the sink rejects are appended to disk instead.
+Events that find the queue full wait in a bounded in-memory overflow, and
+the flusher thread then spills everything still queued, followed by the
+overflow, so the request thread never waits for disk. The flusher replays
+the spool before writing new batches, so rows still reach the database in
+arrival order. While the spool holds events, new batches go behind them.
+Replay isolates and quarantines events the database rejects as invalid
+(is_data_error), so they don't block the spool.
+
+put_many() queues all of its events or none of them, so a caller that
+retries a refused batch never stores part of it twice.
+"""
+
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+
+from spool import SegmentSpool
+
+logger = logging.getLogger(__name__)
+
+# Queued by stop() to wake the flusher without waiting out flush_interval
+_STOP = object()
+
+
+class MetricsWriteBehindQueue:
+    """
+    Bounded queue with a background thread that flushes events to a sink
+
+    Args:
+        sink: Callable that persists a list of events (raises on failure)
+        max_queue_size: Events held in memory before put() starts refusing
+        batch_size: Flush as soon as this many events are pending
+        flush_interval: Flush at most this many seconds after an event arrives
+        spool: Durable overflow for events the sink can't take right now
+        max_overflow: Events held for the flusher to spill once the queue is
+            full (with a spool; default: max_queue_size)
+        retry_interval: Seconds between replay attempts while the sink fails
+        is_data_error: Tells a batch the sink rejected for its data apart
+            from a transient failure (see SegmentSpool.replay)
+        registry: Prometheus registry for the queue's own metrics
+    """
+
+    def __init__(self,
+                 sink: Callable[[List[Dict[str, Any]]], Any],
+                 max_queue_size: int = 10000,
+                 batch_size: int = 500,
+                 flush_interval: float = 1.0,
+                 spool: Optional[SegmentSpool] = None,
+                 max_overflow: Optional[int] = None,
+                 retry_interval: float = 5.0,
+                 is_data_error: Optional[Callable[[Exception], bool]] = None,
+                 registry=REGISTRY):
+        self._sink = sink
+        self._is_data_error = is_data_error
+        self._spool = spool
+        self._max_overflow = max_queue_size if max_overflow is None else max_overflow
+        # Events that arrived after the queue filled up, newer than everything
+        # queued; guarded by _put_lock like every put
+        self._overflow: List[Any] = []
+        self._put_lock = threading.Lock()
+        self._retry_interval = retry_interval
+        self._retry_at = 0.0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        self.queue_depth = Gauge(
+            'metrics_write_queue_depth',
+            'Events waiting in the write-behind queue',
+            registry=registry,
+            multiprocess_mode='livesum'
+        )
+
+        self.flush_latency = Histogram(
+            'metrics_write_flush_seconds',
+            'Time taken to write one batch to the database',
+            buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0],
+            registry=registry
+        )
+
+        self.batch_size_observed = Histogram(
+            'metrics_write_batch_size',
+            'Number of events written per flush',
+            buckets=[1, 10, 50, 100, 250, 500, 1000, 5000],
+            registry=registry
+        )
+
+        self.events_dropped = Counter(
+            'metrics_write_dropped_total',
+            'Events dropped by the write-behind queue',
+            ['reason'],
+            registry=registry
+        )
+
+    def start(self):
+        """Start the background flusher (safe to call more than once)"""
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(
+                target=self._run,
+                name='metrics-write-behind',
+                daemon=True
+            )
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the flusher and write out anything still queued"""
+        self._stop_event.set()
+        if self._thread is not None:
+            try:
+                self._queue.put_nowait(_STOP)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+        if self._spool is not None:
+            # Whatever is still spooled is replayed by the next process
+            self._spool.close()
+
+    def put(self, metrics_data: Dict[str, Any]) -> bool:
+        """
+        Queue one event for persistence without blocking
+
+        Returns:
+            True if queued, False if the queue is full
+        """
+        return self.put_many([metrics_data])
+
+    def put_many(self, events: Iterable[Any]) -> bool:
+        """
+        Queue several events without blocking, all of them or none
+
+        Returns:
+            True if every event was queued, False if none were
+        """
+        events = list(events)
+        if not events:
+            return True
+        self.start()
+        with self._put_lock:
+            room = self._queue.maxsize - self._queue.qsize()
+            if not self._overflow and room >= len(events):
+                for metrics_data in events:
+                    self._queue.put_nowait(metrics_data)
+                queued = True
+            elif self._spool is not None and len(self._overflow) + len(events) <= self._max_overflow:
+                # Only the flusher touches the spool; it spills what is queued,
+                # then these, so they stay behind older events
+                self._overflow.extend(events)
+                queued = True
+            else:
+                queued = False
+        # Set explicitly rather than via set_function so the value is
+        # also exported when gunicorn workers aggregate their metrics
+        self.queue_depth.set(self.depth())
+        if not queued:
+            self.events_dropped.labels(reason='queue_full').inc(len(events))
+            logger.warning("Write-behind queue full, dropping %d metrics events", len(events))
+        return queued
+
+    def depth(self) -> int:
+        """Number of events currently waiting to be written"""
+        return self._queue.qsize() + len(self._overflow)
+
+    def flush(self) -> int:
+        """
+        Synchronously write everything currently queued
+
+        Returns:
+            Number of events handed to the sink
+        """
+        written = 0
+        if self._overflow:
+            self._spill_backlog()
+        while True:
+            batch = self._drain(self._batch_size)
+            if not batch:
+                return written
+            self._write(batch)
+            written += len(batch)
+
+    def _drain(self, limit: int) -> List[Dict[str, Any]]:
+        batch = []
+        while len(batch) < limit:
+            try:
+                metrics_data = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if metrics_data is not _STOP:
+                batch.append(metrics_data)
+        return batch
+
+    def replay_spool(self) -> int:
+        """
+        Write spooled events to the sink, unless a recent attempt failed
+
+        Returns:
+            Number of events replayed
+        """
+        if self._spool is None or time.monotonic() < self._retry_at or not self._spool.pending():
+            return 0
+        with self._flush_lock:
+            try:
+                return self._spool.replay(self._sink, self._batch_size, is_data_error=self._is_data_error)
+            except Exception as e:
+                self._retry_at = time.monotonic() + self._retry_interval
+                logger.warning("Spool replay failed, retrying in %.0fs: %s", self._retry_interval, e)
+                return 0
+
+    def _spill_backlog(self):
+        """Move everything queued, then the overflow, to the spool (flusher thread)"""
+        with self._put_lock:
+            backlog = self._drain(self._queue.maxsize)
+            backlog.extend(self._overflow)
+            self._overflow = []
+        self.queue_depth.set(self.depth())
+        with self._flush_lock:
+            if backlog and self._spill(backlog):
+                logger.warning("Write-behind queue full, spooled %d metrics events", len(backlog))
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            if self._overflow:
+                self._spill_backlog()
+            self.replay_spool()
+            try:
+                first = self._queue.get(timeout=self._flush_interval)
+            except queue.Empty:
+                continue
+            if first is _STOP:
+                break
+
+            batch = [first]
+            deadline = time.monotonic() + self._flush_interval
+            while len(batch) < self._batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    metrics_data = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if metrics_data is _STOP:
+                    break
+                batch.append(metrics_data)
+
+            self._write(batch)
+
+    def _write(self, batch: List[Dict[str, Any]]):
+        self.queue_depth.set(self._queue.qsize())
+        # One writer at a time keeps batches in arrival order
+        with self._flush_lock:
+            if self._spool is not None and self._spool.pending():
+                # Older events are still on disk; queue this batch behind them
+                self._spill(batch)
+                return
+            start = time.perf_counter()
+            try:
+                self._sink(batch)
+            except Exception as e:
+                if self._spool is not None and self._spill(batch):
+                    self._retry_at = time.monotonic() + self._retry_interval
+                    logger.warning("Database write failed, spooled %d metrics events: %s", len(batch), e)
+                    return
+                self.events_dropped.labels(reason='sink_error').inc(len(batch))
+                logger.error(f"Error writing {len(batch)} metrics events to database: {e}")
+                return
+            finally:
+                self.flush_latency.observe(time.perf_counter() - start)
+            self.batch_size_observed.observe(len(batch))
+
+    def _spill(self, events: List[Any]) -> bool:
+        # Stamp the arrival time so replayed rows keep it in created_at
+        created_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        stamped = []
+        for event in events:
+            data = event if isinstance(event, dict) else event.to_dict()
+            stamped.append(dict(data, created_at=data.get('created_at') or created_at))
+        try:
+            if self._spool.append(stamped):
+                return True
+            reason = 'spool_full'
+        except OSError as e:
+            logger.error("Error writing to the metrics spool: %s", e)
+            reason = 'spool_error'
+        self.events_dropped.labels(reason=reason).inc(len(events))
+        return False
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for Prometheus update and exposition cost
+Lab 3: Testing AI Systems
+
+load_test.py measures whole requests. This module isolates the two costs
+that grow with label cardinality:
+- update_prometheus_metrics() for one event when N label children exist
+- generate_latest() for the registry holding them
+It also measures memory per label child, using tracemalloc.
+
+Each cardinality level runs in a fresh interpreter that imports app, so
+the numbers come from the service's real collectors and guards and don't
+leak between levels. LABEL_MAX_SERIES is lifted for the run, so the
+cardinality cap does not fold series away. Use the results to size pods
+and to choose LABEL_MAX_SERIES.
+
+Usage:
+    python microbenchmarks.py                               # 10, 1k, 50k businesses
+    python microbenchmarks.py --businesses 10 1000 --output results.json
+    python microbenchmarks.py --save-baseline               # refresh the stored baseline
+    python microbenchmarks.py --compare microbenchmarks_baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(SERVICE_DIR, 'microbenchmarks_baseline.json')
+
+INTENTS = ['appointment', 'pricing', 'general', 'complaint']
+MODELS = ['gemini-1.5-flash', 'gemini-1.5-pro']
+
+# Metrics compared against the baseline; higher is worse for all of them
+COMPARED = ('update_p50_us', 'update_p99_us', 'render_ms', 'bytes_per_child')
+
+
+def make_event(business: int, intent: str, model: str, rng: random.Random) -> Dict[str, Any]:
+    return {
+        'business_id': f'bench-business-{business}',
+        'response_time_ms': rng.randint(100, 3000),
+        'tokens_used': rng.randint(50, 800),
+        'api_cost_usd': 0.001,
+        'success_rate': 1.0,
+        'model_name': model,
+        'intent_detected': intent,
+        'response_type': 'text',
+        'appointment_requested': True,
+        'appointment_booked': True,
+        'human_handoff_requested': True
+    }
+
+
+def count_children(service) -> int:
+    """Label children held by the service's labelled collectors"""
+    from metric_internals import children
+    collectors = list(service.db_counters.values()) + [service.ai_success_rate]
+    return sum(len(children(collector)) for collector in collectors)
+
+
+def run_level(businesses: int, updates: int = 5000, renders: int = 5) -> Dict[str, Any]:
+    """
+    Measure one cardinality level in this process (imports app)
+
+    Args:
+        businesses: Distinct business_ids; every business gets every intent
+            and model, so label children grow as businesses x intents x models
+        updates: Timed single-event updates against existing children
+        renders: Timed generate_latest() calls (median reported)
+    """
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, SERVICE_DIR)
+    from app import create_app, get_service
+    from prometheus_client import CollectorRegistry, generate_latest
+    from schema import parse_event
+
+    service = get_service(create_app({
+        'METRICS_REGISTRY': CollectorRegistry(),
+        'STARTUP_IN_BACKGROUND': False,
+        'LABEL_MAX_SERIES': 10 ** 9,
+        'PERSIST_METRICS': 'false'
+    }))
+
+    rng = random.Random(7)
+    parse = parse_event
+    update = service.update_prometheus_metrics
+    children_before = count_children(service)
+
+    # Populate every label combination while tracing allocations
+    tracemalloc.start()
+    baseline_memory = tracemalloc.get_traced_memory()[0]
+    for business in range(businesses):
+        for intent in INTENTS:
+            for model in MODELS:
+                update(parse(make_event(business, intent, model, rng)))
+    populated_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    children = count_children(service) - children_before
+
+    # Steady-state update cost: events for children that already exist
+    events = [parse(make_event(rng.randrange(businesses), rng.choice(INTENTS), rng.choice(MODELS), rng))
+              for _ in range(updates)]
+    timings = []
+    for event in events:
+        started = time.perf_counter_ns()
+        update(event)
+        timings.append(time.perf_counter_ns() - started)
+    timings.sort()
+
+    render_times = []
+    size = 0
+    for _ in range(renders):
+        started = time.perf_counter()
+        size = len(generate_latest(service.registry))
+        render_times.append(time.perf_counter() - started)
+    render_times.sort()
+
+    return {
+        'businesses': businesses,
+        'label_children': children,
+        'update_mean_us': round(sum(timings) / len(timings) / 1000, 2),
+        'update_p50_us': round(timings[len(timings) // 2] / 1000, 2),
+        'update_p99_us': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))] / 1000, 2),
+        'render_ms': round(render_times[len(render_times) // 2] * 1000, 2),
+        'render_bytes': size,
+        'memory_bytes': populated_memory - baseline_memory,
+        'bytes_per_child': round((populated_memory - baseline_memory) / children, 1) if children else 0.0
+    }
+
+
+def run_level_isolated(businesses: int, updates: int, renders: int) -> Dict[str, Any]:
+    """Run one level in a fresh interpreter so levels don't share collectors"""
+    env = dict(os.environ)
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    env.pop('DATABASE_URL', None)
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--level', str(businesses),
+         '--updates', str(updates), '--renders', str(renders)],
+        cwd=SERVICE_DIR, env=env, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    Compare results with a baseline report, level by level
+
+    Returns:
+        Regressions where a metric grew by more than `tolerance` (0.25 = 25%)
+    """
+    previous = {level['businesses']: level for level in baseline.get('results', [])}
+    regressions = []
+    for level in results:
+        base = previous.get(level['businesses'])
+        if base is None:
+            continue
+        for key in COMPARED:
+            if base.get(key) and level[key] > base[key] * (1 + tolerance):
+                regressions.append(
+                    f"{level['businesses']} businesses: {key} {level[key]} vs baseline {base[key]} "
+                    f"(+{(level[key] / base[key] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Prometheus update/exposition microbenchmarks')
+    parser.add_argument('--businesses', type=int, nargs='+', default=[10, 1000, 50000],
+                        help='Cardinality levels (x%d intents x%d models)' % (len(INTENTS), len(MODELS)))
+    parser.add_argument('--updates', type=int, default=5000, help='Timed updates per level')
+    parser.add_argument('--renders', type=int, default=5, help='Timed renders per level')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--save-baseline', action='store_true', help=f'Also write {os.path.basename(BASELINE_PATH)}')
+    parser.add_argument('--compare', help='Baseline report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed growth before a regression')
+    parser.add_argument('--level', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.level is not None:
+        # Child process: measure one level and print it as the last line
+        print(json.dumps(run_level(args.level, args.updates, args.renders)))
+        return 0
+
+    results = []
+    for businesses in args.businesses:
+        level = run_level_isolated(businesses, args.updates, args.renders)
+        results.append(level)
+        print(f"{businesses:>7} businesses {level['label_children']:>8} children  "
+              f"update p50 {level['update_p50_us']:>7.1f} us  p99 {level['update_p99_us']:>7.1f} us  "
+              f"render {level['render_ms']:>9.1f} ms  {level['bytes_per_child']:>7.0f} B/child",
+              file=sys.stderr)
+
+    report = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'intents': len(INTENTS),
+        'models': len(MODELS),
+        'results': results
+    }
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        report['regressions'] = regressions
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(BASELINE_PATH, 'w') as f:
+            f.write(output + '\n')
+
+    for regression in regressions:
+        print(f'❌ {regression}', file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,517 @@
+"""
+Schema migrations and retention for ai_metrics
+Lab 2: AI Lifecycle & MLOps Integration
+
+The production ai_metrics table (see schema.sql) has only a primary key on
+id, so every analytics query and every rebuild of the Prometheus counters
+scans the whole table. Its api_cost_usd and success_rate columns are
+integers, which truncates sub-cent costs. This module brings the table up
+to date with numbered migrations:
+
+1. Create ai_metrics if it doesn't exist yet.
+2. Store api_cost_usd and success_rate as NUMERIC.
+3. PostgreSQL only: rebuild ai_metrics as a table range-partitioned by
+   month on created_at. Queries over a time window only touch the
+   partitions in that window, and expired months can be dropped whole
+   instead of being deleted row by row.
+4. Add (business_id, created_at) and conversation_id indexes.
+5. Create ai_metrics_hourly, which holds hourly aggregates of compacted
+   rows.
+6. Create ai_conversations, one row per finished conversation (see
+   sessions.py), indexed by business and end time.
+
+Applied versions are recorded in schema_migrations. Each migration runs in
+its own transaction, so a failed one leaves the table as it was. On
+PostgreSQL an advisory lock keeps two runners from applying the same
+migration.
+
+The retention job compacts raw rows older than RAW_RETENTION_DAYS into
+ai_metrics_hourly, one row per (business, hour, model, intent, response
+type), then removes them. It also creates monthly partitions ahead of
+time. The service rebuilds its counters from the last
+METRICS_RETENTION_DAYS of raw rows, so compaction never reaches into that
+window.
+
+Usage:
+    python migrations.py upgrade                       # apply pending migrations
+    python migrations.py status
+    python migrations.py maintain --older-than-days 90 # partitions + compaction (daily)
+"""
+
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+from typing import Any, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Raw rows older than this many days are compacted into ai_metrics_hourly
+RAW_RETENTION_DAYS = int(os.getenv('RAW_RETENTION_DAYS', '90'))
+
+# Monthly partitions created ahead of the current month
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', '3'))
+
+# Arbitrary key for pg_advisory_xact_lock, shared by every migration runner
+ADVISORY_LOCK_KEY = 7412093
+
+MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+HOURLY_TABLE = """
+CREATE TABLE IF NOT EXISTS ai_metrics_hourly (
+    business_id VARCHAR(255) NOT NULL,
+    hour_start TIMESTAMP NOT NULL,
+    model_name VARCHAR(100) NOT NULL,
+    intent_detected VARCHAR(50) NOT NULL,
+    response_type VARCHAR(50) NOT NULL,
+    requests INTEGER NOT NULL,
+    tokens_used BIGINT NOT NULL,
+    api_cost_usd NUMERIC(14,8) NOT NULL,
+    response_time_ms_sum BIGINT NOT NULL,
+    success_rate_sum NUMERIC(14,4) NOT NULL,
+    appointments_requested INTEGER NOT NULL,
+    appointments_booked INTEGER NOT NULL,
+    human_handoffs INTEGER NOT NULL,
+    PRIMARY KEY (business_id, hour_start, model_name, intent_detected, response_type)
+)
+"""
+
+# Summed columns of ai_metrics_hourly, merged when an hour is compacted twice
+HOURLY_TOTALS = ['requests', 'tokens_used', 'api_cost_usd', 'response_time_ms_sum', 'success_rate_sum',
+                 'appointments_requested', 'appointments_booked', 'human_handoffs']
+
+
+def _execute(db, cursor, query: str, params: tuple = ()) -> List[tuple]:
+    cursor.execute(db.sql(query), params)
+    return cursor.fetchall() if cursor.description else []
+
+
+# ---------------------------------------------------------------------------
+# Migrations
+# ---------------------------------------------------------------------------
+
+def create_ai_metrics(db, cursor):
+    """Baseline: the table created by Database.create_metrics_table"""
+    from database import POSTGRES_METRICS_TABLE, SQLITE_METRICS_TABLE
+    _execute(db, cursor, POSTGRES_METRICS_TABLE if db.dialect == 'postgresql' else SQLITE_METRICS_TABLE)
+
+
+def numeric_cost_columns(db, cursor):
+    """Store api_cost_usd and success_rate as NUMERIC instead of INTEGER"""
+    if db.dialect != 'postgresql':
+        # SQLite columns are REAL, which keeps fractions
+        return
+    rows = _execute(db, cursor, """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'ai_metrics'
+          AND column_name IN ('api_cost_usd', 'success_rate') AND data_type <> 'numeric'
+    """)
+    # Existing integer values convert exactly; columns already NUMERIC are
+    # left alone so the table isn't rewritten for nothing
+    types = {'api_cost_usd': 'NUMERIC(12,8)', 'success_rate': 'NUMERIC(5,4)'}
+    for (column,) in rows:
+        _execute(db, cursor,
+                 f"ALTER TABLE ai_metrics ALTER COLUMN {column} TYPE {types[column]} USING {column}::numeric")
+
+
+def partition_by_created_at(db, cursor):
+    """Rebuild ai_metrics as a table range-partitioned by month on created_at"""
+    if db.dialect != 'postgresql':
+        return
+    (kind,) = _execute(db, cursor, """
+        SELECT c.relkind FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = current_schema() AND c.relname = 'ai_metrics'
+    """)[0]
+    if kind == 'p':
+        return
+
+    _execute(db, cursor, "ALTER TABLE ai_metrics RENAME TO ai_metrics_unpartitioned")
+    # The partition key must be part of the primary key, and cannot be NULL
+    _execute(db, cursor, """
+        CREATE TABLE ai_metrics (
+            id BIGINT NOT NULL,
+            business_id VARCHAR(255) NOT NULL,
+            conversation_id VARCHAR(255),
+            session_id VARCHAR(255) NOT NULL,
+            response_time_ms INTEGER NOT NULL,
+            success_rate NUMERIC(5,4) NOT NULL,
+            tokens_used INTEGER NOT NULL,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            api_cost_usd NUMERIC(12,8) NOT NULL,
+            model_name VARCHAR(100) NOT NULL,
+            intent_detected VARCHAR(50) NOT NULL,
+            appointment_requested BOOLEAN DEFAULT FALSE,
+            human_handoff_requested BOOLEAN DEFAULT FALSE,
+            appointment_booked BOOLEAN DEFAULT FALSE,
+            user_message_length INTEGER NOT NULL,
+            ai_response_length INTEGER NOT NULL,
+            response_type VARCHAR(50) NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ) PARTITION BY RANGE (created_at)
+    """)
+    # Rows that fall outside every monthly partition land here
+    _execute(db, cursor, "CREATE TABLE ai_metrics_default PARTITION OF ai_metrics DEFAULT")
+
+    (oldest,) = _execute(db, cursor, "SELECT MIN(created_at) FROM ai_metrics_unpartitioned")[0]
+    ensure_partitions(db, cursor, start=oldest)
+
+    # NOT NULL constraints of the production schema are not guaranteed
+    # there, so missing values get the same defaults as new inserts. Rows
+    # without created_at are kept outside every time window, as before.
+    from database import METRICS_COLUMNS, METRICS_DEFAULTS
+    values = []
+    for column in METRICS_COLUMNS:
+        default = METRICS_DEFAULTS.get(column)
+        if column == 'business_id':
+            values.append("COALESCE(business_id, 'unknown')")
+        elif column in ('response_time_ms', 'tokens_used'):
+            values.append(f"COALESCE({column}, 0)")
+        elif isinstance(default, str):
+            values.append(f"COALESCE({column}, '{default}')")
+        elif default is not None:
+            values.append(f"COALESCE({column}, {str(default).upper()})")
+        else:
+            values.append(column)
+    _execute(db, cursor, f"""
+        INSERT INTO ai_metrics (id, {', '.join(METRICS_COLUMNS)}, created_at)
+        SELECT id, {', '.join(values)}, COALESCE(created_at, TIMESTAMP '1970-01-01')
+        FROM ai_metrics_unpartitioned
+    """)
+    # Drops the old id sequence and indexes along with the table
+    _execute(db, cursor, "DROP TABLE ai_metrics_unpartitioned")
+
+    _execute(db, cursor, "CREATE SEQUENCE ai_metrics_id_seq AS BIGINT OWNED BY ai_metrics.id")
+    _execute(db, cursor, "SELECT setval('ai_metrics_id_seq', COALESCE((SELECT MAX(id) FROM ai_metrics), 0) + 1, false)")
+    _execute(db, cursor, "ALTER TABLE ai_metrics ALTER COLUMN id SET DEFAULT nextval('ai_metrics_id_seq')")
+    _execute(db, cursor, "ALTER TABLE ai_metrics ADD PRIMARY KEY (id, created_at)")
+
+
+def business_time_indexes(db, cursor):
+    """Indexes for per-business time ranges and conversation lookups"""
+    _execute(db, cursor,
+             "CREATE INDEX IF NOT EXISTS idx_ai_metrics_business_created ON ai_metrics (business_id, created_at)")
+    _execute(db, cursor,
+             "CREATE INDEX IF NOT EXISTS idx_ai_metrics_conversation_id ON ai_metrics (conversation_id)")
+    if db.dialect != 'postgresql':
+        # Without partitions, a plain time-range scan needs its own index
+        _execute(db, cursor, "CREATE INDEX IF NOT EXISTS idx_ai_metrics_created_at ON ai_metrics (created_at)")
+
+
+def hourly_rollup_table(db, cursor):
+    """Hourly aggregates that compacted raw rows are folded into"""
+    _execute(db, cursor, HOURLY_TABLE)
+
+
+def conversations_table(db, cursor):
+    """Per-conversation totals written by the service's session aggregator"""
+    from database import POSTGRES_CONVERSATIONS_TABLE, SQLITE_CONVERSATIONS_TABLE
+    _execute(db, cursor,
+             POSTGRES_CONVERSATIONS_TABLE if db.dialect == 'postgresql' else SQLITE_CONVERSATIONS_TABLE)
+    _execute(db, cursor,
+             "CREATE INDEX IF NOT EXISTS idx_ai_conversations_business_ended ON ai_conversations (business_id, ended_at)")
+    _execute(db, cursor,
+             "CREATE INDEX IF NOT EXISTS idx_ai_conversations_conversation_id ON ai_conversations (conversation_id)")
+
+
+# (version, name, migration) in the order they are applied
+MIGRATIONS: List[Tuple[int, str, Callable[[Any, Any], None]]] = [
+    (1, 'create_ai_metrics', create_ai_metrics),
+    (2, 'numeric_cost_columns', numeric_cost_columns),
+    (3, 'partition_by_created_at', partition_by_created_at),
+    (4, 'business_time_indexes', business_time_indexes),
+    (5, 'hourly_rollup_table', hourly_rollup_table),
+    (6, 'conversations_table', conversations_table),
+]
+
+
+def applied_versions(db) -> List[int]:
+    """Versions recorded in schema_migrations, creating the table if needed"""
+    db.execute(MIGRATIONS_TABLE)
+    return [row[0] for row in db.execute("SELECT version FROM schema_migrations ORDER BY version")]
+
+
+def migrate(db, target: Optional[int] = None) -> List[int]:
+    """
+    Apply pending migrations up to `target` (default: all)
+
+    Args:
+        db: database.Database
+        target: Highest version to apply
+
+    Returns:
+        Versions applied by this call
+    """
+    done = set(applied_versions(db))
+    applied = []
+    for version, name, migration in MIGRATIONS:
+        if (target is not None and version > target) or version in done:
+            continue
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                if db.dialect == 'postgresql':
+                    _execute(db, cursor, "SELECT pg_advisory_xact_lock(%s)", (ADVISORY_LOCK_KEY,))
+                    # Another runner may have applied it while we waited
+                    if _execute(db, cursor, "SELECT 1 FROM schema_migrations WHERE version = %s", (version,)):
+                        continue
+                logger.info("Applying migration %03d_%s", version, name)
+                migration(db, cursor)
+                _execute(db, cursor, "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                         (version, name))
+            finally:
+                cursor.close()
+        applied.append(version)
+    return applied
+
+
+# ---------------------------------------------------------------------------
+# Partition maintenance (PostgreSQL)
+# ---------------------------------------------------------------------------
+
+def month_ranges(start: datetime, end: datetime) -> List[Tuple[datetime, datetime]]:
+    """[first day, first day of next month) for every month from start to end inclusive"""
+    month = datetime(start.year, start.month, 1)
+    ranges = []
+    while month <= end:
+        following = datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+        ranges.append((month, following))
+        month = following
+    return ranges
+
+
+def partition_name(month: datetime) -> str:
+    return f"ai_metrics_y{month.year:04d}m{month.month:02d}"
+
+
+def ensure_partitions(db, cursor, start: Optional[datetime] = None,
+                      months_ahead: int = PARTITION_MONTHS_AHEAD) -> List[str]:
+    """
+    Create monthly partitions from `start` to `months_ahead` months from now
+
+    A missing month may already have rows in the default partition. Those
+    rows are moved into the new partition before it is attached, because
+    PostgreSQL refuses to attach a range the default partition still has
+    rows for.
+
+    Returns:
+        Names of the partitions created
+    """
+    now = datetime.utcnow()
+    end = datetime(now.year + (now.month - 1 + months_ahead) // 12, (now.month - 1 + months_ahead) % 12 + 1, 1)
+    existing = {row[0] for row in _execute(db, cursor, """
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'ai_metrics'
+    """)}
+
+    created = []
+    for lower, upper in month_ranges(min(start or now, now), end):
+        name = partition_name(lower)
+        if name in existing:
+            continue
+        bounds = (lower.strftime('%Y-%m-%d'), upper.strftime('%Y-%m-%d'))
+        _execute(db, cursor, f"CREATE TABLE {name} (LIKE ai_metrics INCLUDING DEFAULTS)")
+        _execute(db, cursor, f"""
+            WITH moved AS (
+                DELETE FROM ai_metrics_default WHERE created_at >= %s AND created_at < %s RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        """, bounds)
+        _execute(db, cursor,
+                 f"ALTER TABLE ai_metrics ATTACH PARTITION {name} FOR VALUES FROM ('{bounds[0]}') TO ('{bounds[1]}')")
+        created.append(name)
+    return created
+
+
+def maintain_partitions(db, months_ahead: int = PARTITION_MONTHS_AHEAD) -> List[str]:
+    """Create upcoming monthly partitions (no-op unless ai_metrics is partitioned)"""
+    if db.dialect != 'postgresql':
+        return []
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            if not _execute(db, cursor, "SELECT 1 FROM pg_partitioned_table t JOIN pg_class c "
+                                        "ON c.oid = t.partrelid WHERE c.relname = 'ai_metrics'"):
+                return []
+            return ensure_partitions(db, cursor, months_ahead=months_ahead)
+        finally:
+            cursor.close()
+
+
+# ---------------------------------------------------------------------------
+# Retention: compact old raw rows into hourly aggregates
+# ---------------------------------------------------------------------------
+
+def build_compact_query(db, source: str = 'ai_metrics') -> str:
+    """
+    INSERT ... SELECT folding the rows of `source` in [%s, %s) into ai_metrics_hourly
+
+    An hour that was already compacted (e.g. split across two runs) has its
+    totals added to the existing row.
+    """
+    hour = db.hour_bucket('created_at')
+    keys = ['business_id', 'hour_start', 'model_name', 'intent_detected', 'response_type']
+    merge = ',\n    '.join(f"{column} = ai_metrics_hourly.{column} + excluded.{column}" for column in HOURLY_TOTALS)
+    return f"""
+INSERT INTO ai_metrics_hourly ({', '.join(keys + HOURLY_TOTALS)})
+SELECT
+    COALESCE(business_id, 'unknown'),
+    {hour},
+    COALESCE(model_name, 'gemini-1.5-flash'),
+    COALESCE(intent_detected, 'unknown'),
+    COALESCE(response_type, 'unknown'),
+    COUNT(*),
+    COALESCE(SUM(tokens_used), 0),
+    COALESCE(SUM(api_cost_usd), 0),
+    COALESCE(SUM(response_time_ms), 0),
+    COALESCE(SUM(success_rate), 0),
+    SUM(CASE WHEN appointment_requested THEN 1 ELSE 0 END),
+    SUM(CASE WHEN appointment_booked THEN 1 ELSE 0 END),
+    SUM(CASE WHEN human_handoff_requested THEN 1 ELSE 0 END)
+FROM {source}
+WHERE created_at >= %s AND created_at < %s
+GROUP BY
+    COALESCE(business_id, 'unknown'),
+    {hour},
+    COALESCE(model_name, 'gemini-1.5-flash'),
+    COALESCE(intent_detected, 'unknown'),
+    COALESCE(response_type, 'unknown')
+ON CONFLICT ({', '.join(keys)}) DO UPDATE SET
+    {merge}
+"""
+
+
+def _timestamp(value: Any) -> datetime:
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+def compact_metrics(db, older_than_days: int = RAW_RETENTION_DAYS,
+                    now: Optional[datetime] = None, slice_hours: int = 24) -> int:
+    """
+    Fold raw ai_metrics rows older than `older_than_days` into ai_metrics_hourly
+
+    The cutoff is rounded down to the hour, so an hour is never split
+    between raw rows and aggregates. On PostgreSQL, monthly partitions that
+    end before the cutoff are aggregated and dropped whole. The remaining
+    rows are processed in `slice_hours` slices. Each slice's aggregate
+    insert and delete share one transaction, so an interrupted run leaves
+    nothing counted twice.
+
+    Args:
+        db: database.Database, migrated to at least version 5
+        older_than_days: Age in days above which raw rows are compacted
+        now: Reference time (UTC), for tests
+        slice_hours: Hours of rows compacted per transaction
+
+    Returns:
+        Number of raw rows compacted
+    """
+    now = now or datetime.utcnow()
+    cutoff = (now - timedelta(days=older_than_days)).replace(minute=0, second=0, microsecond=0)
+    compacted = 0
+
+    if db.dialect == 'postgresql':
+        compacted += _compact_partitions(db, cutoff)
+
+    query = build_compact_query(db)
+    while True:
+        # Deleted slices leave the next remaining row first, so gaps are skipped
+        (oldest,) = db.execute("SELECT MIN(created_at) FROM ai_metrics WHERE created_at < %s",
+                               (cutoff.strftime('%Y-%m-%d %H:%M:%S'),))[0]
+        if oldest is None:
+            break
+        lower = _timestamp(oldest).replace(minute=0, second=0, microsecond=0)
+        upper = min(lower + timedelta(hours=slice_hours), cutoff)
+        bounds = (lower.strftime('%Y-%m-%d %H:%M:%S'), upper.strftime('%Y-%m-%d %H:%M:%S'))
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                _execute(db, cursor, query, bounds)
+                _execute(db, cursor, "DELETE FROM ai_metrics WHERE created_at >= %s AND created_at < %s", bounds)
+                compacted += max(cursor.rowcount, 0)
+            finally:
+                cursor.close()
+
+    logger.info("Compacted %d ai_metrics rows older than %s into hourly aggregates", compacted, cutoff)
+    return compacted
+
+
+def _compact_partitions(db, cutoff: datetime) -> int:
+    compacted = 0
+    partitions = db.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'ai_metrics' AND c.relname LIKE 'ai_metrics_y%%m%%'
+        ORDER BY c.relname
+    """)
+    for (name,) in partitions:
+        lower = datetime(int(name[12:16]), int(name[17:19]), 1)
+        upper = month_ranges(lower, lower)[0][1]
+        if upper > cutoff:
+            break
+        bounds = (lower.strftime('%Y-%m-%d'), upper.strftime('%Y-%m-%d'))
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                (rows,) = _execute(db, cursor, f"SELECT COUNT(*) FROM {name}")[0]
+                _execute(db, cursor, build_compact_query(db, name), bounds)
+                _execute(db, cursor, f"ALTER TABLE ai_metrics DETACH PARTITION {name}")
+                _execute(db, cursor, f"DROP TABLE {name}")
+            finally:
+                cursor.close()
+        compacted += rows
+    return compacted
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Schema migrations and retention for ai_metrics')
+    commands = parser.add_subparsers(dest='command', required=True)
+    upgrade = commands.add_parser('upgrade', help='Apply pending migrations')
+    upgrade.add_argument('--target', type=int, help='Highest version to apply')
+    commands.add_parser('status', help='List migrations and whether they are applied')
+    maintain = commands.add_parser('maintain', help='Create partitions and compact old raw rows')
+    maintain.add_argument('--older-than-days', type=int, default=RAW_RETENTION_DAYS)
+    maintain.add_argument('--months-ahead', type=int, default=PARTITION_MONTHS_AHEAD)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    from database import get_database
+    database = get_database()
+    if database is None:
+        print('DATABASE_URL is not set', file=sys.stderr)
+        return 1
+
+    if args.command == 'upgrade':
+        applied = migrate(database, args.target)
+        print(f"Applied {len(applied)} migration(s)" + (f": {applied}" if applied else ''))
+    elif args.command == 'status':
+        done = set(applied_versions(database))
+        for version, name, _ in MIGRATIONS:
+            print(f"{version:03d}_{name}: {'applied' if version in done else 'pending'}")
+    else:
+        # The service rebuilds its counters from raw rows in this window
+        window = int(os.getenv('METRICS_RETENTION_DAYS', '30'))
+        if args.older_than_days < window:
+            print(f'--older-than-days must be at least METRICS_RETENTION_DAYS ({window})', file=sys.stderr)
+            return 1
+        created = maintain_partitions(database, args.months_ahead)
+        compacted = compact_metrics(database, args.older_than_days)
+        print(f"Created {len(created)} partition(s), compacted {compacted} row(s)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
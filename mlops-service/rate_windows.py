@@ -0,0 +1,192 @@
+"""
+Sliding-window success and conversion rates per business
+Lab 2: AI Lifecycle & MLOps Integration
+
+ai_success_rate used to hold whatever success_rate the last client sent,
+and the appointment conversion rate was only computed over whole
+analytics periods. RateWindows computes both on the server, over
+sliding 1 minute, 15 minute and 1 hour windows for each business.
+
+Each window is a ring of `slots` time buckets; for the 1 hour window with
+20 slots, each bucket covers 3 minutes. The ring keeps running totals.
+Recording an event adds it to the current bucket and to the totals.
+Moving into a new bucket subtracts the oldest one from the totals and
+clears it. Both updates and reads are therefore O(1) amortised, and rates
+decay on their own when a business goes quiet. A window covers between
+(slots - 1) / slots and all of its length.
+
+Rates are computed at scrape time by RateWindowCollector. Like the
+latency sketches, they are per process and only exported in single-process
+mode; /analytics reports them in both modes.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from prometheus_client.core import GaugeMetricFamily
+
+# (label, seconds) of every window
+DEFAULT_WINDOWS: Tuple[Tuple[str, int], ...] = (('1m', 60), ('15m', 900), ('1h', 3600))
+
+# Indexes into a bucket / the running totals
+_REQUESTS, _SUCCESS_SAMPLES, _SUCCESS_SUM, _REQUESTED, _BOOKED = range(5)
+_FIELDS = 5
+
+
+class _Ring:
+    """Time buckets for one window, oldest overwritten first"""
+
+    __slots__ = ('slot_seconds', 'buckets', 'totals', 'last')
+
+    def __init__(self, seconds: int, slots: int):
+        self.slot_seconds = seconds / slots
+        self.buckets: List[List[float]] = [[0.0] * _FIELDS for _ in range(slots)]
+        self.totals = [0.0] * _FIELDS
+        self.last: Optional[int] = None
+
+    def advance(self, now: float) -> List[float]:
+        """Expire buckets that slid out of the window; returns the current one"""
+        index = int(now // self.slot_seconds)
+        slots = len(self.buckets)
+        if self.last is None or index - self.last >= slots:
+            # Idle for a whole window (or first use): everything expired
+            for bucket in self.buckets:
+                bucket[:] = [0.0] * _FIELDS
+            self.totals = [0.0] * _FIELDS
+            self.last = index
+        elif index > self.last:
+            for step in range(self.last + 1, index + 1):
+                bucket = self.buckets[step % slots]
+                for field in range(_FIELDS):
+                    self.totals[field] -= bucket[field]
+                bucket[:] = [0.0] * _FIELDS
+            self.last = index
+        # A clock that stepped back keeps adding to the newest bucket
+        return self.buckets[self.last % slots]
+
+    def add(self, now: float, values: Tuple[float, ...]):
+        bucket = self.advance(now)
+        for field, value in enumerate(values):
+            if value:
+                bucket[field] += value
+                self.totals[field] += value
+
+
+def _rates(totals: List[float]) -> Dict[str, Any]:
+    requested = totals[_REQUESTED]
+    samples = totals[_SUCCESS_SAMPLES]
+    return {
+        'requests': int(round(totals[_REQUESTS])),
+        'success_rate': round(totals[_SUCCESS_SUM] / samples, 4) if samples >= 0.5 else None,
+        'appointment_conversion_rate': round(totals[_BOOKED] / requested, 4) if requested >= 0.5 else None
+    }
+
+
+class RateWindows:
+    """
+    Sliding-window success and conversion rates per business
+
+    Args:
+        windows: (label, seconds) pairs
+        slots: Buckets per window (more slots = sharper window edge, more memory)
+        max_businesses: Businesses tracked before the least recently active is dropped
+    """
+
+    def __init__(self, windows: Iterable[Tuple[str, int]] = DEFAULT_WINDOWS,
+                 slots: int = 20, max_businesses: int = 10000):
+        self.windows = tuple(windows)
+        self.slots = slots
+        self.max_businesses = max_businesses
+        self._businesses: 'OrderedDict[str, List[_Ring]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, event: Any, now: Optional[float] = None):
+        """
+        Add one event (MetricEvent or dict) to its business's windows
+
+        Only events that carry success_rate count towards the success rate.
+        """
+        now = time.time() if now is None else now
+        success_rate = event.get('success_rate')
+        values = (
+            1,
+            0 if success_rate is None else 1,
+            success_rate or 0.0,
+            1 if event.get('appointment_requested') else 0,
+            1 if event.get('appointment_booked') else 0
+        )
+        business_id = event.get('business_id', 'unknown')
+
+        with self._lock:
+            rings = self._businesses.get(business_id)
+            if rings is None:
+                rings = self._businesses[business_id] = [
+                    _Ring(seconds, self.slots) for _, seconds in self.windows
+                ]
+                while len(self._businesses) > self.max_businesses:
+                    self._businesses.popitem(last=False)
+            else:
+                self._businesses.move_to_end(business_id)
+            for ring in rings:
+                ring.add(now, values)
+
+    def rates(self, business_id: str, now: Optional[float] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        Current rates for one business
+
+        Returns:
+            {window_label: {'requests', 'success_rate', 'appointment_conversion_rate'}}
+            with None for a rate that has no events in the window
+        """
+        now = time.time() if now is None else now
+        totals = []
+        with self._lock:
+            for ring in self._businesses.get(business_id, ()):
+                ring.advance(now)
+                totals.append(list(ring.totals))
+        if not totals:
+            totals = [[0.0] * _FIELDS for _ in self.windows]
+        return {label: _rates(window_totals) for (label, _), window_totals in zip(self.windows, totals)}
+
+    def success_rate(self, business_id: str, window: str = '1h') -> Optional[float]:
+        """Success rate of one window, or None without samples"""
+        return self.rates(business_id)[window]['success_rate']
+
+    def snapshot(self, now: Optional[float] = None) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """Rates of every tracked business, for the scrape-time collector"""
+        now = time.time() if now is None else now
+        with self._lock:
+            business_ids = list(self._businesses)
+        return {business_id: self.rates(business_id, now) for business_id in business_ids}
+
+
+class RateWindowCollector:
+    """Prometheus collector exporting windowed rates, computed at scrape time"""
+
+    def __init__(self, windows: RateWindows):
+        self.windows = windows
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        success_family = GaugeMetricFamily(
+            'ai_success_rate_window',
+            'Mean success_rate of events over a sliding window, per business',
+            labels=['business_id', 'window']
+        )
+        conversion_family = GaugeMetricFamily(
+            'ai_appointment_conversion_rate',
+            'Appointments booked per appointment requested over a sliding window, per business',
+            labels=['business_id', 'window']
+        )
+        for business_id, windows in self.windows.snapshot().items():
+            for label, rates in windows.items():
+                if rates['success_rate'] is not None:
+                    success_family.add_metric([business_id, label], rates['success_rate'])
+                if rates['appointment_conversion_rate'] is not None:
+                    conversion_family.add_metric([business_id, label], rates['appointment_conversion_rate'])
+        yield success_family
+        yield conversion_family
@@ -0,0 +1,177 @@
+"""
+Per-business metric rollups for analytics
+Lab 2: AI Lifecycle & MLOps Integration
+
+Every tracked event is folded into a per-minute and a per-hour bucket for
+its business as it arrives. Analytics queries then sum a few hundred
+buckets at most instead of scanning raw ai_metrics rows.
+
+Minute buckets cover the recent past (2 hours by default) and hour
+buckets cover the analytics window (30 days by default). Older buckets
+are pruned as new ones are created, so memory per business is bounded.
+At most max_businesses businesses are kept; the least recently active
+one is dropped to make room for a new one.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+class RollupBucket:
+    """Totals for one business over one time bucket"""
+
+    __slots__ = ('count', 'response_time_ms_sum', 'tokens_used', 'api_cost_usd',
+                 'appointment_requests', 'appointments_booked', 'human_handoffs')
+
+    def __init__(self):
+        self.count = 0
+        self.response_time_ms_sum = 0.0
+        self.tokens_used = 0.0
+        self.api_cost_usd = 0.0
+        self.appointment_requests = 0
+        self.appointments_booked = 0
+        self.human_handoffs = 0
+
+    def add(self, metrics_data: Dict[str, Any]):
+        self.count += 1
+        self.response_time_ms_sum += metrics_data.get('response_time_ms') or 0
+        self.tokens_used += metrics_data.get('tokens_used') or 0
+        self.api_cost_usd += metrics_data.get('api_cost_usd') or 0
+        if metrics_data.get('appointment_requested', False):
+            self.appointment_requests += 1
+        if metrics_data.get('appointment_booked', False):
+            self.appointments_booked += 1
+        if metrics_data.get('human_handoff_requested', False):
+            self.human_handoffs += 1
+
+    def merge(self, other: 'RollupBucket'):
+        for field in self.__slots__:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+
+class _BusinessRollups:
+    """Minute and hour buckets for one business, oldest first"""
+
+    __slots__ = ('minutes', 'hours')
+
+    def __init__(self):
+        self.minutes: 'OrderedDict[int, RollupBucket]' = OrderedDict()
+        self.hours: 'OrderedDict[int, RollupBucket]' = OrderedDict()
+
+
+def _bucket_for(buckets: 'OrderedDict[int, RollupBucket]', start: int,
+                size: int, retention: int) -> RollupBucket:
+    bucket = buckets.get(start)
+    if bucket is None:
+        newest = next(reversed(buckets), start)
+        bucket = buckets[start] = RollupBucket()
+        # Events normally arrive in time order, so a new bucket usually
+        # sorts last; re-sort only when a late event opens an older one
+        if start < newest:
+            for key in sorted(buckets):
+                buckets.move_to_end(key)
+        newest = max(newest, start)
+        oldest = newest - (retention - 1) * size
+        while next(iter(buckets)) < oldest:
+            buckets.popitem(last=False)
+    return buckets.get(start, bucket)
+
+
+class RollupStore:
+    """
+    Incrementally maintained per-minute and per-hour rollups per business
+
+    Args:
+        minute_retention: Minute buckets kept per business
+        hour_retention: Hour buckets kept per business
+        max_businesses: Businesses tracked before the least recently active is dropped
+    """
+
+    def __init__(self, minute_retention: int = 120, hour_retention: int = 24 * 30,
+                 max_businesses: int = 10000):
+        self.minute_retention = minute_retention
+        self.hour_retention = hour_retention
+        self.max_businesses = max_businesses
+        self._businesses: 'OrderedDict[str, _BusinessRollups]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, metrics_data: Dict[str, Any], timestamp: Optional[float] = None):
+        """
+        Fold one event into its business's current minute and hour buckets
+
+        Args:
+            metrics_data: Validated metrics event
+            timestamp: Event time (epoch seconds), defaults to now
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        minute = int(timestamp // 60) * 60
+        hour = int(timestamp // 3600) * 3600
+        business_id = metrics_data.get('business_id', 'unknown')
+
+        with self._lock:
+            rollups = self._rollups_for(business_id)
+            _bucket_for(rollups.minutes, minute, 60, self.minute_retention).add(metrics_data)
+            _bucket_for(rollups.hours, hour, 3600, self.hour_retention).add(metrics_data)
+
+    def add_minute(self, business_id: str, minute_start: int, bucket: RollupBucket):
+        """Merge a pre-aggregated minute bucket (used when seeding from the database)"""
+        minute = int(minute_start // 60) * 60
+        with self._lock:
+            rollups = self._rollups_for(business_id)
+            _bucket_for(rollups.minutes, minute, 60, self.minute_retention).merge(bucket)
+
+    def add_hour(self, business_id: str, hour_start: int, bucket: RollupBucket):
+        """Merge a pre-aggregated hour bucket (used when seeding from the database)"""
+        hour = int(hour_start // 3600) * 3600
+        with self._lock:
+            rollups = self._rollups_for(business_id)
+            _bucket_for(rollups.hours, hour, 3600, self.hour_retention).merge(bucket)
+
+    def _rollups_for(self, business_id: str) -> _BusinessRollups:
+        # Called with _lock held
+        rollups = self._businesses.get(business_id)
+        if rollups is None:
+            rollups = self._businesses[business_id] = _BusinessRollups()
+            while len(self._businesses) > self.max_businesses:
+                self._businesses.popitem(last=False)
+        else:
+            self._businesses.move_to_end(business_id)
+        return rollups
+
+    def summary(self, business_id: str, window_seconds: int, now: Optional[float] = None) -> RollupBucket:
+        """
+        Sum the buckets covering the last window_seconds
+
+        Windows up to the minute retention are answered from minute
+        buckets; longer windows use hour buckets.
+
+        Returns:
+            RollupBucket with the totals for the window
+        """
+        now = time.time() if now is None else now
+        total = RollupBucket()
+
+        with self._lock:
+            rollups = self._businesses.get(business_id)
+            if rollups is None:
+                return total
+
+            if window_seconds <= self.minute_retention * 60:
+                buckets, size = rollups.minutes, 60
+            else:
+                buckets, size = rollups.hours, 3600
+
+            oldest = int((now - window_seconds) // size) * size + size
+            for start in reversed(buckets):
+                if start < oldest:
+                    break
+                total.merge(buckets[start])
+
+        return total
+
+    def businesses(self):
+        """Business ids with at least one bucket"""
+        with self._lock:
+            return list(self._businesses)
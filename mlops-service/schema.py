@@ -0,0 +1,220 @@
+"""
+Typed metrics events for the ingestion endpoints
+Lab 2: AI Lifecycle & MLOps Integration
+
+MetricEvent mirrors MetricsData in lib/mlops-tracking.ts. Events are
+stored in __slots__ instead of a per-event dict, and the ingest path reads
+them through plain attributes.
+
+parse_event() validates and coerces a decoded JSON object in one pass. It
+walks a field table that is compiled once at import, and it raises
+EventValidationError with a client-facing message.
+
+loads() uses orjson when it is installed and falls back to the standard
+library json module otherwise.
+"""
+
+import json
+import math
+from decimal import Decimal
+from typing import Any, Callable, Dict, Tuple
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+    loads = json.loads
+
+# Fields every tracked event must carry
+REQUIRED_FIELDS = ['business_id', 'response_time_ms', 'tokens_used']
+
+# Longest accepted string value (ai_metrics uses VARCHAR(255))
+MAX_STRING_LENGTH = 255
+
+# Narrower ai_metrics columns (see database.py). On PostgreSQL one
+# over-long value fails the whole multi-row INSERT, so reject it here
+COLUMN_LENGTHS = {
+    'model_name': 100,
+    'intent_detected': 50,
+    'response_type': 50
+}
+
+# Largest value of an ai_metrics INTEGER column
+MAX_INTEGER = 2 ** 31 - 1
+
+# Values used when an optional field is absent, as update_prometheus_metrics
+# and the ai_metrics defaults expect
+FIELD_DEFAULTS = {
+    'business_id': 'unknown',
+    'model_name': 'gemini-1.5-flash',
+    'intent_detected': 'unknown',
+    'response_type': 'unknown',
+    'appointment_requested': False,
+    'human_handoff_requested': False,
+    'appointment_booked': False
+}
+
+
+class EventValidationError(ValueError):
+    """Raised when a metrics event fails validation"""
+
+
+def _string_of(max_length: int) -> Callable[[Any], str]:
+    def _string(value: Any) -> str:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = str(value)
+        elif not isinstance(value, str):
+            raise ValueError('must be a string')
+        if len(value) > max_length:
+            raise ValueError(f'must be at most {max_length} characters')
+        return value
+    return _string
+
+
+_string = _string_of(MAX_STRING_LENGTH)
+
+
+def _number(value: Any) -> float:
+    if isinstance(value, bool):
+        raise ValueError('must be a number')
+    if isinstance(value, (int, float, Decimal)):
+        number = float(value)
+    elif isinstance(value, str):
+        try:
+            number = float(value)
+        except ValueError:
+            raise ValueError('must be a number') from None
+    else:
+        raise ValueError('must be a number')
+    if not math.isfinite(number) or number < 0:
+        raise ValueError('must be a non-negative number')
+    return number
+
+
+def _integer(value: Any) -> int:
+    if isinstance(value, int) and not isinstance(value, bool):
+        if value < 0:
+            raise ValueError('must be a non-negative number')
+    else:
+        value = int(round(_number(value)))
+    if value > MAX_INTEGER:
+        raise ValueError(f'must be at most {MAX_INTEGER}')
+    return value
+
+
+def _boolean(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    if value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    raise ValueError('must be a boolean')
+
+
+# (field, coercion) in MetricsData order
+FIELDS: Tuple[Tuple[str, Callable[[Any], Any]], ...] = (
+    ('business_id', _string),
+    ('conversation_id', _string),
+    ('session_id', _string),
+    ('response_time_ms', _integer),
+    ('success_rate', _number),
+    ('user_satisfaction', _number),
+    ('tokens_used', _integer),
+    ('prompt_tokens', _integer),
+    ('completion_tokens', _integer),
+    ('api_cost_usd', _number),
+    ('model_name', _string_of(COLUMN_LENGTHS['model_name'])),
+    ('intent_detected', _string_of(COLUMN_LENGTHS['intent_detected'])),
+    ('appointment_requested', _boolean),
+    ('human_handoff_requested', _boolean),
+    ('appointment_booked', _boolean),
+    ('user_message_length', _integer),
+    ('ai_response_length', _integer),
+    ('response_type', _string_of(COLUMN_LENGTHS['response_type'])),
+    # Idempotency: explicit id, or the client's timestamp (see dedup.py)
+    ('event_id', _string),
+    ('timestamp', _string)
+)
+
+FIELD_NAMES = tuple(name for name, _ in FIELDS)
+
+
+class MetricEvent:
+    """
+    One tracked AI interaction
+
+    Optional numeric fields are None when the client did not send them;
+    label fields and flags fall back to FIELD_DEFAULTS. get() and item
+    access mirror the dict API for code shared with database rows.
+    """
+
+    __slots__ = FIELD_NAMES
+
+    def __init__(self, **fields: Any):
+        for name in FIELD_NAMES:
+            value = fields.get(name)
+            setattr(self, name, FIELD_DEFAULTS.get(name) if value is None else value)
+
+    def get(self, name: str, default: Any = None) -> Any:
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+    def __getitem__(self, name: str) -> Any:
+        if name not in FIELD_NAMES:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Fields that are set, as a JSON-serialisable dict"""
+        return {name: getattr(self, name) for name in FIELD_NAMES if getattr(self, name) is not None}
+
+    def __repr__(self) -> str:
+        return f'MetricEvent({self.to_dict()!r})'
+
+
+def _compile_parser(fields: Tuple[Tuple[str, Callable[[Any], Any]], ...]) -> Callable[[Any], MetricEvent]:
+    # Resolve the field table into locals once; the returned parser only
+    # loops over it, with no per-event lookups or reflection
+    required = tuple(REQUIRED_FIELDS)
+    table = tuple((name, coerce, FIELD_DEFAULTS.get(name)) for name, coerce in fields)
+    new_event = MetricEvent.__new__
+
+    def parse_event(data: Any) -> MetricEvent:
+        """
+        Validate and coerce a decoded JSON object into a MetricEvent
+
+        Args:
+            data: Decoded JSON value
+
+        Returns:
+            MetricEvent with every field coerced to its declared type
+
+        Raises:
+            EventValidationError: If the event is missing or invalid
+        """
+        if not data or not isinstance(data, dict):
+            raise EventValidationError('No metrics data provided')
+        for name in required:
+            value = data.get(name)
+            # A blank id would create an empty-string label child
+            if value is None or (isinstance(value, str) and not value.strip()):
+                raise EventValidationError(f'Missing required field: {name}')
+
+        event = new_event(MetricEvent)
+        for name, coerce, default in table:
+            value = data.get(name)
+            if value is None:
+                setattr(event, name, default)
+                continue
+            try:
+                setattr(event, name, coerce(value))
+            except ValueError as e:
+                raise EventValidationError(f'Invalid field {name}: {e}') from None
+        return event
+
+    return parse_event
+
+
+parse_event = _compile_parser(FIELDS)
@@ -0,0 +1,1492 @@
+"""
+Metrics state and background work behind the MLOps service
+Lab 2: AI Lifecycle & MLOps Integration
+
+MLOpsService holds everything the HTTP routes in app.py work on:
+- the ai_* Prometheus collectors and their cardinality guards
+- latency sketches, rate windows, rollups, the live stream
+- admission control, the idempotency index and conversation sessions
+- the write-behind queue, the Parquet archive and registry snapshots
+- the watermark and totals used to reconcile counters with ai_metrics
+
+Every collector is registered in the service's own registry, so tests and
+tools can build as many services as they like in one process. Production
+uses the default prometheus_client REGISTRY.
+
+Settings are read from the Flask config first, then from the environment
+(see MLOpsService.setting). The database handle is still process-wide
+(see database.get_database).
+
+Constructing a service only creates in-memory state. The slow startup
+work runs in initialise(): the table check, the counter rebuild from the
+database and seeding the rollups. `ready` is set once that is done.
+"""
+
+import atexit
+import calendar
+import logging
+import os
+import signal
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from decimal import Decimal
+from urllib.parse import urlsplit
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, Info, multiprocess
+
+from admission import AdmissionController, parse_tenant_limits
+from cache import TTLCache
+from cardinality import OVERFLOW_LABEL_VALUE, CardinalityGuard, CardinalityMetrics
+from database import get_database, is_data_error
+from dedup import DedupIndex
+from exposition import ExpositionCache
+from instrumentation import RequestInstrumentation
+from live_stream import LiveStream, serve_stream
+from metric_internals import bucket_cells, children, counter_cell, raise_to, sum_cell
+from metrics_writer import MetricsWriteBehindQueue
+from rate_windows import RateWindowCollector, RateWindows
+from rollups import RollupBucket, RollupStore
+from schema import MetricEvent
+from sessions import SessionAggregator
+from sketches import SketchCollector, SketchStore
+from snapshot import RegistrySnapshotter, default_child
+from spool import SegmentSpool
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket bounds in seconds (also used by the aggregate rebuild query)
+RESPONSE_TIME_BUCKETS = [0.1, 0.5, 1.0, 2.0, 5.0, 10.0]
+
+# Methods whose run time is recorded as an mlops_service stage
+STAGES = (
+    'update_prometheus_metrics',
+    'update_prometheus_metrics_batch',
+    'record_rollups',
+    'store_metrics_in_db',
+    'store_metrics_batch_in_db'
+)
+
+METRICS_QUERY = """
+SELECT
+    id, created_at, business_id, response_time_ms, tokens_used, api_cost_usd, model_name,
+    intent_detected, response_type, appointment_requested, appointment_booked,
+    human_handoff_requested, success_rate
+FROM ai_metrics
+WHERE created_at >= %s
+ORDER BY id
+"""
+
+# Analytics periods and the window (in seconds) each one covers
+ANALYTICS_PERIODS = {
+    '1_hour': 3600,
+    '24_hours': 24 * 3600,
+    '7_days': 7 * 24 * 3600,
+    '30_days': 30 * 24 * 3600
+}
+
+
+def row_to_metrics_data(row: Dict[str, Any]) -> MetricEvent:
+    """
+    Convert an ai_metrics row into the event type used by /track
+
+    Rows were validated on the way in, so no coercion is needed beyond
+    converting DECIMAL values to floats for Prometheus. NULL columns
+    count as absent fields.
+    """
+    return MetricEvent(**{
+        column: float(value) if isinstance(value, Decimal) else value
+        for column, value in row.items()
+        if column not in ('id', 'created_at')
+    })
+
+
+def build_aggregate_query() -> str:
+    """
+    Build the GROUP BY query used by the aggregate rebuild and refresh
+
+    One row is returned per (business_id, model_name, intent_detected,
+    response_type) combination, carrying every counter total plus the
+    cumulative response time histogram buckets for that group. Only rows
+    above the id watermark are read.
+    """
+    bucket_columns = ',\n    '.join(
+        f"SUM(CASE WHEN response_time_ms <= {bound * 1000:g} THEN 1 ELSE 0 END) AS le_{index}"
+        for index, bound in enumerate(RESPONSE_TIME_BUCKETS)
+    )
+    return f"""
+SELECT
+    COALESCE(business_id, 'unknown') AS business_id,
+    COALESCE(model_name, 'gemini-1.5-flash') AS model_name,
+    COALESCE(intent_detected, 'unknown') AS intent_detected,
+    COALESCE(response_type, 'unknown') AS response_type,
+    COUNT(*) AS requests,
+    MAX(id) AS max_id,
+    MAX(created_at) AS max_created_at,
+    COALESCE(SUM(tokens_used), 0) AS tokens_used,
+    COALESCE(SUM(api_cost_usd), 0) AS api_cost_usd,
+    SUM(CASE WHEN appointment_requested THEN 1 ELSE 0 END) AS appointments_requested,
+    SUM(CASE WHEN appointment_booked THEN 1 ELSE 0 END) AS appointments_booked,
+    SUM(CASE WHEN human_handoff_requested THEN 1 ELSE 0 END) AS human_handoffs,
+    COUNT(response_time_ms) AS response_time_count,
+    COALESCE(SUM(response_time_ms), 0) AS response_time_ms_sum,
+    {bucket_columns}
+FROM ai_metrics
+WHERE created_at >= %s AND id > %s
+GROUP BY
+    COALESCE(business_id, 'unknown'),
+    COALESCE(model_name, 'gemini-1.5-flash'),
+    COALESCE(intent_detected, 'unknown'),
+    COALESCE(response_type, 'unknown')
+"""
+
+
+def accumulate_aggregate_row(row: Dict[str, Any], totals: Dict[Tuple[str, tuple], float]):
+    """
+    Add one GROUP BY row to per-child totals
+
+    Several groups map onto the same counter child (e.g. every intent
+    shares one ai_tokens_used child), so totals are summed per child.
+    """
+    business_id = row['business_id']
+    model_name = row['model_name']
+    response_type = row['response_type']
+    reason = 'error' if response_type == 'error' else 'complex_query'
+
+    totals[('ai_requests_total', (business_id, response_type, row['intent_detected']))] += int(row['requests'])
+    totals[('ai_tokens_used_total', (business_id, model_name))] += float(row['tokens_used'])
+    totals[('ai_api_cost_usd_total', (business_id, model_name))] += float(row['api_cost_usd'])
+    totals[('appointments_requested_total', (business_id,))] += int(row['appointments_requested'] or 0)
+    totals[('appointments_booked_total', (business_id,))] += int(row['appointments_booked'] or 0)
+    totals[('human_handoffs_total', (business_id, reason))] += int(row['human_handoffs'] or 0)
+
+    # Convert cumulative "<= bound" counts into per-bucket counts (+Inf last)
+    previous = 0
+    for index in range(len(RESPONSE_TIME_BUCKETS)):
+        cumulative = int(row[f'le_{index}'] or 0)
+        totals[('ai_response_time_seconds', (index,))] += cumulative - previous
+        previous = cumulative
+    totals[('ai_response_time_seconds', (len(RESPONSE_TIME_BUCKETS),))] += int(row['response_time_count']) - previous
+    totals[('ai_response_time_seconds', ('sum',))] += float(row['response_time_ms_sum']) / 1000.0
+
+
+class MLOpsService:
+    """
+    Prometheus collectors, in-memory aggregates and background workers of one app
+
+    Args:
+        config: Settings that take precedence over environment variables
+            (the Flask app's config)
+        registry: Prometheus registry for every collector of the service
+    """
+
+    def __init__(self, config: Optional[Mapping[str, Any]] = None, registry=REGISTRY):
+        self.config = config if config is not None else {}
+        self.registry = registry
+        self.ready = threading.Event()
+
+        if not self.setting('DATABASE_URL'):
+            logger.error("DATABASE_URL environment variable not set")
+
+        # Next.js stores every event in ai_metrics itself (see trackMetrics in
+        # lib/mlops-tracking.ts). Set PERSIST_METRICS=true to have this service
+        # write them instead, through the write-behind queue.
+        self.persist_metrics = self.setting('PERSIST_METRICS', 'false').lower() == 'true'
+
+        # Set by gunicorn.conf.py: each worker process writes its metric values to
+        # mmap files in this directory and /metrics sums them across workers
+        self.multiprocess = bool(self.setting('PROMETHEUS_MULTIPROC_DIR'))
+        # gunicorn worker processes (see gunicorn.conf.py)
+        self.workers = int(self.setting('WEB_CONCURRENCY', '1'))
+
+        # Upper bound on events accepted by a single /track/batch request
+        self.max_batch_size = int(self.setting('MAX_BATCH_SIZE', '1000'))
+        # How far back the startup rebuild and analytics look
+        self.metrics_retention_days = int(self.setting('METRICS_RETENTION_DAYS', '30'))
+        # Rows read per round trip when replaying ai_metrics into Prometheus
+        self.fetch_chunk_size = int(self.setting('FETCH_CHUNK_SIZE', '1000'))
+        # 'aggregate' pushes GROUP BY totals down to the database; 'replay' streams raw rows
+        self.rebuild_mode = self.setting('REBUILD_MODE', 'aggregate')
+        # Triggers to /refresh-metrics within this window are merged into one job
+        self.refresh_debounce_seconds = float(self.setting('REFRESH_DEBOUNCE_SECONDS', '2.0'))
+
+        # The service's own request latency, sizes, errors and stage timings,
+        # exported as mlops_service_* next to the ai_* metrics; the Flask
+        # hooks are registered by create_app
+        self.instrumentation = RequestInstrumentation(registry=registry)
+        for name in STAGES:
+            setattr(self, name, self.instrumentation.stage(name)(getattr(self, name)))
+
+        self._create_collectors()
+
+        # Rendered /metrics output shared by all scrapers (see exposition.py).
+        # Other workers' updates don't mark this cache dirty, so in multiprocess
+        # mode renderings are only reused for the TTL.
+        cache_ttl = float(self.setting('METRICS_CACHE_TTL_SECONDS', '1.0'))
+        self.exposition_cache = ExpositionCache(
+            registry=self.build_scrape_registry(),
+            ttl=cache_ttl,
+            max_age=cache_ttl if self.multiprocess
+                    else float(self.setting('METRICS_CACHE_MAX_AGE_SECONDS', '15.0'))
+        )
+
+        # Per-business minute/hour rollups behind /analytics/<business_id>
+        self.rollup_store = RollupStore(
+            minute_retention=int(self.setting('ROLLUP_MINUTE_RETENTION', '120')),
+            hour_retention=self.metrics_retention_days * 24,
+            max_businesses=int(self.setting('LABEL_MAX_SERIES', '10000'))
+        )
+
+        # Rendered analytics responses, invalidated per business on new events
+        self.analytics_cache = TTLCache(ttl=float(self.setting('ANALYTICS_CACHE_TTL_SECONDS', '5')))
+
+        # Live deltas pushed to dashboards over /stream (one shared message per interval)
+        self.live_stream = LiveStream(
+            interval=float(self.setting('STREAM_INTERVAL_SECONDS', '1.0')),
+            max_buffer=int(self.setting('STREAM_MAX_BUFFER', '64')),
+            max_subscribers=int(self.setting('STREAM_MAX_SUBSCRIBERS', '100')),
+            registry=registry
+        )
+        # SSE connections hold a request thread for as long as the dashboard is
+        # open. With STREAM_PORT set, a gunicorn worker serves /stream from its
+        # own listener (see start_stream_server) and redirects there; otherwise
+        # streams on the request pool are capped below its GUNICORN_THREADS
+        # (set by gunicorn.conf.py; unset under the development server).
+        self.stream_port = int(self.setting('STREAM_PORT', '0'))
+        # Port clients reach the listener on, if a proxy or NodePort maps it
+        self.stream_public_port = int(self.setting('STREAM_PUBLIC_PORT', '0'))
+        self.stream_server = None
+        request_threads = int(self.setting('GUNICORN_THREADS', '0'))
+        self.pool_stream_slots = None
+        if request_threads:
+            pool_streams = int(self.setting('STREAM_POOL_SUBSCRIBERS', str(request_threads // 2)))
+            self.pool_stream_slots = threading.BoundedSemaphore(
+                max(0, min(pool_streams, request_threads - 1))
+            )
+
+        # Per-business token buckets and a cap on concurrent ingestion requests.
+        # Limits apply per worker process; rate 0 / concurrency 0 disable them.
+        self.admission = AdmissionController(
+            rate=float(self.setting('ADMISSION_RATE', '0')),
+            burst=float(self.setting('ADMISSION_BURST', '100')),
+            tenant_limits=parse_tenant_limits(self.setting('ADMISSION_TENANT_LIMITS', '')),
+            max_concurrency=int(self.setting('ADMISSION_MAX_CONCURRENCY', '0')),
+            max_tenants=int(self.setting('ADMISSION_MAX_TENANTS', '10000')),
+            registry=registry
+        )
+
+        # Idempotency keys seen recently, so client retries are not counted twice
+        self.dedup_index = DedupIndex(
+            max_entries=int(self.setting('DEDUP_MAX_KEYS', '100000')),
+            ttl=float(self.setting('DEDUP_TTL_SECONDS', '600')),
+            registry=registry
+        )
+
+        # Running totals per conversation_id, finished after SESSION_IDLE_SECONDS
+        # without a turn and written to ai_conversations (see sessions.py)
+        self.sessions = self.create_session_aggregator()
+
+        # Database-derived totals per counter child, keyed by (metric name, label
+        # values). Response time histogram entries use (bucket index,) and ('sum',).
+        self._db_totals: Dict[Tuple[str, tuple], float] = defaultdict(float)
+        # (metric name, evicted labels, __other__ labels) of top-K evictions not yet
+        # applied to _db_totals; filled by the guards, drained under _refresh_lock
+        self._pending_folds = deque()
+
+        # Newest ai_metrics row already folded into _db_totals
+        self._watermark = {'id': 0, 'created_at': None}
+
+        # Serialises rebuilds and refreshes so the watermark only moves forward
+        self._refresh_lock = threading.Lock()
+
+        self._refresh_timer: Optional[threading.Timer] = None
+        self._refresh_timer_lock = threading.Lock()
+
+        # Background writer for metrics persistence (None when Next.js persists).
+        # Created here rather than in initialise() so no event tracked during
+        # startup goes unpersisted.
+        self.metrics_writer = self.create_metrics_writer()
+
+        # Not started until initialise() has restored the last snapshot
+        self.snapshotter = self.create_snapshotter()
+
+        # Created by initialise(): pyarrow is slow to import
+        self.archiver = None
+
+    def setting(self, name: str, default: str = '') -> str:
+        """Value of a setting from the app config, else the environment"""
+        value = self.config.get(name)
+        if value is None:
+            return os.getenv(name, default)
+        return str(value)
+
+    def _create_collectors(self):
+        registry = self.registry
+
+        # Conversation Metrics
+        self.ai_response_time = Histogram(
+            'ai_response_time_seconds',
+            'Time taken for AI to respond to user messages',
+            buckets=RESPONSE_TIME_BUCKETS,
+            registry=registry
+        )
+
+        self.ai_requests_total = Counter(
+            'ai_requests_total',
+            'Total number of AI requests',
+            ['business_id', 'response_type', 'intent'],
+            registry=registry
+        )
+
+        self.ai_success_rate = Gauge(
+            'ai_success_rate',
+            'Success rate of AI responses over the last hour (see rate_windows.py)',
+            ['business_id'],
+            multiprocess_mode='mostrecent',
+            registry=registry
+        )
+
+        # AI Performance Metrics
+        self.ai_tokens_used = Counter(
+            'ai_tokens_used_total',
+            'Total tokens consumed by AI',
+            ['business_id', 'model_name'],
+            registry=registry
+        )
+
+        self.ai_api_cost = Counter(
+            'ai_api_cost_usd_total',
+            'Total API costs in USD',
+            ['business_id', 'model_name'],
+            registry=registry
+        )
+
+        # Business Metrics
+        self.appointments_requested = Counter(
+            'appointments_requested_total',
+            'Total appointment requests',
+            ['business_id'],
+            registry=registry
+        )
+
+        self.appointments_booked = Counter(
+            'appointments_booked_total',
+            'Total appointments successfully booked',
+            ['business_id'],
+            registry=registry
+        )
+
+        self.human_handoffs = Counter(
+            'human_handoffs_total',
+            'Total requests requiring human assistance',
+            ['business_id', 'reason'],
+            registry=registry
+        )
+
+        # Label-cardinality guards: business_id, intent, response_type and
+        # model_name come from client payloads, so each labelled collector is
+        # capped at LABEL_MAX_SERIES label sets; overflow folds into __other__
+        max_series = int(self.setting('LABEL_MAX_SERIES', '10000'))
+        allow_list = [value.strip() for value in self.setting('LABEL_ALLOW_LIST', '').split(',') if value.strip()]
+        top_k = self.setting('LABEL_TOP_K', 'false').lower() == 'true'
+        self.cardinality_metrics = CardinalityMetrics(registry=registry)
+
+        def guard(metric, name: str, fold_labels: Optional[List[str]] = None) -> CardinalityGuard:
+            return CardinalityGuard(
+                metric, name,
+                max_series=max_series,
+                metrics=self.cardinality_metrics,
+                fold_labels=fold_labels,
+                allow_list=allow_list,
+                top_k=top_k,
+                on_fold=lambda evicted, folded: self.queue_db_total_fold(name, evicted, folded)
+            )
+
+        self.ai_requests_guard = guard(self.ai_requests_total, 'ai_requests_total')
+        self.ai_success_rate_guard = guard(self.ai_success_rate, 'ai_success_rate')
+        self.ai_tokens_used_guard = guard(self.ai_tokens_used, 'ai_tokens_used_total')
+        self.ai_api_cost_guard = guard(self.ai_api_cost, 'ai_api_cost_usd_total')
+        self.appointments_requested_guard = guard(self.appointments_requested, 'appointments_requested_total')
+        self.appointments_booked_guard = guard(self.appointments_booked, 'appointments_booked_total')
+        # reason is derived server-side and already bounded
+        self.human_handoffs_guard = guard(self.human_handoffs, 'human_handoffs_total', fold_labels=['business_id'])
+
+        # Counters reconciled against ai_metrics, keyed by metric name
+        self.db_counters = {
+            'ai_requests_total': self.ai_requests_total,
+            'ai_tokens_used_total': self.ai_tokens_used,
+            'ai_api_cost_usd_total': self.ai_api_cost,
+            'appointments_requested_total': self.appointments_requested,
+            'appointments_booked_total': self.appointments_booked,
+            'human_handoffs_total': self.human_handoffs
+        }
+
+        # Cardinality guards for db_counters, so rebuilt series respect the same cap
+        self.db_counter_guards = {
+            'ai_requests_total': self.ai_requests_guard,
+            'ai_tokens_used_total': self.ai_tokens_used_guard,
+            'ai_api_cost_usd_total': self.ai_api_cost_guard,
+            'appointments_requested_total': self.appointments_requested_guard,
+            'appointments_booked_total': self.appointments_booked_guard,
+            'human_handoffs_total': self.human_handoffs_guard
+        }
+
+        # Guards that labelled collectors' children are created through, by collector
+        self.guards_by_metric = {
+            id(metric_guard.metric): metric_guard
+            for metric_guard in [self.ai_success_rate_guard, *self.db_counter_guards.values()]
+        }
+
+        # Per-business, per-model latency sketches; ai_response_time above is
+        # global, these give p50/p95/p99 per tenant and merge across replicas
+        self.latency_sketches = SketchStore(
+            relative_accuracy=float(self.setting('SKETCH_RELATIVE_ACCURACY', '0.01')),
+            max_keys=max_series
+        )
+        self.sketch_collector = SketchCollector(self.latency_sketches)
+        registry.register(self.sketch_collector)
+
+        # Server-side success and conversion rates over sliding 1m/15m/1h windows;
+        # ai_success_rate reports the 1h success rate instead of the client's value
+        self.rate_windows = RateWindows(max_businesses=max_series)
+        self.rate_window_collector = RateWindowCollector(self.rate_windows)
+        registry.register(self.rate_window_collector)
+
+        # Incremented by the logging pipeline (see structured_logging.py), which
+        # drops records rather than block a request thread on a full queue
+        self.log_records_dropped = Counter(
+            'log_records_dropped_total',
+            'Log records dropped because the logging queue was full',
+            registry=registry
+        )
+
+        # System Info
+        self.system_info = Info(
+            'ai_system_info',
+            'Information about the AI system',
+            registry=registry
+        )
+        self.system_info.info({
+            'service': 'ai-appointment-setter',
+            'version': '1.0.0',
+            'monitoring': 'prometheus'
+        })
+
+    def build_scrape_registry(self):
+        """
+        Registry rendered by /metrics
+
+        In multiprocess mode this is a fresh registry whose collector reads
+        every worker's mmap files, so any worker answers a scrape with the
+        totals of all of them. The sketch and rate window collectors hold
+        per-process state; they are added when there is a single worker,
+        whose state is then the whole picture.
+        """
+        if not self.multiprocess:
+            return self.registry
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        if self.workers == 1:
+            registry.register(self.sketch_collector)
+            registry.register(self.rate_window_collector)
+        return registry
+
+    def execute_sql(self, query: str, params: tuple = None) -> Optional[Dict]:
+        """
+        Execute SQL query over the pooled database connection
+
+        Args:
+            query: SQL query string (%s placeholders)
+            params: Query parameters
+
+        Returns:
+            Query result or None if failed
+        """
+        try:
+            logger.debug("SQL query: %s", query, extra={'params': params})
+
+            db = get_database()
+            if db is None:
+                # No database configured: nothing to run against
+                return {"success": True, "rows": []}
+
+            rows = db.execute(query, params or ())
+            return {"success": True, "rows": rows}
+        except Exception as e:
+            logger.error(f"Database query error: {e}")
+            return None
+
+    def create_metrics_table(self):
+        """
+        Initialize metrics storage
+        Creates the ai_metrics table when a database is configured, and
+        ai_conversations when finished conversations are persisted
+        """
+        try:
+            db = get_database()
+            if db is not None:
+                db.create_metrics_table()
+                if self.sessions.sink is not None:
+                    db.create_conversations_table()
+            logger.info("Metrics storage initialized successfully")
+            return True
+        except Exception as e:
+            logger.error(f"Error initializing metrics storage: {e}")
+            return False
+
+    def create_metrics_writer(self) -> Optional[MetricsWriteBehindQueue]:
+        """
+        Create the write-behind queue used by store_metrics_in_db
+
+        Returns:
+            Writer instance, or None if this service does not persist metrics
+        """
+        if not self.persist_metrics:
+            return None
+
+        try:
+            if get_database() is None:
+                logger.warning("PERSIST_METRICS is enabled but DATABASE_URL is not set")
+                return None
+        except Exception as e:
+            logger.error(f"Error connecting to database for metrics persistence: {e}")
+            return None
+
+        spool = self.create_spool()
+        writer = MetricsWriteBehindQueue(
+            sink=lambda events: get_database().insert_metrics(events),
+            max_queue_size=int(self.setting('WRITE_QUEUE_SIZE', '10000')),
+            batch_size=int(self.setting('WRITE_BATCH_SIZE', '500')),
+            flush_interval=float(self.setting('WRITE_FLUSH_INTERVAL_SECONDS', '1.0')),
+            spool=spool,
+            retry_interval=float(self.setting('SPOOL_RETRY_SECONDS', '5')),
+            is_data_error=is_data_error,
+            registry=self.registry
+        )
+        # Write out queued events when the process exits
+        atexit.register(writer.stop)
+        if spool is not None and spool.pending():
+            # Replay events left on disk by a previous run without waiting for traffic
+            writer.start()
+        return writer
+
+    def create_session_aggregator(self) -> SessionAggregator:
+        """
+        Create the per-conversation aggregator fed by record_events
+
+        Finished conversations are written to ai_conversations whenever a
+        database is configured; set PERSIST_SESSIONS=false to only export
+        the ai_conversation_* histograms.
+        """
+        persist = False
+        if self.setting('PERSIST_SESSIONS', 'true').lower() == 'true':
+            try:
+                persist = get_database() is not None
+            except Exception as e:
+                logger.error(f"Error connecting to database for session persistence: {e}")
+
+        aggregator = SessionAggregator(
+            idle_timeout=float(self.setting('SESSION_IDLE_SECONDS', '1800')),
+            max_sessions=int(self.setting('SESSION_MAX_LIVE', '10000')),
+            sweep_interval=float(self.setting('SESSION_SWEEP_SECONDS', '30')),
+            sink=(lambda sessions: get_database().insert_conversations(sessions)) if persist else None,
+            registry=self.registry
+        )
+        if persist:
+            # Write out live conversations when the process exits
+            atexit.register(aggregator.close)
+        return aggregator
+
+    def create_spool(self) -> Optional[SegmentSpool]:
+        """
+        Create the on-disk spool that holds events while the database is down
+
+        Set SPOOL_DIR to an empty string to disable it (events are then
+        dropped when the database fails or the queue is full).
+
+        Returns:
+            Spool instance, or None if spooling is disabled
+        """
+        directory = self.setting('SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'mlops-spool'))
+        if not directory:
+            return None
+        return SegmentSpool(
+            directory,
+            segment_bytes=int(float(self.setting('SPOOL_SEGMENT_MB', '16')) * 1024 * 1024),
+            max_bytes=int(float(self.setting('SPOOL_MAX_MB', '1024')) * 1024 * 1024),
+            fsync=self.setting('SPOOL_FSYNC', 'false').lower() == 'true',
+            registry=self.registry
+        )
+
+    def create_archiver(self):
+        """
+        Create the Parquet archive of ingested events (see archive.py)
+
+        Returns:
+            ParquetArchiver instance, or None unless ARCHIVE_DIR is set and
+            pyarrow is installed
+        """
+        directory = self.setting('ARCHIVE_DIR')
+        if not directory:
+            return None
+        # Imported here: pyarrow alone takes longer to import than the rest of the service
+        from archive import ParquetArchiver
+        try:
+            archiver = ParquetArchiver(
+                directory,
+                row_group_size=int(self.setting('ARCHIVE_ROW_GROUP_SIZE', '10000')),
+                min_row_group_size=int(self.setting('ARCHIVE_MIN_ROW_GROUP_SIZE', '1000')),
+                flush_interval=float(self.setting('ARCHIVE_FLUSH_INTERVAL_SECONDS', '60')),
+                roll_interval=float(self.setting('ARCHIVE_ROLL_INTERVAL_SECONDS', '900')),
+                max_clock_skew=float(self.setting('ARCHIVE_MAX_CLOCK_SKEW_SECONDS', '3600')),
+                registry=self.registry
+            )
+        except RuntimeError as e:
+            logger.warning("ARCHIVE_DIR is set but the archive is disabled: %s", e)
+            return None
+        # Publish open files when the process exits
+        atexit.register(archiver.stop)
+        return archiver
+
+    def update_prometheus_metrics(self, event: MetricEvent) -> bool:
+        """
+        Update Prometheus metrics with the received data
+
+        Args:
+            event: Validated metrics event
+
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            business_id = event.business_id
+            response_type = event.response_type
+            model_name = event.model_name
+
+            # Update response time histogram
+            if event.response_time_ms is not None:
+                response_time_seconds = event.response_time_ms / 1000.0
+                self.ai_response_time.observe(response_time_seconds)
+                self.latency_sketches.add(business_id, model_name, response_time_seconds)
+
+            # Increment request counter
+            self.ai_requests_guard.labels(business_id, response_type, event.intent_detected).inc()
+
+            # Update token usage
+            if event.tokens_used is not None:
+                self.ai_tokens_used_guard.labels(business_id, model_name).inc(event.tokens_used)
+
+            # Update API costs
+            if event.api_cost_usd is not None:
+                self.ai_api_cost_guard.labels(business_id, model_name).inc(event.api_cost_usd)
+
+            # Update business metrics
+            if event.appointment_requested:
+                self.appointments_requested_guard.labels(business_id).inc()
+
+            if event.appointment_booked:
+                self.appointments_booked_guard.labels(business_id).inc()
+
+            if event.human_handoff_requested:
+                reason = 'error' if response_type == 'error' else 'complex_query'
+                self.human_handoffs_guard.labels(business_id=business_id, reason=reason).inc()
+
+            self.exposition_cache.mark_dirty()
+            logger.debug("Updated Prometheus metrics for business %s", business_id)
+            return True
+
+        except Exception as e:
+            logger.error(f"Error updating Prometheus metrics: {e}")
+            return False
+
+    def update_prometheus_metrics_batch(self, events: List[MetricEvent]) -> bool:
+        """
+        Apply many events to the Prometheus collectors in one pass
+
+        Increments are summed per label set first, so each counter child is
+        touched once per batch instead of once per event.
+
+        Args:
+            events: Validated metrics events
+
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            request_counts = defaultdict(int)
+            token_totals = defaultdict(float)
+            cost_totals = defaultdict(float)
+            requested_counts = defaultdict(int)
+            booked_counts = defaultdict(int)
+            handoff_counts = defaultdict(int)
+            latency_observations = []
+
+            for event in events:
+                business_id = event.business_id
+                response_type = event.response_type
+                model_name = event.model_name
+
+                if event.response_time_ms is not None:
+                    response_time_seconds = event.response_time_ms / 1000.0
+                    self.ai_response_time.observe(response_time_seconds)
+                    latency_observations.append((business_id, model_name, response_time_seconds))
+
+                request_counts[(business_id, response_type, event.intent_detected)] += 1
+
+                if event.tokens_used is not None:
+                    token_totals[(business_id, model_name)] += event.tokens_used
+
+                if event.api_cost_usd is not None:
+                    cost_totals[(business_id, model_name)] += event.api_cost_usd
+
+                if event.appointment_requested:
+                    requested_counts[business_id] += 1
+
+                if event.appointment_booked:
+                    booked_counts[business_id] += 1
+
+                if event.human_handoff_requested:
+                    reason = 'error' if response_type == 'error' else 'complex_query'
+                    handoff_counts[(business_id, reason)] += 1
+
+            for (business_id, response_type, intent), count in request_counts.items():
+                self.ai_requests_guard.labels(
+                    business_id=business_id,
+                    response_type=response_type,
+                    intent=intent
+                ).inc(count)
+
+            for (business_id, model_name), total in token_totals.items():
+                self.ai_tokens_used_guard.labels(business_id=business_id, model_name=model_name).inc(total)
+
+            for (business_id, model_name), total in cost_totals.items():
+                self.ai_api_cost_guard.labels(business_id=business_id, model_name=model_name).inc(total)
+
+            for business_id, count in requested_counts.items():
+                self.appointments_requested_guard.labels(business_id=business_id).inc(count)
+
+            for business_id, count in booked_counts.items():
+                self.appointments_booked_guard.labels(business_id=business_id).inc(count)
+
+            for (business_id, reason), count in handoff_counts.items():
+                self.human_handoffs_guard.labels(business_id=business_id, reason=reason).inc(count)
+
+            self.latency_sketches.add_many(latency_observations)
+            self.exposition_cache.mark_dirty()
+
+            logger.debug("Updated Prometheus metrics for batch of %d events", len(events))
+            return True
+
+        except Exception as e:
+            logger.error(f"Error updating Prometheus metrics batch: {e}")
+            return False
+
+    def record_rollups(self, events: List[MetricEvent]):
+        """
+        Fold events into the analytics rollups and rate windows, refresh
+        ai_success_rate and drop stale cached responses
+
+        Args:
+            events: Validated metrics events
+        """
+        try:
+            now = time.time()
+            for event in events:
+                self.rollup_store.record(event, now)
+                self.rate_windows.record(event, now)
+            for business_id in {event.business_id for event in events}:
+                self.analytics_cache.invalidate(business_id)
+                success_rate = self.rate_windows.success_rate(business_id, '1h')
+                if success_rate is not None:
+                    self.ai_success_rate_guard.labels(business_id).set(success_rate)
+        except Exception as e:
+            logger.error(f"Error updating analytics rollups: {e}")
+
+    def record_events(self, events: List[MetricEvent]):
+        """Feed accepted events to the rollups, live stream, conversation sessions and archive"""
+        self.record_rollups(events)
+        self.live_stream.record(events)
+        self.sessions.record(events)
+        archiver = self.archiver
+        if archiver is not None:
+            archiver.record(events)
+
+    def store_metrics_in_db(self, metrics_data: MetricEvent) -> bool:
+        """
+        Queue metrics for storage in the database
+        The write-behind queue persists them in batches off the request path;
+        without PERSIST_METRICS, Next.js stores the metrics itself
+
+        Args:
+            metrics_data: Validated metrics event
+
+        Returns:
+            True if the event was accepted for storage, False otherwise
+        """
+        try:
+            if self.metrics_writer is None:
+                # Database storage is handled by Next.js side
+                return True
+
+            return self.metrics_writer.put(metrics_data)
+        except Exception as e:
+            logger.error(f"Error processing metrics: {e}")
+            return False
+
+    def store_metrics_batch_in_db(self, events: List[MetricEvent]) -> bool:
+        """
+        Queue a batch of metrics events for storage
+
+        Args:
+            events: Validated metrics events
+
+        Returns:
+            True if every event was accepted for storage, False if none
+            were (the write-behind queue takes a batch whole or not at all)
+        """
+        try:
+            if self.metrics_writer is None:
+                return True
+            return self.metrics_writer.put_many(events)
+        except Exception as e:
+            logger.error(f"Error processing metrics batch: {e}")
+            return False
+
+    def seed_rollups_from_db(self) -> bool:
+        """
+        Load rollups for the retention windows from ai_metrics on startup
+
+        Hour buckets cover METRICS_RETENTION_DAYS and minute buckets cover
+        the minute retention, so short analytics periods are right straight
+        after a restart too.
+
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            db = get_database()
+            if db is None:
+                return False
+
+            now = datetime.utcnow()
+            store = self.rollup_store
+            levels = [
+                (db.hour_bucket('created_at'), now - timedelta(days=self.metrics_retention_days), store.add_hour),
+                (db.minute_bucket('created_at'), now - timedelta(minutes=store.minute_retention), store.add_minute)
+            ]
+            buckets = 0
+            for bucket_start, cutoff, add in levels:
+                query = f"""
+                SELECT
+                    COALESCE(business_id, 'unknown') AS business_id,
+                    {bucket_start} AS bucket_start,
+                    COUNT(*) AS count,
+                    COALESCE(SUM(response_time_ms), 0) AS response_time_ms_sum,
+                    COALESCE(SUM(tokens_used), 0) AS tokens_used,
+                    COALESCE(SUM(api_cost_usd), 0) AS api_cost_usd,
+                    SUM(CASE WHEN appointment_requested THEN 1 ELSE 0 END) AS appointment_requests,
+                    SUM(CASE WHEN appointment_booked THEN 1 ELSE 0 END) AS appointments_booked,
+                    SUM(CASE WHEN human_handoff_requested THEN 1 ELSE 0 END) AS human_handoffs
+                FROM ai_metrics
+                WHERE created_at >= %s
+                GROUP BY COALESCE(business_id, 'unknown'), {bucket_start}
+                """
+
+                for chunk in db.stream(query, (cutoff.strftime('%Y-%m-%d %H:%M:%S'),),
+                                       chunk_size=self.fetch_chunk_size):
+                    for row in chunk:
+                        start = row['bucket_start']
+                        if isinstance(start, str):
+                            start = datetime.strptime(start, '%Y-%m-%d %H:%M:%S')
+                        bucket = RollupBucket()
+                        for field in RollupBucket.__slots__:
+                            setattr(bucket, field, float(row[field] or 0))
+                        add(row['business_id'], calendar.timegm(start.timetuple()), bucket)
+                        buckets += 1
+
+            logger.info(f"Seeded analytics rollups with {buckets} minute and hourly buckets")
+            return True
+
+        except Exception as e:
+            logger.error(f"Error seeding analytics rollups: {e}")
+            return False
+
+    def fetch_metrics_from_db(self, chunk_size: int = None) -> bool:
+        """
+        Replay the last METRICS_RETENTION_DAYS of ai_metrics into Prometheus
+
+        Rows are streamed in fixed-size chunks over a pooled connection and
+        each chunk is applied to the collectors before the next one is read,
+        so memory stays flat however many rows the window contains.
+
+        Args:
+            chunk_size: Rows per chunk (defaults to FETCH_CHUNK_SIZE)
+
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            db = get_database()
+            if db is None:
+                logger.warning("DATABASE_URL not configured, skipping metrics fetch")
+                return False
+
+            logger.info("Fetching historical metrics from database...")
+
+            cutoff = datetime.utcnow() - timedelta(days=self.metrics_retention_days)
+            total_rows = 0
+            with self._refresh_lock:
+                for chunk in db.stream(METRICS_QUERY,
+                                       (cutoff.strftime('%Y-%m-%d %H:%M:%S'),),
+                                       chunk_size=chunk_size or self.fetch_chunk_size):
+                    if not self.update_prometheus_metrics_batch([row_to_metrics_data(row) for row in chunk]):
+                        return False
+                    total_rows += len(chunk)
+                    # Rows are ordered by id, so the last row is the newest seen
+                    self.advance_watermark(chunk[-1]['id'], chunk[-1]['created_at'])
+
+                # The counters now hold exactly what was replayed
+                self.seed_db_totals_from_collectors()
+
+            logger.info(f"Replayed {total_rows} historical metrics rows from database")
+            return True
+
+        except Exception as e:
+            logger.error(f"Error fetching metrics from database: {e}")
+            return False
+
+    def advance_watermark(self, row_id: Any, created_at: Any):
+        """Move the refresh watermark forward to the given row"""
+        if row_id is not None and int(row_id) > self._watermark['id']:
+            self._watermark['id'] = int(row_id)
+            self._watermark['created_at'] = created_at
+
+    def resolve_db_totals(self, totals: Dict[Tuple[str, tuple], float]) -> Dict[Tuple[str, tuple], float]:
+        """
+        Re-key database totals by the counter child they are recorded in
+
+        Label sets the cardinality guard folds into one __other__ child are
+        summed, so that child is reconciled against the total of all of them.
+        """
+        resolved: Dict[Tuple[str, tuple], float] = defaultdict(float)
+        for (name, labels), total in totals.items():
+            if name != 'ai_response_time_seconds':
+                labels = self.db_counter_guards[name].resolve(tuple(str(value) for value in labels))
+            resolved[(name, labels)] += total
+        return resolved
+
+    def queue_db_total_fold(self, name: str, evicted: tuple, folded: tuple):
+        """
+        Record that a guard moved an evicted child's counts into __other__
+
+        Called from request threads while the guard holds its lock, so the
+        move is only queued here and applied by apply_pending_folds().
+        """
+        if (name, evicted) in self._db_totals:
+            self._pending_folds.append((name, evicted, folded))
+
+    def apply_pending_folds(self):
+        """Move queued evictions' database totals to their __other__ keys (_refresh_lock held)"""
+        while self._pending_folds:
+            name, evicted, folded = self._pending_folds.popleft()
+            self._db_totals[(name, folded)] += self._db_totals.pop((name, evicted), 0.0)
+
+    def raise_to_db_totals(self, keys):
+        """
+        Bring counter children up to their database-derived totals
+
+        A child is only incremented by the amount it is behind the database.
+        Events this process already counted through /track are therefore not
+        counted again when their rows are read back, while rows written via
+        other replicas are picked up.
+
+        Args:
+            keys: (metric name, resolved label values) keys of _db_totals to
+                reconcile (see resolve_db_totals)
+        """
+        for key in keys:
+            name, labels = key
+            target = self._db_totals[key]
+            if target <= 0:
+                continue
+
+            if name == 'ai_response_time_seconds':
+                if labels == ('sum',):
+                    cell = sum_cell(self.ai_response_time)
+                else:
+                    cell = bucket_cells(self.ai_response_time)[labels[0]]
+            else:
+                cell = counter_cell(self.db_counters[name].labels(*labels))
+            raise_to(cell, target)
+
+    def seed_db_totals_from_collectors(self):
+        """Record current counter values as the database-derived totals"""
+        for name, collector in self.db_counters.items():
+            for labels, child in children(collector):
+                self._db_totals[(name, labels)] = counter_cell(child).get()
+        for index, bucket in enumerate(bucket_cells(self.ai_response_time)):
+            self._db_totals[('ai_response_time_seconds', (index,))] = bucket.get()
+        self._db_totals[('ai_response_time_seconds', ('sum',))] = sum_cell(self.ai_response_time).get()
+
+    def apply_db_aggregates(self, raise_counters: bool = True) -> Optional[int]:
+        """
+        Fold GROUP BY aggregates of rows above the watermark into Prometheus
+
+        The database does the summing and each counter child is then touched
+        once, so cost scales with label cardinality, not with row count. On
+        startup the watermark is 0 and this rebuilds the whole window; later
+        calls only read rows added since.
+
+        Args:
+            raise_counters: False only advances the watermark and database
+                totals, for counters that already include the rows (see
+                write_snapshot)
+
+        Returns:
+            Number of rows folded in, or None if the query failed
+        """
+        db = get_database()
+        if db is None:
+            logger.warning("DATABASE_URL not configured, skipping metrics aggregation")
+            return None
+
+        cutoff = datetime.utcnow() - timedelta(days=self.metrics_retention_days)
+
+        with self._refresh_lock:
+            delta = defaultdict(float)
+            newest = (self._watermark['id'], self._watermark['created_at'])
+            rows = 0
+            for chunk in db.stream(build_aggregate_query(),
+                                   (cutoff.strftime('%Y-%m-%d %H:%M:%S'), self._watermark['id']),
+                                   chunk_size=self.fetch_chunk_size):
+                for row in chunk:
+                    accumulate_aggregate_row(row, delta)
+                    rows += int(row['requests'])
+                    if int(row['max_id']) > newest[0]:
+                        newest = (int(row['max_id']), row['max_created_at'])
+
+            delta = self.resolve_db_totals(delta)
+            self.apply_pending_folds()
+            for key, total in delta.items():
+                self._db_totals[key] += total
+            if raise_counters:
+                self.raise_to_db_totals(delta.keys())
+            self.advance_watermark(*newest)
+            self.exposition_cache.mark_dirty()
+
+        return rows
+
+    def aggregate_metrics_from_db(self) -> bool:
+        """
+        Rebuild Prometheus counters from GROUP BY aggregates
+
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            logger.info("Aggregating historical metrics in database...")
+            rows = self.apply_db_aggregates()
+            if rows is None:
+                return False
+            logger.info(f"Rebuilt Prometheus metrics from {rows} rows (watermark id {self._watermark['id']})")
+            return True
+
+        except Exception as e:
+            logger.error(f"Error aggregating metrics from database: {e}")
+            return False
+
+    def rebuild_prometheus_metrics_from_db(self):
+        """
+        Rebuild Prometheus metrics from database on startup
+        This ensures continuity across service restarts
+        """
+        try:
+            logger.info(f"Rebuilding Prometheus metrics from database ({self.rebuild_mode} mode)...")
+
+            # Fetch and rebuild metrics
+            if self.rebuild_mode == 'replay':
+                success = self.fetch_metrics_from_db()
+            else:
+                success = self.aggregate_metrics_from_db()
+
+            if success:
+                logger.info("Successfully rebuilt Prometheus metrics from database")
+            else:
+                logger.warning("Could not rebuild metrics from database, starting fresh")
+            return success
+
+        except Exception as e:
+            logger.error(f"Error rebuilding Prometheus metrics: {e}")
+            return False
+
+    def refresh_metrics_from_db(self) -> bool:
+        """
+        Incrementally apply ai_metrics rows added since the last refresh
+
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            rows = self.apply_db_aggregates()
+            if rows is None:
+                return False
+            logger.info(f"Refreshed Prometheus metrics with {rows} new rows (watermark id {self._watermark['id']})")
+            return True
+        except Exception as e:
+            logger.error(f"Error refreshing metrics from database: {e}")
+            return False
+
+    def _run_scheduled_refresh(self):
+        # Clear first so triggers arriving during the refresh schedule the next one
+        with self._refresh_timer_lock:
+            self._refresh_timer = None
+        self.refresh_metrics_from_db()
+
+    def schedule_refresh(self) -> bool:
+        """
+        Schedule a background refresh, merging triggers within the debounce window
+
+        Returns:
+            True if a new refresh was scheduled, False if one was already pending
+        """
+        with self._refresh_timer_lock:
+            if self._refresh_timer is not None:
+                return False
+            self._refresh_timer = threading.Timer(self.refresh_debounce_seconds, self._run_scheduled_refresh)
+            self._refresh_timer.daemon = True
+            self._refresh_timer.start()
+            return True
+
+    def watermark(self) -> Dict[str, Any]:
+        """Newest ai_metrics row applied so far, for API responses"""
+        return {
+            'id': self._watermark['id'],
+            'created_at': str(self._watermark['created_at']) if self._watermark['created_at'] else None
+        }
+
+    def snapshot_state(self) -> Dict[str, Any]:
+        """Database watermark and totals stored alongside each registry snapshot"""
+        with self._refresh_lock:
+            self.apply_pending_folds()
+            return {
+                'watermark': dict(self._watermark),
+                'db_totals': [[name, list(labels), value] for (name, labels), value in self._db_totals.items()]
+            }
+
+    def create_snapshotter(self) -> Optional[RegistrySnapshotter]:
+        """
+        Create the warm-restart snapshotter (see snapshot.py)
+
+        Returns:
+            Snapshotter instance, or None unless SNAPSHOT_PATH is set
+        """
+        path = self.setting('SNAPSHOT_PATH', '')
+        if not path:
+            return None
+        return RegistrySnapshotter(
+            path,
+            source=self.build_scrape_registry(),
+            target=self.registry,
+            interval=float(self.setting('SNAPSHOT_INTERVAL_SECONDS', '60')),
+            state=self.snapshot_state,
+            registry=self.registry
+        )
+
+    def write_snapshot(self) -> bool:
+        """
+        Write a registry snapshot now
+
+        In multiprocess mode this runs in the gunicorn master, periodically
+        (start_master_snapshots) and once every worker has exited (on_exit
+        in gunicorn.conf.py). Workers don't refresh from the database
+        there, so the master's watermark lags behind the counters, which
+        include every event the workers tracked. The watermark and
+        database totals are therefore first moved up to the rows the
+        workers stored, without raising counters that already include them.
+        Otherwise the next startup would read those rows back from a stale
+        watermark.
+
+        Returns:
+            True if the snapshot was written
+        """
+        if self.snapshotter is None:
+            return False
+        if self.multiprocess and get_database() is not None:
+            try:
+                self.apply_db_aggregates(raise_counters=False)
+            except Exception as e:
+                # The previous snapshot's watermark still matches its counters
+                logger.error("Not writing a registry snapshot, could not advance its watermark: %s", e)
+                return False
+        return self.snapshotter.write()
+
+    def restore_registry_snapshot(self) -> bool:
+        """
+        Restore counters, the watermark and database totals from the last snapshot
+
+        Returns:
+            True if a snapshot was restored
+        """
+        if self.snapshotter is None:
+            return False
+        snapshot = self.snapshotter.load()
+        if snapshot is None:
+            return False
+
+        def child_for(collector, labelvalues: tuple):
+            # Restored series count against the cardinality cap like new ones
+            metric_guard = self.guards_by_metric.get(id(collector))
+            if metric_guard is None or OVERFLOW_LABEL_VALUE in labelvalues:
+                return default_child(collector, labelvalues)
+            return metric_guard.labels(*labelvalues)
+
+        with self._refresh_lock:
+            # Totals first, so folds made while restoring children find them
+            for name, labels, value in snapshot.get('db_totals', []):
+                self._db_totals[(name, tuple(labels))] = value
+            restored = self.snapshotter.restore(snapshot, child_for)
+            self.apply_pending_folds()
+            watermark = snapshot.get('watermark') or {}
+            self.advance_watermark(watermark.get('id'), watermark.get('created_at'))
+        self.exposition_cache.mark_dirty()
+
+        logger.info(f"Restored {restored} series from registry snapshot taken "
+                    f"{time.time() - snapshot.get('taken_at', time.time()):.0f}s ago "
+                    f"(watermark id {self._watermark['id']})")
+        return True
+
+    def warm_start_metrics(self) -> bool:
+        """
+        Bring Prometheus metrics up to date on startup
+
+        With a snapshot, only ai_metrics rows above the restored watermark are
+        read; without one, the whole retention window is rebuilt.
+
+        Returns:
+            True if successful, False otherwise
+        """
+        if self.restore_registry_snapshot():
+            return self.refresh_metrics_from_db()
+        return self.rebuild_prometheus_metrics_from_db()
+
+    def start_master_snapshots(self):
+        """
+        Write snapshots every SNAPSHOT_INTERVAL_SECONDS from the gunicorn master
+
+        Called from when_ready in gunicorn.conf.py, so a SIGKILL or OOM kill
+        loses at most one interval instead of everything since startup. The
+        master keeps forking workers, on startup and whenever one is replaced.
+        A lock held across each fork makes the fork wait for a write in
+        progress, so a worker never inherits a lock taken mid-write. The
+        database pool is closed after every write, so no worker inherits a
+        connection either.
+        """
+        if self.snapshotter is None:
+            return
+        fork_lock = threading.Lock()
+        os.register_at_fork(before=fork_lock.acquire,
+                            after_in_parent=fork_lock.release,
+                            after_in_child=fork_lock.release)
+
+        def write():
+            with fork_lock:
+                self.write_snapshot()
+                database = get_database()
+                if database is not None:
+                    database.close()
+
+        self.snapshotter.start(write=write)
+
+    def write_snapshot_on_sigterm(self):
+        """
+        Write a final snapshot when the process is asked to stop
+
+        The previous SIGTERM handler runs afterwards. gunicorn installs its own
+        handlers, so there the final snapshot is written by the on_exit hook in
+        gunicorn.conf.py instead. Nothing is written before the startup
+        restore has finished, so an early stop keeps the previous snapshot.
+        """
+        snapshotter = self.snapshotter
+        if (snapshotter is None or self.multiprocess
+                or threading.current_thread() is not threading.main_thread()):
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def handle_sigterm(signum, frame):
+            if self.ready.is_set():
+                self.write_snapshot()
+            signal.signal(signal.SIGTERM, previous if previous is not None else signal.SIG_DFL)
+            if callable(previous):
+                previous(signum, frame)
+            elif previous != signal.SIG_IGN:
+                os.kill(os.getpid(), signum)
+
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+    def seed_live_stream(self):
+        """Start the /stream totals from the (possibly rebuilt) Prometheus counters"""
+        def total(metric) -> float:
+            return sum(sample.value for family in metric.collect() for sample in family.samples
+                       if sample.name.endswith('_total'))
+
+        self.live_stream.seed({
+            'requests': total(self.ai_requests_total),
+            'tokens_used': total(self.ai_tokens_used),
+            'api_cost_usd': total(self.ai_api_cost),
+            'appointments_requested': total(self.appointments_requested),
+            'appointments_booked': total(self.appointments_booked),
+            'human_handoffs': total(self.human_handoffs)
+        })
+
+    def build_analytics(self, business_id: str, period: str) -> Dict[str, Any]:
+        """
+        Summarise a business's rollups for one analytics period
+
+        Args:
+            business_id: UUID of the business
+            period: Key of ANALYTICS_PERIODS
+
+        Returns:
+            Analytics response body
+        """
+        totals = self.rollup_store.summary(business_id, ANALYTICS_PERIODS[period])
+        count = totals.count
+
+        return {
+            'business_id': business_id,
+            'period': period,
+            'metrics': {
+                'total_conversations': count,
+                'avg_response_time_ms': round(totals.response_time_ms_sum / count, 1) if count else 0.0,
+                'avg_tokens_used': round(totals.tokens_used / count, 1) if count else 0.0,
+                'total_api_cost_usd': round(totals.api_cost_usd, 6),
+                'appointment_requests': int(totals.appointment_requests),
+                'appointments_booked': int(totals.appointments_booked),
+                'human_handoffs': int(totals.human_handoffs),
+                'appointment_conversion_rate': round(
+                    totals.appointments_booked / totals.appointment_requests, 4
+                ) if totals.appointment_requests else 0.0
+            },
+            'rate_windows': self.rate_windows.rates(business_id),
+            'latency_quantiles_ms': {
+                model_name: {
+                    f'p{int(q * 100)}': round(value * 1000, 1) if value is not None else None
+                    for q, value in quantiles.items()
+                }
+                for model_name, quantiles in self.latency_sketches.quantiles(business_id).items()
+            },
+            'monitoring': 'prometheus',
+            'prometheus_metrics_url': '/metrics',
+            'timestamp': datetime.utcnow().isoformat()
+        }
+
+    def initialise(self):
+        """
+        Run the startup work and mark the service ready
+
+        Creates the ai_metrics table, restores Prometheus metrics from the
+        last snapshot plus the rows written since (or rebuilds them from the
+        database) and loads the analytics rollups. Every step degrades to
+        starting fresh, so the service becomes ready even if one fails.
+        """
+        started = time.perf_counter()
+        try:
+            self.create_metrics_table()
+            self.archiver = self.create_archiver()
+            self.warm_start_metrics()
+            # In multiprocess mode only the gunicorn master writes snapshots
+            if self.snapshotter is not None and not self.multiprocess:
+                self.snapshotter.start()
+            self.seed_rollups_from_db()
+            self.seed_live_stream()
+        except Exception as e:
+            logger.error(f"Error during service startup: {e}")
+        finally:
+            self.ready.set()
+        logger.info(f"Service ready after {time.perf_counter() - started:.2f}s of startup work")
+
+    def start(self, background: bool = True):
+        """
+        Run initialise(), by default in a background thread
+
+        The process can answer liveness probes while the database rebuild
+        runs; /ready reports 503 until it has finished.
+        """
+        # Signal handlers can only be installed from the main thread
+        self.write_snapshot_on_sigterm()
+        if not background:
+            self.initialise()
+            return
+        threading.Thread(target=self.initialise, name='service-startup', daemon=True).start()
+
+    def wait_until_ready(self, timeout: Optional[float] = None) -> bool:
+        """Block until initialise() has finished; False on timeout"""
+        return self.ready.wait(timeout)
+
+    def start_after_fork(self):
+        """
+        Start the background threads in a forked worker
+
+        Starts the flusher right away so events a previous worker left in
+        the spool are replayed without waiting for traffic.
+        """
+        if self.metrics_writer is not None:
+            self.metrics_writer.start()
+        # No snapshotter: workers would overwrite each other's SNAPSHOT_PATH
+        # with stale watermarks; the master writes it once they have exited
+        self.start_stream_server()
+
+    def start_stream_server(self):
+        """
+        Serve /stream on STREAM_PORT, outside the gunicorn request pool
+
+        Only with a single worker: every worker would need its own port,
+        and each one's stream only covers the events that worker received.
+        """
+        if not self.stream_port or self.stream_server is not None:
+            return
+        if self.workers > 1:
+            logger.warning("STREAM_PORT ignored with WEB_CONCURRENCY=%d; /stream is served from "
+                           "each worker's request pool", self.workers)
+            return
+        try:
+            self.stream_server = serve_stream(self.live_stream, self.stream_port)
+        except OSError as e:
+            logger.error("Could not serve /stream on port %d: %s", self.stream_port, e)
+
+    def stream_url(self, host: str) -> Optional[str]:
+        """URL of the dedicated /stream listener as seen by a client of `host`, or None"""
+        if self.stream_server is None:
+            return None
+        hostname = urlsplit(f'//{host}').hostname or 'localhost'
+        if ':' in hostname:
+            hostname = f'[{hostname}]'
+        port = self.stream_public_port or self.stream_server.server_port
+        return f'http://{hostname}:{port}/stream'
+
+    def release_process_resources(self):
+        """
+        Stop background threads and close pooled connections before forking
+
+        gunicorn.conf.py preloads the app in the master process, so the
+        startup rebuild runs once rather than once per worker. Threads
+        don't survive a fork and connections must not be shared with workers;
+        each worker reopens both lazily on first use.
+        """
+        if self.metrics_writer is not None:
+            self.metrics_writer.stop()
+        if self.archiver is not None:
+            self.archiver.stop()
+        self.sessions.stop()
+        if self.snapshotter is not None:
+            self.snapshotter.stop()
+        if self.stream_server is not None:
+            self.stream_server.shutdown()
+            self.stream_server.server_close()
+            self.stream_server = None
+        database = get_database()
+        if database is not None:
+            database.close()
@@ -0,0 +1,372 @@
+"""
+Per-conversation session aggregates
+Lab 2: AI Lifecycle & MLOps Integration
+
+Every /track event carries the conversation_id and session_id of the chat
+turn it describes, but the ai_* metrics only count turns. Turns per
+conversation, the latency of a whole conversation, or whether it ended in
+a booking or a handoff would otherwise need a GROUP BY conversation_id
+over the raw ai_metrics rows.
+
+SessionAggregator folds events into one running total per conversation_id:
+turns, tokens, cost, summed response time and the booking/handoff flags.
+A conversation is finished when:
+- no turn arrived for `idle_timeout` seconds ('idle', found by a sweep
+  that runs every `sweep_interval` seconds)
+- max_sessions conversations are live and a new one starts; the one idle
+  the longest is finished early ('evicted')
+- the process exits ('shutdown')
+
+Finished conversations are observed in the ai_conversation_* histograms,
+labelled by outcome (booked, handoff, requested or none), and handed to
+`sink` as ai_conversations rows by the sweep thread. Live sessions are an
+OrderedDict in last-seen order, so recording a turn, sweeping and evicting
+are all O(1) per session.
+
+Sessions live in one process. With several gunicorn workers, the turns of
+one conversation can land on different workers and are then reported as
+separate rows; summing the rows of a conversation_id gives its totals. A
+conversation that resumes after it was finished also gets a new row.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+TURN_BUCKETS = [1, 2, 3, 5, 8, 13, 21, 34]
+TOKEN_BUCKETS = [100, 500, 1000, 2500, 5000, 10000, 25000, 50000]
+COST_BUCKETS = [0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0]
+DURATION_BUCKETS = [10, 30, 60, 120, 300, 600, 1800, 3600]
+
+
+def _timestamp(seconds: float) -> str:
+    """UTC timestamp in the format the ai_metrics created_at column uses"""
+    return datetime.utcfromtimestamp(seconds).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class ConversationSession:
+    """Running totals of one live conversation"""
+
+    __slots__ = ('business_id', 'conversation_id', 'session_id', 'started_at', 'last_seen', 'turns',
+                 'tokens_used', 'api_cost_usd', 'response_time_ms_sum', 'appointment_requested',
+                 'appointment_booked', 'human_handoff_requested')
+
+    def __init__(self, business_id: str, conversation_id: str, session_id: str, now: float):
+        self.business_id = business_id
+        self.conversation_id = conversation_id
+        self.session_id = session_id
+        self.started_at = now
+        self.last_seen = now
+        self.turns = 0
+        self.tokens_used = 0
+        self.api_cost_usd = 0.0
+        self.response_time_ms_sum = 0
+        self.appointment_requested = False
+        self.appointment_booked = False
+        self.human_handoff_requested = False
+
+    def add(self, event: Any, now: float):
+        self.last_seen = now
+        self.turns += 1
+        self.tokens_used += event.get('tokens_used') or 0
+        self.api_cost_usd += event.get('api_cost_usd') or 0.0
+        self.response_time_ms_sum += event.get('response_time_ms') or 0
+        self.appointment_requested = self.appointment_requested or bool(event.get('appointment_requested'))
+        self.appointment_booked = self.appointment_booked or bool(event.get('appointment_booked'))
+        self.human_handoff_requested = (self.human_handoff_requested
+                                        or bool(event.get('human_handoff_requested')))
+
+    @property
+    def outcome(self) -> str:
+        if self.appointment_booked:
+            return 'booked'
+        if self.human_handoff_requested:
+            return 'handoff'
+        if self.appointment_requested:
+            return 'requested'
+        return 'none'
+
+    @property
+    def duration(self) -> float:
+        """Seconds from the first to the last turn"""
+        return self.last_seen - self.started_at
+
+    def to_row(self, end_reason: str) -> Dict[str, Any]:
+        """The session as an ai_conversations row"""
+        return {
+            'business_id': self.business_id,
+            'conversation_id': self.conversation_id,
+            'session_id': self.session_id,
+            'started_at': _timestamp(self.started_at),
+            'ended_at': _timestamp(self.last_seen),
+            'turns': self.turns,
+            'tokens_used': self.tokens_used,
+            'api_cost_usd': self.api_cost_usd,
+            'response_time_ms_sum': self.response_time_ms_sum,
+            'appointment_requested': self.appointment_requested,
+            'appointment_booked': self.appointment_booked,
+            'human_handoff_requested': self.human_handoff_requested,
+            'outcome': self.outcome,
+            'end_reason': end_reason
+        }
+
+
+class SessionAggregator:
+    """
+    Bounded map of live conversations, finished on idleness or at the cap
+
+    Args:
+        idle_timeout: Seconds without a turn after which a conversation is finished
+        max_sessions: Live conversations kept before the idlest is finished early
+        sweep_interval: Seconds between sweeps for idle sessions
+        sink: Callable that persists a list of finished sessions (ai_conversations
+            rows); called from the sweep thread
+        max_pending: Finished sessions held for the sink while it is failing
+        registry: Prometheus registry for the aggregator's metrics
+    """
+
+    def __init__(self, idle_timeout: float = 1800.0, max_sessions: int = 10000, sweep_interval: float = 30.0,
+                 sink: Optional[Callable[[List[Dict[str, Any]]], Any]] = None, max_pending: int = 10000,
+                 registry=REGISTRY):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.sweep_interval = sweep_interval
+        self.sink = sink
+        self.max_pending = max_pending
+
+        self._sessions: 'OrderedDict[str, ConversationSession]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending: List[Dict[str, Any]] = []
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+        self.turns = Histogram(
+            'ai_conversation_turns',
+            'Turns per finished conversation',
+            ['outcome'],
+            buckets=TURN_BUCKETS,
+            registry=registry
+        )
+        self.tokens = Histogram(
+            'ai_conversation_tokens',
+            'Tokens used per finished conversation',
+            ['outcome'],
+            buckets=TOKEN_BUCKETS,
+            registry=registry
+        )
+        self.cost = Histogram(
+            'ai_conversation_cost_usd',
+            'API cost in USD per finished conversation',
+            ['outcome'],
+            buckets=COST_BUCKETS,
+            registry=registry
+        )
+        self.duration = Histogram(
+            'ai_conversation_duration_seconds',
+            'Time from the first to the last turn of a finished conversation',
+            ['outcome'],
+            buckets=DURATION_BUCKETS,
+            registry=registry
+        )
+        self.finished = Counter(
+            'ai_conversations_finished_total',
+            'Conversations finished, by outcome and by why they were finished',
+            ['outcome', 'reason'],
+            registry=registry
+        )
+        self.active = Gauge(
+            'ai_conversations_active',
+            'Conversations with a turn in the last idle timeout',
+            registry=registry,
+            multiprocess_mode='livesum'
+        )
+        self.sink_errors = Counter(
+            'metrics_session_sink_errors_total',
+            'Failed attempts to persist finished conversations',
+            registry=registry
+        )
+        self.dropped = Counter(
+            'metrics_session_dropped_total',
+            'Finished conversations dropped because too many were waiting for the sink',
+            registry=registry
+        )
+
+    def record(self, events: Iterable[Any], now: Optional[float] = None) -> int:
+        """
+        Fold events into their conversations
+
+        Events without a conversation_id are skipped.
+
+        Returns:
+            Number of events recorded
+        """
+        now = time.time() if now is None else now
+        recorded = 0
+        evicted: List[ConversationSession] = []
+        with self._lock:
+            for event in events:
+                conversation_id = event.get('conversation_id')
+                if not conversation_id:
+                    continue
+                session = self._sessions.get(conversation_id)
+                if session is None:
+                    session = ConversationSession(event.get('business_id') or 'unknown', conversation_id,
+                                                  event.get('session_id') or 'unknown', now)
+                    self._sessions[conversation_id] = session
+                else:
+                    self._sessions.move_to_end(conversation_id)
+                session.add(event, now)
+                recorded += 1
+
+            while len(self._sessions) > self.max_sessions:
+                evicted.append(self._sessions.popitem(last=False)[1])
+            size = len(self._sessions)
+
+        self.active.set(size)
+        self._finish(evicted, 'evicted')
+        if recorded:
+            self._ensure_started()
+        return recorded
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """
+        Finish every conversation idle for longer than idle_timeout
+
+        Returns:
+            Number of conversations finished
+        """
+        cutoff = (time.time() if now is None else now) - self.idle_timeout
+        idle: List[ConversationSession] = []
+        with self._lock:
+            # Sessions are in last-seen order, so idle ones are at the front
+            while self._sessions:
+                session = next(iter(self._sessions.values()))
+                if session.last_seen > cutoff:
+                    break
+                idle.append(self._sessions.popitem(last=False)[1])
+            size = len(self._sessions)
+
+        self.active.set(size)
+        self._finish(idle, 'idle')
+        return len(idle)
+
+    def finish_all(self, reason: str = 'shutdown') -> int:
+        """Finish every live conversation, e.g. before the process exits"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        self.active.set(0)
+        self._finish(sessions, reason)
+        return len(sessions)
+
+    def _finish(self, sessions: List[ConversationSession], reason: str):
+        if not sessions:
+            return
+        rows = []
+        for session in sessions:
+            outcome = session.outcome
+            self.turns.labels(outcome).observe(session.turns)
+            self.tokens.labels(outcome).observe(session.tokens_used)
+            self.cost.labels(outcome).observe(session.api_cost_usd)
+            self.duration.labels(outcome).observe(session.duration)
+            self.finished.labels(outcome, reason).inc()
+            if self.sink is not None:
+                rows.append(session.to_row(reason))
+        if rows:
+            self._enqueue(rows)
+
+    def _enqueue(self, rows: List[Dict[str, Any]], front: bool = False):
+        with self._pending_lock:
+            self._pending = rows + self._pending if front else self._pending + rows
+            overflow = len(self._pending) - self.max_pending
+            if overflow > 0:
+                # Keep the newest sessions
+                del self._pending[:overflow]
+        if overflow > 0:
+            self.dropped.inc(overflow)
+
+    def flush(self) -> int:
+        """
+        Hand finished conversations to the sink
+
+        Rows the sink rejects are kept for the next flush, up to max_pending.
+
+        Returns:
+            Number of rows persisted
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                rows, self._pending = self._pending, []
+            if not rows or self.sink is None:
+                return 0
+            try:
+                self.sink(rows)
+            except Exception as e:
+                logger.error("Error persisting %d finished conversations: %s", len(rows), e)
+                self.sink_errors.inc()
+                self._enqueue(rows, front=True)
+                return 0
+            return len(rows)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._flush_lock:
+            if self._pid != os.getpid():
+                # Threads don't survive a fork; this process needs its own sweeper
+                self._thread = None
+                self._pid = os.getpid()
+            if self._thread is None or not self._thread.is_alive():
+                self._stop_event.clear()
+                self._thread = threading.Thread(target=self._run, name='conversation-sweep', daemon=True)
+                self._thread.start()
+
+    def start(self):
+        """Start the sweep thread (otherwise started by the first recorded turn)"""
+        self._ensure_started()
+
+    def _run(self):
+        while not self._stop_event.wait(self.sweep_interval):
+            try:
+                self.sweep()
+                self.flush()
+            except Exception as e:
+                logger.error("Error sweeping conversation sessions: %s", e)
+
+    def stop(self, timeout: float = 10.0):
+        """Stop the sweep thread and persist conversations already finished"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def close(self):
+        """Finish every live conversation and persist it"""
+        self.finish_all()
+        self.stop()
+
+    def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """Running totals of a live conversation, or None"""
+        with self._lock:
+            session = self._sessions.get(conversation_id)
+            if session is None:
+                return None
+            row = session.to_row('live')
+        del row['end_reason']
+        row['last_seen_at'] = row.pop('ended_at')
+        return row
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -0,0 +1,288 @@
+"""
+Mergeable streaming quantile sketches for response latency
+Lab 2: AI Lifecycle & MLOps Integration
+
+Implements a DDSketch-style sketch: values are counted in logarithmically
+sized bins, so any quantile is reported within a fixed relative error
+(1% by default) no matter how skewed the distribution is. Adding a value
+is O(1), memory is capped by max_bins, and two sketches with the same
+accuracy merge exactly by adding bin counts - which is what lets
+replicas combine their latency distributions.
+"""
+
+import math
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from prometheus_client.core import GaugeMetricFamily
+
+from cardinality import OVERFLOW_LABEL_VALUE
+
+# Quantiles exported to Prometheus and analytics
+DEFAULT_QUANTILES = (0.5, 0.95, 0.99)
+
+
+class DDSketch:
+    """
+    Relative-error quantile sketch
+
+    Args:
+        relative_accuracy: Maximum relative error of reported quantiles
+        max_bins: Bins kept before the lowest ones are collapsed together
+    """
+
+    __slots__ = ('relative_accuracy', 'max_bins', '_gamma', '_log_gamma',
+                 'bins', 'zero_count', 'count', 'sum', 'min', 'max')
+
+    # Values at or below this are counted as zero
+    MIN_VALUE = 1e-9
+
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.bins: Dict[int, float] = {}
+        self.zero_count = 0.0
+        self.count = 0.0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float, weight: float = 1.0):
+        """Record a (non-negative) value"""
+        self.count += weight
+        self.sum += value * weight
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+        if value <= self.MIN_VALUE:
+            self.zero_count += weight
+            return
+
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.bins[index] = self.bins.get(index, 0.0) + weight
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self):
+        # Fold the lowest bins into one; high quantiles keep full accuracy
+        keys = sorted(self.bins)
+        excess = len(keys) - self.max_bins + 1
+        target = keys[excess]
+        for key in keys[:excess]:
+            self.bins[target] += self.bins.pop(key)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Estimate the q-quantile (0 <= q <= 1)
+
+        Returns:
+            Estimated value, or None if the sketch is empty
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+
+        seen = self.zero_count
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                estimate = 2 * self._gamma ** index / (self._gamma + 1)
+                return min(max(estimate, self.min), self.max)
+        return self.max
+
+    def merge(self, other: 'DDSketch'):
+        """Add another sketch's observations to this one"""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+        for index, weight in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0.0) + weight
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        while len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialise for transfer between replicas"""
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'bins': {str(index): weight for index, weight in self.bins.items()},
+            'zero_count': self.zero_count,
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], max_bins: int = 2048) -> 'DDSketch':
+        sketch = cls(float(data['relative_accuracy']), max_bins=max_bins)
+        sketch.bins = {int(index): float(weight) for index, weight in data.get('bins', {}).items()}
+        sketch.zero_count = float(data.get('zero_count', 0))
+        sketch.count = float(data.get('count', 0))
+        sketch.sum = float(data.get('sum', 0))
+        if data.get('min') is not None:
+            sketch.min = float(data['min'])
+        if data.get('max') is not None:
+            sketch.max = float(data['max'])
+        while len(sketch.bins) > sketch.max_bins:
+            sketch._collapse()
+        return sketch
+
+
+class SketchStore:
+    """
+    One latency sketch per (business_id, model_name)
+
+    Args:
+        relative_accuracy: Accuracy of every sketch in the store
+        max_bins: Bin cap per sketch (bounds memory per key)
+        max_keys: Sketches kept before new keys are folded into __other__
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048,
+                 max_keys: Optional[int] = None):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.max_keys = max_keys
+        # business_id -> model_name -> sketch, so per-business reads don't scan every key
+        self._sketches: Dict[str, Dict[str, DDSketch]] = {}
+        self._keys = 0
+        self._lock = threading.Lock()
+
+    def _sketch(self, business_id: str, model_name: str) -> DDSketch:
+        models = self._sketches.get(business_id)
+        sketch = models.get(model_name) if models is not None else None
+        if sketch is not None:
+            return sketch
+
+        if self.max_keys is not None and self._keys >= self.max_keys:
+            business_id = model_name = OVERFLOW_LABEL_VALUE
+            models = self._sketches.get(business_id)
+            sketch = models.get(model_name) if models is not None else None
+            if sketch is not None:
+                return sketch
+
+        if models is None:
+            models = self._sketches[business_id] = {}
+        sketch = models[model_name] = DDSketch(self.relative_accuracy, self.max_bins)
+        self._keys += 1
+        return sketch
+
+    def add(self, business_id: str, model_name: str, value: float):
+        with self._lock:
+            self._sketch(business_id, model_name).add(value)
+
+    def add_many(self, observations: Iterable[Tuple[str, str, float]]):
+        """Record (business_id, model_name, value) observations under one lock"""
+        with self._lock:
+            for business_id, model_name, value in observations:
+                self._sketch(business_id, model_name).add(value)
+
+    def quantiles(self, business_id: str,
+                  quantiles: Iterable[float] = DEFAULT_QUANTILES) -> Dict[str, Dict[float, Optional[float]]]:
+        """
+        Quantiles for every model a business has used
+
+        Returns:
+            {model_name: {quantile: value}}
+        """
+        with self._lock:
+            return {
+                model_name: {q: sketch.quantile(q) for q in quantiles}
+                for model_name, sketch in self._sketches.get(business_id, {}).items()
+            }
+
+    def to_dict(self) -> List[Dict[str, Any]]:
+        """Serialise every sketch for merging on another replica"""
+        with self._lock:
+            return [
+                {'business_id': business_id, 'model_name': model_name, 'sketch': sketch.to_dict()}
+                for business_id, models in self._sketches.items()
+                for model_name, sketch in models.items()
+            ]
+
+    def merge_dict(self, data: List[Dict[str, Any]]) -> int:
+        """
+        Merge sketches serialised by to_dict() on another replica
+
+        Returns:
+            Number of sketches merged
+        """
+        incoming = [
+            (entry['business_id'], entry['model_name'], DDSketch.from_dict(entry['sketch'], self.max_bins))
+            for entry in data
+        ]
+        with self._lock:
+            for business_id, model_name, sketch in incoming:
+                self._sketch(business_id, model_name).merge(sketch)
+        return len(incoming)
+
+    def merged_with(self, data: List[Dict[str, Any]], include_self: bool = True) -> 'SketchStore':
+        """
+        A new store combining this store's sketches with ones serialised elsewhere
+
+        This store is left unchanged, so merging the same replica twice (or
+        two replicas merging each other) never counts an observation twice
+        in what this process records and exports.
+
+        Args:
+            data: Sketches as returned by to_dict() on other replicas
+            include_self: Start from a copy of this store's sketches
+
+        Returns:
+            The merged view
+        """
+        view = SketchStore(self.relative_accuracy, self.max_bins)
+        if include_self:
+            view.merge_dict(self.to_dict())
+        view.merge_dict(data)
+        return view
+
+
+class SketchCollector:
+    """
+    Prometheus collector exporting sketch quantiles
+
+    Quantiles are computed at scrape time, so recording stays O(1).
+    """
+
+    def __init__(self, store: SketchStore, quantiles: Iterable[float] = DEFAULT_QUANTILES):
+        self.store = store
+        self.quantiles = tuple(quantiles)
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        quantile_family = GaugeMetricFamily(
+            'ai_response_time_quantile_seconds',
+            'AI response time quantiles per business and model (DDSketch estimate)',
+            labels=['business_id', 'model_name', 'quantile']
+        )
+        count_family = GaugeMetricFamily(
+            'ai_response_time_sketch_count',
+            'Observations recorded in each response time sketch',
+            labels=['business_id', 'model_name']
+        )
+        with self.store._lock:
+            for business_id, models in self.store._sketches.items():
+                for model_name, sketch in models.items():
+                    for q in self.quantiles:
+                        value = sketch.quantile(q)
+                        if value is not None:
+                            quantile_family.add_metric([business_id, model_name, str(q)], value)
+                    count_family.add_metric([business_id, model_name], sketch.count)
+        yield quantile_family
+        yield count_family
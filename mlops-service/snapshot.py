@@ -0,0 +1,276 @@
+"""
+Warm-restart snapshots of the Prometheus registry
+Lab 2: AI Lifecycle & MLOps Integration
+
+Every restart, including each rollout, starts all counters from zero. The
+service then either loses continuity or rebuilds its counters from
+ai_metrics before it can serve. RegistrySnapshotter writes the value of
+every counter, histogram and gauge child to a local file:
+
+- periodically, every `interval` seconds, from a background thread
+- once more when the process is asked to stop (SIGTERM)
+
+Under gunicorn (multiprocess mode) only the master writes the snapshot:
+every `interval` seconds once the workers are up, so a SIGKILL or OOM kill
+loses at most one interval, and a last time from its on_exit hook once
+every worker has exited. See write_snapshot and start_master_snapshots in
+service.py.
+
+On startup the snapshot is restored first. The caller then only reads
+the rows written since the snapshot (see restore_registry_snapshot in
+service.py).
+
+The file is gzipped JSON. It is written under a temporary name, fsynced
+and renamed over the previous snapshot, so a crash mid-write leaves the
+previous snapshot intact.
+
+Samples are read from a registry view, not from the collectors, so in
+gunicorn multiprocess mode the snapshot holds the totals of every worker
+(see build_scrape_registry). Gauges in a live* multiprocess mode describe
+processes that are running right now, such as queue depths and requests
+in flight; they are not restored.
+"""
+
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+
+from metric_internals import (bucket_cells, collector_for, counter_cell, is_live_gauge, label_names,
+                              raise_to, sum_cell)
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+def _restorable(collector) -> bool:
+    if isinstance(collector, Gauge):
+        return not is_live_gauge(collector)
+    return isinstance(collector, (Counter, Histogram))
+
+
+def collect_samples(source, target=REGISTRY) -> List[list]:
+    """
+    Read restorable samples from a registry view
+
+    Args:
+        source: Registry whose collect() provides the values (e.g. the
+            multiprocess scrape registry)
+        target: Registry holding the collectors the samples will be
+            restored into; families without a matching collector are skipped
+
+    Returns:
+        [sample name, labels, value] lists
+    """
+    samples = []
+    for family in source.collect():
+        collector = collector_for(target, family.name)
+        if collector is None or not _restorable(collector):
+            continue
+        if family.type == 'counter':
+            wanted = (family.name + '_total',)
+        elif family.type == 'histogram':
+            wanted = (family.name + '_bucket', family.name + '_sum')
+        elif family.type == 'gauge':
+            wanted = (family.name,)
+        else:
+            continue
+        for sample in family.samples:
+            if sample.name in wanted:
+                samples.append([sample.name, sample.labels, sample.value])
+    return samples
+
+
+def default_child(collector, labelvalues: tuple):
+    return collector.labels(*labelvalues) if labelvalues else collector
+
+
+def restore_samples(samples: List[list], target=REGISTRY,
+                    child_for: Callable[[Any, tuple], Any] = default_child) -> int:
+    """
+    Bring collectors up to the values in a snapshot
+
+    Counters and histograms are only ever raised, so values counted since
+    the process started are never lost. Gauges are set.
+
+    Args:
+        samples: Output of collect_samples
+        target: Registry holding the collectors
+        child_for: (collector, label values) -> child, e.g. through a
+            cardinality guard
+
+    Returns:
+        Number of children restored
+    """
+    # Histogram samples are cumulative per le; gather them per child first
+    histograms: Dict[tuple, Dict[str, Any]] = defaultdict(lambda: {'buckets': [], 'sum': 0.0})
+    restored = 0
+
+    for name, labels, value in samples:
+        collector = collector_for(target, name)
+        if collector is None or not _restorable(collector):
+            continue
+        names = label_names(collector)
+        if isinstance(collector, Histogram):
+            if set(labels) - {'le'} != set(names):
+                continue
+            entry = histograms[(id(collector), tuple(labels[label] for label in names))]
+            entry['collector'] = collector
+            if name.endswith('_bucket'):
+                entry['buckets'].append((float(labels['le']), value))
+            else:
+                entry['sum'] = value
+            continue
+        if set(labels) != set(names):
+            continue
+
+        child = child_for(collector, tuple(labels[label] for label in names))
+        if isinstance(collector, Gauge):
+            child.set(value)
+        else:
+            raise_to(counter_cell(child), value)
+        restored += 1
+
+    for (_, labelvalues), entry in histograms.items():
+        child = child_for(entry['collector'], labelvalues)
+        buckets = bucket_cells(child)
+        previous = 0.0
+        for index, (_, cumulative) in enumerate(sorted(entry['buckets'])):
+            if index >= len(buckets):
+                break
+            raise_to(buckets[index], cumulative - previous)
+            previous = cumulative
+        raise_to(sum_cell(child), entry['sum'])
+        restored += 1
+
+    return restored
+
+
+class RegistrySnapshotter:
+    """
+    Periodically writes a registry snapshot to a local file
+
+    Args:
+        path: Snapshot file
+        source: Registry view the values are read from
+        target: Registry holding the collectors to restore into
+        interval: Seconds between background snapshots
+        state: Callable returning extra JSON-serialisable state to store
+            alongside the samples (e.g. the database watermark)
+        registry: Prometheus registry for the snapshotter's own metrics
+    """
+
+    def __init__(self, path: str, source=REGISTRY, target=REGISTRY, interval: float = 60.0,
+                 state: Optional[Callable[[], Dict[str, Any]]] = None, registry=REGISTRY):
+        self.path = path
+        self.source = source
+        self.target = target
+        self.interval = interval
+        self.state = state
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.writes = Counter(
+            'metrics_snapshot_writes_total',
+            'Registry snapshots written, by result',
+            ['result'],
+            registry=registry
+        )
+        self.write_latency = Histogram(
+            'metrics_snapshot_write_seconds',
+            'Time taken to collect and write one registry snapshot',
+            buckets=[0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0],
+            registry=registry
+        )
+
+    def write(self) -> bool:
+        """
+        Write a snapshot now, replacing the previous one atomically
+
+        Returns:
+            True if the snapshot was written
+        """
+        start = time.perf_counter()
+        try:
+            snapshot = {'version': SNAPSHOT_VERSION, 'taken_at': time.time(),
+                        'samples': collect_samples(self.source, self.target)}
+            if self.state is not None:
+                snapshot.update(self.state())
+            data = gzip.compress(json.dumps(snapshot, separators=(',', ':'), default=str).encode('utf-8'))
+
+            with self._lock:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                temporary = f'{self.path}.{os.getpid()}.tmp'
+                with open(temporary, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temporary, self.path)
+        except Exception as e:
+            logger.error("Error writing registry snapshot to %s: %s", self.path, e)
+            self.writes.labels(result='error').inc()
+            return False
+        self.write_latency.observe(time.perf_counter() - start)
+        self.writes.labels(result='ok').inc()
+        return True
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """
+        Read the last snapshot
+
+        Returns:
+            The snapshot, or None if there is none or it can't be read
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                snapshot = json.loads(gzip.decompress(f.read()).decode('utf-8'))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable registry snapshot %s: %s", self.path, e)
+            return None
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            logger.warning("Ignoring registry snapshot %s with version %s", self.path, snapshot.get('version'))
+            return None
+        return snapshot
+
+    def restore(self, snapshot: Dict[str, Any],
+                child_for: Callable[[Any, tuple], Any] = default_child) -> int:
+        """Apply a loaded snapshot's samples to the target registry"""
+        return restore_samples(snapshot.get('samples', []), self.target, child_for)
+
+    def start(self, write: Optional[Callable[[], Any]] = None):
+        """
+        Start the background snapshot thread (again, after a fork)
+
+        Args:
+            write: Called every interval instead of write(), e.g. to bring
+                the state up to date first
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, args=(write or self.write,),
+                                        name='registry-snapshot', daemon=True)
+        self._thread.start()
+
+    def _run(self, write: Callable[[], Any]):
+        while not self._stop_event.wait(self.interval):
+            write()
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the background thread without writing a final snapshot"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
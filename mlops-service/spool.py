@@ -0,0 +1,447 @@
+"""
+Durable on-disk spool for metrics events
+Lab 2: AI Lifecycle & MLOps Integration
+
+When the database is down or slower than ingestion, the write-behind
+queue (metrics_writer.py) appends events here instead of dropping them.
+It replays them, in order, once the database accepts writes again.
+
+On disk the spool is a directory of append-only segment files,
+0000000000000001.seg, 0000000000000002.seg, and so on. Each record is:
+
+    <length: uint32 LE> <crc32: uint32 LE> <payload: JSON event>
+
+A new segment is started once the current one reaches segment_bytes.
+Segments are deleted as soon as they have been replayed, so total disk
+use never goes past max_bytes; appends are refused beyond that. Replay
+progress is kept in a small cursor file, which is replaced atomically
+after every batch the sink accepts. After a crash, only the last batch
+can be written twice.
+
+A batch the sink rejects because of its data (see replay()) is split
+in half until the offending rows are isolated. Those rows are moved to
+quarantine.jsonl, so one bad event can't hold up the events behind it.
+
+The CRC catches torn writes (a crash mid-append) and disk corruption.
+A torn tail is truncated when the spool is opened. A record that fails
+its CRC is counted and the rest of its segment is skipped.
+
+Each process claims its own slot-N subdirectory with an exclusive file
+lock, so gunicorn workers never append to the same segment. A restarted
+worker takes over a free slot together with the events left in it.
+"""
+
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from prometheus_client import REGISTRY, Counter, Gauge
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows: one process per spool directory
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct('<II')
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor.json'
+QUARANTINE_FILE = 'quarantine.jsonl'
+LOCK_FILE = '.lock'
+
+
+def encode_record(payload: bytes) -> bytes:
+    """Frame one payload with its length and CRC32"""
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path: str, offset: int = 0, limit: Optional[int] = None) -> Tuple[List[Tuple[bytes, int]], int, bool]:
+    """
+    Read whole records from one segment file
+
+    Args:
+        path: Segment file
+        offset: Byte offset of the first record to read
+        limit: Stop after this many records
+
+    Returns:
+        ([(payload, end_offset), ...], offset_after_last_valid_record, corrupt)
+        where corrupt is True when reading stopped at a record whose CRC
+        does not match (a short read at the end is not corruption)
+    """
+    records = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while limit is None or len(records) < limit:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            length, crc = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                break
+            if zlib.crc32(payload) != crc:
+                return records, offset, True
+            offset += RECORD_HEADER.size + length
+            records.append((payload, offset))
+    return records, offset, False
+
+
+class SegmentSpool:
+    """
+    Append-only, segment-rotated spool of JSON events
+
+    Args:
+        directory: Base directory; each process claims a slot-N subdirectory
+        segment_bytes: Start a new segment once the current one is this large
+        max_bytes: Disk budget for this process's segments
+        fsync: fsync after every append (survives power loss, costs a disk flush)
+        max_slots: Subdirectories tried when claiming a slot
+        registry: Prometheus registry for the spool's own metrics
+    """
+
+    def __init__(self,
+                 directory: str,
+                 segment_bytes: int = 16 * 1024 * 1024,
+                 max_bytes: int = 1024 * 1024 * 1024,
+                 fsync: bool = False,
+                 max_slots: int = 64,
+                 registry=REGISTRY):
+        self.base_directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.max_slots = max_slots
+        self.directory: Optional[str] = None
+
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._lock_file = None
+        self._segments: List[int] = []
+        self._sizes: Dict[int, int] = {}
+        self._writer = None
+        self._cursor = (0, 0)
+
+        self.disk_bytes = Gauge(
+            'metrics_spool_bytes',
+            'Bytes held in spool segments',
+            registry=registry,
+            multiprocess_mode='livesum'
+        )
+        self.appended = Counter(
+            'metrics_spool_appended_total',
+            'Events written to the spool',
+            registry=registry
+        )
+        self.replayed = Counter(
+            'metrics_spool_replayed_total',
+            'Spooled events written to the database',
+            registry=registry
+        )
+        self.rejected = Counter(
+            'metrics_spool_rejected_total',
+            'Events refused because the spool reached max_bytes',
+            registry=registry
+        )
+        self.corrupt = Counter(
+            'metrics_spool_corrupt_records_total',
+            'Records that failed their CRC check (the rest of the segment is skipped)',
+            registry=registry
+        )
+        self.quarantined = Counter(
+            'metrics_spool_quarantined_total',
+            'Spooled events the sink rejected as invalid, moved to the quarantine file',
+            registry=registry
+        )
+
+    # -- lifecycle ---------------------------------------------------------
+
+    def open(self):
+        """Claim a slot and recover its segments (done lazily by every method)"""
+        with self._lock:
+            self._ensure_open()
+
+    def close(self):
+        """Close the current segment and release the slot"""
+        with self._lock:
+            self._close()
+
+    def _ensure_open(self):
+        if self._pid == os.getpid():
+            return
+        # Fresh process, or a worker forked from the process that opened
+        # the spool: forget inherited handles and claim a slot of our own
+        self._writer = None
+        self._lock_file = None
+        self._claim_slot()
+        self._recover()
+        self._pid = os.getpid()
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        self._pid = None
+
+    def _claim_slot(self):
+        os.makedirs(self.base_directory, exist_ok=True)
+        for slot in range(self.max_slots):
+            directory = os.path.join(self.base_directory, f'slot-{slot}')
+            os.makedirs(directory, exist_ok=True)
+            lock_file = open(os.path.join(directory, LOCK_FILE), 'a')
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lock_file.close()
+                    continue
+            self._lock_file = lock_file
+            self.directory = directory
+            return
+        raise RuntimeError(f'No free spool slot under {self.base_directory}')
+
+    def _recover(self):
+        self._segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        self._sizes = {}
+        for segment in self._segments:
+            self._sizes[segment] = os.path.getsize(self._path(segment))
+
+        # A crash mid-append leaves a partial record at the end of the last
+        # segment; cut it off so new appends start on a record boundary
+        if self._segments:
+            last = self._segments[-1]
+            _, valid_end, _ = read_records(self._path(last))
+            if valid_end < self._sizes[last]:
+                with open(self._path(last), 'r+b') as f:
+                    f.truncate(valid_end)
+                self._sizes[last] = valid_end
+
+        self._cursor = self._load_cursor()
+        self._update_disk_gauge()
+        if self.pending_bytes():
+            logger.warning("Recovered %d spooled bytes in %s", self.pending_bytes(), self.directory)
+
+    # -- appending ---------------------------------------------------------
+
+    def append(self, events: List[Any]) -> bool:
+        """
+        Append events (dicts or MetricEvents) as one write
+
+        Returns:
+            True if written, False if the spool is full
+        """
+        data = b''.join(
+            encode_record(json.dumps(event if isinstance(event, dict) else event.to_dict(),
+                                     separators=(',', ':'), default=str).encode('utf-8'))
+            for event in events
+        )
+        with self._lock:
+            self._ensure_open()
+            if self.total_bytes() + len(data) > self.max_bytes:
+                self.rejected.inc(len(events))
+                return False
+            writer = self._active_writer(len(data))
+            writer.write(data)
+            writer.flush()
+            if self.fsync:
+                os.fsync(writer.fileno())
+            self._sizes[self._segments[-1]] += len(data)
+        self.appended.inc(len(events))
+        self._update_disk_gauge()
+        return True
+
+    def _active_writer(self, incoming: int):
+        if not self._segments:
+            # Empty spool: numbering carries on from the cursor, which
+            # points at the segment after the last one replayed
+            active = max(self._cursor[0], 1)
+            self._cursor = (active, 0)
+            self._segments.append(active)
+            self._sizes[active] = 0
+        active = self._segments[-1]
+        if self._sizes[active] and self._sizes[active] + incoming > self.segment_bytes:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            active += 1
+            self._segments.append(active)
+            self._sizes[active] = 0
+        if self._writer is None:
+            self._writer = open(self._path(active), 'ab')
+        return self._writer
+
+    # -- replaying ---------------------------------------------------------
+
+    def pending_bytes(self) -> int:
+        """Bytes appended but not yet replayed"""
+        segment, offset = self._cursor
+        return sum(size for number, size in self._sizes.items() if number >= segment) - offset
+
+    def pending(self) -> bool:
+        """True if there are events waiting to be replayed"""
+        with self._lock:
+            self._ensure_open()
+            return self.pending_bytes() > 0
+
+    def total_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def replay(self, sink: Callable[[List[Dict[str, Any]]], Any], batch_size: int = 500,
+               max_batches: Optional[int] = None,
+               is_data_error: Optional[Callable[[Exception], bool]] = None) -> int:
+        """
+        Write spooled events to sink in order, batch by batch
+
+        The cursor only moves past a batch once sink returns, so a failing
+        sink leaves the batch in place for the next attempt. When
+        is_data_error says the failure came from the events themselves,
+        retrying would fail forever; the batch is split in half and each
+        half written on its own, down to single events, which are
+        quarantined. If a later half then fails for another reason, the
+        halves already written are written again on the next attempt.
+
+        Args:
+            sink: Callable that persists a list of events (raises on failure)
+            batch_size: Events per sink call
+            max_batches: Stop after this many batches (None drains the spool)
+            is_data_error: Tells rejected data apart from transient failures
+                (None treats every failure as transient)
+
+        Returns:
+            Number of events replayed
+
+        Raises:
+            Whatever sink raises, after committing the batches before it
+        """
+        replayed = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            with self._lock:
+                self._ensure_open()
+                batch, cursor = self._read_batch(batch_size)
+            if not batch:
+                return replayed
+
+            written = self._write_batch(sink, batch, is_data_error)
+
+            with self._lock:
+                self._commit(cursor)
+            self.replayed.inc(written)
+            replayed += written
+            batches += 1
+        return replayed
+
+    def _write_batch(self, sink: Callable[[List[Dict[str, Any]]], Any], batch: List[Dict[str, Any]],
+                     is_data_error: Optional[Callable[[Exception], bool]]) -> int:
+        try:
+            sink(batch)
+            return len(batch)
+        except Exception as e:
+            if is_data_error is None or not is_data_error(e):
+                raise
+            if len(batch) == 1:
+                self._quarantine(batch[0], e)
+                return 0
+        middle = len(batch) // 2
+        return (self._write_batch(sink, batch[:middle], is_data_error)
+                + self._write_batch(sink, batch[middle:], is_data_error))
+
+    def _quarantine(self, event: Dict[str, Any], error: Exception):
+        with self._lock:
+            path = os.path.join(self.directory, QUARANTINE_FILE)
+            with open(path, 'a') as f:
+                f.write(json.dumps({'error': str(error), 'event': event}, default=str) + '\n')
+        self.quarantined.inc()
+        logger.error("Database rejected a spooled metrics event, moved it to %s: %s", path, error)
+
+    def _read_batch(self, batch_size: int) -> Tuple[List[Dict[str, Any]], Tuple[int, int]]:
+        segment, offset = self._cursor
+        batch: List[Dict[str, Any]] = []
+        while len(batch) < batch_size and segment in self._sizes:
+            records, end, corrupt = read_records(self._path(segment), offset, batch_size - len(batch))
+            for payload, offset in records:
+                batch.append(json.loads(payload))
+            if corrupt:
+                self.corrupt.inc()
+                logger.error("Corrupt record in spool segment %s at byte %d; skipping the rest of it",
+                             self._path(segment), end)
+                offset = self._sizes[segment]
+            if offset < self._sizes[segment] or segment == self._segments[-1]:
+                break
+            # Finished a sealed segment: carry on in the next one
+            segment, offset = self._next_segment(segment), 0
+        return batch, (segment, offset)
+
+    def _next_segment(self, segment: int) -> int:
+        later = [number for number in self._segments if number > segment]
+        return later[0] if later else segment + 1
+
+    def _commit(self, cursor: Tuple[int, int]):
+        segment, offset = cursor
+        # Delete every segment the cursor has moved past
+        for number in [number for number in self._segments if number < segment]:
+            self._delete_segment(number)
+
+        # Fully drained: drop the active segment as well, so an idle spool
+        # holds no data on disk
+        if self._segments == [segment] and offset >= self._sizes[segment]:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            self._delete_segment(segment)
+            segment, offset = segment + 1, 0
+
+        self._cursor = (segment, offset)
+        self._save_cursor()
+        self._update_disk_gauge()
+
+    def _delete_segment(self, number: int):
+        try:
+            os.remove(self._path(number))
+        except FileNotFoundError:
+            pass
+        self._segments.remove(number)
+        del self._sizes[number]
+
+    # -- helpers -----------------------------------------------------------
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'{segment:016d}{SEGMENT_SUFFIX}')
+
+    def _load_cursor(self) -> Tuple[int, int]:
+        first = self._segments[0] if self._segments else 0
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                saved = json.load(f)
+            segment, offset = int(saved['segment']), int(saved['offset'])
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            return first, 0
+        if segment < first:
+            # The saved segment was deleted after it was replayed
+            return first, 0
+        return segment, offset
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        temporary = path + '.tmp'
+        segment, offset = self._cursor
+        with open(temporary, 'w') as f:
+            json.dump({'segment': segment, 'offset': offset}, f)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+    def _update_disk_gauge(self):
+        self.disk_bytes.set(self.total_bytes())
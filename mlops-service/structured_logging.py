@@ -0,0 +1,198 @@
+"""
+Non-blocking, structured logging for the MLOps service
+Lab 2: AI Lifecycle & MLOps Integration
+
+Request threads should not pay for log output. configure_logging() attaches
+one handler to the root logger. That handler puts each record on a bounded
+queue, and a background QueueListener formats and writes the records:
+- messages are only formatted by the listener, so %-style arguments cost
+  nothing on the request path
+- output is one JSON object per line (or plain text for local runs)
+- per-event loggers are rate limited, and each line that passes reports
+  how many were suppressed before it
+- when the queue is full, records are dropped instead of blocking, and
+  counted on a Prometheus counter (see LoggingPipeline.count_drops)
+
+Log per-event lines (one per tracked metric) through a logger listed in
+rate_limits, e.g. logging.getLogger('app.events').
+"""
+
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+# LogRecord attributes that are not user-supplied `extra` fields
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Render records as single-line JSON objects, including `extra` fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token-bucket rate limit per logger name
+
+    Records at WARNING and above always pass. The first record let through
+    after a suppression carries a `suppressed` count.
+
+    Args:
+        rates: Logger name -> records per second (also the burst size)
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = dict(rates)
+        # Logger name -> [tokens, last refill time, suppressed count]
+        self._buckets = {name: [rate, time.monotonic(), 0] for name, rate in self.rates.items()}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        bucket = self._buckets.get(record.name)
+        if bucket is None or record.levelno >= logging.WARNING:
+            return True
+
+        rate = self.rates[record.name]
+        with self._lock:
+            now = time.monotonic()
+            bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    QueueHandler that neither formats nor blocks in the logging thread
+
+    The stock handler formats the message before queueing it. Here the
+    record is queued as-is (the queue never leaves this process), so
+    arguments should not be mutated after the logging call.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        # Prometheus Counter incremented alongside `dropped`
+        self.dropped_counter = None
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            counter = self.dropped_counter
+            if counter is not None:
+                counter.inc()
+
+
+class LoggingPipeline:
+    """
+    Root QueueHandler plus the listener thread that drains it
+
+    Args:
+        handler: Handler that writes formatted records (runs on the listener)
+        rate_limits: Logger name -> records per second
+        max_queue_size: Records buffered before new ones are dropped
+    """
+
+    def __init__(self, handler: logging.Handler,
+                 rate_limits: Optional[Dict[str, float]] = None,
+                 max_queue_size: int = 10000):
+        self.output = handler
+        self.max_queue_size = max_queue_size
+        self.handler = NonBlockingQueueHandler(queue.Queue(max_queue_size))
+        if rate_limits:
+            self.handler.addFilter(RateLimitFilter(rate_limits))
+        self.listener: Optional[QueueListener] = None
+
+    def count_drops(self, counter):
+        """
+        Report dropped records on a Prometheus Counter
+
+        The counter starts at the records dropped so far and replaces any
+        counter set before.
+        """
+        counter.inc(self.handler.dropped)
+        self.handler.dropped_counter = counter
+
+    def start(self):
+        self.listener = QueueListener(self.handler.queue, self.output, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """Write out everything queued and stop the listener thread"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def restart_after_fork(self):
+        # The listener thread does not survive fork(); give the child a fresh
+        # queue (its locks may have been held mid-fork) and a new listener
+        self.handler.queue = queue.Queue(self.max_queue_size)
+        self.listener = None
+        self.start()
+
+
+def configure_logging(level: str = 'INFO', json_format: bool = True,
+                      rate_limits: Optional[Dict[str, float]] = None,
+                      max_queue_size: int = 10000, stream=None) -> LoggingPipeline:
+    """
+    Route every log record through a background listener
+
+    Args:
+        level: Root log level name
+        json_format: JSON lines if True, plain text otherwise
+        rate_limits: Logger name -> records per second, for per-event loggers
+        max_queue_size: Records buffered before new ones are dropped
+        stream: Output stream (defaults to stderr)
+
+    Returns:
+        The running LoggingPipeline (stop() it to flush on shutdown)
+    """
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if json_format
+                        else logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+
+    pipeline = LoggingPipeline(output, rate_limits, max_queue_size)
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(pipeline.handler)
+    root.setLevel(level.upper())
+    pipeline.start()
+
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=pipeline.restart_after_fork)
+    return pipeline
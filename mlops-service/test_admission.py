@@ -0,0 +1,98 @@
+"""
+Unit tests for per-tenant admission control
+Lab 3: Testing AI Systems
+"""
+
+from unittest.mock import patch
+
+import pytest
+from prometheus_client import CollectorRegistry
+
+from admission import AdmissionController, parse_tenant_limits
+
+
+@pytest.fixture
+def registry():
+    return CollectorRegistry()
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    fake = FakeClock()
+    with patch('admission.time.monotonic', fake):
+        yield fake
+
+
+class TestTokenBuckets:
+    """Test cases for per-tenant rate limiting"""
+
+    def test_burst_then_refill(self, registry, clock):
+        """A tenant gets its burst at once, then `rate` per second"""
+        controller = AdmissionController(rate=2, burst=3, registry=registry)
+
+        assert [controller.acquire('noisy') for _ in range(3)] == [None, None, None]
+        assert controller.acquire('noisy') == pytest.approx(0.5)
+
+        clock.now += 0.5
+        assert controller.acquire('noisy') is None
+        assert registry.get_sample_value('ingest_shed_total', {'reason': 'tenant_rate'}) == 1
+
+    def test_tenants_are_isolated(self, registry, clock):
+        """One tenant exhausting its bucket doesn't affect another"""
+        controller = AdmissionController(rate=1, burst=1, registry=registry)
+        controller.acquire('noisy')
+
+        assert controller.acquire('noisy') is not None
+        assert controller.acquire('quiet') is None
+
+    def test_tenant_overrides(self, registry, clock):
+        controller = AdmissionController(rate=1, burst=1, registry=registry,
+                                         tenant_limits=parse_tenant_limits('vip=10:5, trial=0.5'))
+
+        assert controller.limits_for('vip') == (10.0, 5.0)
+        assert controller.limits_for('trial') == (0.5, 0.5)
+        assert sum(controller.acquire('vip') is None for _ in range(6)) == 5
+
+    def test_zero_rate_disables_limit(self, registry):
+        controller = AdmissionController(rate=0, registry=registry)
+
+        assert all(controller.acquire('any') is None for _ in range(1000))
+
+    def test_idle_buckets_are_evicted(self, registry, clock):
+        """Refilled buckets are dropped lazily, and the tenant cap holds"""
+        controller = AdmissionController(rate=10, burst=10, max_tenants=3, registry=registry)
+        for tenant in ('a', 'b', 'c'):
+            controller.acquire(tenant)
+        clock.now += 5
+        controller.acquire('d')
+
+        assert list(controller._buckets) == ['d']
+
+        for tenant in ('e', 'f', 'g', 'h'):
+            controller.acquire(tenant)
+        assert len(controller._buckets) == 3
+
+    def test_malformed_tenant_limit(self):
+        with pytest.raises(ValueError):
+            parse_tenant_limits('no-equals-sign')
+
+
+class TestConcurrencyCap:
+    """Test cases for the global in-flight cap"""
+
+    def test_requests_beyond_cap_are_shed(self, registry):
+        controller = AdmissionController(max_concurrency=2, registry=registry)
+
+        assert controller.try_enter() and controller.try_enter()
+        assert controller.try_enter() is False
+        controller.leave()
+        assert controller.try_enter() is True
+        assert registry.get_sample_value('ingest_shed_total', {'reason': 'concurrency'}) == 1
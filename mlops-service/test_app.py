@@ -4,26 +4,33 @@ Lab 3: Testing AI Systems
 
 This module contains tests for the Flask MLOps service including:
 - Health check endpoint testing
+- Readiness after deferred startup, per-app registries
 - Metrics tracking functionality
 - Prometheus metrics validation
 - Error handling and edge cases
 """
 
+import gzip
+import logging
+import queue
+from itertools import islice
+import os
 import pytest
 import json
+import subprocess
+import sys
 import time
-from app import app
+import app as app_module
+from app import create_app, get_service
+from schema import parse_event
+from database import configure_database
+from admission import AdmissionController
+from snapshot import RegistrySnapshotter
+from live_stream import serve_stream
+from prometheus_client import CollectorRegistry
 from unittest.mock import patch, MagicMock
 
 
-@pytest.fixture
-def client():
-    """Create a test client for the Flask application"""
-    app.config['TESTING'] = True
-    with app.test_client() as client:
-        yield client
-
-
 @pytest.fixture
 def sample_metrics_data():
     """Sample metrics data for testing"""
@@ -48,6 +55,22 @@ def sample_metrics_data():
     }
 
 
+@pytest.fixture
+def uncached_metrics(service):
+    """Render /metrics on every scrape so tests see their own updates"""
+    with patch.object(service.exposition_cache, 'ttl', 0):
+        yield
+
+
+@pytest.fixture
+def metrics_db(tmp_path):
+    """SQLite stand-in for the ai_metrics database"""
+    db = configure_database(f"sqlite:///{tmp_path / 'metrics.db'}")
+    db.create_metrics_table()
+    yield db
+    configure_database(None)
+
+
 class TestHealthEndpoint:
     """Test cases for the health check endpoint"""
 
@@ -72,6 +95,51 @@ class TestHealthEndpoint:
             assert field in data, f"Missing required field: {field}"
 
 
+class TestReadiness:
+    """Test cases for deferred startup and the /ready endpoint"""
+
+    def test_not_ready_until_startup_has_run(self):
+        """Liveness answers at once; readiness waits for the startup work"""
+        with patch('service.MLOpsService.start'):
+            app = create_app({'METRICS_REGISTRY': CollectorRegistry()})
+        client = app.test_client()
+
+        assert client.get('/health').status_code == 200
+        assert client.get('/ready').status_code == 503
+        assert client.get('/ready').get_json()['status'] == 'starting'
+
+        get_service(app).initialise()
+        assert client.get('/ready').status_code == 200
+
+    def test_background_startup(self):
+        app = create_app({'METRICS_REGISTRY': CollectorRegistry()})
+
+        assert get_service(app).wait_until_ready(timeout=10) is True
+        assert app.test_client().get('/ready').get_json()['status'] == 'ready'
+
+    def test_apps_have_isolated_registries(self, sample_metrics_data):
+        """Each app counts into its own registry"""
+        first, second = (create_app({'METRICS_REGISTRY': CollectorRegistry(), 'STARTUP_IN_BACKGROUND': False})
+                         for _ in range(2))
+        first.test_client().post('/track', json=sample_metrics_data)
+
+        labels = {'business_id': 'test-business-123', 'response_type': 'appointment_booking',
+                  'intent': 'appointment'}
+        assert get_service(first).registry.get_sample_value('ai_requests_total', labels) == 1
+        assert get_service(second).registry.get_sample_value('ai_requests_total', labels) is None
+
+    def test_import_has_no_side_effects(self):
+        """Importing app creates no app and registers no collectors"""
+        code = ("import app\n"
+                "from prometheus_client import REGISTRY\n"
+                "assert app._default_app is None\n"
+                "assert 'ai_requests_total' not in REGISTRY._names_to_collectors\n"
+                "assert 'archive' not in __import__('sys').modules\n")
+        result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, timeout=60)
+        assert result.returncode == 0, result.stderr
+
+
 class TestMetricsEndpoint:
     """Test cases for the Prometheus metrics endpoint"""
 
@@ -102,6 +170,68 @@ class TestMetricsEndpoint:
         assert 'charset=utf-8' in response.content_type
 
 
+class TestMetricsExpositionCache:
+    """Test cases for the cached /metrics exposition"""
+
+    def test_scrapes_share_one_rendering(self, client, service):
+        """Test that repeated scrapes within the TTL render once"""
+        with patch.object(service.exposition_cache, 'ttl', 60), \
+                patch('exposition.generate_latest', return_value=b'# cached\n') as render:
+            service.exposition_cache.mark_dirty()
+            service.exposition_cache._rendered.clear()
+            first = client.get('/metrics')
+            second = client.get('/metrics')
+        # Don't leave the stub rendering behind for other tests
+        service.exposition_cache.mark_dirty()
+        service.exposition_cache._rendered.clear()
+
+        assert render.call_count == 1
+        assert first.data == second.data == b'# cached\n'
+
+    def test_rerenders_after_mutation(self, client, uncached_metrics, sample_metrics_data):
+        """Test that a tracked event invalidates the rendering once the TTL is over"""
+        event = sample_metrics_data.copy()
+        event['business_id'] = 'exposition-business'
+
+        client.get('/metrics')
+        client.post('/track', json=event)
+        content = client.get('/metrics').data.decode('utf-8')
+
+        assert 'exposition-business' in content
+
+    @pytest.mark.parametrize('accept_encoding, gzipped', [
+        ('gzip', True),
+        ('deflate, gzip;q=0.5', True),
+        ('*', True),
+        ('gzip;q=0', False),
+        ('gzip; q=0.0, deflate', False),
+        ('*;q=0', False),
+        ('*, gzip;q=0', False),
+        ('identity', False),
+    ])
+    def test_gzip_quality_values(self, client, accept_encoding, gzipped):
+        """Test that Accept-Encoding q-values decide whether gzip is used"""
+        response = client.get('/metrics', headers={'Accept-Encoding': accept_encoding})
+
+        assert (response.headers.get('Content-Encoding') == 'gzip') is gzipped
+
+    def test_gzip_encoding(self, client):
+        """Test that gzip is used when the scraper accepts it"""
+        response = client.get('/metrics', headers={'Accept-Encoding': 'gzip, deflate'})
+
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert b'# HELP' in gzip.decompress(response.data)
+
+    def test_openmetrics_negotiation(self, client):
+        """Test that OpenMetrics is served when requested"""
+        response = client.get('/metrics', headers={
+            'Accept': 'application/openmetrics-text; version=1.0.0'
+        })
+
+        assert 'application/openmetrics-text' in response.content_type
+        assert response.data.decode('utf-8').rstrip().endswith('# EOF')
+
+
 class TestTrackingEndpoint:
     """Test cases for the metrics tracking endpoint"""
 
@@ -162,6 +292,234 @@ class TestTrackingEndpoint:
         assert response.status_code == 500
 
 
+class TestBatchTrackingEndpoint:
+    """Test cases for the batch tracking endpoint"""
+
+    def test_track_batch_json_array(self, client, sample_metrics_data, service):
+        """Test batch tracking with a JSON array body"""
+        events = []
+        for i in range(3):
+            event = sample_metrics_data.copy()
+            event['business_id'] = 'batch-array-business'
+            events.append(event)
+
+        response = client.post('/track/batch', json=events)
+
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data['status'] == 'success'
+        assert data['accepted'] == 3
+        assert data['rejected'] == 0
+        assert [r['status'] for r in data['results']] == ['accepted'] * 3
+
+        requests_total = service.registry.get_sample_value('ai_requests_total', {
+            'business_id': 'batch-array-business',
+            'response_type': 'appointment_booking',
+            'intent': 'appointment'
+        })
+        tokens_total = service.registry.get_sample_value('ai_tokens_used_total', {
+            'business_id': 'batch-array-business',
+            'model_name': 'gemini-1.5-flash'
+        })
+        assert requests_total == 3
+        assert tokens_total == 450
+
+    def test_track_batch_ndjson_partial(self, client, sample_metrics_data):
+        """Test NDJSON batch with invalid lines reports per-item status"""
+        valid = sample_metrics_data.copy()
+        valid['business_id'] = 'batch-ndjson-business'
+        missing_field = {'business_id': 'batch-ndjson-business'}
+        body = '\n'.join([json.dumps(valid), 'not json', json.dumps(missing_field)])
+
+        response = client.post('/track/batch',
+                             data=body,
+                             content_type='application/x-ndjson')
+
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data['status'] == 'partial'
+        assert data['accepted'] == 1
+        assert data['rejected'] == 2
+        assert data['results'][0] == {'index': 0, 'status': 'accepted'}
+        assert 'Invalid JSON' in data['results'][1]['error']
+        assert 'Missing required field' in data['results'][2]['error']
+
+    def test_track_batch_all_rejected(self, client):
+        """Test that a batch with no valid events is rejected"""
+        response = client.post('/track/batch', json=[{}, {'business_id': 'x'}])
+
+        assert response.status_code == 400
+        data = json.loads(response.data)
+        assert data['status'] == 'failed'
+        assert data['rejected'] == 2
+
+    def test_track_batch_empty_body(self, client):
+        """Test batch tracking without any events"""
+        response = client.post('/track/batch', data='')
+        assert response.status_code == 400
+
+    def test_track_batch_invalid_array(self, client):
+        """Test batch tracking with a malformed JSON array"""
+        response = client.post('/track/batch',
+                             data='[{"business_id": ',
+                             content_type='application/json')
+        assert response.status_code == 400
+
+    def test_track_batch_too_large(self, client, sample_metrics_data, service):
+        """Test that oversized batches are refused"""
+        with patch.object(service, 'max_batch_size', 2):
+            response = client.post('/track/batch', json=[sample_metrics_data] * 3)
+        assert response.status_code == 413
+
+    def test_max_batch_size_from_app_config(self, sample_metrics_data):
+        """Settings passed to create_app take precedence over the environment"""
+        app = create_app({'METRICS_REGISTRY': CollectorRegistry(), 'STARTUP_IN_BACKGROUND': False,
+                          'MAX_BATCH_SIZE': 1})
+        response = app.test_client().post('/track/batch', json=[sample_metrics_data] * 2)
+        assert response.status_code == 413
+
+
+class TestIdempotentIngestion:
+    """Test cases for ignoring retried events"""
+
+    @staticmethod
+    def requests_total(service, data):
+        return service.registry.get_sample_value('ai_requests_total', {
+            'business_id': data['business_id'],
+            'response_type': data['response_type'],
+            'intent': data['intent_detected']
+        }) or 0
+
+    def test_retried_event_is_counted_once(self, client, service, sample_metrics_data):
+        """A repeated event_id is acknowledged but not applied again"""
+        sample_metrics_data['event_id'] = f'evt-{time.time_ns()}'
+        before = self.requests_total(service, sample_metrics_data)
+
+        first = client.post('/track', json=sample_metrics_data)
+        retry = client.post('/track', json=sample_metrics_data)
+
+        assert first.get_json()['status'] == 'success'
+        assert retry.status_code == 200
+        assert retry.get_json()['status'] == 'duplicate'
+        assert self.requests_total(service, sample_metrics_data) == before + 1
+
+    def test_idempotency_key_header(self, client, sample_metrics_data):
+        """The Idempotency-Key header identifies the request"""
+        headers = {'Idempotency-Key': f'hdr-{time.time_ns()}'}
+        client.post('/track', json=sample_metrics_data, headers=headers)
+
+        retry = client.post('/track', json=sample_metrics_data, headers=headers)
+        assert retry.get_json()['status'] == 'duplicate'
+
+    def test_failed_event_can_be_retried(self, client, service, sample_metrics_data):
+        """A request that failed is not remembered as seen"""
+        sample_metrics_data['event_id'] = f'evt-{time.time_ns()}'
+        with patch.object(service, 'store_metrics_in_db', return_value=False) as mock_store:
+            assert client.post('/track', json=sample_metrics_data).status_code == 500
+
+            mock_store.return_value = True
+            assert client.post('/track', json=sample_metrics_data).get_json()['status'] == 'success'
+
+    def test_failed_store_applies_nothing(self, client, service, sample_metrics_data):
+        """Nothing is counted before the event is stored, so the retry counts it once"""
+        sample_metrics_data['event_id'] = f'evt-{time.time_ns()}'
+        before = self.requests_total(service, sample_metrics_data)
+        with patch.object(service, 'store_metrics_batch_in_db', return_value=False):
+            assert client.post('/track/batch', json=[sample_metrics_data]).status_code == 500
+        with patch.object(service, 'store_metrics_in_db', return_value=False):
+            assert client.post('/track', json=sample_metrics_data).status_code == 500
+        assert self.requests_total(service, sample_metrics_data) == before
+
+        assert client.post('/track', json=sample_metrics_data).get_json()['status'] == 'success'
+        assert self.requests_total(service, sample_metrics_data) == before + 1
+
+    def test_stored_event_keeps_its_key(self, client, service, sample_metrics_data):
+        """Once an event is stored, a retry is a duplicate even if the update failed"""
+        sample_metrics_data['event_id'] = f'evt-{time.time_ns()}'
+        with patch.object(service, 'store_metrics_in_db', return_value=True) as mock_store, \
+                patch.object(service, 'update_prometheus_metrics', return_value=False):
+            first = client.post('/track', json=sample_metrics_data)
+            retry = client.post('/track', json=sample_metrics_data)
+
+        assert first.status_code == 200
+        assert first.get_json()['prometheus_updated'] is False
+        assert retry.get_json()['status'] == 'duplicate'
+        assert mock_store.call_count == 1
+
+    def test_duplicate_is_not_rate_limited(self, client, service, sample_metrics_data):
+        """A retry of a tracked event is acknowledged even when its business is over the limit"""
+        sample_metrics_data['event_id'] = f'evt-{time.time_ns()}'
+        controller = AdmissionController(rate=0.001, burst=1, registry=CollectorRegistry())
+        with patch.object(service, 'admission', controller):
+            assert client.post('/track', json=sample_metrics_data).status_code == 200
+            retry = client.post('/track', json=sample_metrics_data)
+            batch = client.post('/track/batch', json=[sample_metrics_data])
+
+        assert retry.status_code == 200
+        assert retry.get_json()['status'] == 'duplicate'
+        assert batch.status_code == 200
+        assert batch.get_json()['duplicates'] == 1
+
+    def test_batch_reports_duplicates(self, client, sample_metrics_data):
+        """Duplicates inside a batch, or of earlier events, are skipped"""
+        sample_metrics_data['event_id'] = f'evt-{time.time_ns()}'
+        response = client.post('/track/batch', json=[sample_metrics_data, sample_metrics_data])
+
+        data = response.get_json()
+        assert response.status_code == 200
+        assert (data['accepted'], data['duplicates'], data['rejected']) == (1, 1, 0)
+        assert data['status'] == 'success'
+        assert data['results'][1]['status'] == 'duplicate'
+
+
+class TestAdmissionControl:
+    """Test cases for per-tenant rate limiting on the ingestion endpoints"""
+
+    @pytest.fixture
+    def limited(self, service):
+        controller = AdmissionController(rate=1, burst=2, max_concurrency=10,
+                                         registry=CollectorRegistry())
+        with patch.object(service, 'admission', controller):
+            yield controller
+
+    def test_over_limit_gets_429_with_retry_after(self, client, limited, sample_metrics_data):
+        """A tenant beyond its burst is told when to come back"""
+        statuses = [client.post('/track', json=sample_metrics_data).status_code for _ in range(3)]
+
+        assert statuses == [200, 200, 429]
+        response = client.post('/track', json=sample_metrics_data)
+        assert response.headers['Retry-After'] == '1'
+        assert response.get_json()['retry_after'] == 1
+
+    def test_other_tenants_unaffected(self, client, limited, sample_metrics_data):
+        for _ in range(3):
+            client.post('/track', json=sample_metrics_data)
+
+        other = dict(sample_metrics_data, business_id='quiet-business')
+        assert client.post('/track', json=other).status_code == 200
+
+    def test_batch_reports_rate_limited_events(self, client, limited, sample_metrics_data):
+        """Only the events over the limit are refused"""
+        response = client.post('/track/batch', json=[sample_metrics_data] * 3)
+        data = response.get_json()
+
+        assert response.status_code == 200
+        assert (data['accepted'], data['rate_limited'], data['status']) == (2, 1, 'partial')
+
+        response = client.post('/track/batch', json=[sample_metrics_data])
+        assert response.status_code == 429
+        assert 'Retry-After' in response.headers
+
+    def test_concurrency_cap(self, client, sample_metrics_data, service):
+        controller = AdmissionController(max_concurrency=1, registry=CollectorRegistry())
+        controller.try_enter()
+        with patch.object(service, 'admission', controller):
+            response = client.post('/track', json=sample_metrics_data)
+
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '1'
+
+
 class TestPrometheusMetrics:
     """Test cases for Prometheus metrics functionality"""
 
@@ -196,6 +554,34 @@ class TestPrometheusMetrics:
         metrics_response = client.get('/metrics')
         assert metrics_response.status_code in [200, 500]
 
+    def test_track_is_self_instrumented(self, client, service, sample_metrics_data):
+        """/track records its own latency and the time spent in each stage"""
+        def sample(name, **labels):
+            return service.registry.get_sample_value(f'mlops_service_{name}', labels) or 0
+
+        route = {'route': '/track', 'method': 'POST', 'status': '200'}
+        requests_before = sample('http_request_duration_seconds_count', **route)
+        updates_before = sample('stage_duration_seconds_count', stage='update_prometheus_metrics')
+        stores_before = sample('stage_duration_seconds_count', stage='store_metrics_in_db')
+
+        response = client.post('/track', json=sample_metrics_data)
+
+        assert response.status_code == 200
+        assert sample('http_request_duration_seconds_count', **route) == requests_before + 1
+        assert sample('stage_duration_seconds_count', stage='update_prometheus_metrics') == updates_before + 1
+        assert sample('stage_duration_seconds_count', stage='store_metrics_in_db') == stores_before + 1
+
+    def test_dropped_log_records_are_exported(self, service):
+        """Records the logging pipeline drops on a full queue are counted on the service registry"""
+        handler = app_module._logging_pipeline.handler
+        before = service.registry.get_sample_value('log_records_dropped_total')
+
+        with patch.object(handler, 'queue', queue.Queue(maxsize=1)):
+            handler.queue.put_nowait(None)
+            logging.getLogger('app').warning('dropped while the queue is full')
+
+        assert service.registry.get_sample_value('log_records_dropped_total') == before + 1
+
 
 class TestErrorHandling:
     """Test cases for error handling scenarios"""
@@ -210,21 +596,530 @@ class TestErrorHandling:
         response = client.get('/track')
         assert response.status_code == 405  # Method not allowed
 
-    @patch('app.store_metrics_in_db')
-    def test_database_storage_failure(self, mock_store, client, sample_metrics_data):
+    def test_database_storage_failure(self, client, service, sample_metrics_data):
         """Test handling of database storage failures"""
         # Mock database storage to fail
-        mock_store.return_value = False
-
-        response = client.post('/track',
-                             json=sample_metrics_data,
-                             content_type='application/json')
+        with patch.object(service, 'store_metrics_in_db', return_value=False):
+            response = client.post('/track',
+                                 json=sample_metrics_data,
+                                 content_type='application/json')
 
         assert response.status_code == 500
         data = json.loads(response.data)
         assert 'error' in data
 
 
+class TestMetricsPersistence:
+    """Test cases for handing events to the write-behind queue"""
+
+    def test_track_queues_event_for_storage(self, client, sample_metrics_data, service):
+        """Test that /track hands the event to the writer"""
+        writer = MagicMock()
+        writer.put.return_value = True
+
+        with patch.object(service, 'metrics_writer', writer):
+            response = client.post('/track', json=sample_metrics_data)
+
+        assert response.status_code == 200
+        writer.put.assert_called_once()
+        assert writer.put.call_args[0][0]['business_id'] == 'test-business-123'
+
+    def test_track_fails_when_queue_full(self, client, sample_metrics_data, service):
+        """Test that a full write queue is reported as a storage failure"""
+        writer = MagicMock()
+        writer.put.return_value = False
+
+        with patch.object(service, 'metrics_writer', writer):
+            response = client.post('/track', json=sample_metrics_data)
+
+        assert response.status_code == 500
+
+    def test_track_batch_queues_all_events(self, client, sample_metrics_data, service):
+        """Test that /track/batch hands accepted events to the writer at once"""
+        writer = MagicMock()
+        writer.put_many.return_value = True
+
+        with patch.object(service, 'metrics_writer', writer):
+            response = client.post('/track/batch', json=[sample_metrics_data, {}])
+
+        assert response.status_code == 200
+        assert len(writer.put_many.call_args[0][0]) == 1
+
+
+class TestDatabaseRebuild:
+    """Test cases for replaying ai_metrics into Prometheus"""
+
+    def test_unusable_database_url_disables_database_once(self, monkeypatch):
+        """Test that a DATABASE_URL that can't be opened is logged once, not raised per call"""
+        import database
+        connector = MagicMock(side_effect=RuntimeError('psycopg2 is required'))
+        monkeypatch.setenv('DATABASE_URL', 'postgresql://user@localhost/metrics')
+        monkeypatch.setattr(database.Database, '_postgres_connector', staticmethod(connector))
+        monkeypatch.setattr(database, '_database_configured', False)
+        try:
+            assert database.get_database() is None
+            assert database.get_database() is None
+            assert connector.call_count == 1
+        finally:
+            configure_database(None)
+
+    def test_fetch_streams_all_rows_in_chunks(self, metrics_db, sample_metrics_data, service):
+        """Test that every row in the window is replayed, chunk by chunk"""
+        event = sample_metrics_data.copy()
+        event['business_id'] = 'rebuild-business'
+        metrics_db.insert_metrics([event] * 25)
+
+        chunk_sizes = []
+        real_batch_update = service.update_prometheus_metrics_batch
+
+        def record_batch(events):
+            chunk_sizes.append(len(events))
+            return real_batch_update(events)
+
+        with patch.object(service, 'update_prometheus_metrics_batch', side_effect=record_batch):
+            assert service.fetch_metrics_from_db(chunk_size=10) is True
+
+        assert chunk_sizes == [10, 10, 5]
+        assert service.registry.get_sample_value('ai_tokens_used_total', {
+            'business_id': 'rebuild-business',
+            'model_name': 'gemini-1.5-flash'
+        }) == 25 * 150
+        assert service.registry.get_sample_value('appointments_requested_total', {
+            'business_id': 'rebuild-business'
+        }) == 25
+
+    def test_fetch_skips_rows_outside_window(self, metrics_db, sample_metrics_data, service):
+        """Test that rows older than the retention window are not replayed"""
+        event = sample_metrics_data.copy()
+        event['business_id'] = 'rebuild-old-business'
+        metrics_db.insert_metrics([event] * 2)
+        metrics_db.execute("UPDATE ai_metrics SET created_at = '2000-01-01 00:00:00' WHERE id = 1")
+
+        assert service.fetch_metrics_from_db() is True
+
+        assert service.registry.get_sample_value('ai_requests_total', {
+            'business_id': 'rebuild-old-business',
+            'response_type': 'appointment_booking',
+            'intent': 'appointment'
+        }) == 1
+
+    def test_aggregate_rebuild_matches_rows(self, metrics_db, sample_metrics_data, service):
+        """Test that the GROUP BY rebuild produces the same totals as replay"""
+        events = []
+        for i in range(6):
+            event = sample_metrics_data.copy()
+            event['business_id'] = 'aggregate-business'
+            event['response_time_ms'] = 300 if i % 2 else 1500
+            event['intent_detected'] = 'pricing' if i < 2 else 'appointment'
+            event['appointment_booked'] = i == 0
+            event['human_handoff_requested'] = i == 1
+            events.append(event)
+        metrics_db.insert_metrics(events)
+
+        le_half_second = {'le': '0.5'}
+        count_before = service.registry.get_sample_value('ai_response_time_seconds_count')
+        fast_before = service.registry.get_sample_value('ai_response_time_seconds_bucket', le_half_second)
+
+        assert service.aggregate_metrics_from_db() is True
+
+        def requests_for(intent):
+            return service.registry.get_sample_value('ai_requests_total', {
+                'business_id': 'aggregate-business',
+                'response_type': 'appointment_booking',
+                'intent': intent
+            })
+
+        assert requests_for('pricing') == 2
+        assert requests_for('appointment') == 4
+        assert service.registry.get_sample_value('ai_tokens_used_total', {
+            'business_id': 'aggregate-business',
+            'model_name': 'gemini-1.5-flash'
+        }) == 6 * 150
+        assert service.registry.get_sample_value('ai_api_cost_usd_total', {
+            'business_id': 'aggregate-business',
+            'model_name': 'gemini-1.5-flash'
+        }) == pytest.approx(6 * 0.002)
+        assert service.registry.get_sample_value('appointments_requested_total', {
+            'business_id': 'aggregate-business'
+        }) == 6
+        assert service.registry.get_sample_value('appointments_booked_total', {
+            'business_id': 'aggregate-business'
+        }) == 1
+        assert service.registry.get_sample_value('human_handoffs_total', {
+            'business_id': 'aggregate-business',
+            'reason': 'complex_query'
+        }) == 1
+        assert service.registry.get_sample_value('ai_response_time_seconds_count') - count_before == 6
+        assert service.registry.get_sample_value('ai_response_time_seconds_bucket', le_half_second) - fast_before == 3
+
+    def test_rebuild_uses_configured_mode(self, metrics_db, service):
+        """Test that REBUILD_MODE selects replay or aggregate"""
+        with patch.object(service, 'rebuild_mode', 'replay'), \
+                patch.object(service, 'fetch_metrics_from_db', return_value=True) as replay, \
+                patch.object(service, 'aggregate_metrics_from_db', return_value=True) as aggregate:
+            assert service.rebuild_prometheus_metrics_from_db() is True
+        replay.assert_called_once()
+        aggregate.assert_not_called()
+
+    def test_rebuild_without_database(self, service):
+        """Test that rebuild reports failure when no database is configured"""
+        configure_database(None)
+        assert service.rebuild_prometheus_metrics_from_db() is False
+
+
+class TestIncrementalRefresh:
+    """Test cases for the incremental, debounced /refresh-metrics"""
+
+    @staticmethod
+    def requests_total(service, business_id):
+        return service.registry.get_sample_value('ai_requests_total', {
+            'business_id': business_id,
+            'response_type': 'appointment_booking',
+            'intent': 'appointment'
+        })
+
+    def test_refresh_only_reads_new_rows(self, metrics_db, sample_metrics_data, service):
+        """Test that refresh applies rows above the watermark and moves it"""
+        event = sample_metrics_data.copy()
+        event['business_id'] = 'refresh-business'
+        metrics_db.insert_metrics([event] * 3)
+        assert service.aggregate_metrics_from_db() is True
+        assert service._watermark['id'] == 3
+
+        metrics_db.insert_metrics([event] * 2)
+        assert service.refresh_metrics_from_db() is True
+        assert service._watermark['id'] == 5
+        assert self.requests_total(service, 'refresh-business') == 5
+
+        # Nothing new: nothing applied
+        assert service.refresh_metrics_from_db() is True
+        assert self.requests_total(service, 'refresh-business') == 5
+
+    def test_refresh_does_not_double_count_tracked_events(self, client, metrics_db, sample_metrics_data, service):
+        """Test that rows for events already seen via /track are not re-applied"""
+        event = sample_metrics_data.copy()
+        event['business_id'] = 'refresh-tracked-business'
+        assert service.aggregate_metrics_from_db() is True
+
+        client.post('/track', json=event)
+        metrics_db.insert_metrics([event])
+        assert service.refresh_metrics_from_db() is True
+
+        assert self.requests_total(service, 'refresh-tracked-business') == 1
+
+    def test_refresh_without_database(self, client):
+        """Test that refresh reports a warning when no database is configured"""
+        configure_database(None)
+        response = client.post('/refresh-metrics', json={'trigger': 'new_metrics'})
+
+        assert response.status_code == 200
+        assert json.loads(response.data)['status'] == 'warning'
+
+    def test_refresh_triggers_are_debounced(self, client, metrics_db, service):
+        """Test that a burst of triggers runs a single background refresh"""
+        with patch.object(service, 'refresh_debounce_seconds', 0.1), \
+                patch.object(service, 'refresh_metrics_from_db', return_value=True) as refresh:
+            responses = [client.post('/refresh-metrics', json={'trigger': 'new_metrics'})
+                         for _ in range(5)]
+            time.sleep(0.3)
+
+        scheduled = [json.loads(r.data)['scheduled'] for r in responses]
+        assert scheduled == [True, False, False, False, False]
+        assert refresh.call_count == 1
+
+
+class TestWarmRestart:
+    """Test cases for restoring the registry from a snapshot on startup"""
+
+    LABELS = {'business_id': 'snapshot-business', 'response_type': 'appointment_booking', 'intent': 'appointment'}
+
+    def test_restore_then_apply_only_new_rows(self, metrics_db, sample_metrics_data, tmp_path, service):
+        """Test that startup restores the snapshot and reads only rows written after it"""
+        event = sample_metrics_data.copy()
+        event['business_id'] = 'snapshot-business'
+        metrics_db.insert_metrics([event] * 3)
+        assert service.aggregate_metrics_from_db() is True
+
+        snapshotter = RegistrySnapshotter(str(tmp_path / 'registry.json.gz'), source=service.registry,
+                                          target=service.registry, state=service.snapshot_state,
+                                          registry=CollectorRegistry())
+        assert snapshotter.write() is True
+
+        # Restart: the counter and the watermark start over
+        service.ai_requests_total.remove(*self.LABELS.values())
+        service._watermark.update({'id': 0, 'created_at': None})
+        metrics_db.insert_metrics([event] * 2)
+
+        with patch.object(service, 'snapshotter', snapshotter), \
+                patch.object(service, 'rebuild_prometheus_metrics_from_db') as rebuild:
+            assert service.warm_start_metrics() is True
+
+        rebuild.assert_not_called()
+        assert service._watermark['id'] == 5
+        assert service.registry.get_sample_value('ai_requests_total', self.LABELS) == 5
+
+    def test_without_snapshot_rebuilds(self, metrics_db, service):
+        """Test that startup falls back to a full rebuild"""
+        with patch.object(service, 'snapshotter', None), \
+                patch.object(service, 'rebuild_prometheus_metrics_from_db', return_value=True) as rebuild:
+            assert service.warm_start_metrics() is True
+        rebuild.assert_called_once()
+
+
+class TestAnalyticsEndpoint:
+    """Test cases for rollup-backed analytics"""
+
+    def test_analytics_reflect_tracked_events(self, client, sample_metrics_data):
+        """Test that analytics are computed from tracked events"""
+        events = []
+        for booked in (True, False):
+            event = sample_metrics_data.copy()
+            event['business_id'] = 'analytics-business'
+            event['appointment_booked'] = booked
+            events.append(event)
+        client.post('/track/batch', json=events)
+
+        response = client.get('/analytics/analytics-business')
+
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data['period'] == '30_days'
+        assert data['metrics']['total_conversations'] == 2
+        assert data['metrics']['avg_response_time_ms'] == 1250.0
+        assert data['metrics']['appointment_requests'] == 2
+        assert data['metrics']['appointments_booked'] == 1
+        assert data['metrics']['appointment_conversion_rate'] == 0.5
+
+    def test_analytics_cache_invalidated_by_new_event(self, client, sample_metrics_data):
+        """Test that a cached response is replaced when the business tracks more"""
+        event = sample_metrics_data.copy()
+        event['business_id'] = 'analytics-cache-business'
+
+        client.post('/track', json=event)
+        first = json.loads(client.get('/analytics/analytics-cache-business').data)
+        client.post('/track', json=event)
+        second = json.loads(client.get('/analytics/analytics-cache-business').data)
+
+        assert first['metrics']['total_conversations'] == 1
+        assert second['metrics']['total_conversations'] == 2
+
+    def test_analytics_served_from_cache(self, client, service):
+        """Test that repeated polls don't recompute the rollup summary"""
+        with patch.object(service, 'build_analytics', return_value={'cached': True}) as build:
+            client.get('/analytics/analytics-poll-business')
+            client.get('/analytics/analytics-poll-business')
+
+        assert build.call_count == 1
+
+    def test_analytics_include_rate_windows(self, client, sample_metrics_data, service):
+        """Sliding-window rates are reported, and ai_success_rate follows them"""
+        business = dict(sample_metrics_data, business_id='windows-business')
+        client.post('/track', json=dict(business, success_rate=1.0, appointment_booked=True))
+        client.post('/track', json=dict(business, success_rate=0.0))
+
+        windows = client.get('/analytics/windows-business').get_json()['rate_windows']
+
+        assert windows['1m'] == {'requests': 2, 'success_rate': 0.5, 'appointment_conversion_rate': 0.5}
+        assert service.registry.get_sample_value('ai_success_rate', {'business_id': 'windows-business'}) == 0.5
+
+    def test_batch_success_rate_follows_rate_windows(self, client, sample_metrics_data, service):
+        """The client's success_rate never sets ai_success_rate, on /track/batch or on replay"""
+        business = dict(sample_metrics_data, business_id='windows-batch-business')
+        client.post('/track/batch', json=[dict(business, success_rate=1.0), dict(business, success_rate=0.0)])
+
+        labels = {'business_id': 'windows-batch-business'}
+        assert service.registry.get_sample_value('ai_success_rate', labels) == 0.5
+
+        # Database replay goes through the batch update without the rate windows
+        replayed = dict(business, business_id='windows-replay-business', success_rate=0.1)
+        assert service.update_prometheus_metrics_batch([parse_event(replayed)]) is True
+        assert service.registry.get_sample_value('ai_success_rate', {'business_id': 'windows-replay-business'}) is None
+
+    def test_analytics_invalid_period(self, client):
+        """Test that unknown periods are rejected"""
+        response = client.get('/analytics/any-business?period=forever')
+        assert response.status_code == 400
+
+    def test_analytics_seeded_from_database(self, client, metrics_db, sample_metrics_data, service):
+        """Test that startup seeding loads hourly rollups from ai_metrics"""
+        event = sample_metrics_data.copy()
+        event['business_id'] = 'analytics-seed-business'
+        metrics_db.insert_metrics([event] * 4)
+
+        assert service.seed_rollups_from_db() is True
+
+        data = json.loads(client.get('/analytics/analytics-seed-business?period=7_days').data)
+        assert data['metrics']['total_conversations'] == 4
+        assert data['metrics']['avg_tokens_used'] == 150.0
+        # Short periods are answered from minute buckets, which are seeded too
+        data = json.loads(client.get('/analytics/analytics-seed-business?period=1_hour').data)
+        assert data['metrics']['total_conversations'] == 4
+
+
+class TestConversationSessions:
+    """Test cases for per-conversation session aggregates"""
+
+    def test_live_conversation_totals(self, client, sample_metrics_data):
+        """Test that turns of one conversation are summed"""
+        client.post('/track', json=sample_metrics_data)
+        client.post('/track', json=dict(sample_metrics_data, appointment_booked=True))
+
+        data = json.loads(client.get('/conversations/conv-456').data)
+        assert data['turns'] == 2
+        assert data['tokens_used'] == 300
+        assert data['response_time_ms_sum'] == 2500
+        assert data['outcome'] == 'booked'
+
+    def test_unknown_conversation(self, client):
+        """Test that conversations that aren't live are not found"""
+        assert client.get('/conversations/never-seen').status_code == 404
+
+    def test_finished_conversations_persisted(self, metrics_db, sample_metrics_data):
+        """Test that finished conversations are written to ai_conversations"""
+        app = create_app({'TESTING': True, 'METRICS_REGISTRY': CollectorRegistry(),
+                          'STARTUP_IN_BACKGROUND': False})
+        service = get_service(app)
+        app.test_client().post('/track/batch', json=[sample_metrics_data] * 3)
+
+        service.sessions.close()
+
+        rows = metrics_db.execute("SELECT conversation_id, turns, outcome, end_reason FROM ai_conversations")
+        assert rows == [('conv-456', 3, 'requested', 'shutdown')]
+        assert service.registry.get_sample_value(
+            'ai_conversation_turns_sum', {'outcome': 'requested'}) == 3
+
+
+class TestLatencySketches:
+    """Test cases for per-business latency quantiles"""
+
+    def test_quantiles_exposed_in_metrics(self, client, uncached_metrics, sample_metrics_data):
+        """Test that tracked latencies show up as quantile gauges"""
+        event = sample_metrics_data.copy()
+        event['business_id'] = 'sketch-business'
+        client.post('/track', json=event)
+
+        content = client.get('/metrics').data.decode('utf-8')
+
+        assert 'ai_response_time_quantile_seconds{business_id="sketch-business"' in content
+
+    def test_quantiles_in_analytics(self, client, sample_metrics_data):
+        """Test that analytics report p50/p95/p99 per model"""
+        events = []
+        for response_time_ms in (1000, 2000, 3000):
+            event = sample_metrics_data.copy()
+            event['business_id'] = 'sketch-analytics-business'
+            event['response_time_ms'] = response_time_ms
+            events.append(event)
+        client.post('/track/batch', json=events)
+
+        data = json.loads(client.get('/analytics/sketch-analytics-business').data)
+        quantiles = data['latency_quantiles_ms']['gemini-1.5-flash']
+
+        assert set(quantiles) == {'p50', 'p95', 'p99'}
+        assert quantiles['p50'] == pytest.approx(2000, rel=0.01)
+
+    def test_sketches_export_and_merge(self, client, sample_metrics_data):
+        """Test merging sketches exported by another replica"""
+        remote = {
+            'sketches': [{
+                'business_id': 'sketch-merge-business',
+                'model_name': 'gemini-1.5-flash',
+                'sketch': {'relative_accuracy': 0.01, 'bins': {'35': 4}, 'count': 4, 'sum': 8.0}
+            }]
+        }
+
+        client.post('/track', json=dict(sample_metrics_data, business_id='sketch-merge-business'))
+
+        for _ in range(2):
+            response = client.post('/sketches/merge', json=remote)
+            assert response.status_code == 200
+            data = json.loads(response.data)
+            assert data['merged'] == 1
+            merged = [s for s in data['sketches'] if s['business_id'] == 'sketch-merge-business']
+            assert merged[0]['sketch']['count'] == 5
+            assert set(merged[0]['quantiles_ms']) == {'p50', 'p95', 'p99'}
+
+        # The local store, and so /metrics, only holds what this replica recorded
+        exported = json.loads(client.get('/sketches').data)['sketches']
+        local = [s for s in exported if s['business_id'] == 'sketch-merge-business']
+        assert local[0]['sketch']['count'] == 1
+
+    def test_sketch_endpoints_require_token_when_set(self, client, app):
+        """Test that SKETCHES_TOKEN guards export and merge"""
+        app.config['SKETCHES_TOKEN'] = 'secret'
+
+        assert client.get('/sketches').status_code == 401
+        assert client.post('/sketches/merge', json={'sketches': []},
+                           headers={'Authorization': 'Bearer wrong'}).status_code == 401
+        assert client.get('/sketches', headers={'Authorization': 'Bearer secret'}).status_code == 200
+
+    def test_merge_rejects_invalid_sketches(self, client):
+        """Test that malformed merge payloads are rejected"""
+        assert client.post('/sketches/merge', json={}).status_code == 400
+        response = client.post('/sketches/merge', json={'sketches': [{'business_id': 'x'}]})
+        assert response.status_code == 400
+
+
+class TestLabelCardinality:
+    """Test cases for the cardinality guard on tracked metrics"""
+
+    def test_new_business_beyond_cap_is_folded(self, client, uncached_metrics, sample_metrics_data, service):
+        """Test that a business beyond the series cap is counted as __other__"""
+        event = sample_metrics_data.copy()
+        event['business_id'] = 'cardinality-overflow-business'
+
+        with patch.object(service.ai_requests_guard, 'max_series',
+                          service.ai_requests_guard.series()):
+            client.post('/track', json=event)
+
+        content = client.get('/metrics').data.decode('utf-8')
+        assert 'ai_requests_total{business_id="__other__"' in content
+        assert 'ai_requests_total{business_id="cardinality-overflow-business"' not in content
+
+    def test_rebuild_sums_businesses_folded_into_other(self, metrics_db, sample_metrics_data, service):
+        """Test that database totals folded into one __other__ child are added, not maxed"""
+        def other_requests():
+            return service.registry.get_sample_value('ai_requests_total', {
+                'business_id': '__other__', 'response_type': '__other__', 'intent': '__other__'
+            })
+
+        metrics_db.insert_metrics([dict(sample_metrics_data, business_id='folded-a')] * 2
+                                  + [dict(sample_metrics_data, business_id='folded-b')] * 3)
+        with patch.object(service.ai_requests_guard, 'max_series', 0), \
+                patch.object(service.ai_requests_guard, 'top_k', 0):
+            assert service.aggregate_metrics_from_db() is True
+            assert other_requests() == 5
+
+            metrics_db.insert_metrics([dict(sample_metrics_data, business_id='folded-a')])
+            assert service.refresh_metrics_from_db() is True
+            assert other_requests() == 6
+
+    def test_evicted_series_database_total_moves_to_other(self, client, metrics_db, sample_metrics_data, service):
+        """Test that rows of a series evicted by top-K are reconciled against __other__"""
+        def requests(business_id):
+            return service.registry.get_sample_value('ai_requests_total', {
+                'business_id': business_id,
+                'response_type': '__other__' if business_id == '__other__' else 'appointment_booking',
+                'intent': '__other__' if business_id == '__other__' else 'appointment'
+            })
+
+        metrics_db.insert_metrics([dict(sample_metrics_data, business_id='evicted-quiet')] * 3)
+        assert service.aggregate_metrics_from_db() is True
+        with patch.object(service.ai_requests_guard, 'max_series', service.ai_requests_guard.series()), \
+                patch.object(service.ai_requests_guard, 'top_k', True):
+            # Folded once, then promoted over the quiet series
+            client.post('/track', json=dict(sample_metrics_data, business_id='evicted-busy'))
+            client.post('/track', json=dict(sample_metrics_data, business_id='evicted-busy'))
+            assert requests('evicted-quiet') is None
+            assert requests('__other__') == 4
+
+            metrics_db.insert_metrics([dict(sample_metrics_data, business_id='evicted-quiet')] * 5)
+            assert service.refresh_metrics_from_db() is True
+
+        # All 8 rows of the evicted series now count towards __other__
+        assert requests('__other__') == 8
+
+
 class TestDataValidation:
     """Test cases for data validation"""
 
@@ -294,4 +1189,77 @@ class TestMyCustomTest:
         assert 'error' in data
 
 if __name__ == '__main__':
-    pytest.main([__file__, '-v'])
\ No newline at end of file
+    pytest.main([__file__, '-v'])
+
+class TestLiveStreamEndpoint:
+    """Test cases for the /stream SSE endpoint"""
+
+    def test_stream_starts_with_snapshot(self, client):
+        """Test that /stream is an event stream opening with a snapshot"""
+        response = client.get('/stream')
+        try:
+            assert response.status_code == 200
+            assert response.mimetype == 'text/event-stream'
+            first = next(iter(response.response)).decode('utf-8')
+        finally:
+            response.close()
+
+        assert 'event: snapshot' in first
+        assert '"totals"' in first
+
+    def test_tracked_events_reach_subscribers(self, client, sample_metrics_data, service):
+        """Test that /track feeds the next delta"""
+        subscription = service.live_stream.subscribe()
+        try:
+            messages = subscription.messages(heartbeat=0.01)
+
+            event = sample_metrics_data.copy()
+            event['business_id'] = 'stream-business'
+            client.post('/track', json=event)
+            service.live_stream.broadcast()
+
+            # Skip the snapshot, earlier tests' deltas and keepalives
+            delta = next(message.decode('utf-8') for message in islice(messages, 100)
+                         if b'stream-business' in message)
+        finally:
+            service.live_stream.unsubscribe(subscription)
+
+        assert 'event: delta' in delta
+        assert 'stream-business' in delta
+
+    def test_pool_streams_capped_below_threads(self):
+        """Test that streams on the request pool leave threads for /track and /ready"""
+        app = create_app({
+            'TESTING': True,
+            'METRICS_REGISTRY': CollectorRegistry(),
+            'STARTUP_IN_BACKGROUND': False,
+            'GUNICORN_THREADS': '4'
+        })
+        client = app.test_client()
+
+        streams = [client.get('/stream'), client.get('/stream')]
+        try:
+            assert [response.status_code for response in streams] == [200, 200]
+            assert client.get('/stream').status_code == 503
+            assert client.get('/ready').status_code == 200
+
+            streams.pop().close()
+            streams.append(client.get('/stream'))
+            assert streams[-1].status_code == 200
+        finally:
+            for response in streams:
+                response.close()
+
+    def test_redirects_to_stream_listener(self, client, service):
+        """Test that /stream points clients at the dedicated listener when it runs"""
+        service.stream_server = serve_stream(service.live_stream, 0, host='127.0.0.1')
+        port = service.stream_server.server_port
+        try:
+            response = client.get('/stream')
+        finally:
+            service.stream_server.shutdown()
+            service.stream_server.server_close()
+            service.stream_server = None
+
+        assert response.status_code == 307
+        assert response.headers['Location'] == f'http://localhost:{port}/stream'
@@ -0,0 +1,239 @@
+"""
+Unit tests for the Parquet archive
+Lab 3: Testing AI Systems
+
+This module contains tests for:
+- Day/business partitioning and publishing files on close
+- Partition, column and time-range pruning in read_archive
+- Dropping events when the buffer is full
+- Holding partitions back until they fill a row group
+- Backfilling the archive from a SQLite stand-in database
+"""
+
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from prometheus_client import CollectorRegistry
+
+pa = pytest.importorskip('pyarrow')
+import pyarrow.parquet as pq  # noqa: E402
+
+from archive import ParquetArchiver, export_from_db, read_archive  # noqa: E402
+from database import Database  # noqa: E402
+
+DAY = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def registry():
+    """Isolated Prometheus registry so tests don't share metric state"""
+    return CollectorRegistry()
+
+
+@pytest.fixture
+def archiver(tmp_path, registry):
+    archiver = ParquetArchiver(str(tmp_path / 'archive'), row_group_size=100, registry=registry)
+    yield archiver
+    archiver.stop()
+
+
+def make_event(i=0, business_id='biz-1', created_at=DAY, **fields):
+    event = {
+        'business_id': business_id,
+        'session_id': f'session-{i}',
+        'created_at': created_at + timedelta(minutes=i),
+        'intent_detected': 'booking' if i % 2 else 'pricing',
+        'response_time_ms': 1000 + i,
+        'tokens_used': 100,
+        'api_cost_usd': 0.001,
+        'appointment_requested': bool(i % 2)
+    }
+    event.update(fields)
+    return event
+
+
+def published_files(root):
+    return sorted(
+        os.path.relpath(os.path.join(directory, name), root)
+        for directory, _, names in os.walk(root) for name in names
+    )
+
+
+class TestParquetArchiver:
+    """Test cases for ParquetArchiver"""
+
+    def test_partitions_by_day_and_business(self, archiver, registry):
+        archiver.write([make_event(0, 'biz-1'), make_event(1, 'biz/2'),
+                        make_event(2, 'biz-1', created_at=DAY + timedelta(days=1))])
+        archiver.close_files()
+
+        files = published_files(archiver.root)
+        assert [os.path.dirname(path) for path in files] == [
+            os.path.join('day=2024-05-01', 'business_id=biz%2F2'),
+            os.path.join('day=2024-05-01', 'business_id=biz-1'),
+            os.path.join('day=2024-05-02', 'business_id=biz-1'),
+        ]
+        assert registry.get_sample_value('metrics_archive_rows_written_total') == 3
+        assert registry.get_sample_value('metrics_archive_files_total') == 3
+
+    def test_files_are_hidden_until_closed(self, archiver):
+        # Files of past days are published right away, so use today's date
+        archiver.write([make_event(0, created_at=datetime.now(timezone.utc))])
+
+        assert all(os.path.basename(path).startswith('.') for path in published_files(archiver.root))
+        assert read_archive(archiver.root).num_rows == 0
+
+        archiver.close_files()
+        assert read_archive(archiver.root).num_rows == 1
+
+    def test_row_groups_sorted_with_statistics(self, archiver):
+        archiver.write([make_event(i) for i in reversed(range(10))])
+        archiver.close_files()
+
+        path = os.path.join(archiver.root, published_files(archiver.root)[0])
+        metadata = pq.ParquetFile(path).metadata
+        statistics = metadata.row_group(0).column(0).statistics
+        assert statistics.has_min_max
+        assert statistics.min == DAY
+        assert statistics.max == DAY + timedelta(minutes=9)
+        assert pq.read_table(path)['session_id'].to_pylist()[0] == 'session-0'
+
+    def test_buffer_cap_drops_events(self, tmp_path, registry):
+        archiver = ParquetArchiver(str(tmp_path), max_buffered_rows=3, registry=registry)
+
+        accepted = archiver._append([make_event(i) for i in range(5)])
+
+        assert accepted == 3
+        assert registry.get_sample_value('metrics_archive_dropped_total') == 2
+        assert registry.get_sample_value('metrics_archive_buffered_rows') == 3
+
+    def test_stop_publishes_recorded_events(self, archiver):
+        now = datetime.now(timezone.utc)
+        archiver.record([make_event(i, created_at=now) for i in range(4)])
+        archiver.stop()
+
+        assert read_archive(archiver.root).num_rows == 4
+
+    def test_recorded_events_far_from_now_are_clamped(self, archiver, registry):
+        """A wrong client clock can't open a partition per stray day"""
+        now = datetime.now(timezone.utc)
+        archiver.record([make_event(0, created_at=now - timedelta(minutes=5)),
+                         make_event(1, created_at=DAY), make_event(2, created_at=now + timedelta(days=400))])
+        archiver.stop()
+
+        days = {path.split(os.sep)[0] for path in published_files(archiver.root)}
+        assert days <= {f'day={day.date().isoformat()}' for day in (now - timedelta(minutes=5), now)}
+        assert registry.get_sample_value('metrics_archive_clamped_total') == 2
+
+    def test_small_partitions_wait_for_a_row_group(self, tmp_path, registry):
+        """Flushes don't write a tiny row group per partition each time"""
+        archiver = ParquetArchiver(str(tmp_path), row_group_size=10, min_row_group_size=5, registry=registry)
+        now = datetime.now(timezone.utc)
+        archiver.write([make_event(0, created_at=now)])
+        archiver.write([make_event(1, created_at=now)])
+
+        assert registry.get_sample_value('metrics_archive_rows_written_total') == 0
+        assert registry.get_sample_value('metrics_archive_buffered_rows') == 2
+
+        # 2 + 11 rows: one full row group, and a 3-row tail held back
+        archiver.write([make_event(i, created_at=now) for i in range(2, 13)])
+        assert registry.get_sample_value('metrics_archive_rows_written_total') == 10
+
+        archiver.close_files()
+        path = os.path.join(str(tmp_path), published_files(str(tmp_path))[0])
+        metadata = pq.ParquetFile(path).metadata
+        assert [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)] == [10, 3]
+
+    def test_held_rows_are_written_after_roll_interval(self, tmp_path, registry):
+        archiver = ParquetArchiver(str(tmp_path), min_row_group_size=100, roll_interval=0, registry=registry)
+        archiver.write([make_event(0, created_at=datetime.now(timezone.utc))])
+
+        assert registry.get_sample_value('metrics_archive_rows_written_total') == 1
+        assert read_archive(str(tmp_path)).num_rows == 1
+
+    def test_write_keeps_historical_created_at(self, archiver, registry):
+        archiver.write([make_event(0)])
+        archiver.close_files()
+
+        assert read_archive(archiver.root)['created_at'].to_pylist() == [DAY]
+        assert registry.get_sample_value('metrics_archive_clamped_total') == 0
+
+
+class TestReadArchive:
+    """Test cases for read_archive pruning"""
+
+    @pytest.fixture
+    def root(self, archiver):
+        archiver.write([make_event(i, business_id) for i in range(6) for business_id in ('biz-1', 'biz-2')])
+        archiver.write([make_event(0, 'biz-1', created_at=DAY + timedelta(days=1))])
+        archiver.close_files()
+        return archiver.root
+
+    def test_reads_everything(self, root):
+        table = read_archive(root)
+
+        assert table.num_rows == 13
+        assert {'business_id', 'day', 'created_at', 'api_cost_usd'} <= set(table.column_names)
+
+    def test_business_and_column_pruning(self, root):
+        table = read_archive(root, columns=['intent_detected', 'api_cost_usd'], business_ids=['biz-2'])
+
+        assert table.column_names == ['intent_detected', 'api_cost_usd']
+        assert table.num_rows == 6
+        totals = table.group_by('intent_detected').aggregate([('api_cost_usd', 'count')])
+        assert sorted(totals['api_cost_usd_count'].to_pylist()) == [3, 3]
+
+    def test_time_range(self, root):
+        table = read_archive(root, columns=['session_id'], business_ids=['biz-1'],
+                             start=DAY + timedelta(minutes=2), end=DAY + timedelta(minutes=4))
+
+        assert sorted(table['session_id'].to_pylist()) == ['session-2', 'session-3']
+
+    def test_time_range_by_iso_string(self, root):
+        table = read_archive(root, start='2024-05-02')
+
+        assert table.num_rows == 1
+
+    def test_missing_archive_is_empty(self, tmp_path):
+        assert read_archive(str(tmp_path / 'missing')).num_rows == 0
+
+
+class TestExportFromDatabase:
+    """Test cases for backfilling the archive from ai_metrics"""
+
+    def test_export_since(self, tmp_path, registry):
+        database = Database(f"sqlite:///{tmp_path / 'metrics.db'}")
+        database.create_metrics_table()
+        try:
+            old = make_event(0, created_at=DAY - timedelta(days=10))
+            recent = [make_event(i, business_id=f'biz-{i % 2}') for i in range(5)]
+            database.insert_metrics([dict(event, created_at=event['created_at'].strftime('%Y-%m-%d %H:%M:%S'))
+                                     for event in [old] + recent])
+
+            exported = export_from_db(database, str(tmp_path / 'archive'), DAY.replace(tzinfo=None),
+                                      chunk_size=2, registry=registry)
+        finally:
+            database.close()
+
+        assert exported == 5
+        table = read_archive(str(tmp_path / 'archive'), columns=['business_id', 'session_id', 'created_at'])
+        assert sorted(table['session_id'].to_pylist()) == [f'session-{i}' for i in range(5)]
+        assert table['created_at'].to_pylist()[0].tzinfo is not None
+
+    def test_export_in_created_at_order(self, tmp_path, registry):
+        """Late-inserted rows don't interleave days, so each chunk fills one partition"""
+        database = Database(f"sqlite:///{tmp_path / 'metrics.db'}")
+        database.create_metrics_table()
+        try:
+            # Insertion (id) order alternates between two days
+            events = [make_event(i, created_at=DAY + timedelta(days=i % 2)) for i in range(4)]
+            database.insert_metrics([dict(event, created_at=event['created_at'].strftime('%Y-%m-%d %H:%M:%S'))
+                                     for event in events])
+
+            export_from_db(database, str(tmp_path / 'archive'), DAY.replace(tzinfo=None),
+                           chunk_size=2, registry=registry)
+        finally:
+            database.close()
+
+        assert len(published_files(str(tmp_path / 'archive'))) == 2
@@ -0,0 +1,133 @@
+"""
+Test Suite for the label-cardinality guard
+Lab 3: Testing AI Systems
+
+This module contains tests for:
+- Capping distinct label sets per metric
+- Folding overflow into the __other__ series
+- Allow-listed business ids
+- Top-K promotion by traffic
+"""
+
+import pytest
+from prometheus_client import CollectorRegistry, Counter
+
+from cardinality import OVERFLOW_LABEL_VALUE, CardinalityGuard, CardinalityMetrics
+
+
+@pytest.fixture
+def registry():
+    """Isolated Prometheus registry so tests don't share metric state"""
+    return CollectorRegistry()
+
+
+@pytest.fixture
+def requests_counter(registry):
+    return Counter('guarded_requests_total', 'Guarded test counter',
+                   ['business_id', 'intent'], registry=registry)
+
+
+def make_guard(counter, registry, **kwargs):
+    kwargs.setdefault('max_series', 2)
+    return CardinalityGuard(counter, 'guarded_requests_total',
+                            metrics=CardinalityMetrics(registry), **kwargs)
+
+
+def value(registry, business_id, intent):
+    return registry.get_sample_value('guarded_requests_total',
+                                     {'business_id': business_id, 'intent': intent})
+
+
+class TestCardinalityGuard:
+    """Test cases for CardinalityGuard"""
+
+    def test_overflow_folds_into_other(self, registry, requests_counter):
+        """Test that label sets beyond the cap share the __other__ series"""
+        guard = make_guard(requests_counter, registry)
+        for business_id in ('a', 'b', 'c', 'd'):
+            guard.labels(business_id=business_id, intent='general').inc()
+
+        assert value(registry, 'a', 'general') == 1
+        assert value(registry, 'b', 'general') == 1
+        assert value(registry, 'c', 'general') is None
+        assert value(registry, OVERFLOW_LABEL_VALUE, OVERFLOW_LABEL_VALUE) == 2
+        assert registry.get_sample_value('metrics_label_overflow_total',
+                                         {'metric': 'guarded_requests_total'}) == 2
+        assert registry.get_sample_value('metrics_label_series',
+                                         {'metric': 'guarded_requests_total'}) == 2
+
+    def test_admitted_label_sets_keep_counting(self, registry, requests_counter):
+        """Test that admitted series are unaffected once the cap is reached"""
+        guard = make_guard(requests_counter, registry)
+        guard.labels('a', 'general').inc()
+        guard.labels('b', 'general').inc()
+        guard.labels('c', 'general').inc()
+        guard.labels('a', 'general').inc()
+
+        assert value(registry, 'a', 'general') == 2
+
+    def test_fold_labels_subset(self, registry, requests_counter):
+        """Test that only the configured labels are folded"""
+        guard = make_guard(requests_counter, registry, max_series=1, fold_labels=['business_id'])
+        guard.labels(business_id='a', intent='general').inc()
+        guard.labels(business_id='b', intent='pricing').inc()
+
+        assert value(registry, OVERFLOW_LABEL_VALUE, 'pricing') == 1
+
+    def test_allow_list_bypasses_cap(self, registry, requests_counter):
+        """Test that allow-listed businesses are always admitted"""
+        guard = make_guard(requests_counter, registry, max_series=1, allow_list=['vip'])
+        guard.labels(business_id='a', intent='general').inc()
+        guard.labels(business_id='vip', intent='general').inc()
+
+        assert value(registry, 'vip', 'general') == 1
+        assert guard.series() == 2
+
+    def test_top_k_promotes_heavy_traffic(self, registry, requests_counter):
+        """Test that a busy folded label set replaces the quietest admitted one"""
+        guard = make_guard(requests_counter, registry, top_k=True)
+        guard.labels('quiet', 'general').inc()
+        for _ in range(5):
+            guard.labels('steady', 'general').inc()
+        for _ in range(3):
+            guard.labels('busy', 'general').inc()
+
+        assert value(registry, 'quiet', 'general') is None
+        assert value(registry, 'steady', 'general') == 5
+        # First update was folded; promoted on the second, counted from then on
+        assert value(registry, 'busy', 'general') == 2
+        # The folded update plus the evicted series' count
+        assert value(registry, OVERFLOW_LABEL_VALUE, OVERFLOW_LABEL_VALUE) == 2
+        assert registry.get_sample_value('metrics_label_evictions_total',
+                                         {'metric': 'guarded_requests_total'}) == 1
+
+    def test_promotion_keeps_summed_totals(self, registry, requests_counter):
+        """Test that evicting a series moves its count into __other__ instead of dropping it"""
+        folds = []
+        guard = make_guard(requests_counter, registry, top_k=True,
+                           on_fold=lambda evicted, folded: folds.append((evicted, folded)))
+        guard.labels('quiet', 'general').inc(7)
+        guard.labels('steady', 'general').inc()
+        guard.labels('steady', 'general').inc()
+
+        def total():
+            return sum(s.value for metric in registry.collect() if metric.name == 'guarded_requests'
+                       for s in metric.samples if s.name == 'guarded_requests_total')
+
+        guard.labels('busy', 'general').inc()
+        before = total()
+        guard.labels('busy', 'general').inc()
+
+        assert folds == [(('quiet', 'general'), (OVERFLOW_LABEL_VALUE, OVERFLOW_LABEL_VALUE))]
+        assert value(registry, 'quiet', 'general') is None
+        assert total() == before + 1
+
+    def test_series_stay_bounded_under_abuse(self, registry, requests_counter):
+        """Test that random label values can't grow the metric without limit"""
+        guard = make_guard(requests_counter, registry, max_series=50, top_k=True)
+        for i in range(5000):
+            guard.labels(business_id=f'random-{i}', intent='general').inc()
+
+        samples = [s for metric in registry.collect() if metric.name == 'guarded_requests'
+                   for s in metric.samples if s.name == 'guarded_requests_total']
+        assert len(samples) <= 51
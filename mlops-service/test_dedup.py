@@ -0,0 +1,88 @@
+"""
+Unit tests for the idempotency index
+Lab 3: Testing AI Systems
+"""
+
+import time
+from unittest.mock import patch
+
+import pytest
+from prometheus_client import CollectorRegistry
+
+from dedup import DedupIndex, idempotency_key
+from schema import MetricEvent
+
+
+@pytest.fixture
+def registry():
+    return CollectorRegistry()
+
+
+class TestIdempotencyKey:
+    """Test cases for choosing an event's key"""
+
+    def test_header_wins_over_event_id(self):
+        event = MetricEvent(business_id='b', event_id='evt-1')
+
+        assert idempotency_key(event, 'hdr-1') == 'header:hdr-1'
+        assert idempotency_key(event) == 'event:evt-1'
+
+    def test_derived_from_conversation_and_timestamp(self):
+        event = MetricEvent(business_id='b', conversation_id='c1', session_id='s1',
+                            timestamp='2024-01-01T00:00:00Z')
+
+        assert idempotency_key(event) == 'turn:c1:s1:2024-01-01T00:00:00Z'
+
+    def test_no_key_without_identity(self):
+        assert idempotency_key(MetricEvent(business_id='b', conversation_id='c1')) is None
+
+
+class TestDedupIndex:
+    """Test cases for the bounded LRU/TTL index"""
+
+    def test_second_sighting_is_duplicate(self, registry):
+        index = DedupIndex(registry=registry)
+
+        assert index.check_and_add('k1') is True
+        assert index.check_and_add('k1') is False
+        assert index.check_and_add(None) is True
+        assert registry.get_sample_value('metrics_dedup_duplicates_total') == 1
+
+    def test_seen_does_not_record(self, registry):
+        index = DedupIndex(ttl=10, registry=registry)
+
+        assert index.seen('k1') is False
+        assert index.seen(None) is False
+        assert index.check_and_add('k1') is True
+        with patch('dedup.time.monotonic', return_value=time.monotonic() + 11):
+            assert index.seen('k1') is False
+        assert index.seen('k1') is True
+        assert registry.get_sample_value('metrics_dedup_duplicates_total') == 1
+
+    def test_keys_expire_after_ttl(self, registry):
+        index = DedupIndex(ttl=10, registry=registry)
+        with patch('dedup.time.monotonic', return_value=100.0):
+            index.check_and_add('k1')
+        with patch('dedup.time.monotonic', return_value=111.0):
+            assert index.check_and_add('k1') is True
+            assert len(index) == 1
+
+    def test_memory_is_capped(self, registry):
+        """The least recently seen key is evicted at the cap"""
+        index = DedupIndex(max_entries=3, registry=registry)
+        for key in ('a', 'b', 'c'):
+            index.check_and_add(key)
+        index.check_and_add('a')  # refresh: 'b' is now the oldest
+        index.check_and_add('d')
+
+        assert len(index) == 3
+        assert index.check_and_add('a') is False
+        assert index.check_and_add('b') is True
+        assert registry.get_sample_value('metrics_dedup_evictions_total') == 2
+
+    def test_discard_lets_retry_through(self, registry):
+        index = DedupIndex(registry=registry)
+        index.check_and_add('k1')
+        index.discard('k1')
+
+        assert index.check_and_add('k1') is True
@@ -0,0 +1,107 @@
+"""
+Unit tests for the service's self-instrumentation
+Lab 3: Testing AI Systems
+"""
+
+import pytest
+from flask import Flask, Response, jsonify
+from prometheus_client import CollectorRegistry
+
+from instrumentation import UNMATCHED_ROUTE, RequestInstrumentation
+
+
+@pytest.fixture
+def registry():
+    return CollectorRegistry()
+
+
+@pytest.fixture
+def instrumented(registry):
+    app = Flask(__name__)
+    instrumentation = RequestInstrumentation(app, registry=registry)
+
+    @instrumentation.stage('work')
+    def work(fail=False):
+        if fail:
+            raise RuntimeError('boom')
+        return 'done'
+
+    @app.route('/items/<item_id>', methods=['POST'])
+    def create_item(item_id):
+        return jsonify({'id': item_id, 'result': work()})
+
+    @app.route('/broken')
+    def broken():
+        return work(fail=True)
+
+    @app.route('/stream')
+    def stream():
+        return Response(iter([b'a', b'b']), mimetype='text/plain')
+
+    return app, instrumentation
+
+
+def sample(registry, name, **labels):
+    return registry.get_sample_value(f'mlops_service_{name}', labels) or 0
+
+
+class TestRequestInstrumentation:
+    """Test cases for the request hooks"""
+
+    def test_latency_and_sizes_labelled_by_route_rule(self, instrumented, registry):
+        """Paths with different ids share the route's series"""
+        app, _ = instrumented
+        client = app.test_client()
+        client.post('/items/1', data=b'x' * 100)
+        client.post('/items/2', data=b'x' * 100)
+
+        labels = {'route': '/items/<item_id>', 'method': 'POST'}
+        assert sample(registry, 'http_request_duration_seconds_count', status='200', **labels) == 2
+        assert sample(registry, 'http_request_size_bytes_sum', **labels) == 200
+        assert sample(registry, 'http_response_size_bytes_count', **labels) == 2
+        assert sample(registry, 'http_requests_in_flight') == 0
+
+    def test_unhandled_exception_counted_as_error(self, instrumented, registry):
+        """A failing view is recorded as a 500 and its stage is still timed"""
+        app, _ = instrumented
+        app.test_client().get('/broken')
+
+        labels = {'route': '/broken', 'method': 'GET', 'status': '500'}
+        assert sample(registry, 'http_request_errors_total', **labels) == 1
+        assert sample(registry, 'http_request_duration_seconds_count', **labels) == 1
+        assert sample(registry, 'stage_duration_seconds_count', stage='work') == 1
+        assert sample(registry, 'http_requests_in_flight') == 0
+
+    def test_unmatched_paths_share_one_series(self, instrumented, registry):
+        """404s don't create a series per path"""
+        app, _ = instrumented
+        client = app.test_client()
+        client.get('/nope/1')
+        client.get('/nope/2')
+
+        assert sample(registry, 'http_request_duration_seconds_count',
+                      route=UNMATCHED_ROUTE, method='GET', status='404') == 2
+        assert sample(registry, 'http_request_errors_total',
+                      route=UNMATCHED_ROUTE, method='GET', status='404') == 0
+
+    def test_streamed_response_size_not_observed(self, instrumented, registry):
+        """Streamed bodies have no known size"""
+        app, _ = instrumented
+        assert app.test_client().get('/stream').data == b'ab'
+
+        assert sample(registry, 'http_request_duration_seconds_count',
+                      route='/stream', method='GET', status='200') == 1
+        assert sample(registry, 'http_response_size_bytes_count', route='/stream', method='GET') == 0
+
+    def test_stage_decorator_preserves_function(self, instrumented):
+        """Wrapped functions keep their name and return value"""
+        _, instrumentation = instrumented
+
+        @instrumentation.stage('other')
+        def compute(x):
+            """Docstring"""
+            return x * 2
+
+        assert compute(2) == 4
+        assert compute.__name__ == 'compute'
+        assert compute.__doc__ == 'Docstring'
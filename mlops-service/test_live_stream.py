@@ -0,0 +1,178 @@
+"""
+Unit tests for the SSE live metrics stream
+Lab 3: Testing AI Systems
+"""
+
+import json
+from http.client import HTTPConnection
+from unittest.mock import patch
+
+import pytest
+from prometheus_client import CollectorRegistry
+
+from live_stream import KEEPALIVE, LiveStream, Subscription, serve_stream
+from schema import MetricEvent
+
+
+def parse_sse(message: bytes):
+    """Return (event, data) from one encoded SSE message"""
+    fields = {}
+    for line in message.decode('utf-8').strip().splitlines():
+        key, _, value = line.partition(': ')
+        fields[key] = value
+    return fields['event'], json.loads(fields['data'])
+
+
+def make_event(**fields):
+    fields.setdefault('business_id', 'biz-1')
+    fields.setdefault('response_time_ms', 200)
+    fields.setdefault('tokens_used', 10)
+    return MetricEvent(**fields)
+
+
+@pytest.fixture
+def registry():
+    return CollectorRegistry()
+
+
+@pytest.fixture
+def stream(registry):
+    # Broadcasts are driven by the tests, so no background thread
+    live = LiveStream(interval=60, max_buffer=3, max_subscribers=2, registry=registry)
+    live.start = lambda: None
+    return live
+
+
+class TestSubscription:
+    """Test cases for a single client's buffer"""
+
+    def test_yields_buffered_messages_then_keepalive(self):
+        """An idle subscription sends keepalives"""
+        subscription = Subscription(max_buffer=2)
+        subscription.offer(b'one')
+        messages = subscription.messages(heartbeat=0.01)
+
+        assert next(messages) == b'one'
+        assert next(messages) == KEEPALIVE
+
+    def test_full_buffer_closes_subscription(self):
+        """A client that falls behind is closed and its buffer dropped"""
+        subscription = Subscription(max_buffer=2)
+        assert subscription.offer(b'1') and subscription.offer(b'2')
+
+        assert subscription.offer(b'3') is False
+        assert subscription.closed
+        assert subscription.reason == 'slow_consumer'
+        assert list(subscription.messages(heartbeat=0.01)) == []
+
+
+class TestLiveStream:
+    """Test cases for snapshot and delta fan-out"""
+
+    def test_subscribe_starts_with_snapshot(self, stream):
+        """New subscribers get the current totals first"""
+        stream.seed({'requests': 5, 'tokens_used': 100})
+        subscription = stream.subscribe()
+
+        event, data = parse_sse(next(subscription.messages(heartbeat=0.01)))
+
+        assert event == 'snapshot'
+        assert data['totals']['requests'] == 5
+        assert data['totals']['tokens_used'] == 100
+
+    def test_delta_contains_changes_since_last_broadcast(self, stream):
+        """Counters, totals, latency and recent events are sent as one delta"""
+        subscription = stream.subscribe()
+        messages = subscription.messages(heartbeat=0.01)
+        next(messages)
+
+        stream.record([make_event(appointment_requested=True), make_event(response_time_ms=400)])
+        stream.broadcast()
+        event, data = parse_sse(next(messages))
+
+        assert event == 'delta'
+        assert data['events'] == 2
+        assert data['counters'] == {'requests': 2, 'tokens_used': 20, 'appointments_requested': 1}
+        assert data['totals']['requests'] == 2
+        assert data['latency']['count'] == 2
+        assert 190 <= data['latency']['p50_ms'] <= 410
+        assert [e['response_time_ms'] for e in data['recent']] == [200, 400]
+
+    def test_one_message_is_shared_by_all_subscribers(self, stream):
+        """The delta is encoded once and the same bytes go to everyone"""
+        first, second = stream.subscribe(), stream.subscribe()
+        first_messages, second_messages = first.messages(0.01), second.messages(0.01)
+        next(first_messages), next(second_messages)
+
+        stream.record([make_event()])
+        assert stream.broadcast() == 2
+
+        assert next(first_messages) is next(second_messages)
+
+    def test_nothing_sent_without_changes(self, stream):
+        """Idle intervals don't produce deltas"""
+        stream.subscribe()
+
+        assert stream.broadcast() == 0
+
+    def test_slow_consumer_is_disconnected(self, stream, registry):
+        """A subscriber that never reads is dropped once its buffer fills"""
+        slow = stream.subscribe()
+        for _ in range(3):
+            stream.record([make_event()])
+            stream.broadcast()
+
+        assert slow.closed
+        assert registry.get_sample_value('live_stream_subscribers') == 0
+        assert registry.get_sample_value('live_stream_disconnects_total', {'reason': 'slow_consumer'}) == 1
+
+    def test_latency_sketches_bounded_without_subscribers(self, stream):
+        """Seconds outside the latency window are dropped even if nothing broadcasts"""
+        for second in range(5000):
+            with patch('live_stream.time.time', return_value=1700000000.0 + second):
+                stream.record([make_event()])
+
+        assert len(stream._latency) <= stream.latency_window
+
+    def test_subscriber_limit(self, stream):
+        """Subscriptions beyond max_subscribers are refused"""
+        assert stream.subscribe() is not None
+        assert stream.subscribe() is not None
+
+        assert stream.subscribe() is None
+
+
+class TestStreamServer:
+    """Test cases for the dedicated /stream listener"""
+
+    @pytest.fixture
+    def server(self, stream):
+        server = serve_stream(stream, 0, host='127.0.0.1')
+        yield server
+        server.shutdown()
+        server.server_close()
+
+    def test_serves_snapshot(self, server, stream, registry):
+        """Each connection gets its own subscription, outside any request pool"""
+        connection = HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+        try:
+            connection.request('GET', '/stream')
+            response = connection.getresponse()
+            assert response.status == 200
+            assert response.getheader('Content-Type') == 'text/event-stream'
+            assert response.getheader('Access-Control-Allow-Origin') == '*'
+
+            message = b''.join(iter(response.readline, b'\n'))
+            event, data = parse_sse(message)
+            assert event == 'snapshot'
+            assert registry.get_sample_value('live_stream_subscribers') == 1
+        finally:
+            connection.close()
+
+    def test_other_paths_not_found(self, server):
+        connection = HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+        try:
+            connection.request('GET', '/track')
+            assert connection.getresponse().status == 404
+        finally:
+            connection.close()
@@ -0,0 +1,110 @@
+"""
+Tests for the load test harness
+Lab 3: Testing AI Systems
+"""
+
+import json
+import random
+
+from load_test import (
+    InProcessTarget, build_request, check_thresholds, make_event, main, percentile, run_scenario
+)
+
+
+def result(name='track/full/c1/b10', rps=1000.0, p99=5.0, error_rate=0.0):
+    return {
+        'name': name,
+        'throughput_rps': rps,
+        'events_per_s': rps,
+        'error_rate': error_rate,
+        'latency_ms': {'p50': 1.0, 'p95': 2.0, 'p99': p99}
+    }
+
+
+class TestHelpers:
+    """Test cases for payload generation and statistics"""
+
+    def test_percentile_nearest_rank(self):
+        values = [float(v) for v in range(1, 101)]
+
+        assert percentile(values, 0.50) == 50
+        assert percentile(values, 0.99) == 99
+        assert percentile([], 0.5) == 0.0
+
+    def test_event_cardinality_and_shape(self):
+        rng = random.Random(1)
+        minimal = [make_event(rng, 3, 'minimal') for _ in range(50)]
+        full = make_event(rng, 3, 'full')
+
+        assert {e['business_id'] for e in minimal} <= {f'load-business-{i}' for i in range(3)}
+        assert set(minimal[0]) == {'business_id', 'response_time_ms', 'tokens_used'}
+        assert 'intent_detected' in full
+
+    def test_batch_request_carries_events(self):
+        method, path, body, _, events = build_request('track_batch', 'batch_5', 10, random.Random(1))
+
+        assert (method, path, events) == ('POST', '/track/batch', 5)
+        assert len(json.loads(body)) == 5
+
+
+class TestThresholds:
+    """Test cases for regression checks"""
+
+    def test_passing_run(self):
+        assert check_thresholds([result()], {'track/*': {'min_rps': 500, 'max_p99_ms': 10}}) == []
+
+    def test_violations_are_reported(self):
+        violations = check_thresholds(
+            [result(rps=100, p99=50, error_rate=0.1)],
+            {'track/*': {'min_rps': 500, 'max_p99_ms': 10}, '*': {'max_error_rate': 0}}
+        )
+
+        assert len(violations) == 3
+        assert any('min_rps' in violation for violation in violations)
+
+    def test_relative_limits_compare_with_baseline(self):
+        limits = {'track/*': {'max_rps_regression': 0.5, 'max_p95_regression': 1.0}}
+        baseline = [result(rps=1000.0)]
+        slower = result(rps=400.0)
+        slower['latency_ms']['p95'] = 5.0
+
+        assert check_thresholds([result(rps=600.0)], limits, baseline) == []
+        violations = check_thresholds([slower], limits, baseline)
+        assert [violation.split(':')[1].split()[0] for violation in violations] == [
+            'max_rps_regression', 'max_p95_regression'
+        ]
+        # Nothing to compare with: relative limits are skipped
+        assert check_thresholds([slower], limits) == []
+        assert check_thresholds([result(name='track/new/c1/b10', rps=1.0)], limits, baseline) == []
+
+    def test_patterns_only_apply_to_matching_scenarios(self):
+        assert check_thresholds([result(name='metrics/scrape/c1/b10', rps=1)],
+                                {'track/*': {'min_rps': 500}}) == []
+
+
+class TestInProcessRun:
+    """Smoke test of a real run through Flask's test client"""
+
+    def test_run_scenario_measures_requests(self):
+        outcome = run_scenario(InProcessTarget(), 'track', 'full', concurrency=2,
+                               cardinality=5, total_requests=10)
+
+        assert outcome['name'] == 'track/full/c2/b5'
+        assert outcome['requests'] == 10
+        assert outcome['errors'] == 0
+        assert outcome['throughput_rps'] > 0
+        assert outcome['latency_ms']['p50'] <= outcome['latency_ms']['p99']
+
+    def test_main_fails_on_threshold_violation(self, tmp_path):
+        thresholds = tmp_path / 'thresholds.json'
+        thresholds.write_text(json.dumps({'analytics/*': {'min_rps': 10 ** 9}}))
+        output = tmp_path / 'report.json'
+
+        code = main(['--in-process', '--endpoint', 'analytics', '--requests', '4',
+                     '--concurrency', '1', '--cardinality', '2',
+                     '--thresholds', str(thresholds), '--output', str(output)])
+
+        report = json.loads(output.read_text())
+        assert code == 1
+        assert report['passed'] is False
+        assert report['results'][0]['endpoint'] == 'analytics'
@@ -0,0 +1,86 @@
+"""
+Unit tests for the prometheus_client internals helpers
+Lab 3: Testing AI Systems
+
+This module contains tests for:
+- The installed prometheus_client matching the version the helpers were checked against
+- Reading, raising and merging counter and histogram cells
+- Listing children and looking collectors up by name
+"""
+
+import os
+import re
+from importlib.metadata import version
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+
+from metric_internals import (TESTED_VERSION, add_child, bucket_cells, children, collector_for, counter_cell,
+                              existing_child, is_live_gauge, is_multiprocess, label_names, raise_to, sum_cell)
+
+
+class TestMetricInternals:
+    """Test cases for metric_internals"""
+
+    def test_pinned_to_tested_version(self):
+        """Upgrading prometheus_client means re-checking these helpers and bumping TESTED_VERSION"""
+        assert version('prometheus_client') == TESTED_VERSION
+
+        with open(os.path.join(os.path.dirname(__file__), 'requirements.txt')) as f:
+            pinned = re.search(r'^prometheus-client==(\S+)', f.read(), re.MULTILINE).group(1)
+        assert pinned == TESTED_VERSION
+
+    def test_counter_cells(self):
+        registry = CollectorRegistry()
+        counter = Counter('internals_requests_total', 'Requests', ['business_id'], registry=registry)
+        counter.labels('biz-1').inc(2)
+
+        assert children(counter) == [(('biz-1',), counter.labels('biz-1'))]
+        assert counter_cell(counter.labels('biz-1')).get() == 2
+        assert raise_to(counter_cell(counter.labels('biz-1')), 5) == 3
+        assert raise_to(counter_cell(counter.labels('biz-1')), 4) == 0
+        assert registry.get_sample_value('internals_requests_total', {'business_id': 'biz-1'}) == 5
+
+    def test_histogram_cells(self):
+        registry = CollectorRegistry()
+        histogram = Histogram('internals_latency_seconds', 'Latency', buckets=[0.1, 1.0], registry=registry)
+        histogram.observe(0.5)
+
+        buckets = bucket_cells(histogram)
+        assert [bucket.get() for bucket in buckets] == [0, 1, 0]
+        raise_to(buckets[0], 2)
+        raise_to(sum_cell(histogram), 1.5)
+
+        assert registry.get_sample_value('internals_latency_seconds_bucket', {'le': '0.1'}) == 2
+        assert registry.get_sample_value('internals_latency_seconds_count') == 3
+        assert registry.get_sample_value('internals_latency_seconds_sum') == 1.5
+
+    def test_add_child(self):
+        registry = CollectorRegistry()
+        counter = Counter('internals_folded_total', 'Folded', ['business_id'], registry=registry)
+        histogram = Histogram('internals_folded_seconds', 'Folded', ['business_id'],
+                              buckets=[0.1, 1.0], registry=registry)
+        counter.labels('a').inc(3)
+        counter.labels('b').inc(1)
+        histogram.labels('a').observe(0.5)
+
+        add_child(counter.labels('b'), existing_child(counter, ('a',)))
+        add_child(histogram.labels('b'), histogram.labels('a'))
+
+        assert existing_child(counter, ('missing',)) is None
+        assert is_multiprocess(counter.labels('a')) is False
+        assert registry.get_sample_value('internals_folded_total', {'business_id': 'b'}) == 4
+        assert registry.get_sample_value('internals_folded_seconds_count', {'business_id': 'b'}) == 1
+        assert registry.get_sample_value('internals_folded_seconds_sum', {'business_id': 'b'}) == 0.5
+
+    def test_collector_lookup(self):
+        registry = CollectorRegistry()
+        counter = Counter('internals_errors_total', 'Errors', ['reason'], registry=registry)
+        in_flight = Gauge('internals_in_flight', 'In flight', registry=registry, multiprocess_mode='livesum')
+        rate = Gauge('internals_rate', 'Rate', registry=registry, multiprocess_mode='mostrecent')
+
+        assert collector_for(registry, 'internals_errors_total') is counter
+        assert collector_for(registry, 'internals_missing') is None
+        assert label_names(counter) == ('reason',)
+        assert is_live_gauge(in_flight) is True
+        assert is_live_gauge(rate) is False
+        assert is_live_gauge(counter) is False
@@ -0,0 +1,291 @@
+"""
+Test Suite for the metrics write-behind queue and database layer
+Lab 3: Testing AI Systems
+
+This module contains tests for:
+- Batching and flushing in the write-behind queue
+- Queue depth, flush latency and drop metrics
+- Multi-row inserts and streamed reads against a SQLite stand-in database
+- Spooling to disk while the database is down, and replaying afterwards
+"""
+
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+from prometheus_client import CollectorRegistry
+
+from database import Database, is_data_error
+from metrics_writer import MetricsWriteBehindQueue
+from spool import SegmentSpool
+
+
+@pytest.fixture
+def registry():
+    """Isolated Prometheus registry so tests don't share metric state"""
+    return CollectorRegistry()
+
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    """SQLite database with an ai_metrics table"""
+    db = Database(f"sqlite:///{tmp_path / 'metrics.db'}")
+    db.create_metrics_table()
+    yield db
+    db.close()
+
+
+def make_event(i=0, business_id='writer-business'):
+    return {
+        'business_id': business_id,
+        'session_id': f'session-{i}',
+        'response_time_ms': 1000 + i,
+        'tokens_used': 100,
+        'api_cost_usd': 0.001
+    }
+
+
+class TestWriteBehindQueue:
+    """Test cases for MetricsWriteBehindQueue"""
+
+    def test_put_does_not_wait_for_sink(self, registry):
+        """Test that put() returns while the sink is still blocked"""
+        release = threading.Event()
+        written = []
+
+        def slow_sink(batch):
+            release.wait(5)
+            written.extend(batch)
+
+        writer = MetricsWriteBehindQueue(slow_sink, flush_interval=0.01, registry=registry)
+        start = time.perf_counter()
+        for i in range(10):
+            assert writer.put(make_event(i))
+        assert time.perf_counter() - start < 0.5
+
+        release.set()
+        writer.stop()
+        assert len(written) == 10
+
+    def test_flushes_on_batch_size(self, registry):
+        """Test that a full batch is written in one sink call"""
+        batches = []
+        writer = MetricsWriteBehindQueue(batches.append, batch_size=5,
+                                         flush_interval=10.0, registry=registry)
+        writer.put_many([make_event(i) for i in range(5)])
+
+        deadline = time.monotonic() + 2
+        while not batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+        writer.stop()
+
+        assert [len(batch) for batch in batches] == [5]
+
+    def test_flushes_on_interval(self, registry):
+        """Test that a partial batch is written after flush_interval"""
+        batches = []
+        writer = MetricsWriteBehindQueue(batches.append, batch_size=100,
+                                         flush_interval=0.05, registry=registry)
+        writer.put(make_event())
+
+        deadline = time.monotonic() + 2
+        while not batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+        writer.stop()
+
+        assert [len(batch) for batch in batches] == [1]
+        assert registry.get_sample_value('metrics_write_flush_seconds_count') >= 1
+
+    def test_queue_full_drops_event(self, registry):
+        """Test that a full queue refuses events and counts the drop"""
+        release = threading.Event()
+        writer = MetricsWriteBehindQueue(lambda batch: release.wait(5), max_queue_size=2,
+                                         batch_size=1, flush_interval=0.01, registry=registry)
+        # Let the flusher take the first event and block on the sink
+        writer.put(make_event(0))
+        time.sleep(0.1)
+        assert writer.put(make_event(1))
+        assert writer.put(make_event(2))
+        assert not writer.put(make_event(3))
+
+        assert registry.get_sample_value('metrics_write_queue_depth') == 2
+        assert registry.get_sample_value('metrics_write_dropped_total', {'reason': 'queue_full'}) == 1
+        release.set()
+        writer.stop()
+
+    def test_put_many_is_all_or_nothing(self, registry):
+        """Test that a batch that doesn't fit is refused whole, so a retry can't store part twice"""
+        release = threading.Event()
+        batches = []
+
+        def sink(batch):
+            release.wait(5)
+            batches.append(len(batch))
+
+        writer = MetricsWriteBehindQueue(sink, max_queue_size=2, batch_size=10, flush_interval=0.01,
+                                         registry=registry)
+        writer.put(make_event(0))
+        time.sleep(0.1)
+
+        assert not writer.put_many([make_event(i) for i in range(1, 4)])
+        assert writer.depth() == 0
+        assert registry.get_sample_value('metrics_write_dropped_total', {'reason': 'queue_full'}) == 3
+        assert writer.put_many([make_event(i) for i in range(1, 3)])
+
+        release.set()
+        writer.stop()
+        assert sum(batches) == 3
+
+    def test_sink_error_is_counted(self, registry):
+        """Test that a failing sink doesn't kill the flusher"""
+        def failing_sink(batch):
+            raise RuntimeError('database unavailable')
+
+        writer = MetricsWriteBehindQueue(failing_sink, registry=registry)
+        writer.put_many([make_event(i) for i in range(3)])
+        writer.stop()
+
+        assert registry.get_sample_value('metrics_write_dropped_total', {'reason': 'sink_error'}) == 3
+
+
+class TestSpooling:
+    """Test cases for the write-behind queue with a disk spool"""
+
+    def test_outage_is_spooled_and_replayed_in_order(self, registry, sqlite_db, tmp_path):
+        """Events written during an outage reach the database once it recovers"""
+        database_up = threading.Event()
+
+        def sink(batch):
+            if not database_up.is_set():
+                raise ConnectionError('database unavailable')
+            sqlite_db.insert_metrics(batch)
+
+        spool = SegmentSpool(str(tmp_path / 'spool'), registry=registry)
+        writer = MetricsWriteBehindQueue(sink, batch_size=5, spool=spool,
+                                         retry_interval=0.01, registry=registry)
+        writer.put_many([make_event(i) for i in range(10)])
+        writer.flush()
+
+        assert spool.pending()
+        assert registry.get_sample_value('metrics_write_dropped_total', {'reason': 'sink_error'}) is None
+
+        database_up.set()
+        time.sleep(0.02)
+        writer.replay_spool()
+        assert not spool.pending()
+        writer.put_many([make_event(i) for i in range(10, 15)])
+        # Joins the flusher, which may be holding the new batch
+        writer.stop()
+
+        rows = sqlite_db.execute("SELECT session_id, created_at FROM ai_metrics ORDER BY id")
+        assert [row[0] for row in rows] == [f'session-{i}' for i in range(15)]
+        assert all(row[1] for row in rows)
+
+    def test_rejected_row_does_not_block_the_spool(self, registry, sqlite_db, tmp_path):
+        """A row the database rejects is quarantined and the rows around it are replayed"""
+        spool = SegmentSpool(str(tmp_path / 'spool'), registry=registry)
+        writer = MetricsWriteBehindQueue(sqlite_db.insert_metrics, batch_size=5, spool=spool,
+                                         is_data_error=is_data_error, registry=registry)
+        events = [make_event(i) for i in range(5)]
+        events[2]['business_id'] = None
+        spool.append(events)
+
+        assert writer.replay_spool() == 4
+
+        rows = sqlite_db.execute("SELECT session_id FROM ai_metrics ORDER BY id")
+        assert [row[0] for row in rows] == ['session-0', 'session-1', 'session-3', 'session-4']
+        assert not spool.pending()
+        assert registry.get_sample_value('metrics_spool_quarantined_total') == 1
+
+    def test_queue_full_spills_to_spool(self, registry, tmp_path):
+        """A full queue hands overflow to the flusher, which spills it behind older events"""
+        release = threading.Event()
+        batches = []
+
+        def sink(batch):
+            release.wait(5)
+            batches.append([event['session_id'] for event in batch])
+
+        spool = SegmentSpool(str(tmp_path / 'spool'), registry=registry)
+        writer = MetricsWriteBehindQueue(sink, max_queue_size=1, batch_size=1, flush_interval=0.01,
+                                         spool=spool, max_overflow=10, registry=registry)
+        writer.put(make_event(0))
+        time.sleep(0.1)
+        assert writer.put(make_event(1))
+        assert writer.put_many([make_event(2), make_event(3)])
+
+        # Nothing is written to disk on the request thread
+        assert registry.get_sample_value('metrics_spool_appended_total') == 0
+        assert registry.get_sample_value('metrics_write_queue_depth') == 3
+        release.set()
+        # The flusher spills the backlog, then replays the spool
+        for _ in range(200):
+            if len(batches) == 4:
+                break
+            time.sleep(0.01)
+        writer.stop()
+
+        assert registry.get_sample_value('metrics_spool_appended_total') == 3
+        assert registry.get_sample_value('metrics_write_dropped_total', {'reason': 'queue_full'}) is None
+        assert [session for batch in batches for session in batch] == [f'session-{i}' for i in range(4)]
+
+    def test_overflow_is_bounded(self, registry, tmp_path):
+        """Once the overflow is full, events are refused rather than held in memory"""
+        release = threading.Event()
+        spool = SegmentSpool(str(tmp_path / 'spool'), registry=registry)
+        writer = MetricsWriteBehindQueue(lambda batch: release.wait(5), max_queue_size=1, batch_size=1,
+                                         flush_interval=0.01, spool=spool, max_overflow=2, registry=registry)
+        writer.put(make_event(0))
+        time.sleep(0.1)
+        assert writer.put(make_event(1))
+        assert writer.put_many([make_event(2), make_event(3)])
+        assert not writer.put(make_event(4))
+
+        assert registry.get_sample_value('metrics_write_dropped_total', {'reason': 'queue_full'}) == 1
+        release.set()
+        writer.stop()
+
+
+class TestDatabaseInsert:
+    """Test cases for multi-row inserts"""
+
+    def test_insert_metrics_multi_row(self, sqlite_db):
+        """Test that a batch is inserted with defaults applied"""
+        written = sqlite_db.insert_metrics([make_event(i) for i in range(120)])
+
+        assert written == 120
+        rows = sqlite_db.execute("SELECT COUNT(*), MIN(model_name), SUM(tokens_used) FROM ai_metrics")
+        assert rows[0] == (120, 'gemini-1.5-flash', 12000)
+
+    def test_writer_with_database_sink(self, registry, sqlite_db):
+        """Test the queue writing through to SQLite"""
+        writer = MetricsWriteBehindQueue(sqlite_db.insert_metrics, registry=registry)
+        writer.put_many([make_event(i, business_id='sqlite-business') for i in range(25)])
+        writer.stop()
+
+        rows = sqlite_db.execute("SELECT COUNT(*) FROM ai_metrics WHERE business_id = %s",
+                                 ('sqlite-business',))
+        assert rows[0][0] == 25
+
+    def test_insert_keeps_spooled_created_at(self, sqlite_db):
+        """Test that replayed events keep their original timestamp"""
+        stamped = dict(make_event(0), created_at='2024-01-02 03:04:05')
+        sqlite_db.insert_metrics([stamped, make_event(1)])
+
+        rows = sqlite_db.execute("SELECT session_id, created_at FROM ai_metrics ORDER BY session_id")
+        assert rows[0] == ('session-0', '2024-01-02 03:04:05')
+        assert rows[1][1] != '2024-01-02 03:04:05'
+
+    def test_abandoned_stream_rolls_back(self, sqlite_db):
+        """Test that closing a stream part-way ends its transaction instead of committing it"""
+        sqlite_db.insert_metrics([make_event(i) for i in range(3)])
+        conn = MagicMock(wraps=sqlite_db.pool.acquire())
+
+        with patch.object(sqlite_db.pool, 'acquire', return_value=conn):
+            chunks = sqlite_db.stream("SELECT session_id FROM ai_metrics", chunk_size=1)
+            assert next(chunks) == [{'session_id': 'session-0'}]
+            chunks.close()
+
+        conn.rollback.assert_called_once_with()
+        conn.commit.assert_not_called()
@@ -0,0 +1,44 @@
+"""
+Tests for the Prometheus microbenchmarks
+Lab 3: Testing AI Systems
+"""
+
+from microbenchmarks import compare, run_level_isolated
+
+
+def level(businesses=10, **overrides):
+    values = {'businesses': businesses, 'update_p50_us': 10.0, 'update_p99_us': 20.0,
+              'render_ms': 5.0, 'bytes_per_child': 500.0}
+    values.update(overrides)
+    return values
+
+
+class TestCompare:
+    """Test cases for baseline comparison"""
+
+    def test_within_tolerance(self):
+        assert compare([level(render_ms=6.0)], {'results': [level()]}, tolerance=0.25) == []
+
+    def test_reports_regressions(self):
+        regressions = compare([level(render_ms=10.0, update_p99_us=50.0)],
+                              {'results': [level()]}, tolerance=0.25)
+
+        assert len(regressions) == 2
+        assert any('render_ms' in regression for regression in regressions)
+
+    def test_ignores_levels_missing_from_baseline(self):
+        assert compare([level(businesses=50000, render_ms=999)], {'results': [level()]}, 0.25) == []
+
+
+class TestRunLevel:
+    """Smoke test of one isolated level"""
+
+    def test_measures_label_children(self):
+        result = run_level_isolated(3, updates=50, renders=1)
+
+        # 3 businesses x 4 intents x 2 models across the labelled collectors
+        assert result['businesses'] == 3
+        assert result['label_children'] > 3 * 4
+        assert result['update_p50_us'] > 0
+        assert result['render_bytes'] > 0
+        assert result['bytes_per_child'] > 0
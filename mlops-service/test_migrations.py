@@ -0,0 +1,155 @@
+"""
+Unit tests for schema migrations and retention compaction
+Lab 3: Testing AI Systems
+
+This module contains tests for:
+- Applying migrations once and recording them in schema_migrations
+- Indexes used by per-business time-range queries
+- Compacting old raw rows into hourly aggregates without losing totals
+- Monthly partition ranges (the partitioning itself needs PostgreSQL)
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import Database
+from migrations import MIGRATIONS, applied_versions, compact_metrics, migrate, month_ranges, partition_name
+
+NOW = datetime(2024, 6, 1, 12, 30)
+
+
+@pytest.fixture
+def db(tmp_path):
+    """SQLite database with every migration applied"""
+    db = Database(f"sqlite:///{tmp_path / 'metrics.db'}")
+    migrate(db)
+    yield db
+    db.close()
+
+
+def insert(db, created_at, business_id='biz-1', cost=0.0015, booked=False, response_time_ms=1000):
+    db.insert_metrics([{
+        'business_id': business_id,
+        'session_id': 'session',
+        'response_time_ms': response_time_ms,
+        'tokens_used': 100,
+        'api_cost_usd': cost,
+        'success_rate': 0.5,
+        'appointment_requested': booked,
+        'appointment_booked': booked,
+        'created_at': created_at.strftime('%Y-%m-%d %H:%M:%S')
+    }])
+
+
+class TestMigrate:
+    """Test cases for the migration runner"""
+
+    def test_applies_every_migration_once(self, db):
+        assert applied_versions(db) == [version for version, _, _ in MIGRATIONS]
+        assert migrate(db) == []
+
+    def test_target_version(self, tmp_path):
+        db = Database(f"sqlite:///{tmp_path / 'partial.db'}")
+        try:
+            assert migrate(db, target=2) == [1, 2]
+            assert migrate(db) == [3, 4, 5, 6]
+        finally:
+            db.close()
+
+    def test_existing_table_is_kept(self, tmp_path):
+        db = Database(f"sqlite:///{tmp_path / 'existing.db'}")
+        try:
+            db.create_metrics_table()
+            insert(db, NOW)
+            migrate(db)
+            assert db.execute("SELECT COUNT(*) FROM ai_metrics") == [(1,)]
+        finally:
+            db.close()
+
+    def test_business_time_index(self, db):
+        plan = db.execute("EXPLAIN QUERY PLAN SELECT COUNT(*) FROM ai_metrics "
+                          "WHERE business_id = 'biz-1' AND created_at >= '2024-01-01'")
+
+        assert any('idx_ai_metrics_business_created' in str(row) for row in plan)
+
+    def test_conversations_index(self, db):
+        plan = db.execute("EXPLAIN QUERY PLAN SELECT SUM(turns) FROM ai_conversations "
+                          "WHERE business_id = 'biz-1' AND ended_at >= '2024-01-01'")
+
+        assert any('idx_ai_conversations_business_ended' in str(row) for row in plan)
+
+    def test_fractional_cost_is_kept(self, db):
+        insert(db, NOW, cost=0.000125)
+
+        assert db.execute("SELECT api_cost_usd FROM ai_metrics") == [(0.000125,)]
+
+
+class TestCompaction:
+    """Test cases for compacting raw rows into ai_metrics_hourly"""
+
+    def test_old_rows_become_hourly_aggregates(self, db):
+        old_hour = NOW - timedelta(days=100)
+        for minute in (1, 20, 59):
+            insert(db, old_hour.replace(minute=minute), booked=minute == 20)
+        insert(db, old_hour.replace(minute=5), business_id='biz-2')
+        insert(db, NOW - timedelta(days=1))
+
+        assert compact_metrics(db, older_than_days=90, now=NOW) == 4
+
+        assert db.execute("SELECT COUNT(*) FROM ai_metrics") == [(1,)]
+        rows = db.execute("SELECT business_id, hour_start, requests, tokens_used, response_time_ms_sum, "
+                          "appointments_booked FROM ai_metrics_hourly ORDER BY business_id")
+        hour = old_hour.strftime('%Y-%m-%d %H:00:00')
+        assert rows == [('biz-1', hour, 3, 300, 3000, 1), ('biz-2', hour, 1, 100, 1000, 0)]
+
+    def test_totals_are_preserved(self, db):
+        start = NOW - timedelta(days=95)
+        for i in range(200):
+            insert(db, start + timedelta(minutes=37 * i), cost=0.001 * (i % 7), response_time_ms=i)
+
+        compact_metrics(db, older_than_days=90, now=NOW, slice_hours=6)
+
+        # Hourly aggregates plus whatever stayed raw add up to the original rows
+        [(requests, cost, response_time)] = db.execute(
+            "SELECT SUM(requests), SUM(api_cost_usd), SUM(response_time_ms_sum) FROM ai_metrics_hourly")
+        [(raw_requests, raw_cost, raw_response_time)] = db.execute(
+            "SELECT COUNT(*), SUM(api_cost_usd), SUM(response_time_ms) FROM ai_metrics")
+        assert 0 < raw_requests < requests
+        assert requests + raw_requests == 200
+        assert cost + raw_cost == pytest.approx(sum(0.001 * (i % 7) for i in range(200)))
+        assert response_time + raw_response_time == sum(range(200))
+
+    def test_recompacting_an_hour_merges_totals(self, db):
+        """Rows arriving late for an already compacted hour are added to it"""
+        hour = (NOW - timedelta(days=100)).replace(minute=10)
+        insert(db, hour)
+        compact_metrics(db, older_than_days=90, now=NOW)
+        insert(db, hour.replace(minute=40))
+        compact_metrics(db, older_than_days=90, now=NOW)
+
+        assert db.execute("SELECT requests, tokens_used FROM ai_metrics_hourly") == [(2, 200)]
+
+    def test_cutoff_is_rounded_to_the_hour(self, db):
+        """The hour containing the cutoff stays raw, so it isn't split"""
+        insert(db, NOW - timedelta(days=90, minutes=20))
+
+        assert compact_metrics(db, older_than_days=90, now=NOW) == 0
+        assert compact_metrics(db, older_than_days=90, now=NOW + timedelta(hours=1)) == 1
+
+    def test_nothing_to_compact(self, db):
+        assert compact_metrics(db, now=NOW) == 0
+
+
+class TestPartitionRanges:
+    """Test cases for monthly partition bounds"""
+
+    def test_month_ranges_cross_year(self):
+        ranges = month_ranges(datetime(2023, 11, 15), datetime(2024, 1, 3))
+
+        assert ranges == [
+            (datetime(2023, 11, 1), datetime(2023, 12, 1)),
+            (datetime(2023, 12, 1), datetime(2024, 1, 1)),
+            (datetime(2024, 1, 1), datetime(2024, 2, 1)),
+        ]
+        assert partition_name(ranges[-1][0]) == 'ai_metrics_y2024m01'
@@ -0,0 +1,213 @@
+"""
+Tests for multi-worker (gunicorn) metrics aggregation
+Lab 3: Testing AI Systems
+
+Each "worker" is a separate Python process importing app with
+PROMETHEUS_MULTIPROC_DIR set, as gunicorn.conf.py arranges.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from database import Database
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TRACK_ONE_EVENT = """
+import app
+service = app.get_service()
+service.wait_until_ready()
+event = app.parse_event({
+    'business_id': 'biz-mp',
+    'response_time_ms': 250,
+    'tokens_used': 40,
+    'model_name': 'gemini-1.5-flash',
+    'intent_detected': 'booking',
+    'response_type': 'success',
+    'success_rate': 1.0
+})
+service.update_prometheus_metrics(event)
+service.record_rollups([event])
+"""
+
+SCRAPE = """
+import app
+client = app.app.test_client()
+print(client.get('/metrics').get_data(as_text=True))
+"""
+
+REFRESH = """
+import app
+from database import configure_database
+configure_database('sqlite:///' + {db_path!r})
+client = app.app.test_client()
+print(client.post('/refresh-metrics', json={{}}).get_json()['status'])
+"""
+
+# The gunicorn master's on_exit hook, once the workers have stored their rows
+MASTER_EXIT = """
+import json
+import app
+from database import configure_database
+service = app.get_service()
+service.wait_until_ready()
+configure_database('sqlite:///' + {db_path!r})
+assert service.write_snapshot()
+snapshot = service.snapshotter.load()
+print(json.dumps({{
+    'watermark': snapshot['watermark']['id'],
+    'requests': sum(value for name, labels, value in snapshot['samples'] if name == 'ai_requests_total')
+}}))
+"""
+
+# when_ready's periodic snapshots, with workers forked meanwhile, then a SIGKILL
+MASTER_PERIODIC = """
+import json
+import os
+import time
+import app
+from database import configure_database, get_database
+service = app.get_service()
+service.wait_until_ready()
+database = configure_database('sqlite:///' + {db_path!r})
+service.start_master_snapshots()
+snapshot = None
+deadline = time.time() + 10
+while time.time() < deadline:
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if get_database().execute('SELECT COUNT(*) FROM ai_metrics') else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+    snapshot = service.snapshotter.load()
+    if snapshot and snapshot['watermark']['id'] == 2:
+        break
+    time.sleep(0.02)
+print(json.dumps({{
+    'watermark': snapshot['watermark']['id'],
+    'requests': sum(value for name, labels, value in snapshot['samples'] if name == 'ai_requests_total')
+}}))
+os._exit(0)
+"""
+
+RESTART = """
+import json
+import app
+service = app.get_service()
+service.wait_until_ready()
+print(json.dumps({
+    'watermark': service.watermark()['id'],
+    'requests': sum(sample.value for family in service.ai_requests_total.collect()
+                    for sample in family.samples if sample.name == 'ai_requests_total')
+}))
+"""
+
+
+def run_worker(code: str, multiproc_dir, **settings) -> str:
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(multiproc_dir), **settings)
+    if 'DATABASE_URL' not in settings:
+        env.pop('DATABASE_URL', None)
+    if 'WEB_CONCURRENCY' not in settings:
+        env.pop('WEB_CONCURRENCY', None)
+    result = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=SERVICE_DIR, env=env, capture_output=True, text=True, timeout=60
+    )
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+@pytest.fixture
+def multiproc_dir(tmp_path):
+    path = tmp_path / 'prometheus'
+    path.mkdir()
+    return path
+
+
+class TestMultiprocessMetrics:
+    """Metrics recorded by separate worker processes"""
+
+    def test_counters_are_summed_across_workers(self, multiproc_dir):
+        """Any worker's /metrics reports the totals of every worker"""
+        run_worker(TRACK_ONE_EVENT, multiproc_dir)
+        run_worker(TRACK_ONE_EVENT, multiproc_dir)
+
+        output = run_worker(SCRAPE, multiproc_dir)
+
+        assert ('ai_requests_total{business_id="biz-mp",intent="booking",response_type="success"} 2.0'
+                in output)
+        assert 'ai_tokens_used_total{business_id="biz-mp",model_name="gemini-1.5-flash"} 80.0' in output
+        assert 'ai_response_time_seconds_count 2.0' in output
+
+    def test_single_worker_exports_process_collectors(self, multiproc_dir):
+        """With one worker, sketch quantiles and rate windows are on /metrics"""
+        output = run_worker(TRACK_ONE_EVENT + SCRAPE.replace('import app\n', '', 1), multiproc_dir)
+
+        assert 'ai_response_time_quantile_seconds{business_id="biz-mp"' in output
+        assert 'ai_success_rate_window{business_id="biz-mp"' in output
+
+    def test_several_workers_leave_out_process_collectors(self, multiproc_dir):
+        """Per-worker sketches would only describe the worker that was scraped"""
+        output = run_worker(TRACK_ONE_EVENT + SCRAPE.replace('import app\n', '', 1), multiproc_dir,
+                            WEB_CONCURRENCY='2')
+
+        assert 'ai_response_time_quantile_seconds' not in output
+
+    def test_success_rate_reports_most_recent_value(self, multiproc_dir):
+        """Gauges are not summed across workers"""
+        run_worker(TRACK_ONE_EVENT, multiproc_dir)
+        run_worker(TRACK_ONE_EVENT, multiproc_dir)
+
+        output = run_worker(SCRAPE, multiproc_dir)
+
+        assert 'ai_success_rate{business_id="biz-mp"} 1.0' in output
+
+    def test_refresh_is_skipped(self, multiproc_dir, tmp_path):
+        """Workers can't reconcile their share of the counters with the database"""
+        code = REFRESH.format(db_path=str(tmp_path / 'metrics.db'))
+
+        assert run_worker(code, multiproc_dir).strip().endswith('skipped')
+
+    @staticmethod
+    def track_and_store(multiproc_dir, db_path):
+        database = Database(f'sqlite:///{db_path}')
+        database.create_metrics_table()
+        database.close()
+
+        # Workers are forked after the master's startup rebuild, which found no rows
+        for _ in range(2):
+            run_worker(TRACK_ONE_EVENT, multiproc_dir)
+        database = Database(f'sqlite:///{db_path}')
+        database.insert_metrics([{'business_id': 'biz-mp', 'response_time_ms': 250, 'tokens_used': 40,
+                                  'intent_detected': 'booking', 'response_type': 'success'}] * 2)
+        database.close()
+
+    def test_master_snapshot_advances_watermark(self, multiproc_dir, tmp_path):
+        """The snapshot's watermark covers the rows the workers stored, not just the startup rebuild"""
+        db_path = tmp_path / 'metrics.db'
+        snapshot_path = str(tmp_path / 'snapshot.json.gz')
+        self.track_and_store(multiproc_dir, db_path)
+
+        master = json.loads(run_worker(MASTER_EXIT.format(db_path=str(db_path)), multiproc_dir,
+                                       SNAPSHOT_PATH=snapshot_path))
+        assert master == {'watermark': 2, 'requests': 2.0}
+
+        # gunicorn.conf.py starts every run with an empty multiprocess directory
+        restarted_dir = tmp_path / 'restarted'
+        restarted_dir.mkdir()
+        restarted = json.loads(run_worker(RESTART, restarted_dir, SNAPSHOT_PATH=snapshot_path,
+                                          DATABASE_URL=f'sqlite:///{db_path}'))
+        assert restarted == {'watermark': 2, 'requests': 2.0}
+
+    def test_master_writes_snapshots_periodically(self, multiproc_dir, tmp_path):
+        """A master killed before on_exit still leaves a recent snapshot, and forks keep working"""
+        db_path = tmp_path / 'metrics.db'
+        self.track_and_store(multiproc_dir, db_path)
+
+        master = json.loads(run_worker(MASTER_PERIODIC.format(db_path=str(db_path)), multiproc_dir,
+                                       SNAPSHOT_PATH=str(tmp_path / 'snapshot.json.gz'),
+                                       SNAPSHOT_INTERVAL_SECONDS='0.05'))
+        assert master == {'watermark': 2, 'requests': 2.0}
@@ -0,0 +1,86 @@
+"""
+Unit tests for sliding-window success and conversion rates
+Lab 3: Testing AI Systems
+"""
+
+import pytest
+from prometheus_client import CollectorRegistry
+
+from rate_windows import RateWindowCollector, RateWindows
+from schema import MetricEvent
+
+
+def event(success_rate=1.0, requested=False, booked=False, business_id='biz-1'):
+    return MetricEvent(business_id=business_id, success_rate=success_rate,
+                       appointment_requested=requested, appointment_booked=booked)
+
+
+@pytest.fixture
+def windows():
+    return RateWindows(slots=10)
+
+
+class TestRateWindows:
+    """Test cases for ring-buffered windows"""
+
+    def test_rates_over_each_window(self, windows):
+        windows.record(event(1.0, requested=True, booked=True), now=1000)
+        windows.record(event(0.0, requested=True), now=1000)
+        windows.record(event(None), now=1000)
+
+        rates = windows.rates('biz-1', now=1001)
+
+        assert rates['1m'] == {'requests': 3, 'success_rate': 0.5, 'appointment_conversion_rate': 0.5}
+        assert rates['1h'] == rates['1m']
+
+    def test_old_events_slide_out(self, windows):
+        """Events leave the 1m window after a minute but stay in the 15m one"""
+        windows.record(event(0.0), now=1000)
+        windows.record(event(1.0), now=1090)
+
+        rates = windows.rates('biz-1', now=1095)
+
+        assert rates['1m']['success_rate'] == 1.0
+        assert rates['15m']['success_rate'] == 0.5
+        assert rates['15m']['requests'] == 2
+
+    def test_idle_business_decays_to_no_data(self, windows):
+        windows.record(event(1.0, requested=True), now=1000)
+
+        rates = windows.rates('biz-1', now=1000 + 7200)
+
+        assert rates['1h'] == {'requests': 0, 'success_rate': None, 'appointment_conversion_rate': None}
+
+    def test_unknown_business(self, windows):
+        assert windows.rates('nobody')['15m']['requests'] == 0
+
+    def test_running_totals_match_recount(self, windows):
+        """Totals stay exact while buckets keep rotating"""
+        for second in range(0, 600, 7):
+            windows.record(event(1.0 if second % 2 else 0.0), now=10000 + second)
+
+        # 10 slots of 6 s: the 1m window starts at the oldest live slot
+        window_start = (10599 // 6 - 9) * 6
+        recent = [s for s in range(0, 600, 7) if 10000 + s >= window_start]
+        assert windows.rates('biz-1', now=10599)['1m']['requests'] == len(recent)
+
+    def test_business_cap(self):
+        windows = RateWindows(max_businesses=2)
+        for business_id in ('a', 'b', 'c'):
+            windows.record(event(business_id=business_id), now=1000)
+
+        assert set(windows.snapshot(now=1000)) == {'b', 'c'}
+
+
+class TestRateWindowCollector:
+    """Test cases for the scrape-time collector"""
+
+    def test_exports_rates_per_window(self, windows):
+        registry = CollectorRegistry()
+        registry.register(RateWindowCollector(windows))
+        windows.record(event(1.0, requested=True, booked=True))
+
+        assert registry.get_sample_value('ai_success_rate_window',
+                                         {'business_id': 'biz-1', 'window': '15m'}) == 1.0
+        assert registry.get_sample_value('ai_appointment_conversion_rate',
+                                         {'business_id': 'biz-1', 'window': '1m'}) == 1.0
@@ -0,0 +1,157 @@
+"""
+Test Suite for analytics rollups and the response cache
+Lab 3: Testing AI Systems
+
+This module contains tests for:
+- Minute and hour rollups per business
+- Bounded bucket retention and business count
+- TTL cache expiry and per-business invalidation
+"""
+
+import time
+
+from cache import TTLCache
+from rollups import RollupBucket, RollupStore
+
+# A fixed, hour-aligned reference time keeps bucket arithmetic predictable
+NOW = 1_700_000_000 - (1_700_000_000 % 3600)
+
+
+def make_event(business_id='rollup-business', **overrides):
+    event = {
+        'business_id': business_id,
+        'response_time_ms': 1000,
+        'tokens_used': 100,
+        'api_cost_usd': 0.001,
+        'appointment_requested': True,
+        'appointment_booked': False
+    }
+    event.update(overrides)
+    return event
+
+
+class TestRollupStore:
+    """Test cases for RollupStore"""
+
+    def test_summary_sums_recent_minutes(self):
+        """Test that short windows are answered from minute buckets"""
+        store = RollupStore()
+        store.record(make_event(response_time_ms=500), NOW - 30)
+        store.record(make_event(response_time_ms=1500, appointment_booked=True), NOW - 90)
+        store.record(make_event(), NOW - 3 * 3600)
+
+        totals = store.summary('rollup-business', 3600, now=NOW)
+
+        assert totals.count == 2
+        assert totals.response_time_ms_sum == 2000
+        assert totals.appointment_requests == 2
+        assert totals.appointments_booked == 1
+
+    def test_summary_uses_hours_for_long_windows(self):
+        """Test that long windows include older hour buckets"""
+        store = RollupStore()
+        store.record(make_event(), NOW - 30)
+        store.record(make_event(), NOW - 3 * 3600)
+        store.record(make_event(), NOW - 10 * 24 * 3600)
+
+        assert store.summary('rollup-business', 24 * 3600, now=NOW).count == 2
+        assert store.summary('rollup-business', 30 * 24 * 3600, now=NOW).count == 3
+
+    def test_businesses_are_isolated(self):
+        """Test that rollups are kept per business"""
+        store = RollupStore()
+        store.record(make_event('business-a'), NOW)
+        store.record(make_event('business-b'), NOW)
+        store.record(make_event('business-b'), NOW)
+
+        assert store.summary('business-a', 3600, now=NOW).count == 1
+        assert store.summary('business-b', 3600, now=NOW).count == 2
+        assert store.summary('business-c', 3600, now=NOW).count == 0
+
+    def test_retention_bounds_bucket_count(self):
+        """Test that old buckets are pruned as new ones arrive"""
+        store = RollupStore(minute_retention=5, hour_retention=3)
+        for minute in range(20):
+            store.record(make_event(), NOW + minute * 60)
+        for hour in range(10):
+            store.record(make_event(), NOW + hour * 3600)
+
+        rollups = store._businesses['rollup-business']
+        assert len(rollups.minutes) <= 5
+        assert len(rollups.hours) <= 3
+
+    def test_late_event_keeps_buckets_ordered(self):
+        """Test that an out-of-order event lands in the right bucket"""
+        store = RollupStore()
+        store.record(make_event(), NOW)
+        store.record(make_event(), NOW - 120)
+
+        assert list(store._businesses['rollup-business'].minutes) == [NOW - 120, NOW]
+
+    def test_max_businesses_evicts_least_recently_active(self):
+        """Test that a new business displaces the one idle the longest"""
+        store = RollupStore(max_businesses=2)
+        store.record(make_event('business-a'), NOW)
+        store.record(make_event('business-b'), NOW)
+        store.record(make_event('business-a'), NOW)
+        store.record(make_event('business-c'), NOW)
+
+        assert sorted(store.businesses()) == ['business-a', 'business-c']
+        assert store.summary('business-a', 3600, now=NOW).count == 2
+
+    def test_seeded_minutes_answer_short_windows(self):
+        """Test that minute buckets merged at startup serve short windows"""
+        store = RollupStore()
+        bucket = RollupBucket()
+        bucket.count = 3
+        store.add_minute('rollup-business', NOW - 90, bucket)
+        store.add_hour('rollup-business', NOW - 3600, bucket)
+
+        assert store.summary('rollup-business', 3600, now=NOW).count == 3
+
+
+class TestTTLCache:
+    """Test cases for TTLCache"""
+
+    def test_get_or_set_caches_value(self):
+        """Test that the value is computed once within the TTL"""
+        cache = TTLCache(ttl=60)
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return {'value': len(calls)}
+
+        assert cache.get_or_set('business', '30_days', compute) == {'value': 1}
+        assert cache.get_or_set('business', '30_days', compute) == {'value': 1}
+        assert len(calls) == 1
+
+    def test_entries_expire(self):
+        """Test that entries are recomputed after the TTL"""
+        cache = TTLCache(ttl=0.01)
+        cache.set('business', 'key', 'old')
+        time.sleep(0.02)
+        assert cache.get('business', 'key') is None
+
+    def test_invalidate_drops_group_only(self):
+        """Test per-business invalidation"""
+        cache = TTLCache(ttl=60)
+        cache.set('business-a', '1_hour', 1)
+        cache.set('business-a', '30_days', 2)
+        cache.set('business-b', '30_days', 3)
+
+        cache.invalidate('business-a')
+
+        assert cache.get('business-a', '1_hour') is None
+        assert cache.get('business-a', '30_days') is None
+        assert cache.get('business-b', '30_days') == 3
+
+    def test_max_groups_evicts_oldest(self):
+        """Test that the number of cached groups is bounded"""
+        cache = TTLCache(ttl=60, max_groups=2)
+        cache.set('a', 'k', 1)
+        cache.set('b', 'k', 2)
+        cache.set('c', 'k', 3)
+
+        assert cache.get('a', 'k') is None
+        assert cache.get('c', 'k') == 3
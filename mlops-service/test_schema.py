@@ -0,0 +1,155 @@
+"""
+Unit tests for the typed metrics event schema
+Lab 3: Testing AI Systems
+"""
+
+from decimal import Decimal
+
+import pytest
+
+from schema import EventValidationError, MetricEvent, loads, parse_event
+
+
+@pytest.fixture
+def payload():
+    return {
+        'business_id': 'biz-1',
+        'session_id': 'session-1',
+        'response_time_ms': 1250,
+        'success_rate': 1.0,
+        'tokens_used': 150,
+        'api_cost_usd': 0.002,
+        'model_name': 'gemini-1.5-flash',
+        'intent_detected': 'appointment',
+        'appointment_requested': True,
+        'human_handoff_requested': False,
+        'user_message_length': 45,
+        'ai_response_length': 120,
+        'response_type': 'appointment_booking'
+    }
+
+
+class TestParseEvent:
+    """Test cases for validation and coercion"""
+
+    def test_parses_every_field(self, payload):
+        """Declared fields become attributes, absent ones get defaults"""
+        event = parse_event(payload)
+
+        assert event.business_id == 'biz-1'
+        assert event.response_time_ms == 1250
+        assert event.appointment_requested is True
+        assert event.appointment_booked is False
+        assert event.conversation_id is None
+        assert event.prompt_tokens is None
+
+    def test_applies_label_defaults(self):
+        """Label fields fall back to the values Prometheus used before"""
+        event = parse_event({'business_id': 'biz-1', 'response_time_ms': 10, 'tokens_used': 1})
+
+        assert event.model_name == 'gemini-1.5-flash'
+        assert event.intent_detected == 'unknown'
+        assert event.response_type == 'unknown'
+        assert event.success_rate is None
+
+    def test_coerces_compatible_types(self, payload):
+        """Numeric strings, floats and 0/1 flags are coerced"""
+        payload.update(response_time_ms='1250.4', tokens_used=150.0, api_cost_usd='0.5',
+                       appointment_booked=1, human_handoff_requested='false')
+
+        event = parse_event(payload)
+
+        assert event.response_time_ms == 1250
+        assert isinstance(event.tokens_used, int)
+        assert event.api_cost_usd == 0.5
+        assert event.appointment_booked is True
+        assert event.human_handoff_requested is False
+
+    @pytest.mark.parametrize('data, message', [
+        (None, 'No metrics data provided'),
+        ([], 'No metrics data provided'),
+        ({'business_id': 'biz-1', 'tokens_used': 1}, 'Missing required field: response_time_ms'),
+        ({'business_id': None, 'response_time_ms': 1, 'tokens_used': 1}, 'Missing required field: business_id'),
+        ({'business_id': '', 'response_time_ms': 1, 'tokens_used': 1}, 'Missing required field: business_id'),
+        ({'business_id': '  ', 'response_time_ms': 1, 'tokens_used': 1}, 'Missing required field: business_id'),
+        ({'business_id': 'biz-1', 'response_time_ms': '', 'tokens_used': 1}, 'Missing required field: response_time_ms'),
+    ])
+    def test_rejects_missing_data(self, data, message):
+        """Empty payloads and missing required fields are rejected"""
+        with pytest.raises(EventValidationError, match=message):
+            parse_event(data)
+
+    @pytest.mark.parametrize('field, value', [
+        ('response_time_ms', 'fast'),
+        ('response_time_ms', -5),
+        ('tokens_used', True),
+        ('api_cost_usd', float('nan')),
+        ('appointment_requested', 'maybe'),
+        ('business_id', {'id': 1}),
+        ('business_id', 'x' * 256),
+        ('model_name', 'x' * 101),
+        ('intent_detected', 'x' * 51),
+        ('response_type', 'x' * 51),
+        ('tokens_used', 2 ** 31),
+    ])
+    def test_rejects_invalid_values(self, payload, field, value):
+        """Values that can't be coerced name the offending field"""
+        payload[field] = value
+
+        with pytest.raises(EventValidationError, match=f'Invalid field {field}'):
+            parse_event(payload)
+
+    def test_accepts_values_that_fill_their_column(self, payload):
+        """Limits match the ai_metrics column widths, not one global length"""
+        payload.update(model_name='m' * 100, intent_detected='i' * 50, tokens_used=2 ** 31 - 1)
+
+        event = parse_event(payload)
+
+        assert len(event.model_name) == 100
+        assert event.tokens_used == 2 ** 31 - 1
+
+
+class TestMetricEvent:
+    """Test cases for the event type"""
+
+    def test_uses_slots(self, payload):
+        """Events carry no per-instance dict"""
+        event = parse_event(payload)
+
+        assert not hasattr(event, '__dict__')
+        with pytest.raises(AttributeError):
+            event.unknown_field = 1
+
+    def test_dict_style_access(self, payload):
+        """get() and item access work like the old dict events"""
+        event = parse_event(payload)
+
+        assert event['business_id'] == 'biz-1'
+        assert event.get('conversation_id', 'none') == 'none'
+        with pytest.raises(KeyError):
+            event['not_a_field']
+
+    def test_to_dict_omits_unset_fields(self, payload):
+        """Serialisation only includes fields that are set"""
+        data = parse_event(payload).to_dict()
+
+        assert data['tokens_used'] == 150
+        assert 'conversation_id' not in data
+
+    def test_from_database_row(self):
+        """Rows construct events directly, with defaults for NULL columns"""
+        event = MetricEvent(business_id='biz-1', api_cost_usd=Decimal('0.5'), model_name=None)
+
+        assert event.model_name == 'gemini-1.5-flash'
+        assert event.api_cost_usd == Decimal('0.5')
+
+
+class TestLoads:
+    """Test cases for the JSON decoder"""
+
+    def test_decodes_bytes(self):
+        assert loads(b'{"a": [1, 2]}') == {'a': [1, 2]}
+
+    def test_raises_value_error(self):
+        with pytest.raises(ValueError):
+            loads(b'not json')
@@ -0,0 +1,162 @@
+"""
+Unit tests for per-conversation session aggregates
+Lab 3: Testing AI Systems
+
+This module contains tests for:
+- Summing the turns of a conversation and deciding its outcome
+- Finishing idle conversations and evicting at the live-session cap
+- Histograms of finished conversations
+- Handing finished conversations to the sink, and retrying when it fails
+"""
+
+import pytest
+from prometheus_client import CollectorRegistry
+
+from database import Database
+from sessions import SessionAggregator
+
+
+def turn(conversation_id='conv-1', **fields):
+    return dict({
+        'business_id': 'biz-1',
+        'conversation_id': conversation_id,
+        'session_id': 'session-1',
+        'response_time_ms': 1000,
+        'tokens_used': 100,
+        'api_cost_usd': 0.002
+    }, **fields)
+
+
+@pytest.fixture
+def registry():
+    return CollectorRegistry()
+
+
+@pytest.fixture
+def persisted():
+    return []
+
+
+@pytest.fixture
+def aggregator(registry, persisted):
+    aggregator = SessionAggregator(idle_timeout=60, max_sessions=3, sweep_interval=3600,
+                                   sink=persisted.extend, registry=registry)
+    yield aggregator
+    aggregator.stop()
+
+
+class TestSessionAggregator:
+    """Test cases for SessionAggregator"""
+
+    def test_turns_are_summed(self, aggregator):
+        aggregator.record([turn(), turn(response_time_ms=500)], now=100)
+        aggregator.record([turn(human_handoff_requested=True)], now=130)
+
+        session = aggregator.get('conv-1')
+        assert session['turns'] == 3
+        assert session['tokens_used'] == 300
+        assert session['api_cost_usd'] == pytest.approx(0.006)
+        assert session['response_time_ms_sum'] == 2500
+        assert session['outcome'] == 'handoff'
+
+    def test_events_without_conversation_are_skipped(self, aggregator):
+        assert aggregator.record([turn(conversation_id=None), turn()], now=100) == 1
+        assert len(aggregator) == 1
+
+    def test_booking_outranks_handoff(self, aggregator):
+        aggregator.record([turn(human_handoff_requested=True), turn(appointment_booked=True)], now=100)
+
+        assert aggregator.get('conv-1')['outcome'] == 'booked'
+
+    def test_idle_sessions_are_finished(self, aggregator, registry, persisted):
+        aggregator.record([turn('conv-1')], now=100)
+        aggregator.record([turn('conv-2')], now=150)
+        aggregator.record([turn('conv-1')], now=170)
+
+        assert aggregator.sweep(now=215) == 1
+        assert aggregator.get('conv-2') is None
+        assert aggregator.get('conv-1') is not None
+        assert registry.get_sample_value('ai_conversations_finished_total',
+                                         {'outcome': 'none', 'reason': 'idle'}) == 1
+        assert registry.get_sample_value('ai_conversations_active') == 1
+
+        assert aggregator.flush() == 1
+        assert persisted[0]['conversation_id'] == 'conv-2'
+        assert persisted[0]['end_reason'] == 'idle'
+
+    def test_cap_evicts_the_idlest_session(self, aggregator, registry):
+        for index, conversation_id in enumerate(['conv-1', 'conv-2', 'conv-3']):
+            aggregator.record([turn(conversation_id)], now=100 + index)
+        aggregator.record([turn('conv-1')], now=110)
+        aggregator.record([turn('conv-4')], now=111)
+
+        assert len(aggregator) == 3
+        assert aggregator.get('conv-2') is None
+        assert registry.get_sample_value('ai_conversations_finished_total',
+                                         {'outcome': 'none', 'reason': 'evicted'}) == 1
+
+    def test_histograms_of_finished_sessions(self, aggregator, registry):
+        aggregator.record([turn(), turn(appointment_booked=True)], now=100)
+        aggregator.record([turn()], now=190)
+        aggregator.finish_all()
+
+        labels = {'outcome': 'booked'}
+        assert registry.get_sample_value('ai_conversation_turns_sum', labels) == 3
+        assert registry.get_sample_value('ai_conversation_tokens_sum', labels) == 300
+        assert registry.get_sample_value('ai_conversation_cost_usd_sum', labels) == pytest.approx(0.006)
+        assert registry.get_sample_value('ai_conversation_duration_seconds_sum', labels) == 90
+        assert registry.get_sample_value('ai_conversation_duration_seconds_bucket',
+                                         {'outcome': 'booked', 'le': '60.0'}) == 0
+
+    def test_failed_sink_keeps_rows(self, registry):
+        calls = []
+
+        def sink(rows):
+            calls.append(len(rows))
+            if len(calls) == 1:
+                raise RuntimeError('database unavailable')
+
+        aggregator = SessionAggregator(sink=sink, max_pending=2, registry=registry)
+        aggregator.record([turn('conv-1')], now=100)
+        aggregator.finish_all()
+
+        assert aggregator.flush() == 0
+        assert registry.get_sample_value('metrics_session_sink_errors_total') == 1
+        assert aggregator.flush() == 1
+        aggregator.stop()
+
+    def test_pending_rows_are_bounded(self, registry):
+        aggregator = SessionAggregator(sink=lambda rows: None, max_pending=2, registry=registry)
+        aggregator.record([turn(f'conv-{index}') for index in range(5)], now=100)
+        aggregator.finish_all()
+
+        assert aggregator.flush() == 2
+        assert registry.get_sample_value('metrics_session_dropped_total') == 3
+        aggregator.stop()
+
+    def test_background_sweep(self, registry, persisted):
+        aggregator = SessionAggregator(idle_timeout=0, sweep_interval=0.01, sink=persisted.extend,
+                                       registry=registry)
+        aggregator.record([turn()])
+        try:
+            for _ in range(200):
+                if persisted:
+                    break
+                aggregator._stop_event.wait(0.01)
+        finally:
+            aggregator.stop()
+
+        assert [row['conversation_id'] for row in persisted] == ['conv-1']
+
+    def test_rows_fit_ai_conversations(self, tmp_path, registry):
+        db = Database(f"sqlite:///{tmp_path / 'sessions.db'}")
+        try:
+            db.create_conversations_table()
+            aggregator = SessionAggregator(sink=db.insert_conversations, registry=registry)
+            aggregator.record([turn(), turn(appointment_requested=True)], now=1700000000)
+            aggregator.close()
+
+            assert db.execute("SELECT business_id, turns, tokens_used, outcome, started_at "
+                              "FROM ai_conversations") == [('biz-1', 2, 200, 'requested', '2023-11-14 22:13:20')]
+        finally:
+            db.close()
@@ -0,0 +1,149 @@
+"""
+Test Suite for latency quantile sketches
+Lab 3: Testing AI Systems
+
+This module contains tests for:
+- DDSketch quantile accuracy
+- Merging sketches across replicas
+- Bounded memory per sketch
+- The Prometheus quantile collector
+"""
+
+import random
+
+import pytest
+from prometheus_client import CollectorRegistry
+
+from sketches import DDSketch, SketchCollector, SketchStore
+
+
+def exact_quantile(values, q):
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+@pytest.fixture
+def latencies():
+    """Log-normal latencies centred around 1.5 seconds"""
+    rng = random.Random(42)
+    return [rng.lognormvariate(0.4, 0.5) for _ in range(20000)]
+
+
+class TestDDSketch:
+    """Test cases for DDSketch"""
+
+    @pytest.mark.parametrize('q', [0.5, 0.95, 0.99])
+    def test_quantiles_within_relative_accuracy(self, latencies, q):
+        """Test that quantiles are within the configured relative error"""
+        sketch = DDSketch(relative_accuracy=0.01)
+        for value in latencies:
+            sketch.add(value)
+
+        expected = exact_quantile(latencies, q)
+        assert sketch.quantile(q) == pytest.approx(expected, rel=0.011)
+
+    def test_empty_sketch(self):
+        """Test that an empty sketch has no quantiles"""
+        assert DDSketch().quantile(0.5) is None
+
+    def test_merge_matches_single_sketch(self, latencies):
+        """Test that merged sketches equal one sketch over all values"""
+        whole = DDSketch()
+        left = DDSketch()
+        right = DDSketch()
+        for i, value in enumerate(latencies):
+            whole.add(value)
+            (left if i % 2 else right).add(value)
+
+        left.merge(right)
+
+        assert left.count == whole.count
+        assert left.bins == whole.bins
+        for q in (0.5, 0.95, 0.99):
+            assert left.quantile(q) == whole.quantile(q)
+
+    def test_merge_rejects_different_accuracy(self):
+        """Test that sketches with different accuracy can't be merged"""
+        with pytest.raises(ValueError):
+            DDSketch(0.01).merge(DDSketch(0.02))
+
+    def test_bins_are_bounded(self):
+        """Test that memory per sketch is capped"""
+        sketch = DDSketch(max_bins=64)
+        values = [10 ** exponent * (1 + step / 100)
+                  for exponent in range(-6, 6) for step in range(100)]
+        for value in values:
+            sketch.add(value)
+
+        assert len(sketch.bins) <= 64
+        # High quantiles stay accurate; collapsing only affects the low end
+        assert sketch.quantile(0.99) == pytest.approx(exact_quantile(values, 0.99), rel=0.011)
+
+    def test_round_trip_serialisation(self, latencies):
+        """Test to_dict/from_dict preserves the sketch"""
+        sketch = DDSketch()
+        for value in latencies[:1000]:
+            sketch.add(value)
+
+        restored = DDSketch.from_dict(sketch.to_dict())
+
+        assert restored.bins == sketch.bins
+        assert restored.quantile(0.95) == sketch.quantile(0.95)
+
+
+class TestSketchStore:
+    """Test cases for SketchStore and its collector"""
+
+    def test_quantiles_per_business_and_model(self):
+        """Test that sketches are kept per (business_id, model_name)"""
+        store = SketchStore()
+        store.add_many([('business-a', 'model-x', 1.0)] * 10)
+        store.add('business-a', 'model-y', 3.0)
+        store.add('business-b', 'model-x', 5.0)
+
+        quantiles = store.quantiles('business-a')
+
+        assert set(quantiles) == {'model-x', 'model-y'}
+        assert quantiles['model-x'][0.5] == pytest.approx(1.0, rel=0.01)
+        assert quantiles['model-y'][0.99] == pytest.approx(3.0, rel=0.01)
+
+    def test_merge_dict_from_other_replica(self):
+        """Test merging sketches exported by another store"""
+        replica_a = SketchStore()
+        replica_b = SketchStore()
+        replica_a.add('business', 'model', 1.0)
+        replica_b.add('business', 'model', 2.0)
+
+        assert replica_a.merge_dict(replica_b.to_dict()) == 1
+
+        exported = replica_a.to_dict()
+        assert exported[0]['sketch']['count'] == 2
+
+    def test_merged_view_leaves_store_unchanged(self):
+        """Test that merging into a view never double-counts the local store"""
+        local = SketchStore()
+        remote = SketchStore()
+        local.add('business', 'model', 1.0)
+        remote.add('business', 'model', 2.0)
+
+        local.merged_with(remote.to_dict())
+        view = local.merged_with(remote.to_dict())
+
+        assert view.to_dict()[0]['sketch']['count'] == 2
+        assert local.to_dict()[0]['sketch']['count'] == 1
+        assert local.merged_with(remote.to_dict(), include_self=False).to_dict()[0]['sketch']['count'] == 1
+
+    def test_collector_exports_quantiles(self):
+        """Test that the collector exposes quantile gauges"""
+        registry = CollectorRegistry()
+        store = SketchStore()
+        registry.register(SketchCollector(store))
+        store.add('business', 'model', 2.0)
+
+        value = registry.get_sample_value('ai_response_time_quantile_seconds', {
+            'business_id': 'business', 'model_name': 'model', 'quantile': '0.95'
+        })
+        assert value == pytest.approx(2.0, rel=0.01)
+        assert registry.get_sample_value('ai_response_time_sketch_count', {
+            'business_id': 'business', 'model_name': 'model'
+        }) == 1
@@ -0,0 +1,173 @@
+"""
+Unit tests for warm-restart registry snapshots
+Lab 3: Testing AI Systems
+
+This module contains tests for:
+- Round-tripping counters, histograms and gauges through a snapshot file
+- Skipping live gauges and collectors that don't exist on restore
+- Atomic replace and unreadable snapshots
+- Extra state stored alongside the samples
+"""
+
+import gzip
+import os
+
+import pytest
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+
+from snapshot import RegistrySnapshotter
+
+
+def make_metrics(registry):
+    return {
+        'requests': Counter('snap_requests_total', 'Requests', ['business_id'], registry=registry),
+        'errors': Counter('snap_errors_total', 'Errors', registry=registry),
+        'latency': Histogram('snap_latency_seconds', 'Latency', buckets=[0.1, 1.0], registry=registry),
+        'rate': Gauge('snap_rate', 'Rate', ['business_id'], registry=registry, multiprocess_mode='mostrecent'),
+        'in_flight': Gauge('snap_in_flight', 'In flight', registry=registry, multiprocess_mode='livesum'),
+    }
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'snapshots' / 'registry.json.gz')
+
+
+def snapshotter(path, registry, **kwargs):
+    return RegistrySnapshotter(path, source=registry, target=registry, registry=CollectorRegistry(), **kwargs)
+
+
+class TestRegistrySnapshotter:
+    """Test cases for RegistrySnapshotter"""
+
+    def test_round_trip(self, path):
+        before = CollectorRegistry()
+        metrics = make_metrics(before)
+        metrics['requests'].labels('biz-1').inc(3)
+        metrics['requests'].labels('biz-2').inc(5)
+        metrics['errors'].inc(2)
+        for value in (0.05, 0.5, 0.5, 3.0):
+            metrics['latency'].observe(value)
+        metrics['rate'].labels('biz-1').set(0.75)
+        metrics['in_flight'].set(4)
+        assert snapshotter(path, before).write() is True
+
+        after = CollectorRegistry()
+        make_metrics(after)
+        restorer = snapshotter(path, after)
+        assert restorer.restore(restorer.load()) == 5
+
+        assert after.get_sample_value('snap_requests_total', {'business_id': 'biz-1'}) == 3
+        assert after.get_sample_value('snap_requests_total', {'business_id': 'biz-2'}) == 5
+        assert after.get_sample_value('snap_errors_total') == 2
+        assert after.get_sample_value('snap_latency_seconds_bucket', {'le': '0.1'}) == 1
+        assert after.get_sample_value('snap_latency_seconds_bucket', {'le': '1.0'}) == 3
+        assert after.get_sample_value('snap_latency_seconds_count') == 4
+        assert after.get_sample_value('snap_latency_seconds_sum') == pytest.approx(4.05)
+        assert after.get_sample_value('snap_rate', {'business_id': 'biz-1'}) == 0.75
+        # Live gauges describe the process that wrote the snapshot
+        assert after.get_sample_value('snap_in_flight') == 0
+
+    def test_restore_only_raises_counters(self, path):
+        """Events counted before the restore are kept"""
+        before = CollectorRegistry()
+        make_metrics(before)['requests'].labels('biz-1').inc(3)
+        snapshotter(path, before).write()
+
+        after = CollectorRegistry()
+        metrics = make_metrics(after)
+        metrics['requests'].labels('biz-1').inc(5)
+        restorer = snapshotter(path, after)
+        restorer.restore(restorer.load())
+
+        assert after.get_sample_value('snap_requests_total', {'business_id': 'biz-1'}) == 5
+
+    def test_unknown_collectors_are_skipped(self, path):
+        before = CollectorRegistry()
+        make_metrics(before)['errors'].inc()
+        Counter('snap_removed_total', 'Gone after the upgrade', registry=before).inc()
+        snapshotter(path, before).write()
+
+        after = CollectorRegistry()
+        make_metrics(after)
+        restorer = snapshotter(path, after)
+        restorer.restore(restorer.load())
+
+        assert after.get_sample_value('snap_errors_total') == 1
+        assert after.get_sample_value('snap_removed_total') is None
+
+    def test_child_for_hook(self, path):
+        before = CollectorRegistry()
+        make_metrics(before)['requests'].labels('biz-1').inc(2)
+        snapshotter(path, before).write()
+
+        after = CollectorRegistry()
+        make_metrics(after)
+        seen = []
+
+        def child_for(collector, labelvalues):
+            seen.append(labelvalues)
+            return collector.labels(*labelvalues) if labelvalues else collector
+
+        restorer = snapshotter(path, after)
+        restorer.restore(restorer.load(), child_for)
+
+        assert ('biz-1',) in seen
+
+    def test_extra_state(self, path):
+        registry = CollectorRegistry()
+        make_metrics(registry)
+        snapshotter(path, registry, state=lambda: {'watermark': {'id': 42}}).write()
+
+        assert snapshotter(path, registry).load()['watermark'] == {'id': 42}
+
+    def test_atomic_replace(self, path):
+        registry = CollectorRegistry()
+        metrics = make_metrics(registry)
+        writer = snapshotter(path, registry)
+        writer.write()
+        metrics['errors'].inc(7)
+        writer.write()
+
+        assert os.listdir(os.path.dirname(path)) == ['registry.json.gz']
+        assert writer.load()['samples']
+
+    def test_missing_or_corrupt_snapshot(self, path):
+        registry = CollectorRegistry()
+        reader = snapshotter(path, registry)
+        assert reader.load() is None
+
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(b'not gzip')
+        assert reader.load() is None
+
+        with open(path, 'wb') as f:
+            f.write(gzip.compress(b'{"version": 99}'))
+        assert reader.load() is None
+
+    def test_write_failure_is_counted(self, tmp_path):
+        registry = CollectorRegistry()
+        own_metrics = CollectorRegistry()
+        blocker = tmp_path / 'file'
+        blocker.write_text('')
+        writer = RegistrySnapshotter(str(blocker / 'registry.json.gz'), source=registry, target=registry,
+                                     registry=own_metrics)
+
+        assert writer.write() is False
+        assert own_metrics.get_sample_value('metrics_snapshot_writes_total', {'result': 'error'}) == 1
+
+    def test_background_thread_writes(self, path):
+        registry = CollectorRegistry()
+        make_metrics(registry)['errors'].inc()
+        writer = snapshotter(path, registry, interval=0.01)
+        writer.start()
+        try:
+            for _ in range(200):
+                if writer.load() is not None:
+                    break
+                writer._stop_event.wait(0.01)
+        finally:
+            writer.stop()
+
+        assert writer.load() is not None
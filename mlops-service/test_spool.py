@@ -0,0 +1,168 @@
+"""
+Unit tests for the durable metrics spool
+Lab 3: Testing AI Systems
+"""
+
+import json
+import os
+
+import pytest
+from prometheus_client import CollectorRegistry
+
+from spool import QUARANTINE_FILE, SEGMENT_SUFFIX, SegmentSpool, encode_record
+
+
+@pytest.fixture
+def registry():
+    return CollectorRegistry()
+
+
+def make_spool(tmp_path, registry, **options):
+    options.setdefault('segment_bytes', 1024)
+    return SegmentSpool(str(tmp_path / 'spool'), registry=registry, **options)
+
+
+def events(start, count):
+    return [{'business_id': 'spool-business', 'tokens_used': i} for i in range(start, start + count)]
+
+
+def segment_files(spool):
+    return sorted(name for name in os.listdir(spool.directory) if name.endswith(SEGMENT_SUFFIX))
+
+
+class TestSegmentSpool:
+    """Test cases for appending, rotating and replaying"""
+
+    def test_replays_in_order_across_segments(self, tmp_path, registry):
+        """Events come back in append order, and replayed segments are deleted"""
+        spool = make_spool(tmp_path, registry)
+        for start in range(0, 100, 10):
+            assert spool.append(events(start, 10))
+        assert len(segment_files(spool)) > 1
+
+        batches = []
+        assert spool.replay(batches.append, batch_size=25) == 100
+
+        assert [e['tokens_used'] for batch in batches for e in batch] == list(range(100))
+        assert max(len(batch) for batch in batches) <= 25
+        assert not spool.pending()
+        assert segment_files(spool) == []
+        assert registry.get_sample_value('metrics_spool_bytes') == 0
+
+    def test_failed_sink_keeps_batch(self, tmp_path, registry):
+        """The cursor only moves once the sink accepts a batch"""
+        spool = make_spool(tmp_path, registry)
+        spool.append(events(0, 10))
+        written = []
+
+        def flaky_sink(batch):
+            if not written:
+                written.append(None)
+                raise ConnectionError('database down')
+            written.extend(batch)
+
+        with pytest.raises(ConnectionError):
+            spool.replay(flaky_sink, batch_size=5)
+        assert spool.replay(flaky_sink, batch_size=5) == 10
+        assert [e['tokens_used'] for e in written[1:]] == list(range(10))
+
+    def test_data_error_quarantines_only_the_bad_event(self, tmp_path, registry):
+        """A batch rejected for its data is split until the bad event is isolated"""
+        spool = make_spool(tmp_path, registry)
+        spool.append(events(0, 8))
+        written = []
+
+        def sink(batch):
+            if any(e['tokens_used'] == 5 for e in batch):
+                raise ValueError('value too long for type character varying(50)')
+            written.extend(batch)
+
+        assert spool.replay(sink, batch_size=8, is_data_error=lambda e: isinstance(e, ValueError)) == 7
+
+        assert [e['tokens_used'] for e in written] == [0, 1, 2, 3, 4, 6, 7]
+        assert not spool.pending()
+        assert registry.get_sample_value('metrics_spool_quarantined_total') == 1
+        with open(os.path.join(spool.directory, QUARANTINE_FILE)) as f:
+            [line] = f.read().splitlines()
+        assert json.loads(line)['event']['tokens_used'] == 5
+
+    def test_transient_error_is_not_split(self, tmp_path, registry):
+        """Failures that aren't data errors keep the whole batch for the next attempt"""
+        spool = make_spool(tmp_path, registry)
+        spool.append(events(0, 8))
+        calls = []
+
+        def sink(batch):
+            calls.append(len(batch))
+            raise ConnectionError('database down')
+
+        with pytest.raises(ConnectionError):
+            spool.replay(sink, batch_size=8, is_data_error=lambda e: isinstance(e, ValueError))
+        assert calls == [8]
+        assert spool.pending()
+        assert registry.get_sample_value('metrics_spool_quarantined_total') == 0
+
+    def test_cursor_survives_restart(self, tmp_path, registry):
+        """A reopened spool resumes after the last replayed batch"""
+        spool = make_spool(tmp_path, registry)
+        spool.append(events(0, 30))
+        spool.replay(lambda batch: None, batch_size=10, max_batches=2)
+        spool.close()
+
+        reopened = make_spool(tmp_path, CollectorRegistry())
+        replayed = []
+        reopened.replay(replayed.extend)
+
+        assert [e['tokens_used'] for e in replayed] == list(range(20, 30))
+
+    def test_torn_tail_is_truncated(self, tmp_path, registry):
+        """A partial record left by a crash is cut off when the spool opens"""
+        spool = make_spool(tmp_path, registry, segment_bytes=10 ** 6)
+        spool.append(events(0, 3))
+        spool.close()
+        path = os.path.join(spool.directory, segment_files(spool)[-1])
+        with open(path, 'ab') as f:
+            f.write(encode_record(b'{"business_id": "torn"}')[:-5])
+
+        reopened = make_spool(tmp_path, CollectorRegistry(), segment_bytes=10 ** 6)
+        reopened.append(events(3, 1))
+        replayed = []
+        reopened.replay(replayed.extend)
+
+        assert [e['tokens_used'] for e in replayed] == [0, 1, 2, 3]
+
+    def test_corrupt_record_is_skipped(self, tmp_path, registry):
+        """A CRC mismatch skips the rest of that segment and is counted"""
+        spool = make_spool(tmp_path, registry, segment_bytes=200)
+        spool.append(events(0, 2))
+        spool.append(events(2, 2))
+        spool.append(events(4, 2))
+        first = os.path.join(spool.directory, segment_files(spool)[0])
+        with open(first, 'r+b') as f:
+            f.seek(12)
+            f.write(b'X')
+
+        replayed = []
+        spool.replay(replayed.extend)
+
+        assert registry.get_sample_value('metrics_spool_corrupt_records_total') == 1
+        assert [e['tokens_used'] for e in replayed][-2:] == [4, 5]
+        assert 0 not in [e['tokens_used'] for e in replayed]
+
+    def test_disk_budget_is_enforced(self, tmp_path, registry):
+        """Appends beyond max_bytes are refused and counted"""
+        spool = make_spool(tmp_path, registry, max_bytes=500)
+        accepted = sum(spool.append(events(i, 1)) for i in range(50))
+
+        assert 0 < accepted < 50
+        assert spool.total_bytes() <= 500
+        assert registry.get_sample_value('metrics_spool_rejected_total') == 50 - accepted
+
+    def test_locked_slot_is_not_shared(self, tmp_path, registry):
+        """A second spool on the same directory claims its own slot"""
+        first = make_spool(tmp_path, registry)
+        second = make_spool(tmp_path, CollectorRegistry())
+        first.open()
+        second.open()
+
+        assert first.directory != second.directory
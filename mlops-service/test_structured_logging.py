@@ -0,0 +1,149 @@
+"""
+Unit tests for the non-blocking logging pipeline
+Lab 3: Testing AI Systems
+"""
+
+import io
+import json
+import logging
+import queue
+import sys
+
+from prometheus_client import CollectorRegistry, Counter
+
+from structured_logging import (
+    JsonFormatter, LoggingPipeline, NonBlockingQueueHandler, RateLimitFilter
+)
+
+
+def make_record(name='app', level=logging.INFO, msg='hello %s', args=('world',), **extra):
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    for key, value in extra.items():
+        setattr(record, key, value)
+    return record
+
+
+class TestJsonFormatter:
+    """Test cases for JSON line output"""
+
+    def test_formats_message_and_extra_fields(self):
+        """Arguments are interpolated and extra fields become keys"""
+        line = JsonFormatter().format(make_record(business_id='biz-1'))
+        entry = json.loads(line)
+
+        assert entry['message'] == 'hello world'
+        assert entry['level'] == 'INFO'
+        assert entry['logger'] == 'app'
+        assert entry['business_id'] == 'biz-1'
+        assert 'args' not in entry
+
+    def test_includes_exception(self):
+        """Tracebacks are rendered into the exception field"""
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = logging.LogRecord('app', logging.ERROR, __file__, 1, 'failed', (), sys.exc_info())
+
+        entry = json.loads(JsonFormatter().format(record))
+
+        assert 'ValueError: boom' in entry['exception']
+
+
+class TestRateLimitFilter:
+    """Test cases for per-logger rate limiting"""
+
+    def test_limits_only_configured_loggers(self):
+        """Records beyond the burst are dropped for limited loggers only"""
+        limiter = RateLimitFilter({'app.events': 2})
+
+        passed = [limiter.filter(make_record(name='app.events')) for _ in range(5)]
+
+        assert passed == [True, True, False, False, False]
+        assert all(limiter.filter(make_record(name='app')) for _ in range(5))
+
+    def test_warnings_always_pass(self):
+        """Rate limits never hide warnings or errors"""
+        limiter = RateLimitFilter({'app.events': 1})
+        limiter.filter(make_record(name='app.events'))
+
+        assert limiter.filter(make_record(name='app.events', level=logging.ERROR))
+
+    def test_reports_suppressed_count(self):
+        """The next record let through carries the number suppressed"""
+        limiter = RateLimitFilter({'app.events': 1})
+        limiter.filter(make_record(name='app.events'))
+        limiter.filter(make_record(name='app.events'))
+        limiter.filter(make_record(name='app.events'))
+
+        # Refill the bucket instead of sleeping
+        limiter._buckets['app.events'][0] = 1
+        record = make_record(name='app.events')
+
+        assert limiter.filter(record)
+        assert record.suppressed == 2
+
+
+class TestNonBlockingQueueHandler:
+    """Test cases for the queueing handler"""
+
+    def test_does_not_format_in_caller(self):
+        """Message arguments are only rendered by the listener"""
+        rendered = []
+
+        class Lazy:
+            def __str__(self):
+                rendered.append(True)
+                return 'lazy'
+
+        handler = NonBlockingQueueHandler(queue.Queue())
+        handler.handle(make_record(msg='value %s', args=(Lazy(),)))
+
+        assert rendered == []
+        assert handler.queue.get_nowait().getMessage() == 'value lazy'
+
+    def test_drops_when_queue_full(self):
+        """A full queue drops records instead of blocking or raising"""
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+        handler.handle(make_record())
+        handler.handle(make_record())
+
+        assert handler.dropped == 1
+
+
+class TestLoggingPipeline:
+    """Test cases for the handler/listener pair"""
+
+    def test_listener_writes_json_lines(self):
+        """Records logged through the handler reach the output after stop()"""
+        stream = io.StringIO()
+        output = logging.StreamHandler(stream)
+        output.setFormatter(JsonFormatter())
+        pipeline = LoggingPipeline(output, rate_limits={'app.events': 1})
+        pipeline.start()
+
+        logger = logging.getLogger('app.events')
+        logger.propagate = False
+        logger.addHandler(pipeline.handler)
+        try:
+            logger.warning('tracked %s', 'biz-1')
+            logger.warning('tracked %s', 'biz-2')
+        finally:
+            logger.removeHandler(pipeline.handler)
+            logger.propagate = True
+            pipeline.stop()
+
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert [line['message'] for line in lines] == ['tracked biz-1', 'tracked biz-2']
+
+    def test_dropped_records_are_counted(self):
+        """Drops before and after count_drops() show up on the Prometheus counter"""
+        registry = CollectorRegistry()
+        pipeline = LoggingPipeline(logging.NullHandler(), max_queue_size=1)
+        pipeline.handler.handle(make_record())
+        pipeline.handler.handle(make_record())
+
+        pipeline.count_drops(Counter('test_log_records_dropped', 'Dropped', registry=registry))
+        pipeline.handler.handle(make_record())
+
+        assert pipeline.handler.dropped == 2
+        assert registry.get_sample_value('test_log_records_dropped_total') == 2